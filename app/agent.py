@@ -1,19 +1,46 @@
+import hashlib
+import logging
 import os
 import re
 import time
-from typing import List, Optional, Tuple
+from contextlib import AsyncExitStack
+from types import MappingProxyType
+from typing import AsyncContextManager, Awaitable, Callable, List, Mapping, Optional, Tuple
+
+from app.coach_summary import get_summary, shared_part
+from app.context_packer import QA_INPUT_BUDGET, QA_RECENT_TURNS, estimate_tokens, messages_tokens, pack_history
+from app.lift_log import LIFT_LOGS
+from app.llm import get_llm_client, record_usage
+from app.metrics import METRICS
+from app.program_json import (
+    JSON_FORMAT_PROMPT,
+    PROGRAM_JSON_MODE,
+    RESPONSE_FORMAT,
+    JsonProgramStream,
+    ProgramJsonError,
+    parse_program_json,
+    render as render_program_json,
+)
+from app.program_model import parse as parse_program
+from app.resilience import LLM_STREAM_DEADLINE, call_with_retries, is_retryable
+from app.response_cache import PROGRAM_CACHE, PROGRAM_CACHE_BUCKETED, bucket_profile, make_key
+from app.storage import PROGRAM_REQUEST_MARK, load_user_data, save_user_data_async
+from app.textproc import clean_answer, clean_program
+
+logger = logging.getLogger("app.agent")
 
-from openai import OpenAI
-
-from app.storage import load_user_data, save_user_data
-
-DEEPSEEK_API_KEY: str = (os.getenv("DEEPSEEK_API_KEY") or "").strip()
-DEEPSEEK_BASE_URL: str = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").strip()
 DEEPSEEK_MODEL: str = os.getenv("DEEPSEEK_MODEL", "deepseek-chat").strip()
 DEEPSEEK_TEMPERATURE: float = float(os.getenv("DEEPSEEK_TEMPERATURE", "0.35"))
 DEEPSEEK_MAX_TOKENS: int = int(os.getenv("DEEPSEEK_MAX_TOKENS", "8000"))
-DEEPSEEK_TIMEOUT: int = int(os.getenv("DEEPSEEK_TIMEOUT", "90"))
-DEEPSEEK_RETRIES: int = int(os.getenv("DEEPSEEK_RETRIES", "3"))
+# потолок ответа на вопрос: короткий совет, но с запасом на план питания на неделю
+DEEPSEEK_QA_MAX_TOKENS: int = int(os.getenv("DEEPSEEK_QA_MAX_TOKENS", str(min(3000, DEEPSEEK_MAX_TOKENS))))
+# stream=True: текст приходит кусками, бот показывает его по мере генерации (см. on_text)
+DEEPSEEK_STREAM: bool = os.getenv("DEEPSEEK_STREAM", "1").strip().lower() not in ("0", "false", "no", "off")
+
+# колбэк стриминга: получает весь накопленный на данный момент «сырой» текст модели
+TextCallback = Callable[[str], Awaitable[None]]
+# допуск к LLM (слот app.scheduler): берётся только если ответа нет в кэше
+Admission = Callable[[], AsyncContextManager[None]]
 
 
 def _to_float(v: Optional[object]) -> Optional[float]:
@@ -329,82 +356,109 @@ QA_SYSTEM_PROMPT = """
 * Порции: мясо/рыба/творог/крупы/овощи — в граммах; крупы с пометкой «в сухом/готовом виде»; яйца и целые фрукты — в штуках; масла — в ч.л./ст.л.
 """
 
+# версия системного промпта в ключе кэша программ: правка промпта не отдаёт старые ответы
+_SYSTEM_PROMPT_ID = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+
+
+# блок «ГЛАВНЫЙ ПРИОРИТЕТ» для программы с акцентом на группу мышц: примеры упражнений и правила объёма
+_FOCUS_DETAILS = {
+    'грудь': {
+        'examples': 'жим штанги лёжа (классический, узким хватом), жим гантелей лёжа и под углом, отжимания (классические, на брусьях, с возвышения), кроссовер (снизу, сверху, по центру), сведение гантелей лёжа, жим в тренажёре',
+        'types': 'базовые жимы (штанга, гантели, тренажёры) и изолирующие (сведения, кроссовер)',
+        'volume': 'при акценте на грудь: 4-6 упражнений на грудь в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'ноги': {
+        'examples': 'приседания (классические, фронтальные, болгарские, гакк, в Смите), выпады (вперед, назад, в сторону, проходкой), жим ногами под разными углами, разгибания/сгибания ног, зашагивания на платформу, приседания с паузой; икры: подъёмы на носки стоя, сидя, в тренажёре, поочерёдные на одной ноге',
+        'types': 'базовые многосуставные (приседания, выпады, жимы ногами), изолирующие (разгибания, сгибания) и икры в конце дня ног (1-2 упражнения)',
+        'volume': 'при акценте на ноги: 4-6 упражнений на ноги + 1-2 на икры в каждой тренировке ног; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'ягодицы': {
+        'examples': 'ягодичный мостик (классический, на одной ноге, с весом), отведения в тренажёре (стоя, на четвереньках), румынская тяга, выпады назад и в сторону, болгарские сплит-приседы, гиперэкстензии с акцентом на ягодицы, приседания сумо, становая тяга сумо',
+        'types': 'базовые (румынская тяга, приседания сумо) и изолирующие (мостики, отведения)',
+        'volume': 'при акценте на ягодицы: 4-6 упражнений на ягодицы в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'спина': {
+        'examples': 'становая тяга (классическая, румынская, сумо), тяги штанги/гантелей в наклоне разными хватами, подтягивания (широким, средним, узким хватом), тяги верхнего блока (к груди, за голову), тяги горизонтального блока (к поясу, к груди), тяга Т-грифа, шраги (со штангой, гантелями), пуловеры',
+        'types': 'вертикальные тяги (подтягивания, тяги блока) и горизонтальные тяги (тяги в наклоне, блока к поясу)',
+        'volume': 'при акценте на спину: 4-6 упражнений на спину в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'плечи': {
+        'examples': 'жимы штанги/гантелей (стоя, сидя), махи гантелей в стороны, махи в наклоне, подъёмы перед собой, разведения в тренажёре, жим Арнольда',
+        'types': 'базовые жимы и изолирующие движения для переднего, среднего и заднего пучков',
+        'volume': 'при акценте на плечи: 3-5 упражнений на плечи в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'руки': {
+        'examples': 'БИЦЕПС: подъёмы штанги/гантелей, молотковые сгибания, скамья Скотта. ТРИЦЕПС: французский жим, разгибания на блоке, отжимания на брусьях, жим узким хватом',
+        'types': 'базовые (брусья, жимы) и изолирующие (сгибания, разгибания)',
+        'volume': 'при акценте на руки: 4-6 упражнений на руки в тренировке (2-3 бицепс, 2-3 трицепс); остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'плечи и руки': {
+        'examples': 'ПЛЕЧИ: жимы штанги/гантелей (стоя, сидя), махи гантелей (в стороны, вперёд, в наклоне), тяги к подбородку, жим Арнольда. БИЦЕПС: подъёмы штанги/гантелей, молотковые, сгибания на скамье Скотта. ТРИЦЕПС: французский жим, отжимания на брусьях, разгибания на блоке',
+        'types': 'базовые (жимы плеч, брусья) и изолирующие (махи, сгибания, разгибания)',
+        'volume': 'при акценте на плечи и руки: 3-5 на плечи + 2-3 бицепс + 2-3 трицепс в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
+    },
+    'кор и пресс': {
+        'examples': 'планки (классические, боковые), подъёмы ног в висе/лёжа, скручивания, «мёртвый жук», роллауты с колесом, Pallof press, гиперэкстензии',
+        'types': 'статические (планки) и динамические (скручивания, подъёмы ног)',
+        'volume': '2-4 упражнения на кор в каждой тренировке (дополнение к основной программе)'
+    },
+    'функциональные и стабилизирующие': {
+        'examples': 'выпады с поворотом корпуса, приседания на одной ноге, тяги в наклоне одной рукой, упражнения с резинками, баланс на одной ноге',
+        'types': 'односторонние и стабилизационные движения',
+        'volume': '1-3 упражнения как дополнение к основной тренировке'
+    },
+}
+_VOLUME_META = (
+    "ОБЪЁМ ЗА ТРЕНИРОВКУ: при акценте на группу — 4–6 упражнений на неё; "
+    "поддерживающая нагрузка на остальные — 2–3 упражнения; "
+    "общее количество упражнений за одну тренировку: 6–9. "
+    "Включай 2–4 упражнения на кор/пресс в неделю; при дне ног — икры в конце (1–2 упражнения)."
+)
+
+
+def _build_focus_block(group: str) -> str:
+    details = _FOCUS_DETAILS.get(group, {})
+    return (
+        f"🎯 ═══ ГЛАВНЫЙ ПРИОРИТЕТ ПРОГРАММЫ ═══\n"
+        f"Пользователь хочет МАКСИМАЛЬНЫЙ АКЦЕНТ НА {group.upper()}!\n\n"
+        f"📋 ОБЯЗАТЕЛЬНЫЕ ТРЕБОВАНИЯ К ПРОГРАММЕ:\n\n"
+        f"1️⃣ ОБЪЁМ НАГРУЗКИ:\n"
+        f"   • {details.get('volume', f'При акценте: 4–6 упражнений на {group}; остальные группы — 2–3 упражнения')}\n"
+        f"   • {_VOLUME_META} (это ОБЩЕЕ ограничение объёма, не добавляется поверх основного)\n\n"
+        f"2️⃣ СТРУКТУРА ТРЕНИРОВОК:\n"
+        f"   • Основной фокус тренировки — {group}\n"
+        f"   • Приоритет — базовые упражнения на {group}, но допускается предварительная активация или изоляция при необходимости\n"
+        f"   • Обязательно сочетай базовые и изолирующие движения\n"
+        f"   • Используй разные углы, хваты, стойки и варианты выполнения\n\n"
+        f"3️⃣ ПРИМЕРЫ УПРАЖНЕНИЙ (для ориентира, НЕ как фиксированный список):\n"
+        f"   {details.get('examples', f'разнообразные эффективные упражнения на {group}')}\n\n"
+        f"🔄 ВАРИАТИВНОСТЬ:\n"
+        f"   • Не повторяй один и тот же набор упражнений из недели в неделю\n"
+        f"   • Допускается замена упражнений на эквивалентные по биомеханике\n\n"
+        f"⚠️ ВАЖНО:\n"
+        f"   • Примеры упражнений приведены для ориентира\n"
+        f"   • Допускаются ЛЮБЫЕ безопасные и эффективные упражнения на {group}, соответствующие уровню пользователя\n"
+        f"   • Минимум две тренировки в неделю должны иметь явный приоритет на {group}"
+    )
+
+
+# блоки для групп с кнопок собираются один раз при импорте; текст блока одинаков у всех
+# пользователей с той же группой — он идёт отдельным сообщением перед анкетой (см. get_program)
+FOCUS_BLOCKS: Mapping[str, str] = MappingProxyType({group: _build_focus_block(group) for group in _FOCUS_DETAILS})
+_BALANCED = ('сбалансированно', 'все группы мышц сбалансированно')
+
+
+def focus_block(group: Optional[str]) -> Optional[str]:
+    """Блок акцента для группы мышц или None (группа не выбрана / сбалансированно)."""
+    if not group or group in _BALANCED:
+        return None
+    block = FOCUS_BLOCKS.get(group)
+    return block if block is not None else _build_focus_block(group)
 
 
-_RPE_PATTERNS = [
-    r"\(?\s*RPE\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
-    r"\(?\s*RIR\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
-    r"\bдо\s+отказа\b",
-    r"\bпочти\s+до\s+отказа\b",
-]
-
-def _strip_noise(text: str) -> str:
-    """Убираем RPE/RIR/«до отказа», LaTeX ($...$), лишние пробелы и #/## заголовки."""
-    out = text or ""
-    # LaTeX: убрать обёртку $...$, оставить содержимое; заменить \times на ×, \text{ ... } на ..., \% на %
-    out = re.sub(r"\$([^$]*)\$", r"\1", out)
-    out = re.sub(r"\\times", "×", out)
-    out = re.sub(r"\\text\{\s*([^}]*)\s*\}", r"\1", out)
-    out = re.sub(r"\\%", "%", out)
-
-    # RPE/RIR
-    for p in _RPE_PATTERNS:
-        out = re.sub(p, "", out, flags=re.IGNORECASE)
-
-    # заменить маркеры • на дефисы, x/* на ×
-    out = re.sub(r"^\s*•\s+", "- ", out, flags=re.MULTILINE)
-    out = re.sub(r"(\d)\s*[xX\*]\s*(\d)", r"\1×\2", out)
-
-    # убрать HTML теги <br>, <p>
-    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
-    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
-
-    # убрать markdown заголовки # и ##
-    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
-
-    # косметика
-    out = re.sub(r"\(\s*\)", "", out)
-    out = re.sub(r",\s*,", ", ", out)
-    out = re.sub(r"[ \t]{2,}", " ", out)
-    out = re.sub(r"[ \t]+\n", "\n", out)
-    out = re.sub(r"\n[ \t]+", "\n", out)
-    out = re.sub(r"\n{3,}", "\n\n", out)
-
-    return out.strip()
-
-def _bold_day_headers(text: str) -> str:
-    """Оборачивает заголовки «День N» или «День N — …» в * для жирного (Telegram ParseMode.MARKDOWN: жирный = один *)."""
-    lines = text.split("\n")
-    out = []
-    for line in lines:
-        stripped = line.strip()
-        if not re.match(r"День\s+\d+(\s*—\s*.+)?$", stripped):
-            out.append(line)
-            continue
-        # Модель могла вывести **...** — убираем, в Telegram нужен один *
-        if stripped.startswith("**") and stripped.endswith("**"):
-            stripped = stripped[2:-2]
-        elif stripped.startswith("*") and stripped.endswith("*"):
-            out.append(line)
-            continue
-        prefix = line[: len(line) - len(line.lstrip())]
-        out.append(prefix + "*" + stripped + "*")
-    return "\n".join(out)
-
-
-def _telegram_bold_fix(text: str) -> str:
-    """Заменяет **...** на *...* по всему тексту (в Telegram Markdown жирный — один *)."""
-    return re.sub(r"\*\*(.+?)\*\*", r"*\1*", text, flags=re.DOTALL)
-
-
-def _format_qa_answer(text: str) -> str:
-    """Форматирование ответа QA для Telegram: жирные заголовки дней, отступы между блоками."""
-    out = _telegram_bold_fix(text)
-    out = _bold_day_headers(out)
-    # Пустая строка перед каждым «День N» (кроме самого первого в тексте) — визуальное разделение
-    out = re.sub(r"\n(День \d+)", r"\n\n\1", out)
-    out = re.sub(r"\n{3,}", "\n\n", out)  # не больше одной пустой строки подряд
-    return out.strip()
+def _estimate_tokens(messages: List[dict[str, str]], answer: str) -> int:
+    """Оценка, когда API не вернул usage (app.context_packer.estimate_tokens)."""
+    return messages_tokens(messages) + estimate_tokens(answer)
 
 
 def _to_int(s) -> Optional[int]:
@@ -415,121 +469,345 @@ def _to_int(s) -> Optional[int]:
 
 
 class FitnessAgent:
-    def __init__(self, token: str, user_id: str):
+    def __init__(self, token: str, user_id: str, user_data: Optional[dict] = None, lifts: Optional[str] = None):
+        """
+        user_data — документ из app.session.UserSession: агент меняет его в памяти,
+        а запись делает сессия. Без него агент сам читает и сохраняет данные.
+        lifts — сводка дневника подходов (app.lift_log); без неё агент прочитает её сам,
+        в потоке, перед первым запросом к модели.
+        """
         self.token = token
         self.user_id = user_id
-        self.user_data = load_user_data(user_id)
+        self._owns_data = user_data is None
+        self.user_data = load_user_data(user_id) if user_data is None else user_data
+        self._lifts = lifts
 
         phys = self.user_data.get("physical_data") or {}
         self._user_name: Optional[str] = (phys.get("name") or "").strip() or None
 
         self._phys_prompt = self._format_physical_data(phys)
+        # токены последнего запроса: usage из ответа API или оценка по длине текста
+        self.last_tokens = 0
+
+    async def _complete(
+        self, messages: List[dict[str, str]], temperature: float, max_tokens: int = DEEPSEEK_MAX_TOKENS, **request
+    ) -> str:
+        """
+        Обычный запрос (stream=False) через общий клиент app.llm; повторы/дедлайн/breaker — app.resilience.
+        request — доп. параметры API (например, response_format).
+        """
+        client = get_llm_client(self.token)
+
+        async def attempt() -> str:
+            resp = await client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=False,
+                **request,
+            )
+            self.last_tokens = record_usage(getattr(resp, "usage", None)) or _estimate_tokens(messages, "")
+            return (resp.choices[0].message.content or "").strip()
+
+        return await call_with_retries(attempt)
+
+    async def _stream_chat(
+        self,
+        messages: List[dict[str, str]],
+        temperature: float,
+        on_text: TextCallback,
+        max_tokens: int = DEEPSEEK_MAX_TOKENS,
+        **request,
+    ) -> str:
+        """
+        Запрос со stream=True: on_text вызывается с накопленным текстом на каждом куске.
+        Повтор — только если модель ещё ничего не прислала (иначе пользователь уже видит начало ответа).
+        """
+        client = get_llm_client(self.token)
+        parts: List[str] = []
 
+        async def attempt() -> str:
+            parts.clear()
+            stream = await client.chat.completions.create(
+                model=DEEPSEEK_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **request,
+            )
+            usage = None
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await on_text("".join(parts))
+            text = "".join(parts).strip()
+            self.last_tokens = record_usage(usage) or _estimate_tokens(messages, text)
+            return text
+
+        return await call_with_retries(
+            attempt,
+            deadline=LLM_STREAM_DEADLINE,
+            retry_if=lambda exc: not parts and is_retryable(exc),
+        )
 
-    async def get_program(self, user_instruction: str = "", focus_group_override: Optional[str] = None) -> str:
+    async def get_program(
+        self,
+        user_instruction: str = "",
+        focus_group_override: Optional[str] = None,
+        on_text: Optional[TextCallback] = None,
+        use_cache: bool = True,
+        admit: Optional[Admission] = None,
+        json_mode: Optional[bool] = None,
+    ) -> str:
         """
         Вернёт сгенерированную программу (Markdown), с учётом анкеты.
         user_instruction — пожелания (стиль, объём и т.д.).
         focus_group_override — при «Другая программа»: группа, выбранная в этом запросе (для блока с примерами и объёмом).
+        on_text — при DEEPSEEK_STREAM получает сырой текст по мере генерации; чистка/форматирование
+        делаются один раз, над готовым текстом.
+        use_cache — искать готовый ответ в app.response_cache (False — «Случайная вариация»).
+        admit — слот планировщика вокруг вызова LLM; при попадании в кэш не нужен.
+        json_mode — ответ JSON-объектом (app.program_json; по умолчанию PROGRAM_JSON_MODE);
+        если он не прошёл проверку, запрос повторяется обычным текстом.
         """
-        from asyncio import to_thread
+        started = time.perf_counter()
         phys = self.user_data.get("physical_data") or {}
-        phys_prompt = self._format_physical_data(phys, focus_group_override=focus_group_override)
-        messages: List[dict[str, str]] = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": phys_prompt + (f"\n\nПожелания: {user_instruction}" if user_instruction else "")},
-        ]
-
-        def _chat_sync():
-            last_err = None
-            client = OpenAI(api_key=self.token, base_url=DEEPSEEK_BASE_URL, timeout=DEEPSEEK_TIMEOUT)
-            for attempt in range(1, DEEPSEEK_RETRIES + 1):
-                try:
-                    resp = client.chat.completions.create(
-                        model=DEEPSEEK_MODEL,
-                        messages=messages,
-                        temperature=DEEPSEEK_TEMPERATURE,
-                        max_tokens=DEEPSEEK_MAX_TOKENS,
-                        stream=False,
-                    )
-                    return (resp.choices[0].message.content or "").strip()
-                except Exception as e:
-                    last_err = e
-                    if attempt == DEEPSEEK_RETRIES:
-                        raise
-                    time.sleep(1.5 * attempt)
-            raise last_err or RuntimeError("DeepSeek call failed")
-
-        txt = await to_thread(_chat_sync)
-        cleaned = _strip_noise(txt)
-        cleaned = _telegram_bold_fix(cleaned)  # **...** → *...* для Telegram
-        cleaned = _bold_day_headers(cleaned)
-        final = self._with_name_prefix(cleaned)
+        summary = get_summary(self.user_data)
+        history_note = summary["text"] if summary else ""
+        shared = use_cache and PROGRAM_CACHE.enabled
+        if shared:
+            # программа из общего кэша: анкета и травмы/ограничения из карточки, без рабочих весов
+            # и личной части сводки — с ними ключ свой у каждого, кто хоть раз писал боту или
+            # записал подход, и вариации у разных пользователей не попадают в кэш
+            profile = self._format_profile(phys)
+            history_note = shared_part(history_note)
+        else:
+            await self._load_lifts()
+            profile = self._profile_with_lifts(phys)
+        block = self._focus_for(phys, focus_group_override)
+        phys_prompt = f"{profile}\n\n{block}" if block else profile
+        # сначала то, что одинаково у многих пользователей (системный промпт, затем блок акцента
+        # на группу), и только потом анкета: общий префикс попадает в контекстный кэш DeepSeek
+        messages: List[dict[str, str]] = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if block:
+            messages.append({"role": "system", "content": block})
+        messages.append({
+            "role": "user",
+            "content": profile
+            + (f"\n\nИз прошлых разговоров:\n{history_note}" if history_note else "")
+            + (f"\n\nПожелания: {user_instruction}" if user_instruction else ""),
+        })
+
+        cache_key = None
+        if not use_cache:
+            PROGRAM_CACHE.bypass()
+        elif shared:
+            cache_key = self._program_cache_key(phys, phys_prompt, focus_group_override, user_instruction, history_note)
+
+        final: Optional[str] = None
+        hit = False
+        if PROGRAM_JSON_MODE if json_mode is None else json_mode:
+            json_key = None
+            if cache_key is not None:
+                json_key = self._program_cache_key(
+                    phys, phys_prompt, focus_group_override, user_instruction, history_note, fmt="json"
+                )
+            final, hit = await self._program_json(messages, json_key, on_text, admit)
+        if final is None:
+            txt, hit = await self._generate(messages, cache_key, on_text, admit)
+            if cache_key is not None and not hit:
+                PROGRAM_CACHE.put(cache_key, txt, self.last_tokens)
+            final = clean_program(txt)
+        if cache_key is not None:
+            PROGRAM_CACHE.observe(hit, time.perf_counter() - started)
+        final = self._with_name_prefix(final)
+        # разбор один раз: разбивка на сообщения и экспорт берут модель из кэша parse();
+        # доля «сырых» — сигнал, что модель поменяла формат дней/упражнений
+        METRICS.inc("program_model.structured" if parse_program(final).structured else "program_model.raw")
 
         # сохраняем в историю и как последнюю программу
         hist = self.user_data.get("history", [])
-        hist.append(("🧍 Запрос программы", "🤖 " + final))
+        hist.append((PROGRAM_REQUEST_MARK, "🤖 " + final))
         self.user_data["history"] = hist
         self.user_data["last_program"] = final
         self.user_data["last_reply"] = final
-        save_user_data(self.user_id, self.user_data)
+        if self._owns_data:
+            await save_user_data_async(self.user_id, self.user_data)
         return final
 
-    def _qa_history_messages(self, current_question: str, max_turns: int = 10) -> List[dict[str, str]]:
-        """Последние пары вопрос–ответ из истории (только QA, без «Запрос программы») для контекста диалога."""
+    async def _generate(
+        self, messages: List[dict[str, str]], cache_key: Optional[str], on_text: Optional[TextCallback],
+        admit: Optional[Admission], **request,
+    ) -> Tuple[str, bool]:
+        """Сырой ответ модели из кэша программ или из LLM (под слотом admit); (текст, из кэша ли). В кэш не пишет."""
+        cached = PROGRAM_CACHE.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            self.last_tokens = 0
+            if on_text is not None:
+                await on_text(cached.text)
+            return cached.text, True
+        async with AsyncExitStack() as stack:
+            if admit is not None:
+                await stack.enter_async_context(admit())
+            if on_text is not None and DEEPSEEK_STREAM:
+                txt = await self._stream_chat(messages, DEEPSEEK_TEMPERATURE, on_text, **request)
+            else:
+                txt = await self._complete(messages, DEEPSEEK_TEMPERATURE, **request)
+        return txt, False
+
+    async def _program_json(
+        self, messages: List[dict[str, str]], cache_key: Optional[str], on_text: Optional[TextCallback],
+        admit: Optional[Admission],
+    ) -> Tuple[Optional[str], bool]:
+        """
+        Программа в JSON-режиме: схема отдельным системным сообщением после SYSTEM_PROMPT
+        (общий префикс для контекстного кэша DeepSeek не меняется), превью — готовыми днями.
+        (Markdown, из кэша ли) или (None, False) — ответ не прошёл проверку, нужен текстовый путь.
+        В кэш программ попадает только проверенный JSON.
+        """
+        messages = messages[:1] + [{"role": "system", "content": JSON_FORMAT_PROMPT}] + messages[1:]
+        stream_on_text: Optional[TextCallback] = None
+        if on_text is not None:
+            preview = JsonProgramStream()
+            shown = ""
+
+            async def stream_on_text(raw: str) -> None:
+                nonlocal shown
+                text = preview.feed(raw)  # неверный день — ProgramJsonError, поток обрывается
+                if text and text != shown:
+                    shown = text
+                    await on_text(text)
+
+        try:
+            txt, hit = await self._generate(messages, cache_key, stream_on_text, admit, response_format=RESPONSE_FORMAT)
+            program = parse_program_json(txt)
+        except ProgramJsonError as e:
+            METRICS.inc("program_json.fallback")
+            logger.warning("program JSON rejected for %s, falling back to text: %s", self.user_id, e)
+            return None, False
+        if cache_key is not None and not hit:
+            PROGRAM_CACHE.put(cache_key, txt, self.last_tokens)
+        METRICS.inc("program_json.ok")
+        return render_program_json(program), hit
+
+    def _program_cache_key(
+        self,
+        phys: dict,
+        phys_prompt: str,
+        focus_group_override: Optional[str],
+        user_instruction: str,
+        history_note: str = "",
+        **params,
+    ) -> str:
+        """
+        Ключ кэша: анкета (при PROGRAM_CACHE_BUCKETED — с округлёнными числами), пожелания,
+        общая часть сводки (shared_part: травмы и ограничения) и параметры модели.
+        params — прочие параметры ответа (fmt="json" у JSON-режима: в кэше лежит сырой ответ).
+        """
+        if PROGRAM_CACHE_BUCKETED:
+            phys_prompt = self._format_physical_data(bucket_profile(phys), focus_group_override=focus_group_override, lifts=False)
+        return make_key(
+            phys_prompt,
+            user_instruction,
+            model=DEEPSEEK_MODEL,
+            temperature=DEEPSEEK_TEMPERATURE,
+            max_tokens=DEEPSEEK_MAX_TOKENS,
+            system=_SYSTEM_PROMPT_ID,
+            history=history_note,
+            **params,
+        )
+
+    def _qa_history_messages(self, current_question: str, budget: int = QA_INPUT_BUDGET) -> List[dict[str, str]]:
+        """
+        Контекст диалога: пары вопрос–ответ из истории (только QA, без «Запрос программы»),
+        упакованные app.context_packer в budget токенов вместе с промптом, анкетой и вопросом:
+        свежие реплики дословно, старые — выжимкой (app.context_packer.summarize_turn).
+        Реплики, уже учтённые сводкой app.coach_summary, заменяет сама сводка (кроме последних QA_RECENT_TURNS).
+        """
         hist = self.user_data.get("history", [])
-        turns = []
-        for user_msg, bot_msg in hist:
-            if user_msg == "🧍 Запрос программы":
+        summary = get_summary(self.user_data)
+        covered = summary["seq"] - (self.user_data.get("history_archived") or 0) if summary else 0
+        indexed = []
+        for i, (user_msg, bot_msg) in enumerate(hist):
+            if user_msg == PROGRAM_REQUEST_MARK:
                 continue
             u = user_msg[2:] if user_msg.startswith("🧍 ") else user_msg
             b = bot_msg[2:] if bot_msg.startswith("🤖 ") else bot_msg
-            turns.append((u, b))
-        recent = turns[-max_turns:] if len(turns) > max_turns else turns
-        messages: List[dict[str, str]] = [
+            indexed.append((i, (u, b)))
+        recent_from = len(indexed) - QA_RECENT_TURNS
+        turns = [turn for n, (i, turn) in enumerate(indexed) if i >= covered or n >= recent_from]
+        profile = f"Анкета:\n{self._phys_prompt}"
+        if summary:
+            profile += f"\n\nИз прошлых разговоров:\n{summary['text']}"
+        head: List[dict[str, str]] = [
             {"role": "system", "content": QA_SYSTEM_PROMPT},
-            {"role": "user", "content": f"Анкета:\n{self._phys_prompt}"},
+            {"role": "user", "content": profile},
         ]
-        for u, b in recent:
-            messages.append({"role": "user", "content": u})
-            messages.append({"role": "assistant", "content": b})
-        messages.append({"role": "user", "content": f"Вопрос (текущий):\n{current_question}"})
+        question = {"role": "user", "content": f"Вопрос (текущий):\n{current_question}"}
+        history = pack_history(turns, budget - messages_tokens(head + [question]))
+        messages = head + history + [question]
+        METRICS.inc("qa_context.requests")
+        METRICS.inc("qa_context.input_tokens", messages_tokens(messages))
         return messages
 
-    async def get_answer(self, question: str) -> str:
+    async def get_answer(self, question: str, on_text: Optional[TextCallback] = None) -> str:
         """
         Краткий структурированный ответ/совет. Если явно просят план — можно выдать план (учитывая анкету).
         Учитывает последние реплики диалога (история QA), чтобы не терять контекст (например, запрос меню на 7 дней).
+        on_text — как в get_program.
         """
-        from asyncio import to_thread
+        await self._load_lifts()
         messages = self._qa_history_messages(question)
         temperature_qa = min(0.55, max(0.45, DEEPSEEK_TEMPERATURE))
 
-        def _chat_sync():
-            client = OpenAI(api_key=self.token, base_url=DEEPSEEK_BASE_URL, timeout=DEEPSEEK_TIMEOUT)
-            resp = client.chat.completions.create(
-                model=DEEPSEEK_MODEL,
-                messages=messages,
-                temperature=temperature_qa,
-                max_tokens=DEEPSEEK_MAX_TOKENS,
-                stream=False,
-            )
-            return (resp.choices[0].message.content or "").strip()
-
-        txt = await to_thread(_chat_sync)
-        cleaned = _strip_noise(txt).strip()
-        cleaned = _format_qa_answer(cleaned)
+        if on_text is not None and DEEPSEEK_STREAM:
+            txt = await self._stream_chat(messages, temperature_qa, on_text, max_tokens=DEEPSEEK_QA_MAX_TOKENS)
+        else:
+            txt = await self._complete(messages, temperature_qa, max_tokens=DEEPSEEK_QA_MAX_TOKENS)
+        cleaned = clean_answer(txt)
 
         # история
         hist = self.user_data.get("history", [])
         hist.append(("🧍 " + question, "🤖 " + cleaned))
         self.user_data["history"] = hist
         self.user_data["last_reply"] = cleaned
-        save_user_data(self.user_id, self.user_data)
+        if self._owns_data:
+            await save_user_data_async(self.user_id, self.user_data)
         return cleaned
 
 
-    def _format_physical_data(self, d: dict, focus_group_override: Optional[str] = None) -> str:
+    def _format_physical_data(self, d: dict, focus_group_override: Optional[str] = None, lifts: bool = True) -> str:
+        """Анкета, рабочие веса из дневника подходов и блок акцента одним текстом (контекст QA, ключ кэша программ)."""
+        profile = self._profile_with_lifts(d) if lifts else self._format_profile(d)
+        block = self._focus_for(d, focus_group_override)
+        return f"{profile}\n\n{block}" if block else profile
+
+    async def _load_lifts(self) -> None:
+        """Сводка дневника подходов: чтение файла журнала — в потоке, не в цикле событий."""
+        if self._lifts is not None:
+            return
+        self._lifts = await LIFT_LOGS.summary_async(self.user_id)
+        if self._lifts:
+            self._phys_prompt = self._format_physical_data(self.user_data.get("physical_data") or {})
+
+    def _profile_with_lifts(self, d: dict) -> str:
+        # агрегаты app.lift_log считаются при записи подхода, сводка уже прочитана (_load_lifts)
+        profile = self._format_profile(d)
+        return f"{profile}\n\n{self._lifts}" if self._lifts else profile
+
+    @staticmethod
+    def _focus_for(d: dict, focus_group_override: Optional[str]) -> Optional[str]:
+        # группа мышц: из override («Другая программа») или из профиля
+        return focus_block(focus_group_override if focus_group_override is not None else d.get('preferred_muscle_group'))
+
+    def _format_profile(self, d: dict) -> str:
         # базовая информация
         result = (
             f"Цель: {d.get('target') or 'не указана'}\n"
@@ -551,88 +829,6 @@ class FitnessAgent:
         if kbju:
             kcal, p, f, c = kbju
             result += f"\nРекомендуемое КБЖУ (Миффлин-Сан Жеора): {kcal}/{p}/{f}/{c}"
-        
-        # группа мышц: из override («Другая программа») или из профиля
-        preferred_group = focus_group_override if focus_group_override is not None else d.get('preferred_muscle_group')
-        if preferred_group and preferred_group not in ('сбалансированно', 'все группы мышц сбалансированно'):
-            # расширенные рекомендации с конкретными примерами и правилами объёма
-            exercises_details = {
-                'грудь': {
-                    'examples': 'жим штанги лёжа (классический, узким хватом), жим гантелей лёжа и под углом, отжимания (классические, на брусьях, с возвышения), кроссовер (снизу, сверху, по центру), сведение гантелей лёжа, жим в тренажёре',
-                    'types': 'базовые жимы (штанга, гантели, тренажёры) и изолирующие (сведения, кроссовер)',
-                    'volume': 'при акценте на грудь: 4-6 упражнений на грудь в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'ноги': {
-                    'examples': 'приседания (классические, фронтальные, болгарские, гакк, в Смите), выпады (вперед, назад, в сторону, проходкой), жим ногами под разными углами, разгибания/сгибания ног, зашагивания на платформу, приседания с паузой; икры: подъёмы на носки стоя, сидя, в тренажёре, поочерёдные на одной ноге',
-                    'types': 'базовые многосуставные (приседания, выпады, жимы ногами), изолирующие (разгибания, сгибания) и икры в конце дня ног (1-2 упражнения)',
-                    'volume': 'при акценте на ноги: 4-6 упражнений на ноги + 1-2 на икры в каждой тренировке ног; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'ягодицы': {
-                    'examples': 'ягодичный мостик (классический, на одной ноге, с весом), отведения в тренажёре (стоя, на четвереньках), румынская тяга, выпады назад и в сторону, болгарские сплит-приседы, гиперэкстензии с акцентом на ягодицы, приседания сумо, становая тяга сумо',
-                    'types': 'базовые (румынская тяга, приседания сумо) и изолирующие (мостики, отведения)',
-                    'volume': 'при акценте на ягодицы: 4-6 упражнений на ягодицы в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'спина': {
-                    'examples': 'становая тяга (классическая, румынская, сумо), тяги штанги/гантелей в наклоне разными хватами, подтягивания (широким, средним, узким хватом), тяги верхнего блока (к груди, за голову), тяги горизонтального блока (к поясу, к груди), тяга Т-грифа, шраги (со штангой, гантелями), пуловеры',
-                    'types': 'вертикальные тяги (подтягивания, тяги блока) и горизонтальные тяги (тяги в наклоне, блока к поясу)',
-                    'volume': 'при акценте на спину: 4-6 упражнений на спину в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'плечи': {
-                    'examples': 'жимы штанги/гантелей (стоя, сидя), махи гантелей в стороны, махи в наклоне, подъёмы перед собой, разведения в тренажёре, жим Арнольда',
-                    'types': 'базовые жимы и изолирующие движения для переднего, среднего и заднего пучков',
-                    'volume': 'при акценте на плечи: 3-5 упражнений на плечи в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'руки': {
-                    'examples': 'БИЦЕПС: подъёмы штанги/гантелей, молотковые сгибания, скамья Скотта. ТРИЦЕПС: французский жим, разгибания на блоке, отжимания на брусьях, жим узким хватом',
-                    'types': 'базовые (брусья, жимы) и изолирующие (сгибания, разгибания)',
-                    'volume': 'при акценте на руки: 4-6 упражнений на руки в тренировке (2-3 бицепс, 2-3 трицепс); остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'плечи и руки': {
-                    'examples': 'ПЛЕЧИ: жимы штанги/гантелей (стоя, сидя), махи гантелей (в стороны, вперёд, в наклоне), тяги к подбородку, жим Арнольда. БИЦЕПС: подъёмы штанги/гантелей, молотковые, сгибания на скамье Скотта. ТРИЦЕПС: французский жим, отжимания на брусьях, разгибания на блоке',
-                    'types': 'базовые (жимы плеч, брусья) и изолирующие (махи, сгибания, разгибания)',
-                    'volume': 'при акценте на плечи и руки: 3-5 на плечи + 2-3 бицепс + 2-3 трицепс в тренировке; остальные группы — поддерживающий объём 2-3 упражнения'
-                },
-                'кор и пресс': {
-                    'examples': 'планки (классические, боковые), подъёмы ног в висе/лёжа, скручивания, «мёртвый жук», роллауты с колесом, Pallof press, гиперэкстензии',
-                    'types': 'статические (планки) и динамические (скручивания, подъёмы ног)',
-                    'volume': '2-4 упражнения на кор в каждой тренировке (дополнение к основной программе)'
-                },
-                'функциональные и стабилизирующие': {
-                    'examples': 'выпады с поворотом корпуса, приседания на одной ноге, тяги в наклоне одной рукой, упражнения с резинками, баланс на одной ноге',
-                    'types': 'односторонние и стабилизационные движения',
-                    'volume': '1-3 упражнения как дополнение к основной тренировке'
-                },
-            }
-            volume_meta = (
-                "ОБЪЁМ ЗА ТРЕНИРОВКУ: при акценте на группу — 4–6 упражнений на неё; "
-                "поддерживающая нагрузка на остальные — 2–3 упражнения; "
-                "общее количество упражнений за одну тренировку: 6–9. "
-                "Включай 2–4 упражнения на кор/пресс в неделю; при дне ног — икры в конце (1–2 упражнения)."
-            )
-            details = exercises_details.get(preferred_group, {})
-            result += (
-                f"\n\n🎯 ═══ ГЛАВНЫЙ ПРИОРИТЕТ ПРОГРАММЫ ═══\n"
-                f"Пользователь хочет МАКСИМАЛЬНЫЙ АКЦЕНТ НА {preferred_group.upper()}!\n\n"
-                f"📋 ОБЯЗАТЕЛЬНЫЕ ТРЕБОВАНИЯ К ПРОГРАММЕ:\n\n"
-                f"1️⃣ ОБЪЁМ НАГРУЗКИ:\n"
-                f"   • {details.get('volume', f'При акценте: 4–6 упражнений на {preferred_group}; остальные группы — 2–3 упражнения')}\n"
-                f"   • {volume_meta} (это ОБЩЕЕ ограничение объёма, не добавляется поверх основного)\n\n"
-                f"2️⃣ СТРУКТУРА ТРЕНИРОВОК:\n"
-                f"   • Основной фокус тренировки — {preferred_group}\n"
-                f"   • Приоритет — базовые упражнения на {preferred_group}, но допускается предварительная активация или изоляция при необходимости\n"
-                f"   • Обязательно сочетай базовые и изолирующие движения\n"
-                f"   • Используй разные углы, хваты, стойки и варианты выполнения\n\n"
-                f"3️⃣ ПРИМЕРЫ УПРАЖНЕНИЙ (для ориентира, НЕ как фиксированный список):\n"
-                f"   {details.get('examples', f'разнообразные эффективные упражнения на {preferred_group}')}\n\n"
-                f"🔄 ВАРИАТИВНОСТЬ:\n"
-                f"   • Не повторяй один и тот же набор упражнений из недели в неделю\n"
-                f"   • Допускается замена упражнений на эквивалентные по биомеханике\n\n"
-                f"⚠️ ВАЖНО:\n"
-                f"   • Примеры упражнений приведены для ориентира\n"
-                f"   • Допускаются ЛЮБЫЕ безопасные и эффективные упражнения на {preferred_group}, соответствующие уровню пользователя\n"
-                f"   • Минимум две тренировки в неделю должны иметь явный приоритет на {preferred_group}"
-            )
-        
         return result
 
     def _with_name_prefix(self, text: str) -> str:
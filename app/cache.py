@@ -0,0 +1,219 @@
+import asyncio
+import copy
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.cache")
+
+CacheKey = Tuple[str, str]  # (user_id, folder)
+# writer(user_id, folder, data, base): base — последняя записанная версия (для частичной записи)
+Writer = Callable[[str, str, Dict[str, Any], Optional[Dict[str, Any]]], Awaitable[None]]
+
+# режимы надёжности
+MODE_OFF = "off"                    # кэш выключен
+MODE_WRITE_THROUGH = "write-through"  # кэш только для чтения, запись сразу в хранилище
+MODE_WRITE_BEHIND = "write-behind"    # запись копится и уходит раз в flush_interval
+
+
+class _Entry:
+    __slots__ = ("data", "base", "size", "dirty", "version")
+
+    def __init__(self, data: Dict[str, Any], size: int, dirty: bool):
+        self.data = data
+        # версия, которая лежит в хранилище: для чистой записи это сами данные
+        self.base: Optional[Dict[str, Any]] = None if dirty else data
+        self.size = size
+        self.dirty = dirty
+        self.version = 0
+
+
+class UserStateCache:
+    """
+    LRU-кэш документов пользователей перед app.storage с отложенной записью.
+
+    Ограничен числом записей и суммарным размером (байты JSON). Изменённые записи
+    помечаются dirty и пишутся пачкой раз в flush_interval (одна запись на пользователя
+    за интервал). Вытесняемые dirty-записи и всё содержимое при остановке сбрасываются
+    принудительно.
+    """
+
+    def __init__(
+        self,
+        writer: Writer,
+        max_entries: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        flush_interval: float = 2.0,
+        mode: str = MODE_WRITE_BEHIND,
+    ):
+        self._writer = writer
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.mode = mode
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._evicted: Dict[CacheKey, _Entry] = {}
+        self._bytes = 0
+        self._seq = 0  # сквозной номер версии записи
+        self._lock = threading.Lock()
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # --- чтение/запись ---
+
+    def get(self, user_id: str, folder: str) -> Optional[Dict[str, Any]]:
+        key = (user_id, folder)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # вытеснена, но ещё не записана — отдаём её, а не устаревшую версию из хранилища
+                entry = self._evicted.get(key)
+            else:
+                self._entries.move_to_end(key)
+            if entry is None:
+                METRICS.inc("user_cache.misses")
+                return None
+            METRICS.inc("user_cache.hits")
+            return copy.deepcopy(entry.data)
+
+    def put(self, user_id: str, folder: str, data: Dict[str, Any], dirty: bool = True) -> None:
+        """Кладёт копию документа; dirty=True — документ изменён и ждёт записи."""
+        key = (user_id, folder)
+        size = len(json.dumps(data, ensure_ascii=False, default=str).encode("utf-8"))
+        evicted_dirty = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self._evicted.pop(key, None)
+            entry = _Entry(copy.deepcopy(data), size, dirty)
+            self._seq += 1
+            entry.version = self._seq
+            if old is not None:
+                self._bytes -= old.size
+                if dirty:
+                    entry.base = old.base
+                if old.dirty:
+                    if dirty:
+                        METRICS.inc("user_cache.coalesced")
+                    entry.dirty = True
+            self._entries[key] = entry
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._bytes -= old_entry.size
+                METRICS.inc("user_cache.evictions")
+                if old_entry.dirty:
+                    # вытесненная dirty-запись (или документ больше лимита целиком) — не теряем
+                    self._evicted[old_key] = old_entry
+                    evicted_dirty = True
+        if evicted_dirty:
+            self._request_flush()
+
+    def invalidate(self, user_id: str, folder: str) -> None:
+        with self._lock:
+            entry = self._entries.pop((user_id, folder), None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            dirty = sum(1 for e in self._entries.values() if e.dirty) + len(self._evicted)
+            entries, size = len(self._entries), self._bytes
+        out = {k.split(".", 1)[1]: v for k, v in METRICS.snapshot("user_cache.").items()}
+        out.update({"entries": entries, "bytes": size, "dirty": dirty, "mode": self.mode})
+        return out
+
+    # --- сброс на диск/в БД ---
+
+    async def flush(self) -> int:
+        """Пишет все dirty-записи (вытесненные — в первую очередь). Возвращает число записей."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            with self._lock:
+                # вытесненные остаются в _evicted до успешной записи, чтобы get() не отдал
+                # устаревшую версию из хранилища, пока запись ещё в пути
+                batch = list(self._evicted.items())
+                batch += [(k, e) for k, e in self._entries.items() if e.dirty]
+                # запоминаем версию: если во время записи придёт новый put,
+                # версия изменится и запись останется dirty до следующего сброса
+                jobs = [(k, e, e.version, e.data, e.base) for k, e in batch]
+            written = 0
+            for key, entry, version, data, base in jobs:
+                try:
+                    await self._writer(key[0], key[1], data, base)
+                except Exception:
+                    logger.exception("Cache flush failed for user %s", key[0])
+                    METRICS.inc("user_cache.flush_errors")
+                    continue
+                written += 1
+                with self._lock:
+                    if self._evicted.get(key) is entry:
+                        del self._evicted[key]
+                    current = self._entries.get(key)
+                    if current is not None:
+                        if current.version == version:
+                            current.dirty = False
+                        # записанное стало базой для следующей частичной записи
+                        current.base = data
+            if jobs:
+                METRICS.inc("user_cache.flushes", written)
+                METRICS.inc("user_cache.flush_batches")
+            return written
+
+    async def write_through(self, user_id: str, folder: str, data: Dict[str, Any]) -> None:
+        """Режим write-through: запись сразу в хранилище, кэш обновляется чистой копией."""
+        with self._lock:
+            entry = self._entries.get((user_id, folder))
+            base = entry.base if entry is not None else None
+        await self._writer(user_id, folder, data, base)
+        METRICS.inc("user_cache.flushes")
+        self.put(user_id, folder, data, dirty=False)
+
+    def _request_flush(self) -> None:
+        if self._loop is None or self._wake is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wake.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Cache flush loop error")
+
+    async def start(self) -> None:
+        if self._task is not None or self.mode != MODE_WRITE_BEHIND:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновый сброс и принудительно пишет всё накопленное."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        written = await self.flush()
+        logger.info("User cache stopped, final flush: %d docs, stats: %s", written, self.stats())
@@ -0,0 +1,230 @@
+"""
+Сводка истории общения с пользователем («карточка клиента»): предпочтения, травмы и
+ограничения, структура прошлых программ — несколько строк вместо десятков длинных реплик.
+
+Хранится в документе пользователя (app.storage) в поле coach_summary:
+    {"format": 1, "version": 7, "seq": 42, "text": "...", "updated": 1700000000}
+- seq — сколько реплик истории (считая ушедшие в архив, history_archived) уже учтено;
+- version — растёт с каждым обновлением, запись идёт только поверх той версии, от которой
+  считали (иначе результат отбрасывается и обновление повторяется);
+- format — версия формата: при смене SUMMARY_FORMAT сводка строится заново.
+
+Обновление инкрементальное и фоновое: когда апдейт добавил реплики в историю, бот после записи
+документа (сессия закрыта) вызывает COACH_SUMMARY.schedule(user_id), через COACH_SUMMARY_DELAY сек задача берёт прежнюю сводку и только новые реплики (после seq)
+и просит модель обновить сводку. Вызов LLM — без аренды пользователя, запись — коротким
+UserSession. Отменённое (остановка бота) или неудачное обновление ничего не теряет: новые
+реплики учтутся в следующий раз.
+
+FitnessAgent добавляет сводку к анкете: в QA вместо учтённых ею реплик (дословно остаются
+только последние), в запросе программы — как «что известно из прошлых разговоров». Программа
+из общего кэша (кнопки вариаций) учитывает только SHARED_SECTIONS, иначе после первого же
+разговора ключ кэша у каждого пользователя свой.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.llm import get_llm_client, record_usage
+from app.metrics import METRICS
+from app.resilience import call_with_retries
+from app.session import UserSession
+from app.storage import PROGRAM_REQUEST_MARK, load_user_data_async
+
+logger = logging.getLogger("app.coach_summary")
+
+COACH_SUMMARY_ENABLED: bool = os.getenv("COACH_SUMMARY", "1").strip().lower() not in ("0", "false", "no", "off")
+COACH_SUMMARY_DELAY: float = float(os.getenv("COACH_SUMMARY_DELAY", "5"))
+COACH_SUMMARY_CONCURRENCY: int = int(os.getenv("COACH_SUMMARY_CONCURRENCY", "2"))
+COACH_SUMMARY_MAX_TOKENS: int = int(os.getenv("COACH_SUMMARY_MAX_TOKENS", "400"))
+# сколько символов ответа/программы отдавать модели на одну реплику при обновлении
+COACH_SUMMARY_INPUT_CHARS: int = int(os.getenv("COACH_SUMMARY_INPUT_CHARS", "2000"))
+# сколько новых реплик обрабатывать за одно обновление (остальные — следующим)
+COACH_SUMMARY_BATCH: int = int(os.getenv("COACH_SUMMARY_BATCH", "6"))
+
+SUMMARY_FORMAT = 1
+FIELD = "coach_summary"
+# разделы карточки, без которых программа может навредить: только они идут в запрос
+# (и в ключ кэша) общих программ из app.response_cache, остальное личное
+SHARED_SECTIONS = ("Травмы и ограничения",)
+
+SUMMARY_SYSTEM_PROMPT = """
+Ты ведёшь краткую карточку клиента фитнес-тренера. Тебе дают текущую карточку и новые
+реплики диалога (вопросы клиента, ответы и программы тренера). Верни обновлённую карточку.
+
+Формат — не больше 8 коротких строк, только факты о клиенте, без советов:
+Предпочтения: ...
+Травмы и ограничения: ...
+Программы: (сплит, число дней, акценты последних программ)
+Питание: ...
+Прочее: ...
+
+Правила:
+* сохраняй всё важное из текущей карточки, дополняй новым, исправляй устаревшее;
+* пропускай пустые разделы;
+* не выдумывай — только то, что есть в репликах или в текущей карточке;
+* без Markdown, без вступлений.
+""".strip()
+
+
+def _strip_prefix(text: str) -> str:
+    return text[2:] if text[:2] in ("🧍 ", "🤖 ") else text
+
+
+def get_summary(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Актуальная сводка из документа или None (нет / старый формат)."""
+    summary = data.get(FIELD)
+    if not isinstance(summary, dict) or summary.get("format") != SUMMARY_FORMAT or not summary.get("text"):
+        return None
+    return summary
+
+
+def shared_part(text: str) -> str:
+    """Строки карточки из SHARED_SECTIONS: у многих пользователей они одинаковые (или пустые)."""
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip().startswith(SHARED_SECTIONS))
+
+
+def history_seq(data: Dict[str, Any]) -> int:
+    """Сквозной номер следующей реплики: ушедшие в архив + окно истории."""
+    return (data.get("history_archived") or 0) + len(data.get("history") or [])
+
+
+def pending_entries(data: Dict[str, Any], seq: int, limit: int = COACH_SUMMARY_BATCH) -> Tuple[List[Any], int]:
+    """Реплики окна истории с номера seq (не больше limit) и номер, до которого они учтут историю."""
+    archived = data.get("history_archived") or 0
+    hist = data.get("history") or []
+    start = max(seq - archived, 0)  # ушедшие в архив до обновления — пропускаем
+    batch = hist[start:start + limit]
+    return batch, archived + start + len(batch)
+
+
+def _format_entries(entries: List[Any], mark: str) -> str:
+    parts = []
+    for entry in entries:
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            continue
+        question, answer = (str(x or "") for x in entry)
+        answer = _strip_prefix(answer)[:COACH_SUMMARY_INPUT_CHARS]
+        if question == mark:
+            parts.append(f"[Программа тренера]\n{answer}")
+        else:
+            parts.append(f"[Клиент] {_strip_prefix(question)}\n[Тренер] {answer}")
+    return "\n\n".join(parts)
+
+
+async def build_summary(previous: Optional[str], entries: List[Any], token: Optional[str] = None) -> str:
+    """Один вызов модели: прежняя карточка + новые реплики → обновлённая карточка."""
+    from app.agent import DEEPSEEK_MODEL  # agent сам импортирует этот модуль
+
+    client = get_llm_client(token)
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"Текущая карточка:\n{previous or '(пусто)'}\n\nНовые реплики:\n{_format_entries(entries, PROGRAM_REQUEST_MARK)}",
+        },
+    ]
+
+    async def attempt() -> str:
+        resp = await client.chat.completions.create(
+            model=DEEPSEEK_MODEL,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=COACH_SUMMARY_MAX_TOKENS,
+            stream=False,
+        )
+        record_usage(getattr(resp, "usage", None))
+        return (resp.choices[0].message.content or "").strip()
+
+    return await call_with_retries(attempt)
+
+
+class CoachSummaryUpdater:
+    """Фоновые обновления сводок: не больше одной задачи на пользователя, общий предел одновременных вызовов."""
+
+    def __init__(self, delay: float = COACH_SUMMARY_DELAY, concurrency: int = COACH_SUMMARY_CONCURRENCY, folder: str = "data/users"):
+        self.delay = delay
+        self.folder = folder
+        self._sem = asyncio.Semaphore(concurrency)
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._again: Set[str] = set()
+
+    def schedule(self, user_id: str) -> None:
+        """Отметить, что у пользователя появились новые реплики (вызывать после записи документа)."""
+        if not COACH_SUMMARY_ENABLED:
+            return
+        if user_id in self._tasks:
+            # задача уже идёт — пусть после записи проверит историю ещё раз
+            self._again.add(user_id)
+            return
+        task = asyncio.get_running_loop().create_task(self._run(user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda t, u=user_id: self._done(u, t))
+
+    def _done(self, user_id: str, task: asyncio.Task) -> None:
+        self._tasks.pop(user_id, None)
+        self._again.discard(user_id)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Coach summary update for %s failed: %s", user_id, task.exception())
+
+    async def _run(self, user_id: str) -> None:
+        while True:
+            # пауза: серия сообщений подряд накапливается в одно обновление
+            await asyncio.sleep(self.delay)
+            self._again.discard(user_id)
+            more = await self.update(user_id)
+            if not more and user_id not in self._again:
+                return
+
+    async def update(self, user_id: str) -> bool:
+        """Одно инкрементальное обновление. True — остались неучтённые реплики (нужен ещё проход)."""
+        data = await load_user_data_async(user_id, self.folder)
+        current = get_summary(data)
+        seq = current["seq"] if current else 0
+        stored = data.get(FIELD)
+        base_version = stored.get("version", 0) if isinstance(stored, dict) else 0
+        entries, new_seq = pending_entries(data, seq)
+        if not entries:
+            return False
+
+        async with self._sem:
+            t0 = time.perf_counter()
+            text = await build_summary(current["text"] if current else None, entries)
+            METRICS.inc("coach_summary.llm_seconds", time.perf_counter() - t0)
+        if not text:
+            return False
+
+        async with UserSession(user_id, self.folder) as session:
+            stored = session.data.get(FIELD)
+            version = stored.get("version", 0) if isinstance(stored, dict) else 0
+            if version != base_version:
+                # сводку успел обновить другой воркер — считаем заново от его версии
+                METRICS.inc("coach_summary.conflicts")
+                return True
+            session.data[FIELD] = {
+                "format": SUMMARY_FORMAT,
+                "version": version + 1,
+                "seq": new_seq,
+                "text": text,
+                "updated": int(time.time()),
+            }
+            more = new_seq < history_seq(session.data)
+        METRICS.inc("coach_summary.updates")
+        METRICS.inc("coach_summary.entries", len(entries))
+        return more
+
+    async def close(self) -> None:
+        """Отменяет фоновые обновления (неучтённые реплики подхватит следующее обновление)."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+COACH_SUMMARY = CoachSummaryUpdater()
+
+
+async def close_coach_summary() -> None:
+    await COACH_SUMMARY.close()
@@ -0,0 +1,144 @@
+"""
+Упаковка истории QA в бюджет входных токенов.
+
+Раньше в запрос уходили последние 10 реплик целиком (каждая — до нескольких тысяч символов)
+плюс системный промпт: длинные диалоги становились медленными и дорогими. Теперь:
+
+- токены считаются локально (estimate_tokens — оценка по словам, без токенизатора и сети);
+- вся входная часть запроса (системный промпт, анкета, история, вопрос) укладывается
+  в QA_INPUT_BUDGET токенов;
+- последние QA_RECENT_TURNS реплик идут дословно, если помещаются;
+- более старые заменяются краткой выжимкой (вопрос + начало ответа до QA_SUMMARY_CHARS
+  символов). Выжимка — обрезка текста, её дешевле посчитать заново, чем хранить в документе.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Sequence, Tuple
+
+QA_INPUT_BUDGET: int = int(os.getenv("QA_INPUT_BUDGET", "6000"))
+QA_RECENT_TURNS: int = int(os.getenv("QA_RECENT_TURNS", "2"))
+QA_MAX_TURNS: int = int(os.getenv("QA_MAX_TURNS", "10"))
+QA_SUMMARY_CHARS: int = int(os.getenv("QA_SUMMARY_CHARS", "400"))
+QA_SUMMARY_QUESTION_CHARS: int = int(os.getenv("QA_SUMMARY_QUESTION_CHARS", "200"))
+
+# накладные токены на одно сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD = 4
+# оценки длинных текстов (системный промпт, реплики истории) кэшируются по хэшу текста:
+# хэш в ~60 раз дешевле оценки, а в памяти — 16 байт ключа вместо самого текста
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_MIN_CHARS = 256
+
+Turn = Tuple[str, str]  # (вопрос, ответ) без префиксов 🧍/🤖
+
+_WORD_RE = re.compile(r"[A-Za-z]+|[А-Яа-яЁё]+|\d+|\S")
+_MARKUP_RE = re.compile(r"[*_`#]+")
+_SPACE_RE = re.compile(r"[ \t]+")
+
+
+_token_cache: "OrderedDict[bytes, int]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценка числа токенов BPE-токенизатора (DeepSeek/OpenAI) без самого токенизатора:
+    латиница ≈ 4 символа на токен, кириллица ≈ 3, числа ≈ 3 цифры, остальное (знаки,
+    эмодзи) — по токену на символ. Погрешность ~10–15%, для бюджета этого хватает.
+    Системный промпт и реплики истории оцениваются при каждом запросе — длинные тексты
+    кэшируются по хэшу (TOKEN_CACHE_SIZE последних).
+    """
+    text = text or ""
+    if len(text) < TOKEN_CACHE_MIN_CHARS:
+        return _count_tokens(text)
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with _token_cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is not None:
+            _token_cache.move_to_end(key)
+            return tokens
+    tokens = _count_tokens(text)
+    with _token_cache_lock:
+        _token_cache[key] = tokens
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return tokens
+
+
+def _count_tokens(text: str) -> int:
+    tokens = 0
+    for m in _WORD_RE.finditer(text):
+        word = m.group()
+        first = word[0]
+        if first.isascii() and first.isalpha():
+            tokens += (len(word) + 3) // 4
+        elif first.isalpha():
+            tokens += (len(word) + 2) // 3
+        elif first.isdigit():
+            tokens += (len(word) + 2) // 3
+        else:
+            tokens += 1
+    return tokens
+
+
+def messages_tokens(messages: Iterable[dict]) -> int:
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def _clip(text: str, limit: int) -> str:
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > limit // 2 else cut).rstrip(" ,.;:—-") + "…"
+
+
+def summarize_turn(question: str, answer: str, max_chars: int = QA_SUMMARY_CHARS) -> str:
+    """Выжимка реплики: вопрос и первые строки ответа без разметки (заголовки, первые пункты)."""
+    lines = []
+    size = 0
+    for raw in answer.splitlines():
+        line = _SPACE_RE.sub(" ", _MARKUP_RE.sub("", raw)).strip(" •-–—\t")
+        if not line:
+            continue
+        if size + len(line) > max_chars:
+            if not lines:
+                lines.append(_clip(line, max_chars))
+            break
+        lines.append(line)
+        size += len(line) + 2
+    body = "; ".join(lines) if lines else _clip(answer.strip(), max_chars)
+    return f"Вопрос: {_clip(question.strip(), QA_SUMMARY_QUESTION_CHARS)}\nКратко из ответа: {body}"
+
+
+def pack_history(
+    turns: Sequence[Turn],
+    budget: int,
+    recent: int = QA_RECENT_TURNS,
+    max_turns: int = QA_MAX_TURNS,
+) -> List[dict]:
+    """
+    Сообщения истории в хронологическом порядке, не больше budget токенов.
+    Идёт от новых реплик к старым: последние recent — дословно (если влезают), остальные —
+    выжимкой (summarize_turn). Останавливается на первой реплике, которая не влезает даже выжимкой.
+    """
+    packed: List[List[dict]] = []
+    left = budget
+    for i, (question, answer) in enumerate(reversed(turns[-max_turns:] if max_turns else turns)):
+        verbatim = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+        if i < recent:
+            cost = messages_tokens(verbatim)
+            if cost <= left:
+                packed.append(verbatim)
+                left -= cost
+                continue
+        # выжимка — одно сообщение-заметка, а не пара «вопрос–ответ»: модель не примет её за свой стиль
+        compact = [{"role": "user", "content": f"(Ранее в диалоге) {summarize_turn(question, answer)}"}]
+        cost = messages_tokens(compact)
+        if cost > left:
+            break
+        packed.append(compact)
+        left -= cost
+    return [m for pair in reversed(packed) for m in pair]
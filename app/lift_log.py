@@ -0,0 +1,318 @@
+"""
+Журнал подходов («🏋️ Дневник подходов»): пользователь пишет «Жим лёжа 60x8», подход
+дописывается в конец файла пользователя, агрегаты по упражнению обновляются сразу.
+
+Файл {LIFT_LOG_DIR}/{user_id}.bin только дописывается, записи фиксированного размера:
+  имя упражнения — _NAME (вид, длина) + UTF-8, номер упражнения = порядок таких записей;
+  подход         — _SET (вид, номер упражнения, ts, вес, повторения, запас RIR; 14 байт).
+Запись подхода — один write() в конец файла, документ пользователя (app.storage) не трогается.
+
+В памяти у пользователя (LiftLog) — по упражнению столбцы array (ts, вес, повторения, RIR)
+и агрегаты, которые обновляются на каждом подходе: последний вес, лучший расчётный 1ПМ
+(Эпли с учётом RIR), тоннаж по неделям. Поэтому сводка для модели (summary_async, её берёт
+FitnessAgent перед первым запросом) — это O(1) на упражнение, без прохода по истории.
+Журналы последних LIFT_LOG_CACHE_USERS пользователей держатся в памяти; если файл вырос
+(подход записал другой воркер), дочитывается только хвост. Запись одного пользователя из
+разных воркеров не пересекается — апдейты идут под арендой UserSession.
+
+Прежний save_lift_history (история в документе) и таблица lift_sets (STORAGE_LAYOUT=relational)
+убраны: подходы хранятся только здесь. Замер против прежнего пути: python -m benchmarks.lift_log_bench.
+"""
+import asyncio
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.lift_log")
+
+LIFT_LOG_DIR = os.getenv("LIFT_LOG_DIR", "data/users/lifts")
+LIFT_LOG_CACHE_USERS = int(os.getenv("LIFT_LOG_CACHE_USERS", "2000"))
+# сколько упражнений (последних по дате) попадает в анкету для модели
+LIFT_SUMMARY_MAX = int(os.getenv("LIFT_SUMMARY_MAX", "6"))
+
+NAME_MAX_LEN = 60
+MAX_WEIGHT = 1000.0
+MAX_REPS = 100
+MAX_RIR = 10
+
+WEEK = 7 * 86400
+# 1970-01-01 — четверг; сдвиг, чтобы неделя начиналась с понедельника
+_WEEK_SHIFT = 3 * 86400
+
+_KIND_NAME, _KIND_SET = 1, 2
+_NAME = struct.Struct("<BH")
+_SET = struct.Struct("<BHIfHb")
+_NO_RIR = -1
+
+# «Жим лёжа 60x8», «присед 100 кг × 5×5 rir 2» (вес × подходы × повторения), «подтягивания 0x10» (0 — свой вес)
+_SET_RE = re.compile(
+    r"^(?P<name>\S.*?)\s+(?P<weight>\d{1,4}(?:[.,]\d{1,2})?)\s*(?:кг\s*)?[xхX×*]\s*"
+    r"(?:(?P<sets>\d{1,2})\s*[xхX×*]\s*)?(?P<reps>\d{1,3})"
+    r"(?:\s*(?:rir|RIR|запас)\s*(?P<rir>\d{1,2}))?$"
+)
+# «присед 100 кг 5x5» разобралось бы как вес 5 — такое имя не принимаем
+_NAME_WITH_WEIGHT_RE = re.compile(r"\d\s*кг$")
+
+
+class LoggedSet(NamedTuple):
+    name: str
+    weight: float
+    reps: int
+    rir: Optional[int] = None
+
+
+def lift_key(name: str) -> str:
+    """Ключ упражнения: без регистра, ё → е, одиночные пробелы."""
+    return " ".join(name.lower().replace("ё", "е").split())
+
+
+def week_of(ts: float) -> int:
+    return int(ts + _WEEK_SHIFT) // WEEK
+
+
+def estimate_1rm(weight: float, reps: int, rir: Optional[int] = None) -> float:
+    """Расчётный 1ПМ по Эпли; запас RIR добавляется к повторениям (подход «до отказа»)."""
+    total = reps + (rir or 0)
+    return weight if total <= 1 else weight * (1 + total / 30)
+
+
+def parse_sets(text: str) -> List[LoggedSet]:
+    """
+    Подходы из сообщения, по одному упражнению на строку; «Присед 100x5x5» — пять подходов по 5.
+    Строка, которую не удалось разобрать, — ValueError с её текстом.
+    """
+    out: List[LoggedSet] = []
+    for line in text.splitlines():
+        line = " ".join(line.strip(" -•").split())
+        if not line:
+            continue
+        m = _SET_RE.match(line)
+        if not m:
+            raise ValueError(line)
+        name = m.group("name").strip(" :—-")
+        weight = float(m.group("weight").replace(",", "."))
+        reps = int(m.group("reps"))
+        rir = int(m.group("rir")) if m.group("rir") else None
+        count = int(m.group("sets") or 1)
+        if (
+            not name or len(name) > NAME_MAX_LEN or _NAME_WITH_WEIGHT_RE.search(name)
+            or weight > MAX_WEIGHT or not 1 <= reps <= MAX_REPS or not 1 <= count <= 20
+            or (rir is not None and rir > MAX_RIR)
+        ):
+            raise ValueError(line)
+        out += [LoggedSet(name, weight, reps, rir)] * count
+    return out
+
+
+def _fmt(x: float) -> str:
+    return f"{x:.1f}".rstrip("0").rstrip(".")
+
+
+class LiftSeries:
+    """Одно упражнение: столбцы подходов и агрегаты, обновляемые на каждом add()."""
+
+    __slots__ = ("id", "name", "ts", "weight", "reps", "rir", "best_e1rm", "weekly")
+
+    def __init__(self, lift_id: int, name: str):
+        self.id = lift_id
+        self.name = name
+        self.ts = array("I")
+        self.weight = array("f")
+        self.reps = array("H")
+        self.rir = array("b")
+        self.best_e1rm = 0.0
+        self.weekly: Dict[int, float] = {}  # неделя (week_of) → тоннаж, кг
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def add(self, ts: int, weight: float, reps: int, rir: int) -> None:
+        self.ts.append(ts)
+        self.weight.append(weight)
+        self.reps.append(reps)
+        self.rir.append(rir)
+        weight = self.weight[-1]  # как в файле (float32)
+        self.best_e1rm = max(self.best_e1rm, estimate_1rm(weight, reps, None if rir == _NO_RIR else rir))
+        week = week_of(ts)
+        self.weekly[week] = self.weekly.get(week, 0.0) + weight * reps
+
+    @property
+    def last_ts(self) -> int:
+        return self.ts[-1]
+
+    @property
+    def last_weight(self) -> float:
+        return self.weight[-1]
+
+    @property
+    def last_reps(self) -> int:
+        return self.reps[-1]
+
+    @property
+    def last_e1rm(self) -> float:
+        rir = self.rir[-1]
+        return estimate_1rm(self.weight[-1], self.reps[-1], None if rir == _NO_RIR else rir)
+
+    def volume(self, week: int) -> float:
+        return self.weekly.get(week, 0.0)
+
+    def describe(self, now: Optional[float] = None) -> str:
+        """«Жим лёжа: 60 кг × 8, 1ПМ ≈ 76 кг (лучший 80), тоннаж за неделю 1440 кг (прошлая 1200)»."""
+        week = week_of(time.time() if now is None else now)
+        text = f"{self.name}: {_fmt(self.last_weight)} кг × {self.last_reps}"
+        if self.last_weight > 0:
+            text += f", 1ПМ ≈ {_fmt(self.last_e1rm)} кг"
+            if self.best_e1rm > self.last_e1rm + 0.05:
+                text += f" (лучший {_fmt(self.best_e1rm)})"
+            text += f", тоннаж за неделю {_fmt(self.volume(week))} кг"
+            previous = self.volume(week - 1)
+            if previous:
+                text += f" (прошлая {_fmt(previous)})"
+        return text
+
+
+class LiftLog:
+    """Журнал одного пользователя: упражнения по ключу и позиция, до которой прочитан файл."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lifts: Dict[str, LiftSeries] = {}
+        self.by_id: List[LiftSeries] = []
+        self.offset = 0
+
+    def catch_up(self, truncate: bool = False) -> None:
+        """
+        Дочитать записи, появившиеся в файле после offset (O(новых), при первом вызове — всех).
+        Недописанный хвост читатель пропускает (его могут дописывать прямо сейчас); отрезает
+        его только truncate=True — append, который идёт под арендой пользователя.
+        """
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return
+        if size <= self.offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            buf = f.read(size - self.offset)
+        pos = 0
+        while pos < len(buf):
+            kind = buf[pos]
+            if kind == _KIND_SET and pos + _SET.size <= len(buf):
+                _, lift_id, ts, weight, reps, rir = _SET.unpack_from(buf, pos)
+                if lift_id < len(self.by_id):
+                    self.by_id[lift_id].add(ts, weight, reps, rir)
+                pos += _SET.size
+            elif kind == _KIND_NAME and pos + _NAME.size <= len(buf):
+                _, length = _NAME.unpack_from(buf, pos)
+                end = pos + _NAME.size + length
+                if end > len(buf):
+                    break
+                self._define(buf[pos + _NAME.size:end].decode("utf-8"))
+                pos = end
+            else:
+                break
+        self.offset += pos
+        if truncate and self.offset < size:
+            # оборванная запись в конце (сбой посреди write) — отрезаем, иначе следующая допишется за мусором
+            logger.warning("lift log %s: truncating %d torn bytes", self.path, size - self.offset)
+            with open(self.path, "r+b") as f:
+                f.truncate(self.offset)
+
+    def _define(self, name: str) -> LiftSeries:
+        series = LiftSeries(len(self.by_id), name)
+        self.by_id.append(series)
+        self.lifts.setdefault(lift_key(name), series)
+        return series
+
+    def append(self, sets: List[LoggedSet], ts: Optional[int] = None) -> List[LiftSeries]:
+        """Дописать подходы одним write(); вернуть затронутые упражнения (по порядку, без повторов)."""
+        self.catch_up(truncate=True)
+        ts = int(time.time()) if ts is None else ts
+        out = bytearray()
+        touched: Dict[int, LiftSeries] = {}
+        for s in sets:
+            series = self.lifts.get(lift_key(s.name))
+            if series is None:
+                raw = s.name.encode("utf-8")
+                out += _NAME.pack(_KIND_NAME, len(raw)) + raw
+                series = self._define(s.name)
+            rir = _NO_RIR if s.rir is None else s.rir
+            out += _SET.pack(_KIND_SET, series.id, ts, s.weight, s.reps, rir)
+            series.add(ts, s.weight, s.reps, rir)
+            touched.setdefault(series.id, series)
+        if out:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(out)
+            self.offset += len(out)
+        return list(touched.values())
+
+    def recent(self, limit: int = LIFT_SUMMARY_MAX) -> List[LiftSeries]:
+        """Упражнения с подходами, последние по дате — первыми."""
+        series = [s for s in self.by_id if len(s)]
+        series.sort(key=lambda s: s.last_ts, reverse=True)
+        return series[:limit]
+
+
+class LiftLogs:
+    """Журналы пользователей в памяти (LRU по числу пользователей) поверх файлов LIFT_LOG_DIR."""
+
+    def __init__(self, root: str = LIFT_LOG_DIR, max_users: int = LIFT_LOG_CACHE_USERS):
+        self.root = Path(root)
+        self.max_users = max(1, max_users)
+        self._logs: "OrderedDict[str, LiftLog]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, user_id: str) -> Path:
+        return self.root / f"{user_id}.bin"
+
+    def get(self, user_id: str) -> LiftLog:
+        user_id = str(user_id)
+        with self._lock:
+            log = self._logs.get(user_id)
+            if log is None:
+                log = self._logs[user_id] = LiftLog(self.path(user_id))
+                while len(self._logs) > self.max_users:
+                    self._logs.popitem(last=False)
+            else:
+                self._logs.move_to_end(user_id)
+            log.catch_up()
+            return log
+
+    def log_sets(self, user_id: str, sets: List[LoggedSet], ts: Optional[int] = None) -> List[LiftSeries]:
+        log = self.get(user_id)
+        with self._lock:
+            touched = log.append(sets, ts)
+        METRICS.inc("lift_log.sets", len(sets))
+        return touched
+
+    async def log_sets_async(self, user_id: str, sets: List[LoggedSet]) -> List[LiftSeries]:
+        return await asyncio.to_thread(self.log_sets, user_id, sets)
+
+    async def get_async(self, user_id: str) -> LiftLog:
+        return await asyncio.to_thread(self.get, user_id)
+
+    async def summary_async(self, user_id: str) -> str:
+        return await asyncio.to_thread(self.summary, user_id)
+
+    def summary(self, user_id: str, limit: int = LIFT_SUMMARY_MAX, now: Optional[float] = None) -> str:
+        """Строки для анкеты модели; пусто, если журнала нет. Читает файл — из цикла событий через summary_async."""
+        if not self.path(user_id).exists() and str(user_id) not in self._logs:
+            return ""
+        recent = self.get(user_id).recent(limit)
+        if not recent:
+            return ""
+        return "\n".join(["🏋️ Рабочие веса (дневник подходов):"] + [f"- {s.describe(now)}" for s in recent])
+
+
+LIFT_LOGS = LiftLogs()
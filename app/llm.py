@@ -0,0 +1,86 @@
+"""
+Общий на процесс асинхронный клиент LLM (DeepSeek, OpenAI-совместимый API).
+
+Раньше каждый запрос создавал свой sync OpenAI (новый пул соединений, новый TLS-хендшейк)
+и уходил в asyncio.to_thread, а пул потоков по умолчанию ограничивал число параллельных
+генераций. Теперь один AsyncOpenAI с одним httpx-пулом на процесс: keep-alive соединения
+переиспользуются, предел — LLM_MAX_CONNECTIONS, вызовы идут прямо из event loop.
+Закрывается в post_shutdown (main.on_shutdown → close_llm_client).
+"""
+import logging
+import os
+from typing import Any, Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.llm")
+
+DEEPSEEK_API_KEY: str = (os.getenv("DEEPSEEK_API_KEY") or "").strip()
+DEEPSEEK_BASE_URL: str = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").strip()
+DEEPSEEK_TIMEOUT: int = int(os.getenv("DEEPSEEK_TIMEOUT", "90"))
+
+LLM_MAX_CONNECTIONS: int = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))        # одновременных запросов к API
+LLM_MAX_KEEPALIVE: int = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))             # простаивающих соединений в пуле
+LLM_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))   # сек жизни простаивающего соединения
+
+_client: Optional[AsyncOpenAI] = None
+
+
+def get_llm_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """
+    Общий клиент (создаётся при первом вызове). Другой api_key — копия клиента
+    на том же пуле соединений (with_options не создаёт новый httpx-клиент).
+    """
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=DEEPSEEK_API_KEY,
+            base_url=DEEPSEEK_BASE_URL,
+            timeout=DEEPSEEK_TIMEOUT,
+            max_retries=0,  # повторы, дедлайн и breaker — в app.resilience
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        )
+        logger.info("LLM client: %s, max %d connections", DEEPSEEK_BASE_URL, LLM_MAX_CONNECTIONS)
+    if api_key and api_key != _client.api_key:
+        return _client.with_options(api_key=api_key)
+    return _client
+
+
+async def close_llm_client() -> None:
+    """Закрывает пул соединений (вызывать из post_shutdown)."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+
+
+def record_usage(usage: Any) -> Optional[int]:
+    """
+    Учитывает usage ответа в app.metrics: llm.prompt_tokens / completion_tokens и входные
+    токены из контекстного кэша DeepSeek (llm.prompt_cache_hit_tokens — тарифицируются
+    дешевле) и мимо него (llm.prompt_cache_miss_tokens). Возвращает total_tokens или None.
+    """
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_tokens", None) or 0
+    METRICS.inc("llm.requests_with_usage")
+    METRICS.inc("llm.prompt_tokens", prompt)
+    METRICS.inc("llm.completion_tokens", getattr(usage, "completion_tokens", None) or 0)
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    if hit is None:
+        # OpenAI-совместимый формат: usage.prompt_tokens_details.cached_tokens
+        hit = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if hit is not None:
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        METRICS.inc("llm.prompt_cache_hit_tokens", hit)
+        METRICS.inc("llm.prompt_cache_miss_tokens", miss if miss is not None else max(0, prompt - hit))
+    return getattr(usage, "total_tokens", None)
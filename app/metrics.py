@@ -0,0 +1,104 @@
+"""
+Счётчики процесса (METRICS.inc("program_cache.hits") и т.п.) и их выдача наружу:
+- раз в METRICS_LOG_INTERVAL секунд — строка INFO в лог с изменившимися с прошлого раза
+  счётчиками (init_metrics_log / close_metrics_log в post_init / post_shutdown);
+- в webhook-режиме — GET /metrics (bot/webhook.py) в текстовом формате Prometheus.
+Счётчики свои у каждого процесса; в логе и в /metrics они помечены pid.
+"""
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, Optional
+
+logger = logging.getLogger("app.metrics")
+
+# 0 — не писать счётчики в лог
+METRICS_LOG_INTERVAL: float = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
+
+
+class Counters:
+    """Простые потокобезопасные счётчики процесса (hits/misses/flushes и т.п.)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[name] += value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self, prefix: str = "") -> Dict[str, float]:
+        with self._lock:
+            return {k: v for k, v in self._values.items() if k.startswith(prefix)}
+
+
+METRICS = Counters()
+
+
+def _fmt(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.6g}"
+
+
+def render_prometheus(counters: Counters = METRICS) -> str:
+    """Все счётчики в текстовом формате Prometheus: program_cache.hits → program_cache_hits{pid="…"}."""
+    pid = os.getpid()
+    lines = []
+    for name, value in sorted(counters.snapshot().items()):
+        metric = name.replace(".", "_").replace("-", "_")
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f'{metric}{{pid="{pid}"}} {_fmt(value)}')
+    return "\n".join(lines) + "\n"
+
+
+class MetricsLog:
+    """Фоновая задача: раз в interval секунд — изменившиеся счётчики одной строкой в лог."""
+
+    def __init__(self, counters: Counters = METRICS, interval: float = METRICS_LOG_INTERVAL):
+        self.counters = counters
+        self.interval = interval
+        self._last: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.write()
+
+    def write(self) -> None:
+        current = self.counters.snapshot()
+        changed = {k: v for k, v in sorted(current.items()) if self._last.get(k) != v}
+        self._last = current
+        if changed:
+            logger.info("metrics pid=%s %s", os.getpid(), " ".join(f"{k}={_fmt(v)}" for k, v in changed.items()))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write()
+
+
+METRICS_LOG = MetricsLog()
+
+
+async def init_metrics_log() -> None:
+    METRICS_LOG.start()
+
+
+async def close_metrics_log() -> None:
+    """Останавливает запись и пишет итоговые значения (вызывать из post_shutdown)."""
+    await METRICS_LOG.stop()
@@ -0,0 +1,151 @@
+"""
+Одноразовый перенос пользователей в нормализованные таблицы (STORAGE_LAYOUT=relational).
+
+Источники: строки user_data (JSONB) и JSON-файлы из data/users вместе с архивом истории
+(history_archive / {user_id}.history.jsonl). Перенос идёт пачками
+по возрастанию user_id; после каждой пачки в migration_progress фиксируется последний
+перенесённый ключ, поэтому прерванную миграцию можно просто запустить снова.
+Перенос пользователя идемпотентен: его строки в новых таблицах переписываются целиком.
+
+Если пользователь есть и в базе, и в файлах, побеждает база: с DATABASE_URL бот читает и пишет
+только Postgres, файл — устаревшая копия. Поэтому при проходе files пользователи, у которых
+уже есть строка user_data или profiles, пропускаются (при --source all база переносится первой).
+
+    DATABASE_URL=... python -m app.migrate_relational --source all --folder data/users
+"""
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple
+
+import psycopg
+
+from app import storage
+from app import storage_relational as rel
+
+logger = logging.getLogger("app.migrate_relational")
+
+_PROGRESS_DDL = """
+CREATE TABLE IF NOT EXISTS migration_progress (
+    source TEXT PRIMARY KEY,
+    last_key TEXT NOT NULL,
+    migrated INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+
+def _progress(conn: "psycopg.Connection", source: str) -> Tuple[str, int]:
+    row = conn.execute(
+        "SELECT last_key, migrated FROM migration_progress WHERE source = %s", (source,)
+    ).fetchone()
+    return (row[0], row[1]) if row else ("", 0)
+
+
+def _set_progress(conn: "psycopg.Connection", source: str, last_key: str, migrated: int) -> None:
+    conn.execute(
+        """
+        INSERT INTO migration_progress (source, last_key, migrated) VALUES (%s, %s, %s)
+        ON CONFLICT (source) DO UPDATE SET last_key = EXCLUDED.last_key,
+            migrated = EXCLUDED.migrated, updated_at = now()
+        """,
+        (source, last_key, migrated),
+    )
+
+
+Batch = List[Tuple[str, dict, list]]  # (user_id, документ, архив истории)
+
+
+def _db_batches(conn: "psycopg.Connection", after: str, batch: int) -> Iterator[Batch]:
+    while True:
+        rows = conn.execute(
+            "SELECT user_id, data FROM user_data WHERE user_id > %s ORDER BY user_id LIMIT %s",
+            (after, batch),
+        ).fetchall()
+        if not rows:
+            return
+        out = []
+        for user_id, raw in rows:
+            raw = json.loads(raw) if isinstance(raw, str) else raw
+            archived = conn.execute(
+                "SELECT question, answer FROM history_archive WHERE user_id = %s ORDER BY seq", (user_id,)
+            ).fetchall()
+            out.append((user_id, storage._ensure_structure(raw), archived))
+        yield out
+        after = rows[-1][0]
+
+
+def _file_batches(folder: str, after: str, batch: int) -> Iterator[Batch]:
+    user_ids = sorted(p.stem for p in Path(folder).glob("*.json"))
+    user_ids = [u for u in user_ids if u > after]
+    for i in range(0, len(user_ids), batch):
+        yield [
+            (u, storage._load_file(u, folder), storage._read_file_archive(u, folder))
+            for u in user_ids[i:i + batch]
+        ]
+
+
+def _in_database(conn: "psycopg.Connection", user_ids: List[str]) -> Set[str]:
+    rows = conn.execute(
+        "SELECT user_id FROM user_data WHERE user_id = ANY(%s) UNION SELECT user_id FROM profiles WHERE user_id = ANY(%s)",
+        (user_ids, user_ids),
+    ).fetchall()
+    return {r[0] for r in rows}
+
+
+def migrate(conn: "psycopg.Connection", source: str, folder: str, batch: int) -> int:
+    after, migrated = _progress(conn, source)
+    if after:
+        logger.info("[%s] resuming after user_id=%s (%d already migrated)", source, after, migrated)
+    batches = _db_batches(conn, after, batch) if source == "db" else _file_batches(folder, after, batch)
+    started = time.perf_counter()
+    skipped = 0
+    for users in batches:
+        last_key = users[-1][0]
+        if source == "files":
+            # живые данные в базе не затираем устаревшим файлом
+            live = _in_database(conn, [u for u, _, _ in users])
+            skipped += len(live)
+            users = [u for u in users if u[0] not in live]
+        # пачка и отметка прогресса — в одной транзакции: либо обе, либо ни одной
+        with conn.transaction():
+            with conn.pipeline(), conn.cursor() as cur:
+                for user_id, doc, archived in users:
+                    for sql, params in rel.replace_statements(user_id, doc, archived):
+                        cur.execute(sql, params)
+            migrated += len(users)
+            _set_progress(conn, source, last_key, migrated)
+        elapsed = time.perf_counter() - started
+        logger.info("[%s] migrated %d users, skipped %d already in the database (last=%s, %.1f users/s)",
+                    source, migrated, skipped, last_key, migrated / elapsed if elapsed else 0)
+    return migrated
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=("db", "files", "all"), default="all")
+    parser.add_argument("--folder", default="data/users", help="папка с JSON-файлами пользователей")
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--reset", action="store_true", help="начать заново, забыв сохранённый прогресс")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    url = storage._get_database_url()
+    if not url:
+        raise SystemExit("Нужен DATABASE_URL / NF_GYM_DB_POSTGRES_URI")
+
+    with psycopg.connect(url, autocommit=True) as conn:
+        for ddl in [storage._USER_DATA_DDL, storage._HISTORY_ARCHIVE_DDL, _PROGRESS_DDL] + rel.DDL:
+            conn.execute(ddl)
+        sources = ("db", "files") if args.source == "all" else (args.source,)
+        if args.reset:
+            conn.execute("DELETE FROM migration_progress WHERE source = ANY(%s)", (list(sources),))
+        for source in sources:
+            total = migrate(conn, source, args.folder, args.batch)
+            logger.info("[%s] done: %d users", source, total)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+Пакетный онбординг участников (партнёрские залы): анкеты из CSV/JSONL сразу в хранилище
+и первые программы заранее — без диалога анкеты в боте.
+
+Файл: CSV с заголовком или JSONL, по одному участнику на строку. Поля — как в анкете
+(physical_data) плюс user_id (Telegram ID):
+    user_id, name, gender, age, height, weight, goal, restrictions, level, schedule, target,
+    preferred_muscle_group
+Обязательны user_id, gender, age, height, weight, schedule, level, target. Числа проверяются
+теми же validate_* из app.storage, что и в анкете бота; строки с ошибками пропускаются
+(с номером строки в логе и, если задан --rejects, в отдельном JSONL).
+
+1. Импорт — пачками по --batch через app.storage.update_users_bulk (в Postgres одна
+   транзакция на пачку, пишутся только изменённые поля). Участника, который уже сам прошёл
+   анкету в боте, не трогаем (--overwrite — перезаписать).
+2. Программы — FitnessAgent.get_program для импортированных без программы, не больше
+   --concurrency запросов одновременно (одинаковые анкеты берутся из кэша программ).
+   Вызов LLM — без аренды пользователя, запись — коротким UserSession.
+
+Повторный запуск продолжает с места остановки: импорт идемпотентен (неизменённые анкеты
+не пишутся), а участники с готовой программой пропускаются. При первом /start бот
+показывает импортированному участнику готовую программу вместо анкеты.
+
+    python -m app.onboarding members.csv --concurrency 4
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from app.metrics import METRICS
+from app.resilience import UpstreamUnavailable
+from app.session import UserSession
+from app.state_store import close_state_store, init_state_store
+from app.storage import (
+    PROGRAM_REQUEST_MARK,
+    close_storage,
+    update_users_bulk,
+    validate_age,
+    validate_height,
+    validate_schedule,
+    validate_weight,
+)
+
+logger = logging.getLogger("app.onboarding")
+
+FIELD = "onboarding"
+REQUIRED = ("user_id", "gender", "age", "height", "weight", "schedule", "level", "target")
+DEFAULT_MUSCLE_GROUP = "сбалансированно"
+
+# значения как после кнопок анкеты; ключ — каноническое значение, кортеж — начала слов
+_GENDERS = {"женский": ("ж", "f", "w"), "мужской": ("м", "m")}
+_TARGETS = {
+    "похудение": ("похуд", "сброс", "сушк", "lose", "cut", "weight loss"),
+    "набор массы": ("набор", "масс", "gain", "bulk", "mass"),
+    "поддержание формы": ("поддерж", "форм", "maint"),
+}
+_LEVELS = {"начинающий": ("нач", "нов", "beg", "nov"), "опытный": ("опыт", "прод", "adv", "exp")}
+
+Profile = Dict[str, Any]
+
+
+def _choice(value: str, options: Dict[str, Tuple[str, ...]]) -> Optional[str]:
+    text = value.strip().lower()
+    if text in options:
+        return text
+    for canonical, prefixes in options.items():
+        if text.startswith(prefixes):
+            return canonical
+    return None
+
+
+def parse_member(row: Dict[str, Any]) -> Tuple[Optional[str], Profile, List[str]]:
+    """Строка файла → (user_id, physical_data, ошибки). Ошибки — в формулировках анкеты бота."""
+    row = {str(k).strip().lower(): ("" if v is None else str(v).strip()) for k, v in row.items() if k}
+    errors = [f"{key}: не заполнено" for key in REQUIRED if not row.get(key)]
+    user_id = row.get("user_id") or None
+    if user_id and not user_id.isdigit():
+        errors.append("user_id: нужен числовой Telegram ID")
+    profile: Profile = {"name": row.get("name") or None}
+
+    for key, validate in (("age", validate_age), ("height", validate_height), ("weight", validate_weight),
+                          ("goal", validate_weight), ("schedule", validate_schedule)):
+        if not row.get(key):
+            continue
+        ok, value, error = validate(row[key])
+        if ok:
+            profile[key] = value
+        else:
+            errors.append(f"{key}: {error}")
+
+    for key, options in (("gender", _GENDERS), ("target", _TARGETS), ("level", _LEVELS)):
+        if not row.get(key):
+            continue
+        value = _choice(row[key], options)
+        if value is None:
+            errors.append(f"{key}: одно из {', '.join(options)}")
+        profile[key] = value
+
+    restrictions = row.get("restrictions") or ""
+    profile["restrictions"] = restrictions if restrictions.lower() not in ("", "нет", "no", "-") else None
+
+    from app.agent import FOCUS_BLOCKS  # тянет промпты агента — только когда реально импортируем
+
+    group = (row.get("preferred_muscle_group") or DEFAULT_MUSCLE_GROUP).lower()
+    if group != DEFAULT_MUSCLE_GROUP and group not in FOCUS_BLOCKS:
+        errors.append(f"preferred_muscle_group: одно из {DEFAULT_MUSCLE_GROUP}, {', '.join(FOCUS_BLOCKS)}")
+    profile["preferred_muscle_group"] = group
+    return user_id, profile, errors
+
+
+def read_rows(path: Path) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """(номер строки, поля) из CSV (с заголовком) или JSONL — по расширению файла."""
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        if path.suffix.lower() in (".jsonl", ".ndjson", ".json"):
+            for lineno, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield lineno, json.loads(line)
+                    except json.JSONDecodeError as e:
+                        yield lineno, {"_error": f"JSON: {e}"}
+            return
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def pending_welcome(data: Dict[str, Any]) -> bool:
+    """Участник импортирован и ещё не открывал бота (ему положено приветствие с программой)."""
+    marker = data.get(FIELD)
+    return isinstance(marker, dict) and not marker.get("welcomed") and bool(data.get("physical_data_completed"))
+
+
+def mark_welcomed(data: Dict[str, Any]) -> None:
+    data[FIELD] = {**(data.get(FIELD) or {}), "welcomed": int(time.time())}
+
+
+def _apply_profile(doc: Dict[str, Any], profile: Profile, source: str, overwrite: bool) -> bool:
+    marker = doc.get(FIELD) if isinstance(doc.get(FIELD), dict) else None
+    if doc.get("physical_data_completed") and not overwrite and not pending_welcome(doc):
+        # анкету заполнил сам участник (или уже видел импортированную) — не перетираем
+        return False
+    phys = dict(doc.get("physical_data") or {})
+    changed = any(phys.get(k) != v for k, v in profile.items())
+    phys.update(profile)
+    doc["physical_data"] = phys
+    doc["physical_data_completed"] = True
+    if changed and pending_welcome(doc):
+        # анкету поправили в файле до первого /start — программа по старой анкете не нужна
+        doc["last_program"] = None
+        doc["last_reply"] = None
+    doc[FIELD] = {
+        "source": (marker or {}).get("source") or source,
+        "imported": (marker or {}).get("imported") or int(time.time()),
+        "welcomed": None,
+    }
+    return True
+
+
+def needs_program(data: Dict[str, Any]) -> bool:
+    return pending_welcome(data) and not data.get("last_program")
+
+
+class _Report:
+    def __init__(self):
+        self.rows = self.rejected = self.imported = self.kept = 0
+        self.generated = self.failed = self.skipped = 0
+        self.latencies: List[float] = []
+        self.import_seconds = self.generate_seconds = 0.0
+
+    def lines(self, pending: int, cache: Dict[str, Any]) -> List[str]:
+        lat = sorted(self.latencies)
+        p50 = lat[len(lat) // 2] if lat else 0.0
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))] if lat else 0.0
+        rate = self.generated / self.generate_seconds * 60 if self.generate_seconds else 0.0
+        return [
+            f"анкеты: строк {self.rows}, отклонено {self.rejected}, импортировано {self.imported}, "
+            f"не тронуто (заполнили сами) {self.kept}; {self.rows / self.import_seconds if self.import_seconds else 0:.0f} строк/с",
+            f"программы: нужно {pending}, готово {self.generated} (из кэша {cache.get('hits', 0)}), "
+            f"ошибок {self.failed}, пропущено {self.skipped}; {rate:.1f} программ/мин, "
+            f"p50 {p50:.1f}s, p95 {p95:.1f}s, токенов {int(METRICS.snapshot('llm.').get('llm.completion_tokens', 0))}",
+        ]
+
+
+def _import(rows: List[Tuple[str, Profile]], source: str, folder: str, batch: int, overwrite: bool,
+            report: _Report) -> Dict[str, Dict[str, Any]]:
+    docs: Dict[str, Dict[str, Any]] = {}
+    started = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        chunk = dict(rows[i:i + batch])  # при повторе user_id в файле побеждает последняя строка
+        applied: List[str] = []
+
+        def update(user_id: str, doc: Dict[str, Any]) -> bool:
+            if _apply_profile(doc, chunk[user_id], source, overwrite):
+                applied.append(user_id)
+                return True
+            return False
+
+        docs.update(update_users_bulk(list(chunk), update, folder))
+        report.imported += len(applied)
+        report.kept += len(chunk) - len(applied)
+        METRICS.inc("onboarding.imported", len(applied))
+        logger.info("imported %d/%d", min(i + batch, len(rows)), len(rows))
+    report.import_seconds = time.perf_counter() - started
+    return docs
+
+
+async def _generate_one(user_id: str, doc: Dict[str, Any], token: Optional[str], folder: str, report: _Report) -> None:
+    from app.agent import FitnessAgent
+
+    t0 = time.perf_counter()
+    agent = FitnessAgent(token=token, user_id=user_id, user_data=json.loads(json.dumps(doc)))
+    plan = await agent.get_program("")
+    async with UserSession(user_id, folder) as session:
+        data = session.data
+        if not needs_program(data) or data.get("physical_data") != doc.get("physical_data"):
+            # участник успел открыть бота или анкету поменяли — эта программа уже не нужна
+            report.skipped += 1
+            return
+        data["history"] = (data.get("history") or []) + [(PROGRAM_REQUEST_MARK, "🤖 " + plan)]
+        data["last_program"] = plan
+        data["last_reply"] = plan
+    report.generated += 1
+    report.latencies.append(time.perf_counter() - t0)
+    METRICS.inc("onboarding.programs")
+
+
+async def _generate(users: List[Tuple[str, Dict[str, Any]]], token: Optional[str], folder: str,
+                    concurrency: int, report: _Report) -> None:
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in users:
+        queue.put_nowait(item)
+    started = time.perf_counter()
+    stop = asyncio.Event()
+
+    async def worker() -> None:
+        while not stop.is_set():
+            try:
+                user_id, doc = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await _generate_one(user_id, doc, token, folder, report)
+            except UpstreamUnavailable:
+                # DeepSeek недоступен — остальных не мучаем, повторный запуск продолжит
+                logger.error("LLM upstream unavailable, stopping; run again to resume")
+                stop.set()
+            except Exception:
+                report.failed += 1
+                logger.exception("Program for %s failed", user_id)
+            done = report.generated + report.failed + report.skipped
+            if done and done % 10 == 0:
+                elapsed = time.perf_counter() - started
+                logger.info("programs %d/%d (%.1f/min)", done, len(users), report.generated / elapsed * 60)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        report.generate_seconds = time.perf_counter() - started
+
+
+async def run(args: argparse.Namespace) -> _Report:
+    from app.response_cache import PROGRAM_CACHE
+
+    path = Path(args.file)
+    report = _Report()
+    valid: List[Tuple[str, Profile]] = []
+    rejects = Path(args.rejects).open("w", encoding="utf-8") if args.rejects else None
+    try:
+        for lineno, row in read_rows(path):
+            report.rows += 1
+            user_id, profile, errors = parse_member(row) if "_error" not in row else (None, {}, [row["_error"]])
+            if errors:
+                report.rejected += 1
+                logger.warning("line %d rejected: %s", lineno, "; ".join(errors))
+                if rejects is not None:
+                    rejects.write(json.dumps({"line": lineno, "row": row, "errors": errors}, ensure_ascii=False) + "\n")
+                continue
+            valid.append((user_id, profile))
+    finally:
+        if rejects is not None:
+            rejects.close()
+
+    docs = await asyncio.to_thread(_import, valid, path.name, args.folder, args.batch, args.overwrite, report)
+    pending = [(u, d) for u, d in docs.items() if needs_program(d)]
+    if pending and not args.no_programs:
+        await init_state_store()
+        try:
+            await _generate(pending, os.getenv("DEEPSEEK_API_KEY"), args.folder, args.concurrency, report)
+        finally:
+            await close_state_store()
+    for line in report.lines(len(pending), PROGRAM_CACHE.stats()):
+        print(line)
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="CSV с заголовком или JSONL")
+    parser.add_argument("--folder", default="data/users", help="папка JSON-файлов (если Postgres не настроен)")
+    parser.add_argument("--batch", type=int, default=200, help="участников в одной транзакции импорта")
+    parser.add_argument("--concurrency", type=int, default=4, help="одновременных генераций программ")
+    parser.add_argument("--overwrite", action="store_true", help="перезаписать анкеты, заполненные в боте")
+    parser.add_argument("--no-programs", action="store_true", help="только импорт анкет")
+    parser.add_argument("--rejects", help="JSONL для отклонённых строк")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+
+    async def _main() -> None:
+        try:
+            await run(args)
+        finally:
+            await close_storage()
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Экспорт программы в PDF (кнопка «📄 PDF»).
+
+Текст программы — уже отформатированный для Telegram (app.textproc) — разбирается в модель
+app.program_model: дни становятся заголовками, упражнения — пунктами с жирным названием,
+прочие «- …»/«• …» — пунктами списка, *жирный* — жирным.
+
+Рендер идёт в пуле процессов (PDF_WORKERS): reportlab — чистый Python и держал бы цикл
+событий и GIL. Шрифты (PDF_FONT_PATH / PDF_FONT_BOLD_PATH — нужен TTF с кириллицей) и стили
+загружаются один раз на процесс-воркер, в инициализаторе пула. Готовые байты кэшируются
+по sha256 текста (LRU до PDF_CACHE_MAX_BYTES): повторный экспорт той же программы не рендерит
+заново, а одновременные запросы одного текста ждут один рендер.
+
+reportlab — необязательная зависимость: без неё PDF_AVAILABLE=False и бот отвечает, что
+экспорт недоступен. Замер: python -m benchmarks.pdf_export_bench.
+"""
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.metrics import METRICS
+from app.program_model import Exercise, iter_lines, parse as parse_program
+
+try:
+    import reportlab  # noqa: F401
+    PDF_AVAILABLE = True
+except ImportError:  # pragma: no cover - reportlab не установлен
+    PDF_AVAILABLE = False
+
+logger = logging.getLogger("app.pdf_export")
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(2, os.cpu_count() or 1))))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+PDF_FONT_BOLD_PATH = os.getenv("PDF_FONT_BOLD_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+# меняется вместе с вёрсткой — старые PDF из кэша не отдаются
+RENDER_VERSION = 2
+
+# «День N» / «День N — …», как у bold_day_headers в app.textproc, с * вокруг или без
+_DAY_RE = re.compile(r"^\**\s*(День\s+\d+(?:\s*—\s*.+?)?)\s*\**$")
+_ITEM_RE = re.compile(r"^(?:[-•]|\d+[.)])\s+")
+_BOLD_RE = re.compile(r"\*([^*\n]+)\*")
+
+# --- воркер (свой процесс) ---
+
+_STYLES: Optional[Dict[str, Any]] = None
+
+
+def _init_worker() -> None:
+    """Инициализатор процесса пула: регистрирует шрифты и собирает стили один раз."""
+    global _STYLES
+    if _STYLES is not None:
+        return
+    from reportlab.lib import colors
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    font, bold = "Helvetica", "Helvetica-Bold"
+    try:
+        pdfmetrics.registerFont(TTFont("ProgramSans", PDF_FONT_PATH))
+        pdfmetrics.registerFont(TTFont("ProgramSans-Bold", PDF_FONT_BOLD_PATH))
+        pdfmetrics.registerFontFamily("ProgramSans", normal="ProgramSans", bold="ProgramSans-Bold")
+        font, bold = "ProgramSans", "ProgramSans-Bold"
+    except Exception:
+        # без TTF кириллица не отрисуется — видно в логах воркера
+        logger.exception("PDF font %s not loaded", PDF_FONT_PATH)
+
+    body = ParagraphStyle("body", fontName=font, fontSize=10.5, leading=14, spaceAfter=3)
+    _STYLES = {
+        "title": ParagraphStyle("title", parent=body, fontName=bold, fontSize=16, leading=20, spaceAfter=10),
+        "day": ParagraphStyle(
+            "day", parent=body, fontName=bold, fontSize=13, leading=17, spaceBefore=10, spaceAfter=5,
+            textColor=colors.HexColor("#1f4e79"),
+        ),
+        "item": ParagraphStyle("item", parent=body, leftIndent=14, bulletIndent=4),
+        "body": body,
+    }
+
+
+def _markup(text: str) -> str:
+    """Экранирование для Paragraph и *жирный* → <b>."""
+    text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return _BOLD_RE.sub(r"<b>\1</b>", text)
+
+
+def _flowables(text: str, title: str) -> List[Any]:
+    from reportlab.platypus import KeepTogether, Paragraph, Spacer
+
+    styles = _STYLES
+    program = parse_program(text)
+    out: List[Any] = [Paragraph(_markup(title), styles["title"])]
+    day: List[Any] = []  # заголовок дня держим на странице вместе с первыми пунктами
+
+    def flush() -> None:
+        if day:
+            out.append(KeepTogether(day[:3]))
+            out.extend(day[3:])
+            day.clear()
+
+    for kind, line in iter_lines(program):
+        if kind == "day":
+            flush()
+            day.append(Paragraph(_markup(line), styles["day"]))
+            continue
+        if isinstance(line, Exercise):
+            # упражнение: название жирным, подходы×повторения и остальное как есть
+            p = Paragraph(
+                f"<b>{_markup(line.name)}</b> {line.sets}×{_markup(line.reps)}{_markup(line.tail)}",
+                styles["item"], bulletText="•",
+            )
+            (day or out).append(p)
+            continue
+        stripped = line.strip()
+        if not stripped:
+            (day or out).append(Spacer(1, 4))
+            continue
+        m = _DAY_RE.match(stripped) if not program.structured else None
+        if m:
+            # текст не разобрался в модель — заголовки дней ищем построчно, как раньше
+            flush()
+            day.append(Paragraph(_markup(m.group(1)), styles["day"]))
+            continue
+        item = _ITEM_RE.match(stripped)
+        if item:
+            p = Paragraph(_markup(stripped[item.end():]), styles["item"], bulletText="•")
+        else:
+            p = Paragraph(_markup(stripped), styles["body"])
+        (day or out).append(p)
+    flush()
+    return out
+
+
+def render_pdf(text: str, title: str = "Программа тренировок") -> bytes:
+    """PDF из текста программы (синхронно; в боте — через PdfExporter в пуле процессов)."""
+    import io
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.platypus import SimpleDocTemplate
+
+    _init_worker()
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buf, pagesize=A4, leftMargin=18 * mm, rightMargin=18 * mm, topMargin=16 * mm, bottomMargin=16 * mm,
+        title=title, author="GymAiMentor",
+    )
+    doc.build(_flowables(text, title))
+    return buf.getvalue()
+
+
+# --- сторона бота ---
+
+
+def content_key(text: str, title: str) -> str:
+    return hashlib.sha256(f"{RENDER_VERSION}\0{title}\0{text}".encode("utf-8")).hexdigest()
+
+
+class PdfExporter:
+    """Пул процессов для render_pdf + LRU-кэш готовых PDF по хэшу текста (в пределах процесса бота)."""
+
+    def __init__(self, workers: int = PDF_WORKERS, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.workers = max(1, workers)
+        self.max_bytes = max_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._cache_bytes = 0
+        self._inflight: Dict[str, "asyncio.Future[bytes]"] = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: не копируем в воркер потоки и соединения процесса бота
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+            )
+        return self._pool
+
+    def _remember(self, key: str, pdf: bytes) -> None:
+        if len(pdf) > self.max_bytes:
+            return
+        self._cache[key] = pdf
+        self._cache_bytes += len(pdf)
+        while self._cache_bytes > self.max_bytes:
+            _, old = self._cache.popitem(last=False)
+            self._cache_bytes -= len(old)
+            METRICS.inc("pdf.cache_evictions")
+
+    async def render(self, text: str, title: str = "Программа тренировок") -> bytes:
+        key = content_key(text, title)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            METRICS.inc("pdf.cache_hits")
+            return cached
+        pending = self._inflight.get(key)
+        if pending is not None:
+            METRICS.inc("pdf.cache_hits")
+            return await asyncio.shield(pending)
+
+        METRICS.inc("pdf.cache_misses")
+        loop = asyncio.get_running_loop()
+        future: "asyncio.Future[bytes]" = loop.create_future()
+        self._inflight[key] = future
+        started = time.perf_counter()
+        try:
+            pdf = await loop.run_in_executor(self._executor(), render_pdf, text, title)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ошибку получат ожидающие; без предупреждения «never retrieved»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        METRICS.inc("pdf.renders")
+        METRICS.inc("pdf.render_seconds", time.perf_counter() - started)
+        self._remember(key, pdf)
+        future.set_result(pdf)
+        return pdf
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+        self._cache.clear()
+        self._cache_bytes = 0
+
+
+PDF_EXPORTER = PdfExporter()
+
+
+async def close_pdf_exporter() -> None:
+    await PDF_EXPORTER.close()
@@ -0,0 +1,230 @@
+"""
+JSON-режим генерации программы (PROGRAM_JSON_MODE=1, по умолчанию выключен).
+
+Модель получает схему (JSON_FORMAT_PROMPT) и response_format={"type": "json_object"}
+(DeepSeek/OpenAI-совместимый API) и отвечает объектом:
+
+    {"intro": "…", "days": [{"title": "День 1", "focus": "Ноги",
+      "exercises": [{"name": "Присед", "sets": 4, "reps": "8–10", "rest": "90 сек", "notes": ""}],
+      "notes": "…"}], "nutrition": "КБЖУ: 1900/140/60/200", "notes": ["…"]}
+
+Текст для Telegram собирается из объекта детерминированно (render) — в формате, который
+понимает app.program_model, — и не проходит через чистку app.textproc (LaTeX, RPE/RIR, HTML…).
+JsonProgramStream проверяет дни по мере стриминга: готовый день сразу идёт в превью,
+а первый неверный день обрывает поток (ProgramJsonError). Тогда, как и при неверном JSON
+в конце, агент повторяет запрос обычным текстом (app.agent, метрика program_json.fallback).
+Сравнение с текстовым путём на записанных ответах — benchmarks.program_json_bench.
+"""
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+PROGRAM_JSON_MODE: bool = os.getenv("PROGRAM_JSON_MODE", "0").strip().lower() in ("1", "true", "yes", "on")
+RESPONSE_FORMAT = {"type": "json_object"}
+MAX_DAYS = 7
+MAX_EXERCISES = 12
+
+JSON_FORMAT_PROMPT = """
+Формат ответа — строго один JSON-объект, без Markdown и текста вокруг. Схема:
+{
+  "intro": "одна-две строки перед планом (можно пустую строку)",
+  "days": [
+    {
+      "title": "День 1",
+      "focus": "Ноги и ягодицы",
+      "exercises": [
+        {"name": "Приседания со штангой", "sets": 4, "reps": "8–10", "rest": "90 сек", "notes": ""}
+      ],
+      "notes": ""
+    }
+  ],
+  "nutrition": "КБЖУ: 1900/140/60/200",
+  "notes": ["короткий совет"]
+}
+Правила: sets — целое число 1–10; reps — число или диапазон («8–10», «12», «30 сек»); rest — отдых
+(«90 сек», «2 мин») или пустая строка; все строки — обычный текст без *, #, HTML, LaTeX,
+RPE/RIR и «до отказа». Дней — столько, сколько тренировок в неделю по анкете (не больше 7).
+"""
+
+_REPS_RE = re.compile(r"^\d+(?:\s*[–-]\s*\d+)?(?:\s*(?:сек|с|мин|раз|шагов|м))?(?:\s+на\s+\S+(?:\s+\S+)?)?$")
+# *, _, ` и [ ломают Telegram Markdown; # и переводы строк — разметку дней
+_PLAIN = str.maketrans({"*": "", "_": " ", "`": "", "[": "(", "]": ")", "#": "", "\n": " ", "\r": " "})
+# translate на кириллице медленный — зовём его, только если есть что менять
+_SPECIAL_RE = re.compile(r"[*_`\[\]#\n\r]")
+
+
+class ProgramJsonError(ValueError):
+    """Ответ не соответствует схеме — нужен обычный текстовый путь."""
+
+
+def _text(value: Any, field: str, limit: int, required: bool = False) -> str:
+    if value is None:
+        value = ""
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise ProgramJsonError(f"{field}: ожидалась строка")
+    out = str(value)
+    if _SPECIAL_RE.search(out):
+        out = out.translate(_PLAIN)
+    out = " ".join(out.split())
+    if required and not out:
+        raise ProgramJsonError(f"{field}: пусто")
+    if len(out) > limit:
+        raise ProgramJsonError(f"{field}: длиннее {limit}")
+    return out
+
+
+def validate_day(obj: Any, number: int) -> Dict[str, Any]:
+    """Нормализованный день или ProgramJsonError."""
+    if not isinstance(obj, dict):
+        raise ProgramJsonError(f"days[{number}]: ожидался объект")
+    exercises = obj.get("exercises")
+    if not isinstance(exercises, list) or not exercises or len(exercises) > MAX_EXERCISES:
+        raise ProgramJsonError(f"days[{number}].exercises: 1–{MAX_EXERCISES} упражнений")
+    out_ex = []
+    for i, ex in enumerate(exercises):
+        where = f"days[{number}].exercises[{i}]"
+        if not isinstance(ex, dict):
+            raise ProgramJsonError(f"{where}: ожидался объект")
+        sets = ex.get("sets")
+        if isinstance(sets, str) and sets.strip().isdigit():
+            sets = int(sets)
+        if not isinstance(sets, int) or isinstance(sets, bool) or not 1 <= sets <= 10:
+            raise ProgramJsonError(f"{where}.sets: целое 1–10")
+        reps = _text(ex.get("reps"), f"{where}.reps", 24, required=True).replace("-", "–").replace(" – ", "–")
+        if not _REPS_RE.match(reps):
+            raise ProgramJsonError(f"{where}.reps: {reps!r}")
+        out_ex.append({
+            "name": _text(ex.get("name"), f"{where}.name", 120, required=True),
+            "sets": sets,
+            "reps": reps,
+            "rest": _text(ex.get("rest"), f"{where}.rest", 40),
+            "notes": _text(ex.get("notes"), f"{where}.notes", 200),
+        })
+    return {
+        # «День N» нумеруем сами (title модели не берём): дни должны идти по порядку для program_model и PDF
+        "title": f"День {number + 1}",
+        "focus": _text(obj.get("focus"), f"days[{number}].focus", 80),
+        "exercises": out_ex,
+        "notes": _text(obj.get("notes"), f"days[{number}].notes", 300),
+    }
+
+
+def validate(obj: Any) -> Dict[str, Any]:
+    """Весь ответ: нормализованный объект или ProgramJsonError."""
+    if not isinstance(obj, dict):
+        raise ProgramJsonError("ожидался объект")
+    days = obj.get("days")
+    if not isinstance(days, list) or not days or len(days) > MAX_DAYS:
+        raise ProgramJsonError(f"days: 1–{MAX_DAYS} дней")
+    notes = obj.get("notes") or []
+    if isinstance(notes, str):
+        notes = [notes]
+    if not isinstance(notes, list) or len(notes) > 10:
+        raise ProgramJsonError("notes: ожидался список")
+    return {
+        "intro": _text(obj.get("intro"), "intro", 400),
+        "days": [validate_day(d, i) for i, d in enumerate(days)],
+        "nutrition": _text(obj.get("nutrition"), "nutrition", 200),
+        "notes": [n for n in (_text(x, "notes[]", 300) for x in notes) if n],
+    }
+
+
+def parse_program_json(raw: str) -> Dict[str, Any]:
+    """json.loads + validate; любая ошибка — ProgramJsonError."""
+    try:
+        obj = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        raise ProgramJsonError(f"невалидный JSON: {e}") from e
+    return validate(obj)
+
+
+def render_day(day: Dict[str, Any]) -> str:
+    lines = [f"*{day['title']} — {day['focus']}*" if day["focus"] else f"*{day['title']}*"]
+    for ex in day["exercises"]:
+        line = f"- {ex['name']} {ex['sets']}×{ex['reps']}"
+        if ex["rest"]:
+            line += f", отдых {ex['rest']}"
+        if ex["notes"]:
+            line += f" — {ex['notes']}"
+        lines.append(line)
+    if day["notes"]:
+        lines.append(day["notes"])
+    return "\n".join(lines)
+
+
+def render(program: Dict[str, Any]) -> str:
+    """Telegram Markdown из проверенного объекта: вступление, дни через пустую строку, КБЖУ, советы."""
+    blocks = [program["intro"]] if program.get("intro") else []
+    blocks += [render_day(d) for d in program["days"]]
+    tail = ([program["nutrition"]] if program.get("nutrition") else []) + [f"- {n}" for n in program.get("notes") or []]
+    if tail:
+        blocks.append("\n".join(tail))
+    return "\n\n".join(blocks)
+
+
+class JsonProgramStream:
+    """
+    Превью JSON-ответа при стриминге. feed() получает весь накопленный текст, досканирует только
+    новый хвост (учитывая строки и экранирование) и возвращает Markdown готовых дней массива
+    "days" — или "" пока ни одного. Неверный день — ProgramJsonError сразу, не дожидаясь конца.
+    """
+
+    def __init__(self):
+        self.days: List[Dict[str, Any]] = []
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_string: Optional[str] = None   # последняя строка на верхнем уровне (кандидат в ключ)
+        self._days_depth: Optional[int] = None    # глубина массива "days" в стеке
+        self._day_start = -1
+        self._rendered = ""
+
+    def feed(self, raw: str) -> str:
+        if len(raw) < self._pos:
+            self.__init__()  # ответ начался заново (повтор запроса)
+        for i in range(self._pos, len(raw)):
+            ch = raw[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        self._last_string = raw[self._string_start + 1:i]
+                continue
+            if ch == '"':
+                self._in_string, self._string_start = True, i
+            elif ch in "{[":
+                if ch == "[" and len(self._stack) == 1 and self._last_string == "days":
+                    self._days_depth = 2
+                elif ch == "{" and self._days_depth is not None and len(self._stack) == self._days_depth:
+                    self._day_start = i
+                self._stack.append(ch)
+            elif ch in "}]":
+                if not self._stack:
+                    raise ProgramJsonError("лишняя закрывающая скобка")
+                self._stack.pop()
+                if ch == "}" and self._days_depth is not None and len(self._stack) == self._days_depth and self._day_start >= 0:
+                    self._add_day(raw[self._day_start:i + 1])
+                    self._day_start = -1
+                elif ch == "]" and self._days_depth is not None and len(self._stack) == self._days_depth - 1:
+                    self._days_depth = None
+        self._pos = len(raw)
+        return self._rendered
+
+    def _add_day(self, chunk: str) -> None:
+        try:
+            obj = json.loads(chunk)
+        except ValueError as e:
+            raise ProgramJsonError(f"days[{len(self.days)}]: {e}") from e
+        day = validate_day(obj, len(self.days))
+        if len(self.days) >= MAX_DAYS:
+            raise ProgramJsonError(f"days: больше {MAX_DAYS}")
+        self.days.append(day)
+        part = render_day(day)
+        self._rendered = f"{self._rendered}\n\n{part}" if self._rendered else part
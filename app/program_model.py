@@ -0,0 +1,192 @@
+"""
+Структура программы: вступление → дни → упражнения (подходы×повторения).
+
+Разбирается из уже отформатированного текста (app.textproc.clean_program / clean_answer:
+заголовки дней — «*День N — …*», упражнения — «- Название 4×8–10, отдых 90 сек»). Текст
+из модели (str(program)) совпадает с исходным символ в символ: строка, которую не удалось
+разложить без потерь, хранится как есть, а если не сошёлся весь текст — Program остаётся
+«сырой» (raw) и ведёт себя как обычный текст. Сверка на образцах и случайных текстах —
+benchmarks.program_model_bench.
+
+parse() запоминает последние разобранные тексты: бот (разбивка на сообщения) и PDF-экспорт
+получают один и тот же объект, текст по «День N» заново не сканируется.
+
+Хранилище по-прежнему держит текст: компактная JSON-запись модели на реальных программах
+почти не меньше текста (замер в том же бенчмарке), а текст читают история, кэш и экспорт.
+"""
+import re
+from functools import lru_cache
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+
+# заголовок дня после bold_day_headers: *День N* / *День N — фокус*
+_DAY_RE = re.compile(r"^\*(День\s+\d+(?:\s*—\s*.+)?)\*$")
+_EXERCISE_RE = re.compile(
+    r"^(?P<lead>(?:[-•]|\d+[.)])\s)?(?P<name>\S.*?)\s(?P<sets>\d{1,2})×(?P<reps>\d+(?:[–-]\d+)?)(?P<tail>(?:[,;.:(\s].*)?)$"
+)
+PARSE_CACHE_SIZE = 256
+
+
+class Exercise(NamedTuple):
+    """«- Жим лёжа 4×8–10, отдых 2 мин» → lead="- ", name, sets=4, reps="8–10", tail=", отдых 2 мин"."""
+    lead: str
+    name: str
+    sets: int
+    reps: str
+    tail: str
+
+    def __str__(self) -> str:
+        return f"{self.lead}{self.name} {self.sets}×{self.reps}{self.tail}"
+
+
+Line = Union[Exercise, str]
+
+
+class Day:
+    """Заголовок дня (без *) и строки до следующего дня: упражнения и прочий текст."""
+
+    __slots__ = ("title", "lines")
+
+    def __init__(self, title: str, lines: Tuple[Line, ...]):
+        self.title = title
+        self.lines = lines
+
+    @property
+    def exercises(self) -> List[Exercise]:
+        return [line for line in self.lines if isinstance(line, Exercise)]
+
+    def text(self) -> str:
+        return "\n".join([f"*{self.title}*"] + [str(line) for line in self.lines])
+
+
+class Program:
+    """Разобранная программа; raw — текст, который разобрать без потерь не удалось."""
+
+    __slots__ = ("intro", "days", "raw", "_blocks", "_text")
+
+    def __init__(self, intro: Tuple[Line, ...] = (), days: Tuple[Day, ...] = (), raw: Optional[str] = None):
+        self.intro = intro
+        self.days = days
+        self.raw = raw
+        # текст собирается один раз: модель неизменяема, а chunks()/str() зовут на каждую отправку
+        self._blocks: Optional[Tuple[str, ...]] = None
+        self._text: Optional[str] = raw
+
+    @property
+    def structured(self) -> bool:
+        return self.raw is None
+
+    def blocks(self) -> Tuple[str, ...]:
+        """Вступление и дни отдельными кусками текста; "\\n".join(blocks()) == str(self)."""
+        if self._blocks is None:
+            if self.raw is not None:
+                self._blocks = (self.raw,)
+            else:
+                intro = ("\n".join(str(line) for line in self.intro),) if self.intro else ()
+                self._blocks = intro + tuple(day.text() for day in self.days)
+        return self._blocks
+
+    def __str__(self) -> str:
+        if self._text is None:
+            self._text = "\n".join(self.blocks())
+        return self._text
+
+    def chunks(self, max_len: int = 3500) -> List[str]:
+        """Части не длиннее max_len для Telegram: целыми днями, длинный день — по абзацам (split_text)."""
+        text = str(self)
+        if len(text) <= max_len:
+            return [text]
+        if self.raw is not None:
+            return split_text(text, max_len)
+        parts: List[str] = []
+        current = ""
+        for block in self.blocks():
+            block = block.strip()
+            if not block:
+                continue
+            if current and len(current) + 2 + len(block) <= max_len:
+                current = f"{current}\n\n{block}"
+                continue
+            if current:
+                parts.append(current)
+            if len(block) <= max_len:
+                current = block
+            else:
+                *head, current = split_text(block, max_len)
+                parts.extend(head)
+        if current:
+            parts.append(current)
+        return parts
+
+
+def split_text(text: str, max_len: int = 3500) -> List[str]:
+    """Разбивка произвольного текста (без структуры, например превью стриминга): по «День», абзацам, жёстко."""
+    if len(text) <= max_len:
+        return [text]
+
+    parts: List[str] = []
+    remaining = text
+    while len(remaining) > max_len:
+        # пробуем найти границу дня
+        cut = remaining.rfind("\n\nДень ", 0, max_len)
+        if cut < 0:
+            cut = remaining.rfind("\n\n**День", 0, max_len)
+        if cut < 0:
+            cut = remaining.rfind("\n\n", 0, max_len)
+        if cut < 0:
+            cut = max_len
+        parts.append(remaining[:cut].strip())
+        remaining = remaining[cut:].strip()
+    if remaining:
+        parts.append(remaining)
+    return parts
+
+
+def _parse_line(line: str) -> Line:
+    if "×" in line:
+        m = _EXERCISE_RE.match(line)
+        if m:
+            ex = Exercise(m.group("lead") or "", m.group("name"), int(m.group("sets")), m.group("reps"), m.group("tail"))
+            if str(ex) == line:
+                return ex
+    return line
+
+
+def _parse(text: str) -> Program:
+    intro: List[Line] = []
+    days: List[Day] = []
+    title: Optional[str] = None
+    lines: List[Line] = []
+    for line in text.split("\n"):
+        m = _DAY_RE.match(line) if line.startswith("*День") else None
+        if m:
+            if title is not None:
+                days.append(Day(title, tuple(lines)))
+            title, lines = m.group(1), []
+            continue
+        (lines if title is not None else intro).append(_parse_line(line))
+    if title is not None:
+        days.append(Day(title, tuple(lines)))
+    if not days:
+        return Program(raw=text)
+    program = Program(tuple(intro), tuple(days))
+    return program if str(program) == text else Program(raw=text)
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(text: str) -> Program:
+    """Program из отформатированного текста; без дней или с расхождением — Program(raw=text)."""
+    return _parse(text or "")
+
+
+def iter_lines(program: Program) -> Iterator[Tuple[str, Line]]:
+    """("day", заголовок) / ("line", строка или Exercise) по порядку — для экспортёров."""
+    if program.raw is not None:
+        for line in program.raw.split("\n"):
+            yield "line", line
+        return
+    for line in program.intro:
+        yield "line", line
+    for day in program.days:
+        yield "day", day.title
+        for line in day.lines:
+            yield "line", line
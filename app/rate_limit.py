@@ -0,0 +1,241 @@
+"""
+Ограничение частоты действий (token bucket) вместо прежней паузы между генерациями.
+
+Три уровня, каждое действие должно пройти все свои корзины:
+- пользователь — все действия одного пользователя вместе (RATE_LIMIT_USER);
+- действие пользователя — program / qa / export по отдельности (RATE_LIMIT_PROGRAM и т.д.);
+- глобально — действие по всем пользователям (RATE_LIMIT_GLOBAL_PROGRAM / _QA): бережёт
+  бюджет API во время всплесков.
+
+Лимит задаётся строкой "N/S" — N действий за S секунд с равномерным пополнением (1/30 —
+одна генерация в 30 секунд, как прежняя пауза); "off" — без лимита.
+
+Проверка — O(1) в памяти процесса, без обращения к хранилищу. Состояние корзин
+пишется в app.state_store фоном (раз в RATE_LIMIT_FLUSH_INTERVAL сек) с TTL = время до
+полного пополнения: после рестарта корзина читается один раз при первом обращении,
+а полностью пополненная корзина не отличается от отсутствующей — такие вытесняются и
+из памяти, и из хранилища (по TTL). При нескольких воркерах у каждого свои корзины в
+памяти: лимит соблюдается приблизительно (до воркеры × лимит в худшем случае).
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from app.metrics import METRICS
+from app.state_store import StateStore, get_state_store
+
+logger = logging.getLogger("app.rate_limit")
+
+ACTION_PROGRAM = "program"
+ACTION_QA = "qa"
+ACTION_EXPORT = "export"
+
+RATE_LIMIT_FLUSH_INTERVAL: float = float(os.getenv("RATE_LIMIT_FLUSH_INTERVAL", "5"))
+
+
+class Limit(NamedTuple):
+    capacity: float     # размер всплеска
+    per: float          # за сколько секунд пополняется capacity
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.per
+
+
+def parse_limit(spec: Optional[str]) -> Optional[Limit]:
+    """'N/S' → Limit(N, S); пусто, 'off' или '0' → без лимита."""
+    spec = (spec or "").strip().lower()
+    if spec in ("", "off", "0", "none"):
+        return None
+    count, _, seconds = spec.partition("/")
+    limit = Limit(float(count), float(seconds or 1))
+    if limit.capacity <= 0 or limit.per <= 0:
+        return None
+    return limit
+
+
+RATE_LIMIT_USER = parse_limit(os.getenv("RATE_LIMIT_USER", "20/60"))
+ACTION_LIMITS: Dict[str, Optional[Limit]] = {
+    ACTION_PROGRAM: parse_limit(os.getenv("RATE_LIMIT_PROGRAM", "1/30")),
+    ACTION_QA: parse_limit(os.getenv("RATE_LIMIT_QA", "10/60")),
+    ACTION_EXPORT: parse_limit(os.getenv("RATE_LIMIT_EXPORT", "5/60")),
+}
+GLOBAL_LIMITS: Dict[str, Optional[Limit]] = {
+    ACTION_PROGRAM: parse_limit(os.getenv("RATE_LIMIT_GLOBAL_PROGRAM", "300/60")),
+    ACTION_QA: parse_limit(os.getenv("RATE_LIMIT_GLOBAL_QA", "600/60")),
+    ACTION_EXPORT: None,
+}
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    retry_after: float = 0.0        # сек до следующей попытки, если не разрешено
+    scope: Optional[str] = None     # какая корзина отказала: user / action / global
+
+
+class _Bucket:
+    __slots__ = ("limit", "tokens", "updated")
+
+    def __init__(self, limit: Limit, tokens: float, updated: float):
+        self.limit = limit
+        self.tokens = tokens
+        self.updated = updated
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.limit.capacity, self.tokens + (now - self.updated) * self.limit.rate)
+            self.updated = now
+
+    def wait_time(self, cost: float) -> float:
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.limit.rate
+
+    def full_at(self) -> float:
+        return self.updated + (self.limit.capacity - self.tokens) / self.limit.rate
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        store: Optional[StateStore] = None,
+        user_limit: Optional[Limit] = RATE_LIMIT_USER,
+        action_limits: Optional[Dict[str, Optional[Limit]]] = None,
+        global_limits: Optional[Dict[str, Optional[Limit]]] = None,
+    ):
+        self._store = store
+        self.user_limit = user_limit
+        self.action_limits = ACTION_LIMITS if action_limits is None else action_limits
+        self.global_limits = GLOBAL_LIMITS if global_limits is None else global_limits
+        # порядок — по последнему обращению: вытеснение идёт с головы
+        self._buckets: "OrderedDict[str, _Bucket]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def store(self) -> StateStore:
+        return self._store if self._store is not None else get_state_store()
+
+    def _rules(self, user_id: str, action: str) -> List[Tuple[str, str, Limit]]:
+        rules = []
+        if self.user_limit is not None:
+            rules.append(("user", f"rl:user:{user_id}", self.user_limit))
+        limit = self.action_limits.get(action)
+        if limit is not None:
+            rules.append(("action", f"rl:{action}:{user_id}", limit))
+        limit = self.global_limits.get(action)
+        if limit is not None:
+            rules.append(("global", f"rl:global:{action}", limit))
+        return rules
+
+    async def _bucket(self, key: str, limit: Limit, now: float) -> _Bucket:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            if bucket.limit != limit:
+                bucket.limit = limit
+            return bucket
+        # холодный путь: корзины нет в памяти — одно чтение из хранилища (после рестарта)
+        tokens, updated = limit.capacity, now
+        try:
+            rec = await self.store.get(key)
+        except Exception as e:
+            logger.warning("Rate limit state read failed for %s: %s", key, e)
+            rec = None
+        if rec is not None and isinstance(rec.value, dict):
+            tokens, updated = float(rec.value.get("t", tokens)), float(rec.value.get("u", updated))
+        bucket = self._buckets.get(key)  # пока читали, корзину мог создать параллельный вызов
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(limit, tokens, updated)
+        return bucket
+
+    async def acquire(self, user_id: str, action: str, cost: float = 1.0) -> Decision:
+        """Списывает cost из всех корзин действия, если хватает во всех; иначе ничего не списывает."""
+        now = time.time()
+        buckets = []
+        for scope, key, limit in self._rules(user_id, action):
+            bucket = await self._bucket(key, limit, now)
+            bucket.refill(now)
+            buckets.append((scope, key, bucket))
+        denied = max(((b.wait_time(cost), scope) for scope, _, b in buckets), default=(0.0, None))
+        if denied[0] > 0:
+            METRICS.inc(f"rate_limit.{action}.denied.{denied[1]}")
+            self._evict(now)
+            return Decision(False, denied[0], denied[1])
+        for _, key, bucket in buckets:
+            bucket.tokens -= cost
+            self._dirty.add(key)
+        METRICS.inc(f"rate_limit.{action}.allowed")
+        self._evict(now)
+        return Decision(True)
+
+    def refund(self, user_id: str, action: str, cost: float = 1.0) -> None:
+        """Возвращает списанное (действие не состоялось: ошибка генерации, переполненная очередь)."""
+        for _, key, limit in self._rules(user_id, action):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.tokens = min(limit.capacity, bucket.tokens + cost)
+                self._dirty.add(key)
+
+    def _evict(self, now: float, budget: int = 4) -> None:
+        """Вытесняет с головы (давно не использованные) полностью пополненные корзины; O(1) амортизированно."""
+        for _ in range(budget):
+            if not self._buckets:
+                return
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket.full_at() > now:
+                return
+            del self._buckets[key]
+            METRICS.inc("rate_limit.evicted")
+            # в хранилище запись с тем же TTL истечёт сама; незаписанное изменение уже не нужно
+            self._dirty.discard(key)
+
+    async def flush(self) -> int:
+        """Пишет изменённые корзины в хранилище (TTL — до полного пополнения)."""
+        keys, self._dirty = self._dirty, set()
+        written = 0
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            ttl = max(1.0, bucket.full_at() - time.time())
+            try:
+                await self.store.set(key, {"t": round(bucket.tokens, 4), "u": bucket.updated}, ttl=ttl)
+                written += 1
+            except Exception as e:
+                logger.warning("Rate limit state write failed for %s: %s", key, e)
+                self._dirty.add(key)
+        return written
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(RATE_LIMIT_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+
+RATE_LIMITER = RateLimiter()
+
+
+async def init_rate_limiter() -> None:
+    """Запускает фоновую запись корзин (после init_state_store)."""
+    RATE_LIMITER.start()
+
+
+async def close_rate_limiter() -> None:
+    """Дописывает корзины в хранилище (до close_state_store)."""
+    await RATE_LIMITER.stop()
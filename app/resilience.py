@@ -0,0 +1,216 @@
+"""
+Устойчивость вызовов LLM: повторы с экспоненциальной задержкой и jitter, общий дедлайн
+на запрос, классификация ошибок и circuit breaker.
+
+- повторяются только временные ошибки: 429, 5xx, таймауты, обрыв соединения;
+  400/401/403/404 и т.п. — сразу наверх;
+- задержка — «full jitter»: случайная в [0, min(LLM_BACKOFF_MAX, base·2^(n-1))],
+  Retry-After от сервера имеет приоритет; ждём через asyncio.sleep, поток не занят;
+- все попытки вместе укладываются в дедлайн (LLM_DEADLINE): если до него не успеть
+  даже подождать — повтора нет;
+- когда среди последних LLM_BREAKER_WINDOW вызовов временных ошибок не меньше
+  LLM_BREAKER_THRESHOLD и их доля >= LLM_BREAKER_RATIO, breaker открывается: следующие
+  LLM_BREAKER_RESET секунд вызовы сразу получают UpstreamUnavailable (пользователю —
+  понятное сообщение, в процессе не копятся ждущие запросы), затем один пробный запрос.
+
+    text = await call_with_retries(lambda: client.chat.completions.create(...), breaker=DEEPSEEK_BREAKER)
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+import httpx
+import openai
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.resilience")
+
+LLM_RETRIES: int = int(os.getenv("DEEPSEEK_RETRIES", "3"))                       # попыток на запрос (не повторов)
+LLM_BACKOFF_BASE: float = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX: float = float(os.getenv("LLM_BACKOFF_MAX", "10"))
+LLM_DEADLINE: float = float(os.getenv("LLM_DEADLINE", "180"))                    # сек на все попытки запроса
+LLM_STREAM_DEADLINE: float = float(os.getenv("LLM_STREAM_DEADLINE", "300"))      # стрим длинной программы идёт дольше
+LLM_BREAKER_THRESHOLD: int = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))   # минимум сбоев в окне
+LLM_BREAKER_RATIO: float = float(os.getenv("LLM_BREAKER_RATIO", "0.5"))      # доля сбоев в окне
+LLM_BREAKER_WINDOW: int = int(os.getenv("LLM_BREAKER_WINDOW", "20"))         # последних вызовов
+LLM_BREAKER_RESET: float = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+T = TypeVar("T")
+
+
+class UpstreamUnavailable(Exception):
+    """API недоступен: breaker открыт. Текст — для пользователя."""
+
+    def __init__(self, name: str, retry_in: float):
+        self.name = name
+        self.retry_in = retry_in
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_in:.0f}s)")
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Запрос со всеми повторами не уложился в дедлайн."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Временная ли ошибка (имеет смысл повторить и считать сбоем upstream)."""
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    if isinstance(exc, asyncio.TimeoutError) and not isinstance(exc, DeadlineExceeded):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code == 408 or exc.status_code >= 500
+    return False
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, exc: Optional[BaseException] = None) -> float:
+    """Задержка перед попыткой attempt+1 (attempt — номер неудачной, с 1)."""
+    hinted = _retry_after(exc) if exc is not None else None
+    if hinted is not None:
+        return min(hinted, LLM_BACKOFF_MAX)
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    closed → open, когда среди последних window исходов не меньше min_failures сбоев
+    и их доля >= ratio (окно, а не «N подряд»: при сотнях параллельных запросов успехи
+    и сбои перемешаны) → через reset_timeout half-open: один пробный вызов, успех
+    закрывает breaker, сбой снова открывает. Состояние — на процесс.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        min_failures: int = LLM_BREAKER_THRESHOLD,
+        ratio: float = LLM_BREAKER_RATIO,
+        window: int = LLM_BREAKER_WINDOW,
+        reset_timeout: float = LLM_BREAKER_RESET,
+    ):
+        self.name = name
+        self.min_failures = min_failures
+        self.ratio = ratio
+        self.reset_timeout = reset_timeout
+        self.outcomes: Deque[bool] = deque(maxlen=window)  # True — успех
+        self.opened_at: Optional[float] = None
+        self._probe = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self) -> bool:
+        """Пропускает вызов (True — это пробный вызов half-open) или бросает UpstreamUnavailable."""
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half-open" and not self._probe:
+            self._probe = True
+            return True
+        METRICS.inc(f"breaker.{self.name}.rejected")
+        retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        raise UpstreamUnavailable(self.name, retry_in)
+
+    def record_success(self, probe: bool = False) -> None:
+        if self.opened_at is not None:
+            if not probe:
+                return  # запрос, начатый до открытия; закрывает только пробный
+            logger.info("Circuit %s closed", self.name)
+            self.reset()
+            return
+        self.outcomes.append(True)
+
+    def record_failure(self, probe: bool = False) -> None:
+        if self.opened_at is not None:
+            if probe:
+                self._open()
+            return
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if failures >= self.min_failures and failures / len(self.outcomes) >= self.ratio:
+            self._open()
+
+    def release_probe(self) -> None:
+        """Пробный вызов кончился не сбоем upstream (например, 400 или отмена) — пустить следующий."""
+        self._probe = False
+
+    def reset(self) -> None:
+        self.outcomes.clear()
+        self.opened_at = None
+        self._probe = False
+
+    def _open(self) -> None:
+        if self.opened_at is None:
+            METRICS.inc(f"breaker.{self.name}.opened")
+        logger.warning("Circuit %s open for %.0fs (%d of last %d calls failed)",
+                       self.name, self.reset_timeout, self.outcomes.count(False), len(self.outcomes))
+        self.opened_at = time.monotonic()
+        self._probe = False
+        self.outcomes.clear()
+
+
+DEEPSEEK_BREAKER = CircuitBreaker("deepseek")
+
+
+async def call_with_retries(
+    fn: Callable[[], Awaitable[T]],
+    *,
+    breaker: Optional[CircuitBreaker] = DEEPSEEK_BREAKER,
+    attempts: int = LLM_RETRIES,
+    deadline: float = LLM_DEADLINE,
+    retry_if: Callable[[BaseException], bool] = is_retryable,
+) -> T:
+    """
+    Выполняет fn() (новая корутина на каждую попытку) с повторами временных ошибок,
+    общим дедлайном и breaker'ом. retry_if — дополнительное условие повтора (например,
+    «стрим ещё ничего не прислал»); сбой upstream для breaker'а всё равно определяет is_retryable.
+    """
+    until = time.monotonic() + deadline
+    attempt = 0
+    while True:
+        attempt += 1
+        probe = breaker.before_call() if breaker is not None else False
+        remaining = until - time.monotonic()
+        try:
+            result = await asyncio.wait_for(fn(), timeout=remaining)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as exc:
+            if breaker is not None:
+                if is_retryable(exc):
+                    breaker.record_failure(probe)
+                elif probe:
+                    breaker.release_probe()
+            if isinstance(exc, asyncio.TimeoutError) and time.monotonic() >= until:
+                METRICS.inc("llm.deadline_exceeded")
+                raise DeadlineExceeded(f"LLM request deadline of {deadline:.0f}s exceeded (timeout)") from exc
+            if attempt >= attempts or not retry_if(exc):
+                raise
+            delay = backoff_delay(attempt, exc)
+            if time.monotonic() + delay >= until:
+                METRICS.inc("llm.deadline_exceeded")
+                raise
+            METRICS.inc("llm.retries")
+            logger.warning("LLM call failed (%s: %s), retry %d/%d in %.1fs", type(exc).__name__, exc, attempt, attempts - 1, delay)
+            await asyncio.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success(probe)
+        return result
@@ -0,0 +1,160 @@
+"""
+Кэш сгенерированных программ: одинаковая анкета + одинаковые пожелания → тот же ответ без вызова LLM.
+
+Ключ — хэш нормализованного текста анкеты (FitnessAgent._format_physical_data, без имени
+и без рабочих весов из дневника подходов), пожеланий, травм и ограничений из карточки клиента
+(app.coach_summary.shared_part) и параметров модели (модель, температура, max_tokens, системный
+промпт). Остальное личное в запрос программы из кэша не попадает. Записи
+живут PROGRAM_CACHE_TTL секунд, всего не больше PROGRAM_CACHE_MAX_ENTRIES (LRU).
+
+PROGRAM_CACHE_BUCKETED=1 — ключ строится по анкете с округлёнными возрастом, ростом и весом
+(до PROGRAM_CACHE_AGE_STEP лет / PROGRAM_CACHE_SIZE_STEP см и кг): попаданий больше, но
+КБЖУ в ответе из кэша посчитано для первого пользователя из того же диапазона.
+
+Кэшируется сырой ответ модели: чистка, форматирование и обращение по имени делаются
+для каждого пользователя заново. Кэш локален для процесса.
+
+Метрики (app.metrics): program_cache.hits / misses / bypass / evictions,
+program_cache.saved_tokens, program_cache.hit_seconds / miss_seconds (суммарное время
+ответа — для средней задержки). Доля попаданий — ResponseCache.stats()["hit_ratio"].
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional
+
+from app.metrics import METRICS
+
+PROGRAM_CACHE_TTL: float = float(os.getenv("PROGRAM_CACHE_TTL", "86400"))
+PROGRAM_CACHE_MAX_ENTRIES: int = int(os.getenv("PROGRAM_CACHE_MAX_ENTRIES", "1000"))
+PROGRAM_CACHE_BUCKETED: bool = os.getenv("PROGRAM_CACHE_BUCKETED", "0").strip().lower() in ("1", "true", "yes", "on")
+PROGRAM_CACHE_AGE_STEP: int = int(os.getenv("PROGRAM_CACHE_AGE_STEP", "5"))
+PROGRAM_CACHE_SIZE_STEP: int = int(os.getenv("PROGRAM_CACHE_SIZE_STEP", "5"))
+
+_WS_RE = re.compile(r"\s+")
+
+
+def _to_number(v: Any) -> Optional[float]:
+    try:
+        return float(str(v).strip().replace(",", "."))
+    except (ValueError, TypeError):
+        return None
+
+
+def _bucket(v: Any, step: int) -> Any:
+    """Середина диапазона шириной step (33 при step=5 → 32.5); нечисловое значение — как есть."""
+    n = _to_number(v)
+    if n is None or step <= 0:
+        return v
+    lo = (n // step) * step
+    return f"{lo + step / 2:g}"
+
+
+def bucket_profile(phys: Dict[str, Any], age_step: int = PROGRAM_CACHE_AGE_STEP, size_step: int = PROGRAM_CACHE_SIZE_STEP) -> Dict[str, Any]:
+    """Копия анкеты с округлёнными возрастом, ростом, текущим и желаемым весом."""
+    out = dict(phys)
+    if "age" in out:
+        out["age"] = _bucket(out["age"], age_step)
+    for field in ("height", "weight", "goal"):
+        if field in out:
+            out[field] = _bucket(out[field], size_step)
+    return out
+
+
+def normalize_prompt(text: str) -> str:
+    return _WS_RE.sub(" ", (text or "").strip().lower())
+
+
+def make_key(profile: str, instruction: str, **params: Any) -> str:
+    payload = json.dumps(
+        {"profile": normalize_prompt(profile), "instruction": normalize_prompt(instruction), "params": params},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CachedResponse(NamedTuple):
+    text: str
+    tokens: int         # сколько токенов стоила генерация (usage или оценка)
+
+
+class _Entry:
+    __slots__ = ("response", "expires")
+
+    def __init__(self, response: CachedResponse, expires: float):
+        self.response = response
+        self.expires = expires
+
+
+class ResponseCache:
+    """LRU с TTL; потокобезопасен (агент может вызываться и вне цикла событий)."""
+
+    def __init__(self, max_entries: int = PROGRAM_CACHE_MAX_ENTRIES, ttl: float = PROGRAM_CACHE_TTL, prefix: str = "program_cache"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= now:
+                del self._entries[key]
+                METRICS.inc(f"{self.prefix}.expired")
+                entry = None
+            if entry is None:
+                METRICS.inc(f"{self.prefix}.misses")
+                return None
+            self._entries.move_to_end(key)
+        METRICS.inc(f"{self.prefix}.hits")
+        METRICS.inc(f"{self.prefix}.saved_tokens", entry.response.tokens)
+        return entry.response
+
+    def put(self, key: str, text: str, tokens: int) -> None:
+        if not self.enabled or not text:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = _Entry(CachedResponse(text, tokens), time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                METRICS.inc(f"{self.prefix}.evictions")
+
+    def bypass(self) -> None:
+        """Запрос намеренно мимо кэша (случайная вариация)."""
+        METRICS.inc(f"{self.prefix}.bypass")
+
+    def observe(self, hit: bool, seconds: float) -> None:
+        """Время ответа с попаданием/промахом — для средней задержки."""
+        METRICS.inc(f"{self.prefix}.{'hit' if hit else 'miss'}_seconds", seconds)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+        out = {k.split(".", 1)[1]: v for k, v in METRICS.snapshot(f"{self.prefix}.").items()}
+        hits, misses = out.get("hits", 0), out.get("misses", 0)
+        out["hit_ratio"] = hits / (hits + misses) if hits + misses else 0.0
+        if hits:
+            out["hit_avg_seconds"] = out.get("hit_seconds", 0) / hits
+        if misses:
+            out["miss_avg_seconds"] = out.get("miss_seconds", 0) / misses
+        out["entries"] = entries
+        return out
+
+
+PROGRAM_CACHE = ResponseCache()
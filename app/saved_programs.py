@@ -0,0 +1,245 @@
+"""
+Сохранённые программы («💾 Сохранить в файл» / «📑 История ответов»).
+
+Файлы лежат по папкам пользователей: {SAVED_PROGRAMS_DIR}/{user_id}/{ts}.txt, а список —
+в документе пользователя, поле programs: [{"file", "ts", "size", "title"}, ...] по возрастанию ts.
+Индекс читается вместе с документом (UserSession), поэтому страница истории — это срез
+из k записей и k открытых файлов, без обхода data/users и stat() каждого файла.
+
+Отправка (бот): страница уходит одним send_media_group, файлы читаются в потоках параллельно,
+а file_id, который Telegram вернул на первую отправку, запоминается в data["program_file_ids"] —
+повторно файл не читается и не загружается. «📦 Все архивом» — один ZIP в памяти (build_zip).
+
+Раньше файлы писались плоско: data/users/program_{user_id}_{ts}.txt. Перенос — этот модуль
+как скрипт (при остановленном боте; повторный запуск продолжает с места остановки):
+
+    python -m app.saved_programs --folder data/users
+"""
+import argparse
+import asyncio
+import io
+import logging
+import os
+import re
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.metrics import METRICS
+from app.storage import close_storage, update_users_bulk
+
+logger = logging.getLogger("app.saved_programs")
+
+SAVED_PROGRAMS_DIR = os.getenv("SAVED_PROGRAMS_DIR", "data/users/programs")
+# сколько файлов отправляем за одно нажатие «📑 История ответов» / «📑 Ещё ответы»
+# (не больше 10 — предел одного send_media_group)
+SAVED_PAGE_SIZE = min(int(os.getenv("SAVED_PAGE_SIZE", "5")), 10)
+# сколько последних программ попадает в ZIP «📦 Все архивом»
+SAVED_ZIP_MAX_FILES = int(os.getenv("SAVED_ZIP_MAX_FILES", "100"))
+TITLE_MAX_LEN = 60
+
+FIELD = "programs"
+FILE_IDS_FIELD = "program_file_ids"
+# старое имя файла в общей папке data/users
+_LEGACY_RE = re.compile(r"^program_(.+)_(\d+)\.txt$")
+
+Entry = Dict[str, Any]
+
+
+def user_dir(user_id: str, root: str = SAVED_PROGRAMS_DIR) -> Path:
+    return Path(root) / str(user_id)
+
+
+def entry_path(user_id: str, entry: Entry, root: str = SAVED_PROGRAMS_DIR) -> Path:
+    return user_dir(user_id, root) / entry["file"]
+
+
+def download_name(user_id: str, entry: Entry) -> str:
+    """Имя файла для Telegram — как раньше, program_{user_id}_{ts}.txt (с суффиксом _N, если их было несколько за секунду)."""
+    return f"program_{user_id}_{Path(entry['file']).stem}.txt"
+
+
+def make_title(text: str) -> str:
+    """Первая непустая строка без markdown-разметки, обрезанная до TITLE_MAX_LEN."""
+    for line in (text or "").splitlines():
+        title = line.strip().strip("*_#`").strip()
+        if title:
+            return title if len(title) <= TITLE_MAX_LEN else title[:TITLE_MAX_LEN - 1].rstrip() + "…"
+    return "Без названия"
+
+
+def _index(data: Dict[str, Any]) -> List[Entry]:
+    items = data.get(FIELD)
+    if not isinstance(items, list):
+        items = data[FIELD] = []
+    return items
+
+
+def save_program(user_id: str, text: str, data: Dict[str, Any], root: str = SAVED_PROGRAMS_DIR) -> Tuple[Path, Entry]:
+    """
+    Пишет text в файл пользователя и дописывает запись в data["programs"] (документ сохранит
+    вызывающий — обычно UserSession). Два сохранения в одну секунду получают разные имена.
+    """
+    ts = int(time.time())
+    folder = user_dir(user_id, root)
+    folder.mkdir(parents=True, exist_ok=True)
+    name, n = f"{ts}.txt", 1
+    while (folder / name).exists():
+        n += 1
+        name = f"{ts}_{n}.txt"
+    raw = text.encode("utf-8")
+    (folder / name).write_bytes(raw)
+    entry = {"file": name, "ts": ts, "size": len(raw), "title": make_title(text)}
+    _index(data).append(entry)
+    METRICS.inc("saved_programs.saved")
+    return folder / name, entry
+
+
+def count(data: Dict[str, Any]) -> int:
+    items = data.get(FIELD)
+    return len(items) if isinstance(items, list) else 0
+
+
+def page(data: Dict[str, Any], number: int = 0, size: int = SAVED_PAGE_SIZE) -> List[Entry]:
+    """Страница number (0 — самые свежие) из size записей, от новых к старым."""
+    items = data.get(FIELD)
+    if not isinstance(items, list) or number < 0:
+        return []
+    end = len(items) - number * size
+    if end <= 0:
+        return []
+    return items[max(end - size, 0):end][::-1]
+
+
+def latest(data: Dict[str, Any], limit: int) -> List[Entry]:
+    """limit последних записей, от новых к старым."""
+    items = data.get(FIELD)
+    return items[-limit:][::-1] if isinstance(items, list) and limit > 0 else []
+
+
+def file_id(data: Dict[str, Any], entry: Entry) -> Optional[str]:
+    ids = data.get(FILE_IDS_FIELD)
+    return ids.get(entry["file"]) if isinstance(ids, dict) else None
+
+
+def remember_file_id(data: Dict[str, Any], entry: Entry, value: Optional[str]) -> None:
+    """file_id из ответа Telegram на отправку файла; дальше этот файл шлём по нему, без загрузки."""
+    if not value:
+        return
+    ids = data.get(FILE_IDS_FIELD)
+    if not isinstance(ids, dict):
+        ids = data[FILE_IDS_FIELD] = {}
+    ids[entry["file"]] = value
+
+
+def forget_file_ids(data: Dict[str, Any], entries: List[Entry]) -> None:
+    """Telegram отверг file_id (например, сменился токен бота) — следующая отправка загрузит файлы заново."""
+    ids = data.get(FILE_IDS_FIELD)
+    if isinstance(ids, dict):
+        for entry in entries:
+            ids.pop(entry["file"], None)
+
+
+def _read(path: Path) -> Optional[bytes]:
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        logger.warning("saved program %s is missing", path)
+        return None
+
+
+async def read_entries(user_id: str, entries: List[Entry], root: str = SAVED_PROGRAMS_DIR) -> List[Optional[bytes]]:
+    """Содержимое файлов записей (None — файла нет), чтение параллельно в потоках, не в цикле событий."""
+    return list(await asyncio.gather(
+        *(asyncio.to_thread(_read, entry_path(user_id, e, root)) for e in entries)
+    ))
+
+
+def build_zip(user_id: str, entries: List[Entry], root: str = SAVED_PROGRAMS_DIR) -> Tuple[bytes, int]:
+    """ZIP в памяти из файлов записей (имена — download_name); (байты, сколько файлов вошло). Звать через to_thread."""
+    buf = io.BytesIO()
+    added = 0
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for entry in entries:
+            raw = _read(entry_path(user_id, entry, root))
+            if raw is None:
+                continue
+            info = zipfile.ZipInfo(download_name(user_id, entry), date_time=time.localtime(entry["ts"])[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, raw)
+            added += 1
+    return buf.getvalue(), added
+
+
+# --- перенос плоских файлов data/users/program_{user_id}_{ts}.txt ---
+
+
+def scan_legacy(folder: str) -> Dict[str, List[Tuple[int, Path]]]:
+    """Один проход os.scandir по папке: старые файлы программ, сгруппированные по user_id."""
+    found: Dict[str, List[Tuple[int, Path]]] = {}
+    with os.scandir(folder) as it:
+        for item in it:
+            m = _LEGACY_RE.match(item.name)
+            if m and item.is_file():
+                found.setdefault(m.group(1), []).append((int(m.group(2)), Path(item.path)))
+    return found
+
+
+def _legacy_entry(ts: int, path: Path) -> Entry:
+    text = path.read_text(encoding="utf-8", errors="replace")
+    return {"file": f"{ts}.txt", "ts": ts, "size": path.stat().st_size, "title": make_title(text)}
+
+
+def migrate(folder: str, root: str = SAVED_PROGRAMS_DIR, batch: int = 200) -> Tuple[int, int]:
+    """
+    Переносит старые файлы в папки пользователей. Сначала запись в индекс (пачкой, через
+    update_users_bulk), потом os.replace файла: после сбоя между ними повторный запуск увидит
+    файл на старом месте, запись не задублирует и просто переместит его.
+    Возвращает (пользователей, файлов).
+    """
+    legacy = scan_legacy(folder)
+    users = sorted(legacy)
+    moved = 0
+    for i in range(0, len(users), batch):
+        chunk = users[i:i + batch]
+
+        def update(user_id: str, doc: Dict[str, Any]) -> bool:
+            items = _index(doc)
+            known = {e.get("file") for e in items if isinstance(e, dict)}
+            new = [_legacy_entry(ts, p) for ts, p in sorted(legacy[user_id]) if f"{ts}.txt" not in known]
+            if not new:
+                return False
+            # индекс держим по возрастанию ts: программы, сохранённые уже новым кодом, могут быть новее
+            doc[FIELD] = sorted(items + new, key=lambda e: e.get("ts") or 0)
+            return True
+
+        update_users_bulk(chunk, update, folder)
+        for user_id in chunk:
+            dest = user_dir(user_id, root)
+            dest.mkdir(parents=True, exist_ok=True)
+            for ts, path in legacy[user_id]:
+                os.replace(path, dest / f"{ts}.txt")
+                moved += 1
+        METRICS.inc("saved_programs.migrated", sum(len(legacy[u]) for u in chunk))
+        logger.info("migrated %d/%d users", min(i + batch, len(users)), len(users))
+    return len(users), moved
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default="data/users", help="папка со старыми program_*.txt (и JSON пользователей)")
+    parser.add_argument("--root", default=SAVED_PROGRAMS_DIR, help="куда раскладывать файлы по пользователям")
+    parser.add_argument("--batch", type=int, default=200, help="пользователей в одной транзакции")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    try:
+        users, files = migrate(args.folder, args.root, args.batch)
+    finally:
+        asyncio.run(close_storage())
+    logger.info("done: %d files of %d users", files, users)
+
+
+if __name__ == "__main__":
+    main()
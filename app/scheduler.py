@@ -0,0 +1,203 @@
+"""
+Общий планировщик запросов к LLM: предел одновременных генераций, очереди с приоритетами,
+честная очередь между пользователями и сброс нагрузки.
+
+- одновременно выполняется не больше LLM_MAX_IN_FLIGHT запросов (на процесс: при
+  WEBHOOK_WORKERS > 1 общий предел — воркеры × LLM_MAX_IN_FLIGHT);
+- остальные ждут в очереди своего вида: "qa" (короткие ответы) и "program" (длинные
+  генерации). Виды чередуются взвешенно (LLM_QA_WEIGHT : LLM_PROGRAM_WEIGHT), так что
+  вопросы не стоят за длинными программами, а программы не голодают;
+- внутри вида — по кругу между пользователями: один пользователь с пачкой запросов
+  не задерживает остальных;
+- ждущий получает номер в очереди (on_position) и 0, когда его запрос пошёл;
+- при LLM_MAX_QUEUE ждущих новые запросы сразу получают Overloaded, как и те, кто
+  прождал дольше LLM_QUEUE_TIMEOUT.
+
+    async with LLM_SCHEDULER.slot(user_id, "program", on_position=show_position):
+        plan = await agent.get_program(...)
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.scheduler")
+
+LLM_MAX_IN_FLIGHT: int = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_MAX_QUEUE: int = int(os.getenv("LLM_MAX_QUEUE", "50"))
+LLM_QUEUE_TIMEOUT: float = float(os.getenv("LLM_QUEUE_TIMEOUT", "120"))
+LLM_QA_WEIGHT: int = int(os.getenv("LLM_QA_WEIGHT", "3"))
+LLM_PROGRAM_WEIGHT: int = int(os.getenv("LLM_PROGRAM_WEIGHT", "1"))
+
+KIND_QA = "qa"
+KIND_PROGRAM = "program"
+
+PositionCallback = Callable[[int], Awaitable[None]]
+
+
+class Overloaded(Exception):
+    """Очередь переполнена или ожидание слишком долгое — запрос отклонён."""
+
+    def __init__(self, reason: str):
+        self.reason = reason
+        super().__init__(f"LLM scheduler overloaded: {reason}")
+
+
+class _Waiter:
+    __slots__ = ("user_id", "kind", "future", "on_position", "position")
+
+    def __init__(self, user_id: str, kind: str, future: "asyncio.Future[None]", on_position: Optional[PositionCallback]):
+        self.user_id = user_id
+        self.kind = kind
+        self.future = future
+        self.on_position = on_position
+        self.position = 0
+
+
+Queues = Dict[str, "OrderedDict[str, Deque[_Waiter]]"]
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        weights: Optional[Dict[str, int]] = None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.weights = weights or {KIND_QA: LLM_QA_WEIGHT, KIND_PROGRAM: LLM_PROGRAM_WEIGHT}
+        # порядок обхода: больший вес — раньше
+        self._kinds = sorted(self.weights, key=lambda k: -self.weights[k])
+        self._queues: Queues = {kind: OrderedDict() for kind in self._kinds}
+        self._credits = dict(self.weights)
+        self.in_flight = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(dq) for q in self._queues.values() for dq in q.values())
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, kind: str, on_position: Optional[PositionCallback] = None) -> AsyncIterator[None]:
+        await self.acquire(user_id, kind, on_position)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: str, kind: str, on_position: Optional[PositionCallback] = None) -> None:
+        if kind not in self._queues:
+            raise ValueError(f"Unknown LLM request kind: {kind}")
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            METRICS.inc(f"scheduler.{kind}.admitted")
+            return
+        if self.queued >= self.max_queue:
+            METRICS.inc(f"scheduler.{kind}.shed")
+            raise Overloaded("queue is full")
+
+        waiter = _Waiter(user_id, kind, asyncio.get_running_loop().create_future(), on_position)
+        self._queues[kind].setdefault(user_id, deque()).append(waiter)
+        METRICS.inc(f"scheduler.{kind}.queued")
+        self._notify_positions()
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except BaseException as exc:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # слот выдали в момент отмены/таймаута — возвращаем его
+                self.release()
+            else:
+                self._remove(waiter)
+            if isinstance(exc, asyncio.TimeoutError):
+                METRICS.inc(f"scheduler.{kind}.timeouts")
+                raise Overloaded("queue wait timeout") from None
+            raise
+        METRICS.inc(f"scheduler.{kind}.admitted")
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        started = False
+        while self.in_flight < self.max_in_flight:
+            waiter = self._pick(self._queues, self._credits)
+            if waiter is None:
+                break
+            self.in_flight += 1
+            waiter.future.set_result(None)
+            self._callback(waiter, 0)
+            started = True
+        if started:
+            self._notify_positions()
+
+    def _pick(self, queues: Queues, credits: Dict[str, int]) -> Optional[_Waiter]:
+        """Следующий ждущий (взвешенный круг по видам, внутри вида — по пользователям). Меняет queues/credits."""
+        for _ in range(2):
+            for kind in self._kinds:
+                users = queues[kind]
+                if users and credits[kind] > 0:
+                    credits[kind] -= 1
+                    user_id, dq = next(iter(users.items()))
+                    waiter = dq.popleft()
+                    if dq:
+                        users.move_to_end(user_id)
+                    else:
+                        del users[user_id]
+                    return waiter
+            # круг закончился (или у непустых видов нет кредитов) — новый круг
+            credits.update(self.weights)
+        return None
+
+    def _service_order(self) -> List[_Waiter]:
+        """Порядок, в котором ждущие получат слот при текущей очереди (для номеров в очереди)."""
+        queues: Queues = {kind: OrderedDict((u, deque(dq)) for u, dq in q.items()) for kind, q in self._queues.items()}
+        credits = dict(self._credits)
+        order = []
+        while True:
+            waiter = self._pick(queues, credits)
+            if waiter is None:
+                return order
+            order.append(waiter)
+
+    def _remove(self, waiter: _Waiter) -> None:
+        users = self._queues[waiter.kind]
+        dq = users.get(waiter.user_id)
+        if dq is not None and waiter in dq:
+            dq.remove(waiter)
+            if not dq:
+                del users[waiter.user_id]
+            self._notify_positions()
+
+    def _notify_positions(self) -> None:
+        for position, waiter in enumerate(self._service_order(), 1):
+            if waiter.position != position:
+                self._callback(waiter, position)
+
+    def _callback(self, waiter: _Waiter, position: int) -> None:
+        waiter.position = position
+        if waiter.on_position is None:
+            return
+        task = asyncio.get_running_loop().create_task(self._report(waiter))
+        self._tasks.add(task)
+        task.add_done_callback(self._callback_done)
+
+    @staticmethod
+    async def _report(waiter: _Waiter) -> None:
+        # колбэк выполняется позже — отдаём актуальный номер, а не тот, что был при постановке задачи
+        await waiter.on_position(waiter.position)
+
+    def _callback_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Queue position callback failed: %s", task.exception())
+
+
+LLM_SCHEDULER = LLMScheduler()
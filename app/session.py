@@ -0,0 +1,131 @@
+import json
+import logging
+from contextlib import AsyncExitStack
+from typing import Any, Dict, Optional
+
+from app.state_store import STATE_LOCK_TTL, STATE_TTL, StateStore, get_state_store
+from app.storage import load_user_data_async, save_user_data_async
+
+logger = logging.getLogger("app.session")
+
+
+def _fingerprint(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class UserSession:
+    """
+    Unit-of-work на один апдейт Telegram: документ пользователя читается один раз,
+    бот/агент/хелперы app.storage меняют его в памяти, в конце — не больше одной записи
+    (и ни одной, если ничего не поменялось).
+
+    Вместе с документом читается runtime-состояние (session.runtime: режим/шаг анкеты)
+    из app.state_store. На время апдейта берётся аренда
+    пользователя, поэтому несколько воркеров обрабатывают его сообщения по одному; order
+    (update_id апдейта) задаёт, кто из ожидающих аренду получит её первым.
+
+        async with UserSession(user_id) as session:
+            session.data["last_reply"] = "..."
+            session.state = {"mode": "qa", "step": 0, "data": {}}
+    """
+
+    def __init__(
+        self, user_id: str, folder: str = "data/users", store: Optional[StateStore] = None, order: Optional[int] = None
+    ):
+        self.user_id = user_id
+        self.folder = folder
+        self.order = order
+        self.data: Dict[str, Any] = {}
+        self.runtime: Dict[str, Any] = {}
+        self.reads = 0
+        self.writes = 0
+        self._snapshot: Optional[str] = None
+        self._store = store
+        self._runtime_version: Optional[int] = None
+        self._runtime_snapshot: Optional[str] = None
+        self._stack: Optional[AsyncExitStack] = None
+
+    @property
+    def _runtime_key(self) -> str:
+        return f"user:{self.user_id}"
+
+    @property
+    def state(self) -> Optional[Dict[str, Any]]:
+        """Текущий шаг диалога ({"mode", "step", "data"}) или None."""
+        return self.runtime.get("state")
+
+    @state.setter
+    def state(self, value: Optional[Dict[str, Any]]) -> None:
+        if value is None:
+            self.runtime.pop("state", None)
+        else:
+            self.runtime["state"] = value
+
+    async def __aenter__(self) -> "UserSession":
+        if self._store is None:
+            self._store = get_state_store()
+        stack = AsyncExitStack()
+        await stack.enter_async_context(self._store.lock(f"lock:{self._runtime_key}", ttl=STATE_LOCK_TTL, order=self.order))
+        self._stack = stack
+        try:
+            await self.load()
+        except BaseException:
+            await stack.aclose()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            # изменения, сделанные до исключения, тоже сохраняем — как раньше делали хелперы
+            await self.flush()
+        finally:
+            if self._stack is not None:
+                await self._stack.aclose()
+                self._stack = None
+        logger.debug(
+            "session user_id=%s: storage reads=%d writes=%d",
+            self.user_id, self.reads, self.writes,
+        )
+
+    async def load(self) -> Dict[str, Any]:
+        self.data = await load_user_data_async(self.user_id, self.folder)
+        self.reads += 1
+        self._snapshot = _fingerprint(self.data)
+        if self._store is not None:
+            rec = await self._store.get(self._runtime_key)
+            self.runtime = rec.value if rec is not None and isinstance(rec.value, dict) else {}
+            self._runtime_version = rec.version if rec is not None else None
+            self._runtime_snapshot = _fingerprint(self.runtime)
+        return self.data
+
+    @property
+    def dirty(self) -> bool:
+        return self._snapshot is None or _fingerprint(self.data) != self._snapshot
+
+    async def flush(self) -> bool:
+        """Пишет документ, только если он изменился с момента чтения/прошлой записи."""
+        await self._flush_runtime()
+        current = _fingerprint(self.data)
+        if current == self._snapshot:
+            return False
+        # снимок прочитанного документа — база для частичной записи (только изменённые поля)
+        base = json.loads(self._snapshot) if self._snapshot is not None else None
+        await save_user_data_async(self.user_id, self.data, self.folder, base=base)
+        self.writes += 1
+        # при сохранении история могла уйти в архив (compact_history) — снимок берём после
+        self._snapshot = _fingerprint(self.data)
+        return True
+
+    async def _flush_runtime(self) -> None:
+        if self._store is None:
+            return
+        current = _fingerprint(self.runtime)
+        if current == self._runtime_snapshot:
+            return
+        version = await self._store.compare_and_set(self._runtime_key, self.runtime, self._runtime_version, STATE_TTL)
+        if version is None:
+            # состояние успел поменять другой воркер (наша аренда истекла) — его версия новее
+            logger.warning("Runtime state of user %s changed concurrently, update dropped", self.user_id)
+            return
+        self._runtime_version = version
+        self._runtime_snapshot = current
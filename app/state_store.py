@@ -0,0 +1,492 @@
+"""
+Хранилище runtime-состояния бота (шаг анкеты, корзины app.rate_limit) вне процесса.
+
+Значения — JSON-совместимые объекты с версией и TTL. compare_and_set пишет, только если
+версия не изменилась с момента чтения, — на этом построена аренда (lock) по пользователю:
+несколько воркеров с одним токеном бота обрабатывают апдейты одного пользователя по одному
+и в порядке update_id (очередь ожидающих аренду).
+
+Реализации: MemoryStateStore (один процесс), SQLiteStateStore (несколько процессов на одной
+машине), PostgresStateStore (несколько реплик). Выбор — переменная STATE_STORE.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, Tuple
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None  # type: ignore
+
+try:
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:
+    AsyncConnectionPool = None  # type: ignore
+
+from app.metrics import METRICS
+
+logger = logging.getLogger("app.state_store")
+
+# auto — Postgres, если задан DATABASE_URL, иначе память; memory | sqlite | postgres — явно
+STATE_STORE: str = os.getenv("STATE_STORE", "auto").strip().lower()
+STATE_STORE_SQLITE_PATH: str = os.getenv("STATE_STORE_SQLITE_PATH", "data/state.sqlite3")
+# незавершённая анкета/режим живут неделю с последнего сообщения
+STATE_TTL: float = float(os.getenv("STATE_TTL", str(7 * 24 * 3600)))
+# аренда пользователя на время обработки апдейта; пока апдейт обрабатывается, она продлевается
+# каждые ttl/3, так что TTL — лишь срок, за который освобождается аренда упавшего процесса
+STATE_LOCK_TTL: float = float(os.getenv("STATE_LOCK_TTL", "60"))
+# сколько ждать чужую аренду (генерация программы — до LLM_QUEUE_TIMEOUT + LLM_STREAM_DEADLINE);
+# не дождались — LockTimeout, бот отвечает «занят», без аренды апдейт не обрабатывается
+STATE_LOCK_WAIT: float = float(os.getenv("STATE_LOCK_WAIT", "60"))
+
+# удалённые/истёкшие ключи какое-то время храним как «надгробия», чтобы версия
+# не начиналась заново (иначе compare_and_set по старой версии мог бы совпасть)
+_PURGE_AFTER = 24 * 3600
+_PURGE_EVERY = 1000
+
+
+class LockTimeout(Exception):
+    """Аренду не удалось получить за отведённое время: ключ держит другой обработчик."""
+
+
+class Record(NamedTuple):
+    value: Any
+    version: int
+
+
+def _dump(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+class StateStore:
+    """Общий интерфейс. Версия ключа растёт с каждой записью и не сбрасывается при удалении."""
+
+    async def get(self, key: str) -> Optional[Record]:
+        raise NotImplementedError
+
+    async def compare_and_set(
+        self, key: str, value: Any, expected: Optional[int], ttl: Optional[float] = None
+    ) -> Optional[int]:
+        """
+        Пишет value, если текущая версия == expected (None — ключа нет или он истёк).
+        Возвращает новую версию или None при конфликте.
+        """
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> int:
+        raise NotImplementedError
+
+    async def delete(self, key: str, expected: Optional[int] = None) -> bool:
+        """Удаляет ключ (при expected — только если версия совпадает)."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    async def _waiters(self, key: str) -> Tuple[Optional[Record], Dict[str, list]]:
+        """Очередь ожидающих аренду: {owner: [order, expires_at]} без истёкших записей."""
+        rec = await self.get(key)
+        now = time.time()
+        waiters = rec.value if rec is not None and isinstance(rec.value, dict) else {}
+        return rec, {owner: entry for owner, entry in waiters.items() if entry[1] > now}
+
+    async def _update_waiters(self, key: str, owner: str, entry: Optional[list]) -> None:
+        """Встать в очередь (entry) или выйти из неё (None): CAS-цикл, как у любого ключа."""
+        while True:
+            rec, waiters = await self._waiters(key)
+            if entry is None:
+                waiters.pop(owner, None)
+            else:
+                waiters[owner] = entry
+            expected = rec.version if rec is not None else None
+            if not waiters:
+                if rec is None or await self.delete(key, expected=expected):
+                    return
+                continue
+            ttl = max(e[1] for e in waiters.values()) - time.time()
+            if await self.compare_and_set(key, waiters, expected, ttl) is not None:
+                return
+
+    @asynccontextmanager
+    async def lock(
+        self, key: str, ttl: float = STATE_LOCK_TTL, timeout: Optional[float] = None, order: Optional[int] = None
+    ) -> AsyncIterator[None]:
+        """
+        Аренда ключа: берётся на ttl секунд и продлевается, пока блок не завершится.
+        Ждёт чужую аренду не дольше timeout (по умолчанию STATE_LOCK_WAIT), иначе — LockTimeout.
+
+        Ожидающие встают в очередь (ключ "<key>:queue") и получают аренду по возрастанию order
+        (для апдейтов Telegram — update_id), а не кто первым опросит хранилище после освобождения.
+        Без order — после всех ожидающих с order (фоновые задачи не обгоняют сообщения).
+        """
+        owner = uuid.uuid4().hex
+        wait = STATE_LOCK_WAIT if timeout is None else timeout
+        deadline = time.monotonic() + wait
+        queue_key = f"{key}:queue"
+        rank = (order if order is not None else float("inf"), owner)
+        queued = False
+        delay = 0.02
+        try:
+            while True:
+                _, waiters = await self._waiters(queue_key)
+                ahead = any((entry[0], other) < rank for other, entry in waiters.items() if other != owner)
+                version = None if ahead else await self.compare_and_set(key, owner, None, ttl)
+                if version is not None:
+                    break
+                METRICS.inc("state_store.lock_waits")
+                if time.monotonic() >= deadline:
+                    METRICS.inc("state_store.lock_timeouts")
+                    raise LockTimeout(key)
+                if order is not None and not queued:
+                    # запись живёт чуть дольше нашего ожидания: упавший процесс не держит очередь
+                    await self._update_waiters(queue_key, owner, [order, time.time() + wait + 5])
+                    queued = True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        finally:
+            if queued:
+                await self._update_waiters(queue_key, owner, None)
+
+        held = [version]
+
+        async def renew() -> None:
+            while True:
+                await asyncio.sleep(ttl / 3)
+                try:
+                    renewed = await self.compare_and_set(key, owner, held[0], ttl)
+                except Exception as e:
+                    # сбой хранилища — попробуем на следующем шаге, запаса ещё 2/3 ttl
+                    logger.warning("Lock %s renewal failed: %s", key, e)
+                    continue
+                if renewed is None:
+                    # процесс стоял дольше ttl (или ключ удалили) — аренду уже мог взять другой
+                    METRICS.inc("state_store.lock_lost")
+                    logger.warning("Lock %s lost before release", key)
+                    return
+                held[0] = renewed
+
+        renewer = asyncio.get_running_loop().create_task(renew())
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            try:
+                await renewer
+            except asyncio.CancelledError:
+                pass
+            # если аренда истекла и ключ уже чужой — версия другая, чужую аренду не снимем
+            await self.delete(key, expected=held[0])
+
+
+class MemoryStateStore(StateStore):
+    """Состояние в памяти процесса: как раньше, но с TTL и версиями."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Optional[str], int, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _write(self, key: str, value: Optional[str], version: int, ttl: Optional[float], now: float) -> int:
+        self._data[key] = (value, version, now + ttl if ttl is not None else None)
+        self._writes += 1
+        if self._writes % _PURGE_EVERY == 0:
+            dead = [k for k, (_, _, exp) in self._data.items() if exp is not None and exp <= now - _PURGE_AFTER]
+            for k in dead:
+                del self._data[k]
+        return version
+
+    def _current(self, key: str, now: float) -> Tuple[Optional[Record], int]:
+        """(живая запись или None, последняя версия ключа)."""
+        rec = self._data.get(key)
+        if rec is None:
+            return None, 0
+        value, version, expires = rec
+        if value is None or (expires is not None and expires <= now):
+            return None, version
+        return Record(json.loads(value), version), version
+
+    async def get(self, key: str) -> Optional[Record]:
+        with self._lock:
+            return self._current(key, time.time())[0]
+
+    async def compare_and_set(self, key, value, expected, ttl=None):
+        now = time.time()
+        with self._lock:
+            live, last = self._current(key, now)
+            if (live.version if live else None) != expected:
+                METRICS.inc("state_store.cas_conflicts")
+                return None
+            return self._write(key, _dump(value), last + 1, ttl, now)
+
+    async def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            return self._write(key, _dump(value), self._current(key, now)[1] + 1, ttl, now)
+
+    async def delete(self, key, expected=None):
+        now = time.time()
+        with self._lock:
+            live, last = self._current(key, now)
+            if live is None or (expected is not None and live.version != expected):
+                return False
+            self._write(key, None, last + 1, 0, now)
+            return True
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Файл SQLite, общий для нескольких процессов на одной машине (dev-замена Postgres).
+    Каждая операция — транзакция BEGIN IMMEDIATE: чтение и запись под блокировкой файла.
+    """
+
+    _DDL = """
+    CREATE TABLE IF NOT EXISTS bot_state (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        version INTEGER NOT NULL,
+        expires_at REAL
+    )
+    """
+
+    def __init__(self, path: str = STATE_STORE_SQLITE_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(self._DDL)
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def _tx(self, fn, *args):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(time.time(), *args)
+                self._ops += 1
+                if self._ops % _PURGE_EVERY == 0:
+                    self._conn.execute(
+                        "DELETE FROM bot_state WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                        (time.time() - _PURGE_AFTER,),
+                    )
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def _current(self, now: float, key: str) -> Tuple[Optional[Record], int]:
+        row = self._conn.execute("SELECT value, version, expires_at FROM bot_state WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, 0
+        value, version, expires = row
+        if value is None or (expires is not None and expires <= now):
+            return None, version
+        return Record(json.loads(value), version), version
+
+    def _write(self, now: float, key: str, value: Optional[str], version: int, ttl: Optional[float]) -> int:
+        self._conn.execute(
+            "INSERT INTO bot_state (key, value, version, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, version = excluded.version, "
+            "expires_at = excluded.expires_at",
+            (key, value, version, now + ttl if ttl is not None else None),
+        )
+        return version
+
+    def _cas_sync(self, now, key, value, expected, ttl):
+        live, last = self._current(now, key)
+        if (live.version if live else None) != expected:
+            return None
+        return self._write(now, key, _dump(value), last + 1, ttl)
+
+    def _set_sync(self, now, key, value, ttl):
+        return self._write(now, key, _dump(value), self._current(now, key)[1] + 1, ttl)
+
+    def _delete_sync(self, now, key, expected):
+        live, last = self._current(now, key)
+        if live is None or (expected is not None and live.version != expected):
+            return False
+        self._write(now, key, None, last + 1, 0)
+        return True
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._tx, lambda now, k: self._current(now, k)[0], key)
+
+    async def compare_and_set(self, key, value, expected, ttl=None):
+        version = await asyncio.to_thread(self._tx, self._cas_sync, key, value, expected, ttl)
+        if version is None:
+            METRICS.inc("state_store.cas_conflicts")
+        return version
+
+    async def set(self, key, value, ttl=None):
+        return await asyncio.to_thread(self._tx, self._set_sync, key, value, ttl)
+
+    async def delete(self, key, expected=None):
+        return await asyncio.to_thread(self._tx, self._delete_sync, key, expected)
+
+    async def close(self):
+        await asyncio.to_thread(self._conn.close)
+
+
+_PG_DDL = """
+CREATE TABLE IF NOT EXISTS bot_state (
+    key TEXT PRIMARY KEY,
+    value JSONB,
+    version BIGINT NOT NULL,
+    expires_at TIMESTAMPTZ
+)
+"""
+
+_PG_LIVE = "(expires_at IS NULL OR expires_at > now())"
+_PG_EXPIRES = "now() + %(ttl)s::float8 * interval '1 second'"
+
+_PG_GET_SQL = f"SELECT value, version FROM bot_state WHERE key = %(k)s AND value IS NOT NULL AND {_PG_LIVE}"
+
+# ключа нет — вставляем; есть, но истёк/удалён — перезаписываем, продолжая его версию
+_PG_CAS_NEW_SQL = f"""
+INSERT INTO bot_state AS s (key, value, version, expires_at) VALUES (%(k)s, %(v)s::jsonb, 1, {_PG_EXPIRES})
+ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, version = s.version + 1, expires_at = EXCLUDED.expires_at
+ WHERE s.value IS NULL OR (s.expires_at IS NOT NULL AND s.expires_at <= now())
+RETURNING version
+"""
+
+_PG_CAS_SQL = f"""
+UPDATE bot_state SET value = %(v)s::jsonb, version = version + 1, expires_at = {_PG_EXPIRES}
+ WHERE key = %(k)s AND version = %(e)s AND value IS NOT NULL AND {_PG_LIVE}
+RETURNING version
+"""
+
+_PG_SET_SQL = f"""
+INSERT INTO bot_state AS s (key, value, version, expires_at) VALUES (%(k)s, %(v)s::jsonb, 1, {_PG_EXPIRES})
+ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, version = s.version + 1, expires_at = EXCLUDED.expires_at
+RETURNING version
+"""
+
+_PG_DELETE_SQL = f"""
+UPDATE bot_state SET value = NULL, version = version + 1, expires_at = now()
+ WHERE key = %(k)s AND value IS NOT NULL AND {_PG_LIVE} AND (%(e)s::bigint IS NULL OR version = %(e)s::bigint)
+RETURNING version
+"""
+
+_PG_PURGE_SQL = "DELETE FROM bot_state WHERE expires_at < now() - %s::float8 * interval '1 second'"
+
+
+class PostgresStateStore(StateStore):
+    """Таблица bot_state в Postgres: общее состояние для нескольких реплик бота."""
+
+    def __init__(self, url: str, min_size: int = 1, max_size: int = 4, timeout: float = 10.0):
+        self._url = url
+        self._pool = None
+        if AsyncConnectionPool is not None:
+            self._pool = AsyncConnectionPool(url, min_size=min_size, max_size=max_size, timeout=timeout, open=False)
+        self._ops = 0
+
+    async def open(self) -> None:
+        if self._pool is not None:
+            await self._pool.open(wait=True)
+        async with self._connection() as conn:
+            await conn.execute(_PG_DDL)
+            await conn.execute(_PG_PURGE_SQL, (_PURGE_AFTER,))
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator["psycopg.AsyncConnection"]:
+        if self._pool is not None:
+            async with self._pool.connection() as conn:
+                yield conn
+            return
+        async with await psycopg.AsyncConnection.connect(self._url, autocommit=True) as conn:
+            yield conn
+
+    async def _one(self, sql: str, params: Dict[str, Any]) -> Optional[tuple]:
+        async with self._connection() as conn:
+            cur = await conn.execute(sql, params)
+            row = await cur.fetchone()
+            self._ops += 1
+            if self._ops % _PURGE_EVERY == 0:
+                await conn.execute(_PG_PURGE_SQL, (_PURGE_AFTER,))
+        return row
+
+    async def get(self, key):
+        row = await self._one(_PG_GET_SQL, {"k": key})
+        if row is None:
+            return None
+        value = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        return Record(value, row[1])
+
+    async def compare_and_set(self, key, value, expected, ttl=None):
+        params = {"k": key, "v": _dump(value), "e": expected, "ttl": ttl}
+        row = await self._one(_PG_CAS_NEW_SQL if expected is None else _PG_CAS_SQL, params)
+        if row is None:
+            METRICS.inc("state_store.cas_conflicts")
+            return None
+        return row[0]
+
+    async def set(self, key, value, ttl=None):
+        row = await self._one(_PG_SET_SQL, {"k": key, "v": _dump(value), "ttl": ttl})
+        return row[0]
+
+    async def delete(self, key, expected=None):
+        return await self._one(_PG_DELETE_SQL, {"k": key, "e": expected}) is not None
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+
+_store: Optional[StateStore] = None
+
+
+def _database_url() -> Optional[str]:
+    return os.environ.get("NF_GYM_DB_POSTGRES_URI") or os.environ.get("DATABASE_URL")
+
+
+def resolve_state_store_kind(kind: str = STATE_STORE) -> str:
+    """memory | sqlite | postgres с учётом auto."""
+    if kind == "auto":
+        return "postgres" if (_database_url() and psycopg) else "memory"
+    return kind
+
+
+def create_state_store(kind: str = STATE_STORE) -> StateStore:
+    url = _database_url()
+    kind = resolve_state_store_kind(kind)
+    if kind == "postgres":
+        if not (url and psycopg):
+            raise RuntimeError("STATE_STORE=postgres требует DATABASE_URL и psycopg")
+        return PostgresStateStore(url)
+    if kind == "sqlite":
+        return SQLiteStateStore(STATE_STORE_SQLITE_PATH)
+    return MemoryStateStore()
+
+
+async def init_state_store() -> StateStore:
+    """Создаёт хранилище состояния процесса (вызывается при старте бота)."""
+    global _store
+    if _store is None:
+        store = create_state_store()
+        if isinstance(store, PostgresStateStore):
+            await store.open()
+        _store = store
+        logger.info("State store: %s", type(store).__name__)
+    return _store
+
+
+def get_state_store() -> StateStore:
+    """Текущее хранилище; без init_state_store — состояние в памяти процесса."""
+    global _store
+    if _store is None:
+        _store = MemoryStateStore()
+    return _store
+
+
+async def close_state_store() -> None:
+    global _store
+    if _store is not None:
+        store, _store = _store, None
+        await store.close()
@@ -1,21 +1,74 @@
+import asyncio
 import json
+import logging
 import os
 import copy
-import time
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
 
 try:
     import psycopg
 except ImportError:
     psycopg = None  # type: ignore
 
+try:
+    from psycopg_pool import AsyncConnectionPool, ConnectionPool
+except ImportError:
+    AsyncConnectionPool = None  # type: ignore
+    ConnectionPool = None  # type: ignore
+
+from app import storage_relational as rel
+from app.cache import MODE_OFF, MODE_WRITE_BEHIND, UserStateCache
+
+logger = logging.getLogger("app.storage")
+
 # Northflank injects NF_GYM_DB_POSTGRES_URI; fallback for DATABASE_URL (e.g. local .env)
 def _get_database_url() -> Optional[str]:
     return os.environ.get("NF_GYM_DB_POSTGRES_URI") or os.environ.get("DATABASE_URL")
 
 _USER_DATA_TABLE = "user_data"
 
+# Раскладка данных в Postgres: jsonb — один документ user_data(user_id, data),
+# relational — нормализованные таблицы из app.storage_relational (перенос: python -m app.migrate_relational)
+STORAGE_LAYOUT: str = os.getenv("STORAGE_LAYOUT", "jsonb").strip().lower()
+# сколько последних реплик истории попадает в документ при relational-раскладке
+RELATIONAL_HISTORY_LIMIT: int = int(os.getenv("RELATIONAL_HISTORY_LIMIT", "50"))
+
+# пометка запроса программы в истории (вопрос пользователя), см. FitnessAgent.get_program
+PROGRAM_REQUEST_MARK = "🧍 Запрос программы"
+
+
+def _relational() -> bool:
+    return STORAGE_LAYOUT == "relational"
+
+# История в документе — «горячее окно» из последних HISTORY_HOT_LIMIT реплик. Когда окно
+# перерастает лимит на HISTORY_ARCHIVE_BATCH, старые реплики уходят в архив (только дописывание):
+# файл {user_id}.history.jsonl, таблица history_archive (jsonb) или флаг archived в history_entries.
+HISTORY_HOT_LIMIT: int = int(os.getenv("HISTORY_HOT_LIMIT", "40"))
+HISTORY_ARCHIVE_BATCH: int = int(os.getenv("HISTORY_ARCHIVE_BATCH", "20"))
+
+# Пул соединений с Postgres: один на процесс, размер ограничен
+DB_POOL_MIN_SIZE: int = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE: int = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Кэш документов перед хранилищем (app.cache): off | write-through | write-behind.
+# write-behind копит изменения и пишет раз в USER_CACHE_FLUSH_INTERVAL сек.:
+# при падении процесса можно потерять изменения за последний интервал.
+# При нескольких репликах бота включай off — кэш локален для процесса.
+USER_CACHE_MODE: str = os.getenv("USER_CACHE_MODE", MODE_WRITE_BEHIND).strip().lower()
+USER_CACHE_MAX_ENTRIES: int = int(os.getenv("USER_CACHE_MAX_ENTRIES", "1000"))
+USER_CACHE_MAX_BYTES: int = int(os.getenv("USER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+USER_CACHE_FLUSH_INTERVAL: float = float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "2"))
+
+_cache: Optional[UserStateCache] = None
+_async_pool: Optional["AsyncConnectionPool"] = None
+_sync_pool: Optional["ConnectionPool"] = None
+_sync_pool_lock = threading.Lock()
+_schema_ready = False
+
 
 def validate_age(text: str) -> Tuple[bool, Optional[int], str]:
     """Проверяет корректность возраста. Возвращает (успех, значение, сообщение об ошибке)."""
@@ -77,25 +130,157 @@ DEFAULT_USER_DATA: Dict[str, Any] = {
         "target": None,        # "похудение"/"набор массы"/"поддержание формы"
         "preferred_muscle_group": None,  # предпочитаемая группа мышц для акцента
     },
-    "lifts": {},               # на будущее (история упражнений)
+    "lifts": {},               # устарело: подходы пишет app.lift_log (свой файл на пользователя)
     "last_reply": None,        # последний текст (любого ответа)
     "last_program": None,      # последняя СГЕНЕРИРОВАННАЯ ПРОГРАММА
     "physical_data_completed": False,
-    "programs": [],            # опционально
+    "programs": [],            # сохранённые программы: индекс файлов (app.saved_programs)
+    "program_file_ids": {},    # file_id Telegram для уже отправленных файлов программ
+    "history_archived": 0,     # сколько реплик уже ушло в архив (номер первой реплики окна)
+    "coach_summary": None,     # сводка всей истории общения (app.coach_summary)
+    "onboarding": None,        # отметка пакетного импорта анкеты (app.onboarding)
 }
 
 
+_USER_DATA_DDL = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id TEXT PRIMARY KEY,
+    data JSONB NOT NULL DEFAULT '{}'
+)
+"""
+
+_HISTORY_ARCHIVE_DDL = """
+CREATE TABLE IF NOT EXISTS history_archive (
+    user_id TEXT NOT NULL,
+    seq BIGINT NOT NULL,
+    ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+    question TEXT,
+    answer TEXT,
+    PRIMARY KEY (user_id, seq)
+)
+"""
+
+_UPSERT_SQL = """
+INSERT INTO user_data (user_id, data)
+VALUES (%s, %s::jsonb)
+ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data
+"""
+
+
+# Прежнее поле history_summaries (выжимки для app.context_packer) больше не пишется, а частичная
+# запись не удаляет ключи, которых нет ни в снимке, ни в новом документе, — убираем его отдельно.
+# Идемпотентно: после первой очистки WHERE ничего не находит.
+_DROP_HISTORY_SUMMARIES_SQL = "UPDATE user_data SET data = data - 'history_summaries' WHERE data ? 'history_summaries'"
+_REL_DROP_HISTORY_SUMMARIES_SQL = (
+    "UPDATE profiles SET extra = extra - 'history_summaries' WHERE extra ? 'history_summaries'"
+)
+
+
+def _schema_ddl() -> list:
+    # user_data и history_archive оставляем и при relational — из них читает миграция
+    ddl = [_USER_DATA_DDL, _HISTORY_ARCHIVE_DDL, _DROP_HISTORY_SUMMARIES_SQL]
+    return ddl + (rel.DDL + [_REL_DROP_HISTORY_SUMMARIES_SQL] if _relational() else [])
+
+
 def _pg_ensure_table(conn: "psycopg.Connection") -> None:
+    """CREATE TABLE выполняем один раз на процесс, а не перед каждым запросом."""
+    global _schema_ready
+    if _schema_ready:
+        return
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id TEXT PRIMARY KEY,
-                data JSONB NOT NULL DEFAULT '{}'
-            )
-            """
-        )
+        for ddl in _schema_ddl():
+            cur.execute(ddl)
     conn.commit()
+    _schema_ready = True
+
+
+async def _pg_ensure_table_async(conn: "psycopg.AsyncConnection") -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    for ddl in _schema_ddl():
+        await conn.execute(ddl)
+    await conn.commit()
+    _schema_ready = True
+
+
+def _get_sync_pool(url: str) -> Optional["ConnectionPool"]:
+    """Ленивый синхронный пул для старого sync-API (если установлен psycopg_pool)."""
+    global _sync_pool
+    if ConnectionPool is None:
+        return None
+    if _sync_pool is None:
+        with _sync_pool_lock:
+            if _sync_pool is None:
+                _sync_pool = ConnectionPool(
+                    url,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    open=True,
+                )
+    return _sync_pool
+
+
+@contextmanager
+def _pg_connection(url: str) -> Iterator["psycopg.Connection"]:
+    """Соединение из пула; без psycopg_pool — старое поведение (connect на вызов)."""
+    pool = _get_sync_pool(url)
+    if pool is not None:
+        with pool.connection() as conn:
+            _pg_ensure_table(conn)
+            yield conn
+        return
+    with psycopg.connect(url) as conn:
+        _pg_ensure_table(conn)
+        yield conn
+
+
+async def init_storage() -> None:
+    """
+    Запускает кэш документов и открывает асинхронный пул соединений,
+    схема создаётся один раз при старте процесса. Без Postgres (или без psycopg_pool)
+    пул не открывается — async-API работает через потоки.
+    """
+    global _async_pool, _cache
+    if _cache is None and USER_CACHE_MODE != MODE_OFF:
+        _cache = UserStateCache(
+            _save_backend_async,
+            max_entries=USER_CACHE_MAX_ENTRIES,
+            max_bytes=USER_CACHE_MAX_BYTES,
+            flush_interval=USER_CACHE_FLUSH_INTERVAL,
+            mode=USER_CACHE_MODE,
+        )
+        await _cache.start()
+    url = _get_database_url()
+    if _async_pool is not None or not (url and psycopg and AsyncConnectionPool):
+        return
+    pool = AsyncConnectionPool(
+        url,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        open=False,
+    )
+    await pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+    async with pool.connection() as conn:
+        await _pg_ensure_table_async(conn)
+    _async_pool = pool
+    logger.info("Postgres pool opened (min=%s, max=%s)", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+
+
+async def close_storage() -> None:
+    """Сбрасывает кэш и закрывает пулы соединений (вызывается при остановке бота)."""
+    global _async_pool, _sync_pool, _cache
+    if _cache is not None:
+        cache, _cache = _cache, None
+        await cache.stop()
+    if _async_pool is not None:
+        pool, _async_pool = _async_pool, None
+        await pool.close()
+    if _sync_pool is not None:
+        pool_sync, _sync_pool = _sync_pool, None
+        await asyncio.to_thread(pool_sync.close)
 
 
 def _user_path(user_id: str, folder: str) -> Path:
@@ -147,32 +332,375 @@ def _ensure_structure(data: Dict[str, Any]) -> Dict[str, Any]:
     if isinstance(data.get("programs"), list):
         result["programs"] = data["programs"]
 
+    if isinstance(data.get("program_file_ids"), dict):
+        result["program_file_ids"] = data["program_file_ids"]
+
+    if isinstance(data.get("history_archived"), int):
+        result["history_archived"] = data["history_archived"]
+
+    if isinstance(data.get("coach_summary"), dict):
+        result["coach_summary"] = data["coach_summary"]
+
+    if isinstance(data.get("onboarding"), dict):
+        result["onboarding"] = data["onboarding"]
+
     return result
 
 
 
-def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+def _row_to_user_data(row: Optional[tuple]) -> Dict[str, Any]:
+    if row is None:
+        return copy.deepcopy(DEFAULT_USER_DATA)
+    raw = row[0] if isinstance(row[0], dict) else json.loads(row[0])
+    return _ensure_structure(raw)
+
+
+# --- частичные обновления ---
+#
+# Вместо перезаписи всего документа пишем только изменения (ops):
+#   ("set", path, value)            — заменить значение по пути
+#   ("append", path, items, at)     — дописать items в список по пути; at — длина списка
+#                                      до дописывания (делает повтор операции идемпотентным)
+#   ("trim", path, keep)            — оставить в списке последние keep элементов
+#                                      (только история: отрезанное уходит в архив)
+# path — кортеж ключей, например ("physical_data", "weight") или ("history",).
+
+_MAX_DIFF_DEPTH = 3
+
+
+def _jsonable(data: Any) -> Any:
+    """Приводим к виду «как после JSON» (кортежи → списки), чтобы сравнение было честным."""
+    return json.loads(json.dumps(data, ensure_ascii=False, default=str))
+
+
+def _diff(old: Dict[str, Any], new: Dict[str, Any], path: tuple) -> list:
+    ops = []
+    for key, value in new.items():
+        key_path = path + (key,)
+        if key not in old:
+            ops.append(("set", key_path, value))
+            continue
+        prev = old[key]
+        if prev == value:
+            continue
+        if (
+            isinstance(prev, dict) and isinstance(value, dict)
+            and len(key_path) < _MAX_DIFF_DEPTH and set(prev) <= set(value)
+        ):
+            ops.extend(_diff(prev, value, key_path))
+        elif (
+            isinstance(prev, list) and isinstance(value, list)
+            and len(value) > len(prev) and value[:len(prev)] == prev
+        ):
+            ops.append(("append", key_path, value[len(prev):], len(prev)))
+        else:
+            ops.append(("set", key_path, value))
+    return ops
+
+
+def _history_keep(prev: Any, value: Any) -> Optional[int]:
     """
-    Читаем данные пользователя из Postgres (если задан DATABASE_URL) или из JSON-файла.
+    Если новая история — хвост старой (плюс, возможно, новые реплики), сколько реплик
+    старой осталось в окне. None — обрезки не было.
     """
+    if not isinstance(prev, list) or not isinstance(value, list) or value[:len(prev)] == prev:
+        return None
+    for keep in range(min(len(prev) - 1, len(value)), -1, -1):
+        if prev[len(prev) - keep:] == value[:keep]:
+            return keep
+    return None
+
+
+def diff_user_data(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[list]:
+    """
+    Список ops, превращающих old в new. None — если частичная запись невозможна
+    (из корня пропали ключи) и нужен полный документ.
+    Укороченная история всегда выражается через trim (+ append), а не перезапись:
+    иначе отрезанные реплики пропали бы мимо архива.
+    """
+    old_j, new_j = _jsonable(old), _jsonable(new)
+    if set(old_j) - set(new_j):
+        return None
+    ops: list = []
+    keep = _history_keep(old_j.get("history"), new_j.get("history"))
+    if keep is not None:
+        ops.append(("trim", ("history",), keep))
+        old_j["history"] = old_j["history"][len(old_j["history"]) - keep:]
+    return ops + _diff(old_j, new_j, ())
+
+
+def archived_entries(base: Optional[Dict[str, Any]], ops: Optional[list]) -> List[Tuple[int, Any]]:
+    """Реплики, которые ops отрезают от истории base, с их сквозными номерами (seq)."""
+    if not base or not ops:
+        return []
+    hist = base.get("history") or []
+    seq0 = base.get("history_archived") or 0
+    for op in ops:
+        if op[0] == "trim" and tuple(op[1]) == ("history",):
+            cut = max(len(hist) - op[2], 0)
+            return [(seq0 + i, e) for i, e in enumerate(hist[:cut])]
+    return []
+
+
+def compact_history(data: Dict[str, Any], keep: Optional[int] = None) -> int:
+    """
+    Переносит старые реплики за пределы горячего окна (в памяти): история укорачивается,
+    счётчик history_archived растёт. Сам архив пишет бэкенд при сохранении (по trim-операции).
+    keep=None — по политике HISTORY_HOT_LIMIT/HISTORY_ARCHIVE_BATCH; keep=0 — сброс истории.
+    Возвращает число перенесённых реплик.
+
+    Архив собирается из записанной ранее версии документа, поэтому отрезаться должны
+    только уже сохранённые реплики: между двумя записями в историю не должно прийти больше
+    HISTORY_HOT_LIMIT новых (при записи на каждый апдейт это 1–2 реплики).
+    """
+    hist = data.get("history")
+    if not isinstance(hist, list):
+        return 0
+    if keep is None:
+        if len(hist) <= HISTORY_HOT_LIMIT + HISTORY_ARCHIVE_BATCH:
+            return 0
+        keep = HISTORY_HOT_LIMIT
+    cut = max(len(hist) - keep, 0)
+    if cut:
+        data["history"] = hist[cut:]
+        data["history_archived"] = (data.get("history_archived") or 0) + cut
+    return cut
+
+
+def apply_user_ops(data: Dict[str, Any], ops: list) -> Dict[str, Any]:
+    """Применяет ops к документу в памяти (используется при чтении журнала файлового бэкенда)."""
+    for op in ops:
+        kind, path, value = op[0], op[1], op[2]
+        parent = data
+        for key in path[:-1]:
+            if not isinstance(parent.get(key), dict):
+                parent[key] = {}
+            parent = parent[key]
+        if kind == "set":
+            parent[path[-1]] = value
+        elif kind == "append":
+            current = parent.get(path[-1])
+            if not isinstance(current, list):
+                current = []
+            at = op[3] if len(op) > 3 else None
+            if at is not None:
+                del current[at:]
+            current.extend(value)
+            parent[path[-1]] = current
+        elif kind == "trim":
+            current = parent.get(path[-1])
+            if isinstance(current, list):
+                parent[path[-1]] = current[len(current) - value:] if value else []
+    return data
+
+
+_PG_TAIL_SQL = (
+    "COALESCE((SELECT jsonb_agg(t.e ORDER BY t.i) FROM jsonb_array_elements(data #> %s::text[]) "
+    "WITH ORDINALITY AS t(e, i) WHERE t.i > jsonb_array_length(data #> %s::text[]) - %s), '[]'::jsonb)"
+)
+
+
+def _pg_ops_sql(ops: list) -> Tuple[str, list]:
+    """Одно UPDATE с вложенными jsonb_set: меняются только затронутые поля документа."""
+    expr = "data"
+    params: list = []
+    # после trim дописываем к обрезанному списку, а не к исходному data #> path
+    sources: Dict[tuple, Tuple[str, list]] = {}
+    for op in ops:
+        kind, path = op[0], list(op[1])
+        if kind == "trim":
+            source = (_PG_TAIL_SQL, [path, path, op[2]])
+            sources[tuple(path)] = source
+            expr = f"jsonb_set({expr}, %s::text[], {source[0]}, true)"
+            params += [path] + source[1]
+            continue
+        value = json.dumps(op[2], ensure_ascii=False)
+        if kind == "set":
+            expr = f"jsonb_set({expr}, %s::text[], %s::jsonb, true)"
+            params += [path, value]
+        else:
+            source = sources.get(tuple(path), ("COALESCE(data #> %s::text[], '[]'::jsonb)", [path]))
+            expr = f"jsonb_set({expr}, %s::text[], {source[0]} || %s::jsonb, true)"
+            params += [path] + source[1] + [value]
+    return f"UPDATE user_data SET data = {expr} WHERE user_id = %s", params
+
+
+_ARCHIVE_INSERT_SQL = (
+    "INSERT INTO history_archive (user_id, seq, question, answer) VALUES {values} "
+    "ON CONFLICT (user_id, seq) DO NOTHING"
+)
+
+
+def _pg_archive_sql(user_id: str, archived: List[Tuple[int, Any]]) -> Tuple[str, list]:
+    """Отрезанные от окна реплики → history_archive; повтор записи (тот же seq) игнорируется."""
+    params: list = []
+    for seq, entry in archived:
+        q, a = _history_pair(entry)
+        params += [user_id, seq, q, a]
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(archived))
+    return _ARCHIVE_INSERT_SQL.format(values=values), params
+
+
+def _history_pair(entry: Any) -> Tuple[Optional[str], Optional[str]]:
+    pair = list(entry) if isinstance(entry, (list, tuple)) else [entry]
+    q, a = (pair + [None, None])[:2]
+    return q, a
+
+
+# Файловый бэкенд: ops дописываются строкой JSON в {user_id}.json.log рядом с документом,
+# при чтении журнал применяется поверх документа. Когда журнал вырастает больше
+# FILE_PATCH_LOG_MAX_BYTES, документ переписывается целиком, а журнал удаляется.
+FILE_PATCH_LOG_MAX_BYTES: int = int(os.getenv("FILE_PATCH_LOG_MAX_BYTES", str(256 * 1024)))
+
+
+def _log_path(user_id: str, folder: str) -> Path:
+    return _user_path(user_id, folder).with_suffix(".json.log")
+
+
+def _log_is_fresh(log: Path, doc: Path) -> bool:
+    """Журнал старше документа — остался после компактизации (сбой до удаления), его не применяем."""
+    try:
+        return log.stat().st_mtime_ns >= doc.stat().st_mtime_ns
+    except OSError:
+        return False
+
+
+def _read_patch_log(path: Path, data: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ops = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # недописанная последняя строка после сбоя
+                apply_user_ops(data, ops)
+    except OSError:
+        pass
+    return data
+
+
+def _write_json_file(user_id: str, data: Dict[str, Any], folder: str) -> None:
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    path = _user_path(user_id, folder)
+    tmp_path = path.with_suffix(".json.tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            try:
+                tmp_path.unlink()
+            except OSError:
+                pass
+    # документ уже содержит всё из журнала; если удалить журнал не успеем, его отсечёт _log_is_fresh
+    log = _log_path(user_id, folder)
+    if log.exists():
+        try:
+            log.unlink()
+        except OSError:
+            pass
+
+
+def _archive_path(user_id: str, folder: str) -> Path:
+    return Path(folder) / f"{user_id}.history.jsonl"
+
+
+def _append_file_archive(user_id: str, folder: str, archived: List[Tuple[int, Any]]) -> None:
+    """Архив истории файлового бэкенда: строка JSON на реплику, файл только дописывается."""
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    lines = "".join(
+        json.dumps({"seq": seq, "entry": entry}, ensure_ascii=False) + "\n" for seq, entry in archived
+    )
+    with _archive_path(user_id, folder).open("a", encoding="utf-8") as f:
+        f.write(lines)
+
+
+def _read_file_archive(user_id: str, folder: str) -> list:
+    # повторная запись после сбоя даёт дубли с тем же seq — берём по одной реплике на номер
+    by_seq: Dict[int, Any] = {}
+    try:
+        with _archive_path(user_id, folder).open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                by_seq[rec["seq"]] = rec["entry"]
+    except OSError:
+        pass
+    return [by_seq[k] for k in sorted(by_seq)]
+
+
+def _save_file(
+    user_id: str, data: Dict[str, Any], folder: str, ops: Optional[list], archived: List[Tuple[int, Any]]
+) -> None:
+    # архив — до документа: при сбое между записями реплики останутся и в окне, и в архиве
+    if archived:
+        _append_file_archive(user_id, folder, archived)
+    path = _user_path(user_id, folder)
+    if ops is None or not path.exists():
+        _write_json_file(user_id, data, folder)
+        return
+    log = _log_path(user_id, folder)
+    try:
+        log_size = log.stat().st_size
+    except OSError:
+        log_size = 0
+    if log_size > FILE_PATCH_LOG_MAX_BYTES:
+        _write_json_file(user_id, data, folder)  # компактизация
+        return
+    line = json.dumps([list(op) for op in ops], ensure_ascii=False) + "\n"
+    with log.open("a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def _relational_doc(row: Optional[tuple]) -> Dict[str, Any]:
+    doc = rel.row_to_doc(row)
+    return copy.deepcopy(DEFAULT_USER_DATA) if doc is None else _ensure_structure(doc)
+
+
+def _full_save_ops(current: Dict[str, Any], new: Dict[str, Any]) -> list:
+    """
+    Полная запись в relational-раскладке = разница с тем, что уже лежит в таблицах:
+    история в документе — лишь последние реплики, переписывать её целиком нельзя.
+    """
+    ops = diff_user_data(current, new)
+    return ops if ops is not None else [("set", (k,), v) for k, v in new.items()]
+
+
+_JSONB_LOAD_SQL = "SELECT data FROM user_data WHERE user_id = %s"
+
+
+def _load_backend(user_id: str, folder: str) -> Dict[str, Any]:
+    """Чтение из Postgres/JSON-файла без кэша; ошибки БД пробрасываются наверх."""
     url = _get_database_url()
     if url and psycopg:
-        try:
-            with psycopg.connect(url) as conn:
-                _pg_ensure_table(conn)
-                with conn.cursor() as cur:
-                    cur.execute(
-                        "SELECT data FROM user_data WHERE user_id = %s",
-                        (user_id,),
-                    )
-                    row = cur.fetchone()
-            if row is None:
-                return copy.deepcopy(DEFAULT_USER_DATA)
-            raw = row[0] if isinstance(row[0], dict) else json.loads(row[0])
-            return _ensure_structure(raw)
-        except Exception:
-            return copy.deepcopy(DEFAULT_USER_DATA)
+        with _pg_connection(url) as conn:
+            with conn.cursor() as cur:
+                return _pg_fetch_doc(cur, user_id)
+
+    return _load_file(user_id, folder)
+
+
+def _pg_fetch_doc(cur: "psycopg.Cursor", user_id: str) -> Dict[str, Any]:
+    if _relational():
+        cur.execute(rel.LOAD_SQL, rel.load_params(user_id, RELATIONAL_HISTORY_LIMIT))
+        return _relational_doc(cur.fetchone())
+    cur.execute(_JSONB_LOAD_SQL, (user_id,))
+    return _row_to_user_data(cur.fetchone())
 
+
+async def _pg_fetch_doc_async(conn: "psycopg.AsyncConnection", user_id: str) -> Dict[str, Any]:
+    if _relational():
+        cur = await conn.execute(rel.LOAD_SQL, rel.load_params(user_id, RELATIONAL_HISTORY_LIMIT))
+        return _relational_doc(await cur.fetchone())
+    cur = await conn.execute(_JSONB_LOAD_SQL, (user_id,))
+    return _row_to_user_data(await cur.fetchone())
+
+
+def _load_file(user_id: str, folder: str) -> Dict[str, Any]:
+    """JSON-файл пользователя с применённым журналом изменений."""
     path = _user_path(user_id, folder)
     if not path.exists():
         return copy.deepcopy(DEFAULT_USER_DATA)
@@ -181,99 +709,374 @@ def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
             raw = json.load(f)
     except (json.JSONDecodeError, OSError):
         return copy.deepcopy(DEFAULT_USER_DATA)
+    log = _log_path(user_id, folder)
+    if isinstance(raw, dict) and _log_is_fresh(log, path):
+        raw = _read_patch_log(log, raw)
     return _ensure_structure(raw)
 
 
-def save_user_data(user_id: str, data: Dict[str, Any], folder: str = "data/users") -> None:
+def _save_ops(base: Dict[str, Any], normalized: Dict[str, Any]) -> Optional[list]:
+    return _full_save_ops(base, normalized) if _relational() else diff_user_data(base, normalized)
+
+
+def _save_backend(
+    user_id: str, data: Dict[str, Any], folder: str, base: Optional[Dict[str, Any]] = None
+) -> None:
     """
-    Сохраняем в Postgres (если задан DATABASE_URL) или в JSON-файл.
+    Запись в Postgres/JSON-файл без кэша; ошибки пробрасываются наверх.
+    base — версия документа, которая уже лежит в хранилище: тогда пишем только разницу.
+    Без base разница считается с текущим содержимым хранилища — так отрезанная от окна
+    история гарантированно попадает в архив.
     """
     normalized = _ensure_structure(data)
-
     url = _get_database_url()
     if url and psycopg:
-        try:
-            payload = json.dumps(normalized, ensure_ascii=False)
-            with psycopg.connect(url) as conn:
-                _pg_ensure_table(conn)
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO user_data (user_id, data)
-                        VALUES (%s, %s::jsonb)
-                        ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data
-                        """,
-                        (user_id, payload),
-                    )
+        with _pg_connection(url) as conn:
+            with conn.cursor() as cur:
+                if base is None:
+                    base = _pg_fetch_doc(cur, user_id)
+            ops = _save_ops(base, normalized)
+            if ops is not None and not ops:
+                return
+            if _relational():
+                with conn.pipeline(), conn.cursor() as cur:
+                    for sql, params in rel.ops_to_statements(user_id, ops):
+                        cur.execute(sql, params)
                 conn.commit()
-        except Exception:
-            pass
+                return
+            archived = archived_entries(base, ops)
+            with conn.cursor() as cur:
+                # архив и обрезка окна — в одной транзакции
+                if archived:
+                    cur.execute(*_pg_archive_sql(user_id, archived))
+                updated = 0
+                if ops:
+                    sql, params = _pg_ops_sql(ops)
+                    cur.execute(sql, params + [user_id])
+                    updated = cur.rowcount
+                if not updated:
+                    cur.execute(_UPSERT_SQL, (user_id, json.dumps(normalized, ensure_ascii=False)))
+            conn.commit()
         return
 
-    Path(folder).mkdir(parents=True, exist_ok=True)
-    path = _user_path(user_id, folder)
-    tmp_path = path.with_suffix(".json.tmp")
+    if base is None:
+        base = _load_file(user_id, folder)
+    ops = diff_user_data(base, normalized)
+    if ops is not None and not ops:
+        return
+    _save_file(user_id, normalized, folder, ops, archived_entries(base, ops))
+
+
+async def _load_backend_async(user_id: str, folder: str) -> Dict[str, Any]:
+    pool = _async_pool
+    if pool is None:
+        return await asyncio.to_thread(_load_backend, user_id, folder)
+    async with pool.connection() as conn:
+        return await _pg_fetch_doc_async(conn, user_id)
+
+
+async def _save_backend_async(
+    user_id: str, folder: str, data: Dict[str, Any], base: Optional[Dict[str, Any]] = None
+) -> None:
+    pool = _async_pool
+    if pool is None:
+        await asyncio.to_thread(_save_backend, user_id, data, folder, base)
+        return
+    normalized = _ensure_structure(data)
+    async with pool.connection() as conn:
+        if base is None:
+            base = await _pg_fetch_doc_async(conn, user_id)
+        ops = _save_ops(base, normalized)
+        if ops is not None and not ops:
+            return
+        if _relational():
+            async with conn.pipeline():
+                async with conn.cursor() as cur:
+                    for sql, params in rel.ops_to_statements(user_id, ops):
+                        await cur.execute(sql, params)
+            return
+        archived = archived_entries(base, ops)
+        if archived:
+            await conn.execute(*_pg_archive_sql(user_id, archived))
+        updated = 0
+        if ops:
+            sql, params = _pg_ops_sql(ops)
+            cur = await conn.execute(sql, params + [user_id])
+            updated = cur.rowcount
+        if not updated:
+            await conn.execute(_UPSERT_SQL, (user_id, json.dumps(normalized, ensure_ascii=False)))
+
+
+def load_user_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+    """
+    Читаем данные пользователя из Postgres (если задан DATABASE_URL) или из JSON-файла.
+    Если запущен кэш (init_storage) — сначала смотрим в него.
+    """
+    cache = _cache
+    if cache is not None:
+        cached = cache.get(user_id, folder)
+        if cached is not None:
+            return cached
     try:
-        with tmp_path.open("w", encoding="utf-8") as f:
-            json.dump(normalized, f, ensure_ascii=False, indent=4)
-        os.replace(tmp_path, path)
-    finally:
-        if tmp_path.exists():
-            try:
-                tmp_path.unlink()
-            except OSError:
-                pass
+        data = _load_backend(user_id, folder)
+    except Exception:
+        # дефолтный документ при ошибке БД в кэш не кладём
+        logger.exception("Failed to load user %s", user_id)
+        return copy.deepcopy(DEFAULT_USER_DATA)
+    if cache is not None:
+        cache.put(user_id, folder, data, dirty=False)
+    return data
 
 
+def save_user_data(
+    user_id: str, data: Dict[str, Any], folder: str = "data/users", base: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Сохраняем в Postgres (если задан DATABASE_URL) или в JSON-файл.
+    base — документ в том виде, в каком его прочитали: тогда пишутся только изменённые поля.
+    В режиме write-behind документ только помечается dirty в кэше и пишется при сбросе.
+    История сверх горячего окна отрезается прямо в data (compact_history).
+    """
+    compact_history(data)
+    cache = _cache
+    if cache is not None and cache.mode == MODE_WRITE_BEHIND:
+        cache.put(user_id, folder, _ensure_structure(data), dirty=True)
+        return
+    try:
+        _save_backend(user_id, data, folder, base)
+    except Exception:
+        logger.exception("Failed to save user %s", user_id)
+        return
+    if cache is not None:
+        cache.put(user_id, folder, _ensure_structure(data), dirty=False)
+
+
+async def load_user_data_async(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+    """
+    Асинхронное чтение для хендлеров бота: кэш → пул соединений (после init_storage),
+    иначе — чтение в отдельном потоке, чтобы не блокировать event loop.
+    """
+    cache = _cache
+    if cache is not None:
+        cached = cache.get(user_id, folder)
+        if cached is not None:
+            return cached
+    try:
+        data = await _load_backend_async(user_id, folder)
+    except Exception:
+        logger.exception("Failed to load user %s", user_id)
+        return copy.deepcopy(DEFAULT_USER_DATA)
+    if cache is not None:
+        cache.put(user_id, folder, data, dirty=False)
+    return data
+
+
+async def save_user_data_async(
+    user_id: str, data: Dict[str, Any], folder: str = "data/users", base: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Асинхронная запись: через кэш (write-behind/write-through), пул соединений или поток.
+    base — как в save_user_data (без кэша); кэш сам помнит последнюю записанную версию.
+    """
+    compact_history(data)
+    cache = _cache
+    normalized = _ensure_structure(data)
+    try:
+        if cache is None:
+            await _save_backend_async(user_id, folder, normalized, base)
+        elif cache.mode == MODE_WRITE_BEHIND:
+            cache.put(user_id, folder, normalized, dirty=True)
+        else:
+            await cache.write_through(user_id, folder, normalized)
+    except Exception:
+        logger.exception("Failed to save user %s", user_id)
+
+
+_JSONB_LOAD_MANY_SQL = "SELECT user_id, data FROM user_data WHERE user_id = ANY(%s) FOR UPDATE"
+
+
+def update_users_bulk(
+    user_ids: List[str],
+    update: Callable[[str, Dict[str, Any]], bool],
+    folder: str = "data/users",
+) -> Dict[str, Dict[str, Any]]:
+    """
+    «Прочитать → изменить → записать» для пачки пользователей (импорт, офлайн-скрипты).
+    update(user_id, doc) меняет документ на месте; False — пользователя не трогать.
+    В Postgres вся пачка идёт одним соединением и одной транзакцией: документы JSONB
+    читаются одним запросом (с блокировкой строк), пишутся только изменённые поля.
+    Кэш процесса (init_storage) не используется — для работающего бота это не замена UserSession.
+    Возвращает документы всей пачки после update (и записанные, и нетронутые).
+    """
+    docs: Dict[str, Dict[str, Any]] = {}
+    url = _get_database_url()
+    if not (url and psycopg):
+        for user_id in user_ids:
+            base = _load_file(user_id, folder)
+            doc = docs[user_id] = copy.deepcopy(base)
+            if not update(user_id, doc):
+                continue
+            compact_history(doc)
+            normalized = _ensure_structure(doc)
+            ops = diff_user_data(base, normalized)
+            if ops is None or ops:
+                _save_file(user_id, normalized, folder, ops, archived_entries(base, ops))
+        return docs
+
+    with _pg_connection(url) as conn:
+        with conn.cursor() as cur:
+            if _relational():
+                stored = {user_id: _pg_fetch_doc(cur, user_id) for user_id in user_ids}
+            else:
+                cur.execute(_JSONB_LOAD_MANY_SQL, (list(user_ids),))
+                stored = {user_id: _row_to_user_data((raw,)) for user_id, raw in cur.fetchall()}
+        statements: List[Tuple[str, Any]] = []
+        for user_id in user_ids:
+            base = stored.get(user_id) or copy.deepcopy(DEFAULT_USER_DATA)
+            doc = docs[user_id] = copy.deepcopy(base)
+            if not update(user_id, doc):
+                continue
+            compact_history(doc)
+            normalized = _ensure_structure(doc)
+            ops = _save_ops(base, normalized)
+            if ops is not None and not ops:
+                continue
+            if _relational():
+                statements += rel.ops_to_statements(user_id, ops)
+            elif user_id in stored and ops is not None:
+                archived = archived_entries(base, ops)
+                if archived:
+                    statements.append(_pg_archive_sql(user_id, archived))
+                sql, params = _pg_ops_sql(ops)
+                statements.append((sql, params + [user_id]))
+            else:
+                statements.append((_UPSERT_SQL, (user_id, json.dumps(normalized, ensure_ascii=False))))
+        if statements:
+            with conn.pipeline(), conn.cursor() as cur:
+                for sql, params in statements:
+                    cur.execute(sql, params)
+        conn.commit()
+    return docs
+
+
+# --- узкие выборки: только то, что нужно вызывающему ---
+
+_JSONB_PHYSICAL_DATA_SQL = "SELECT data->'physical_data' FROM user_data WHERE user_id = %s"
+
+
+def get_physical_data(user_id: str, folder: str = "data/users") -> Dict[str, Any]:
+    """Только анкета (physical_data), без истории и текстов программ."""
+    cache = _cache
+    if cache is not None:
+        cached = cache.get(user_id, folder)
+        if cached is not None:
+            return cached["physical_data"]
+    url = _get_database_url()
+    if not (url and psycopg):
+        return load_user_data(user_id, folder)["physical_data"]
+    try:
+        with _pg_connection(url) as conn, conn.cursor() as cur:
+            cur.execute(rel.PHYSICAL_DATA_SQL if _relational() else _JSONB_PHYSICAL_DATA_SQL, (user_id,))
+            row = cur.fetchone()
+    except Exception:
+        logger.exception("Failed to load physical data for user %s", user_id)
+        row = None
+    raw = row[0] if row else None
+    raw = json.loads(raw) if isinstance(raw, str) else raw
+    return _ensure_structure({"physical_data": raw})["physical_data"]
+
+
+_JSONB_ARCHIVE_SQL = """
+SELECT question, answer FROM history_archive
+ WHERE user_id = %s
+ ORDER BY seq DESC
+ LIMIT %s
+"""
+
+
+def get_archived_history(user_id: str, limit: int = 50, folder: str = "data/users") -> List[Tuple[Any, Any]]:
+    """Последние limit реплик из архива истории (вне горячего окна документа), от старых к новым."""
+    if limit <= 0:
+        return []
+    url = _get_database_url()
+    if not (url and psycopg):
+        return [tuple(e) if isinstance(e, list) else e for e in _read_file_archive(user_id, folder)[-limit:]]
+    try:
+        with _pg_connection(url) as conn, conn.cursor() as cur:
+            cur.execute(rel.ARCHIVED_HISTORY_SQL if _relational() else _JSONB_ARCHIVE_SQL, (user_id, limit))
+            return [tuple(r) for r in reversed(cur.fetchall())]
+    except Exception:
+        logger.exception("Failed to load archived history for user %s", user_id)
+        return []
+
+
+def _doc(user_id: str, folder: str, data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Документ из сессии (если передан) или свежая загрузка из хранилища."""
+    return data if data is not None else load_user_data(user_id, folder)
+
 
-def get_user_name(user_id: str, folder: str = "data/users") -> Optional[str]:
-    d = load_user_data(user_id, folder)
+# Хелперы ниже принимают data= (документ из app.session.UserSession): тогда они только
+# меняют его в памяти, а запись делает сессия. Без data — старое поведение load → save.
+
+def get_user_name(user_id: str, folder: str = "data/users", data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    d = _doc(user_id, folder, data)
     return (d.get("physical_data") or {}).get("name")
 
 
-def set_user_name(user_id: str, name: Optional[str], folder: str = "data/users") -> Dict[str, Any]:
-    d = load_user_data(user_id, folder)
+def set_user_name(
+    user_id: str, name: Optional[str], folder: str = "data/users", data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    d = _doc(user_id, folder, data)
     if isinstance(name, str):
         name = (name or "").strip()[:80] or None
     d.setdefault("physical_data", {}).update({"name": name})
-    save_user_data(user_id, d, folder)
+    if data is None:
+        save_user_data(user_id, d, folder)
     return d
 
 
-def set_last_reply(user_id: str, text: Optional[str], folder: str = "data/users") -> Optional[str]:
-    d = load_user_data(user_id, folder)
+def set_last_reply(
+    user_id: str, text: Optional[str], folder: str = "data/users", data: Optional[Dict[str, Any]] = None
+) -> Optional[str]:
+    d = _doc(user_id, folder, data)
     d["last_reply"] = text
-    save_user_data(user_id, d, folder)
+    if data is None:
+        save_user_data(user_id, d, folder)
     return text
 
 
-def get_last_reply(user_id: str, folder: str = "data/users") -> Optional[str]:
-    d = load_user_data(user_id, folder)
+def get_last_reply(user_id: str, folder: str = "data/users", data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    d = _doc(user_id, folder, data)
     return d.get("last_reply")
 
 
-def set_last_program(user_id: str, text: Optional[str], folder: str = "data/users") -> Optional[str]:
+def set_last_program(
+    user_id: str, text: Optional[str], folder: str = "data/users", data: Optional[Dict[str, Any]] = None
+) -> Optional[str]:
     """
     Храним последнюю сгенерированную ПРОГРАММУ отдельно от last_reply,
     чтобы кнопка «Сохранить в файл» работала предсказуемо.
     """
-    d = load_user_data(user_id, folder)
+    d = _doc(user_id, folder, data)
     d["last_program"] = text
-    save_user_data(user_id, d, folder)
+    if data is None:
+        save_user_data(user_id, d, folder)
     return text
 
 
-def get_last_program(user_id: str, folder: str = "data/users") -> Optional[str]:
-    d = load_user_data(user_id, folder)
+def get_last_program(user_id: str, folder: str = "data/users", data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    d = _doc(user_id, folder, data)
     return d.get("last_program")
 
 
-def set_user_goal(user_id: str, goal: str, folder: str = "data/users") -> Dict[str, Any]:
+def set_user_goal(
+    user_id: str, goal: str, folder: str = "data/users", data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
     """
     Устанавливает новую цель тренировок для пользователя.
     Добавляет запись в историю об изменении цели.
     """
-    d = load_user_data(user_id, folder)
+    d = _doc(user_id, folder, data)
     old_goal = (d.get("physical_data") or {}).get("target")
     
     # обновляем цель
@@ -288,16 +1091,19 @@ def set_user_goal(user_id: str, goal: str, folder: str = "data/users") -> Dict[s
         ))
         d["history"] = hist
     
-    save_user_data(user_id, d, folder)
+    if data is None:
+        save_user_data(user_id, d, folder)
     return d
 
 
-def update_user_param(user_id: str, param_name: str, value: Any, folder: str = "data/users") -> Dict[str, Any]:
+def update_user_param(
+    user_id: str, param_name: str, value: Any, folder: str = "data/users", data: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
     """
     Обновляет отдельный параметр в анкете пользователя.
     param_name: 'weight', 'schedule', 'restrictions', 'level', 'age', 'height', 'goal'
     """
-    d = load_user_data(user_id, folder)
+    d = _doc(user_id, folder, data)
     old_value = (d.get("physical_data") or {}).get(param_name)
     
     # обновляем параметр
@@ -324,16 +1130,17 @@ def update_user_param(user_id: str, param_name: str, value: Any, folder: str = "
         ))
         d["history"] = hist
     
-    save_user_data(user_id, d, folder)
+    if data is None:
+        save_user_data(user_id, d, folder)
     return d
 
 
-def get_user_profile_text(user_id: str, folder: str = "data/users") -> str:
+def get_user_profile_text(user_id: str, folder: str = "data/users", data: Optional[Dict[str, Any]] = None) -> str:
     """
     Возвращает форматированный текст анкеты пользователя.
     """
-    d = load_user_data(user_id, folder)
-    phys = d.get("physical_data") or {}
+    # без документа из сессии читаем только анкету, а не весь документ с историей
+    phys = (data.get("physical_data") if data is not None else get_physical_data(user_id, folder)) or {}
     
     # иконки для целей
     goal_icons = {
@@ -377,48 +1184,3 @@ def get_user_profile_text(user_id: str, folder: str = "data/users") -> str:
 ⚠️ Ограничения: {phys.get('restrictions') or 'нет'}"""
     
     return text
-
-
-
-def get_lift_history(user_id: str, lift_key: str, folder: str = "data/users"):
-    d = load_user_data(user_id, folder)
-    return (d.get("lifts") or {}).get(lift_key)
-
-
-def save_lift_history(
-    user_id: str,
-    lift_key: str,
-    last_weight: float,
-    reps: int,
-    rir: Optional[int] = None,
-    folder: str = "data/users",
-):
-    """
-    Универсальный накопитель истории по упражнению.
-    Сейчас в проекте почти не используется, но оставляем для совместимости/расширений.
-    """
-    d = load_user_data(user_id, folder)
-
-    entry = {
-        "ts": int(time.time()),
-        "last_weight": float(last_weight),
-        "reps": int(reps),
-        "rir": None if rir is None else int(rir),
-    }
-
-    lifts = d.setdefault("lifts", {})
-    rec = lifts.get(lift_key) or {}
-
-    rec["last_weight"] = entry["last_weight"]
-    rec["reps"] = entry["reps"]
-    rec["rir"] = entry["rir"]
-
-    hist = rec.get("history") or []
-    hist.append(entry)
-    rec["history"] = hist[-50:]
-
-    lifts[lift_key] = rec
-    d["lifts"] = lifts
-
-    save_user_data(user_id, d, folder)
-    return d["lifts"][lift_key]
@@ -0,0 +1,219 @@
+"""
+Нормализованная схема Postgres (STORAGE_LAYOUT=relational) вместо одной JSONB-строки.
+
+profiles        — анкета и короткие поля документа (одна строка на пользователя)
+history_entries — реплики истории (вопрос/ответ), индекс (user_id, ts); archived — реплика
+                  вне горячего окна документа (строки никогда не удаляются при обрезке окна)
+programs        — сохранённые программы, индекс (user_id, ts)
+
+Подходов здесь нет: дневник подходов — app.lift_log (файл на пользователя). Прежнее поле
+документа "lifts", если оно есть, лежит в profiles.extra как любое другое.
+
+Функции модуля только строят SQL (список (sql, params)), а выполняет его app.storage
+синхронным или асинхронным соединением — так один и тот же код работает в обоих API.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+Statement = Tuple[str, tuple]
+
+DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS profiles (
+        user_id TEXT PRIMARY KEY,
+        physical_data JSONB NOT NULL DEFAULT '{}',
+        physical_data_completed BOOLEAN NOT NULL DEFAULT FALSE,
+        last_reply TEXT,
+        last_program TEXT,
+        extra JSONB NOT NULL DEFAULT '{}',
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS history_entries (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+        question TEXT,
+        answer TEXT,
+        archived BOOLEAN NOT NULL DEFAULT FALSE
+    )
+    """,
+    "ALTER TABLE history_entries ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT FALSE",
+    "CREATE INDEX IF NOT EXISTS history_entries_user_ts ON history_entries (user_id, ts)",
+    """
+    CREATE TABLE IF NOT EXISTS programs (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        ts TIMESTAMPTZ NOT NULL DEFAULT now(),
+        data JSONB NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS programs_user_ts ON programs (user_id, ts)",
+]
+
+# поля документа, у которых есть свои колонки в profiles; остальное — в profiles.extra
+_PROFILE_COLUMNS = ("physical_data_completed", "last_reply", "last_program")
+_TABLE_KEYS = ("physical_data", "history", "programs") + _PROFILE_COLUMNS
+
+# Документ целиком одним запросом: анкета + последние N реплик + программы
+LOAD_SQL = """
+SELECT
+    (SELECT row_to_json(p)::jsonb FROM profiles p WHERE p.user_id = %(u)s),
+    (SELECT COALESCE(jsonb_agg(jsonb_build_array(h.question, h.answer) ORDER BY h.ts, h.id), '[]'::jsonb)
+       FROM (SELECT id, ts, question, answer FROM history_entries
+              WHERE user_id = %(u)s AND NOT archived ORDER BY ts DESC, id DESC LIMIT %(n)s) h),
+    (SELECT COALESCE(jsonb_agg(pr.data ORDER BY pr.ts, pr.id), '[]'::jsonb)
+       FROM programs pr WHERE pr.user_id = %(u)s)
+"""
+
+PHYSICAL_DATA_SQL = "SELECT physical_data FROM profiles WHERE user_id = %s"
+
+ARCHIVED_HISTORY_SQL = """
+SELECT question, answer FROM history_entries
+ WHERE user_id = %s AND archived
+ ORDER BY ts DESC, id DESC
+ LIMIT %s
+"""
+
+# окно документа = последние keep неархивных реплик, всё старше помечается archived
+_TRIM_HISTORY_SQL = """
+UPDATE history_entries SET archived = TRUE
+ WHERE id IN (SELECT id FROM history_entries
+               WHERE user_id = %s AND NOT archived
+               ORDER BY ts DESC, id DESC OFFSET %s)
+"""
+
+
+def load_params(user_id: str, history_limit: int) -> Dict[str, Any]:
+    return {"u": user_id, "n": history_limit}
+
+
+def _as_json(value: Any) -> Any:
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def row_to_doc(row: Optional[tuple]) -> Optional[Dict[str, Any]]:
+    """Собирает документ из результата LOAD_SQL; None — пользователя нет."""
+    if row is None:
+        return None
+    profile, history, programs = (_as_json(v) for v in row)
+    if profile is None and not history and not programs:
+        return None
+    profile = profile or {}
+    doc: Dict[str, Any] = dict(_as_json(profile.get("extra")) or {})
+    doc.update({
+        "physical_data": _as_json(profile.get("physical_data")) or {},
+        "physical_data_completed": bool(profile.get("physical_data_completed")),
+        "last_reply": profile.get("last_reply"),
+        "last_program": profile.get("last_program"),
+        "history": [tuple(e) for e in (history or [])],
+        "programs": programs or [],
+    })
+    return doc
+
+
+def _dump(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _insert_history(user_id: str, entries: List[Any], archived: bool = False) -> List[Statement]:
+    rows = []
+    for e in entries:
+        pair = list(e) if isinstance(e, (list, tuple)) else [e]
+        rows.append((user_id, *(pair + [None, None])[:2], archived))
+    if not rows:
+        return []
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+    params = tuple(v for r in rows for v in r)
+    return [(f"INSERT INTO history_entries (user_id, question, answer, archived) VALUES {values}", params)]
+
+
+def _insert_programs(user_id: str, items: List[Any]) -> List[Statement]:
+    if not items:
+        return []
+    values = ", ".join(["(%s, %s::jsonb)"] * len(items))
+    params = tuple(v for item in items for v in (user_id, _dump(item)))
+    return [(f"INSERT INTO programs (user_id, data) VALUES {values}", params)]
+
+
+def ops_to_statements(user_id: str, ops: list) -> List[Statement]:
+    """Переводит ops из app.storage.diff_user_data в запросы к нормализованным таблицам."""
+    stmts: List[Statement] = [
+        ("INSERT INTO profiles (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,)),
+    ]
+    for op in ops:
+        kind, path, value = op[0], tuple(op[1]), op[2]
+        head = path[0]
+        if head == "physical_data":
+            if len(path) == 1:
+                stmts.append(("UPDATE profiles SET physical_data = %s::jsonb WHERE user_id = %s", (_dump(value), user_id)))
+            else:
+                stmts.append((
+                    "UPDATE profiles SET physical_data = jsonb_set(physical_data, %s::text[], %s::jsonb, true) "
+                    "WHERE user_id = %s",
+                    (list(path[1:]), _dump(value), user_id),
+                ))
+        elif head in _PROFILE_COLUMNS and len(path) == 1:
+            stmts.append((f"UPDATE profiles SET {head} = %s WHERE user_id = %s", (value, user_id)))
+        elif head == "history" and len(path) == 1:
+            if kind == "trim":
+                stmts.append((_TRIM_HISTORY_SQL, (user_id, value)))
+                continue
+            if kind == "set":
+                stmts.append(("DELETE FROM history_entries WHERE user_id = %s", (user_id,)))
+            stmts += _insert_history(user_id, value or [])
+        elif head == "programs" and len(path) == 1:
+            if kind == "set":
+                stmts.append(("DELETE FROM programs WHERE user_id = %s", (user_id,)))
+            stmts += _insert_programs(user_id, value or [])
+        elif kind == "set":
+            stmts.append((
+                "UPDATE profiles SET extra = jsonb_set(extra, %s::text[], %s::jsonb, true) WHERE user_id = %s",
+                (list(path), _dump(value), user_id),
+            ))
+        else:
+            stmts.append((
+                "UPDATE profiles SET extra = jsonb_set(extra, %s::text[], "
+                "COALESCE(extra #> %s::text[], '[]'::jsonb) || %s::jsonb, true) WHERE user_id = %s",
+                (list(path), list(path), _dump(value), user_id),
+            ))
+    stmts.append(("UPDATE profiles SET updated_at = now() WHERE user_id = %s", (user_id,)))
+    return stmts
+
+
+def replace_statements(user_id: str, doc: Dict[str, Any], archived: List[Any] = ()) -> List[Statement]:
+    """
+    Полная перезапись пользователя (для миграции): удалить всё и вставить заново.
+    archived — реплики из архива истории, они встают перед окном документа.
+    """
+    extra = {k: v for k, v in doc.items() if k not in _TABLE_KEYS}
+    stmts: List[Statement] = [
+        ("DELETE FROM history_entries WHERE user_id = %s", (user_id,)),
+        ("DELETE FROM programs WHERE user_id = %s", (user_id,)),
+        (
+            """
+            INSERT INTO profiles (user_id, physical_data, physical_data_completed, last_reply, last_program, extra)
+            VALUES (%s, %s::jsonb, %s, %s, %s, %s::jsonb)
+            ON CONFLICT (user_id) DO UPDATE SET
+                physical_data = EXCLUDED.physical_data,
+                physical_data_completed = EXCLUDED.physical_data_completed,
+                last_reply = EXCLUDED.last_reply,
+                last_program = EXCLUDED.last_program,
+                extra = EXCLUDED.extra,
+                updated_at = now()
+            """,
+            (
+                user_id,
+                _dump(doc.get("physical_data") or {}),
+                bool(doc.get("physical_data_completed")),
+                doc.get("last_reply"),
+                doc.get("last_program"),
+                _dump(extra),
+            ),
+        ),
+    ]
+    stmts += _insert_history(user_id, list(archived), archived=True)
+    stmts += _insert_history(user_id, doc.get("history") or [])
+    stmts += _insert_programs(user_id, doc.get("programs") or [])
+    return stmts
@@ -0,0 +1,188 @@
+"""
+Постобработка ответов модели для Telegram: один модуль вместо _strip_noise / _telegram_bold_fix /
+_bold_day_headers / _format_qa_answer в app.agent и _sanitize_for_tg в боте.
+
+- clean_program(text) — программа: шум (LaTeX, RPE/RIR, «до отказа», HTML, #-заголовки,
+  лишние пробелы) → **…** в *…* → жирные «День N»;
+- clean_answer(text) — ответ на вопрос: то же + пустая строка перед каждым «День N»;
+- sanitize(text) — только HTML/#-заголовки/пустые строки (превью и чужой текст);
+- StreamSanitizer — sanitize для стриминга: весь накопленный текст приходит на каждом куске,
+  а готовые абзацы чистятся один раз.
+
+Результат совпадает с прежней цепочкой функций (сверка — benchmarks.textproc_bench).
+Отличия только в том, как считается: шаблоны скомпилированы один раз, независимые замены
+(LaTeX, теги <br>/<p>, пробелы вокруг переводов строк) сведены в один проход,
+а проход пропускается, если в тексте нет его символа (#, <, $, \\, ** …).
+"""
+import re
+from typing import List, Match
+
+# LaTeX: $...$ → содержимое; \times → ×, \text{ ... } → ..., \% → %
+_DOLLAR_RE = re.compile(r"\$([^$]*)\$")
+_LATEX_RE = re.compile(r"\\times|\\text\{\s*([^}]*)\s*\}|\\%")
+# RPE, RIR и «до отказа» — три прохода по очереди, не один: вырезанный кусок склеивает соседей
+# («RIR 2(RPE 8)3» → «RIR 23», «пункт (RPE 8) до» → «пунктдо»), и от порядка зависит результат.
+# «почти до отказа» оставляет «почти» — как и раньше
+_RPE_RE = re.compile(r"\(?\s*RPE\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?", re.IGNORECASE)
+_RIR_RE = re.compile(r"\(?\s*RIR\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?", re.IGNORECASE)
+_FAILURE_RE = re.compile(r"\bдо\s+отказа\b", re.IGNORECASE)
+_BULLET_RE = re.compile(r"^\s*•\s+", re.MULTILINE)
+_TIMES_RE = re.compile(r"(\d)\s*[xX\*]\s*(\d)")
+_HTML_RE = re.compile(r"\s*<br\s*/?>\s*|</?p\s*/?>", re.IGNORECASE)
+_HEADER_RE = re.compile(r"^\s*#{1,6}\s*", re.MULTILINE)
+_EMPTY_PARENS_RE = re.compile(r"\(\s*\)")
+_DOUBLE_COMMA_RE = re.compile(r",\s*,")
+_SPACES_RE = re.compile(r"[ \t]{2,}")
+_LINE_EDGE_RE = re.compile(r"[ \t]*\n[ \t]*")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*", re.DOTALL)
+_DAY_HEADER_RE = re.compile(r"День\s+\d+(\s*—\s*.+)?$")
+_DAY_BREAK_RE = re.compile(r"\n(День \d+)")
+
+
+def _latex_sub(m: Match) -> str:
+    token = m.group(0)
+    if token == "\\times":
+        return "×"
+    if token == "\\%":
+        return "%"
+    # \times и \% внутри \text{…} тоже заменяются (раньше это делали отдельные проходы)
+    return m.group(1).replace("\\times", "×").replace("\\%", "%")
+
+
+def strip_noise(text: str) -> str:
+    """Убираем RPE/RIR/«до отказа», LaTeX ($...$), лишние пробелы и #/## заголовки."""
+    out = text or ""
+    if "$" in out:
+        out = _DOLLAR_RE.sub(r"\1", out)
+    if "\\" in out:
+        out = _LATEX_RE.sub(_latex_sub, out)
+    low = out.lower()
+    if "rpe" in low:
+        out = _RPE_RE.sub("", out)
+        low = out.lower()  # вырезанное могло склеить «rir»/«отказ» из соседних кусков
+    if "rir" in low:
+        out = _RIR_RE.sub("", out)
+        low = out.lower()
+    if "отказ" in low:
+        out = _FAILURE_RE.sub("", out)
+    if "•" in out:
+        out = _BULLET_RE.sub("- ", out)
+    out = _TIMES_RE.sub(r"\1×\2", out)
+    if "<" in out:
+        out = _HTML_RE.sub("\n", out)
+    if "#" in out:
+        out = _HEADER_RE.sub("", out)
+    # косметика
+    if "(" in out:
+        out = _EMPTY_PARENS_RE.sub("", out)
+    if "," in out:
+        out = _DOUBLE_COMMA_RE.sub(", ", out)
+    out = _SPACES_RE.sub(" ", out)
+    out = _LINE_EDGE_RE.sub("\n", out)
+    if "\n\n\n" in out:
+        out = _BLANK_LINES_RE.sub("\n\n", out)
+    return out.strip()
+
+
+def bold_fix(text: str) -> str:
+    """Заменяет **...** на *...* по всему тексту (в Telegram Markdown жирный — один *)."""
+    return _BOLD_RE.sub(r"*\1*", text) if "**" in text else text
+
+
+def bold_day_headers(text: str) -> str:
+    """Оборачивает заголовки «День N» или «День N — …» в * для жирного (Telegram ParseMode.MARKDOWN: жирный = один *)."""
+    if "День" not in text:
+        return text
+    out: List[str] = []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not stripped.startswith("День") or not _DAY_HEADER_RE.match(stripped):
+            out.append(line)
+            continue
+        # Модель могла вывести **...** — убираем, в Telegram нужен один *
+        if stripped.startswith("**") and stripped.endswith("**"):
+            stripped = stripped[2:-2]
+        elif stripped.startswith("*") and stripped.endswith("*"):
+            out.append(line)
+            continue
+        prefix = line[: len(line) - len(line.lstrip())]
+        out.append(prefix + "*" + stripped + "*")
+    return "\n".join(out)
+
+
+def sanitize(text: str) -> str:
+    """Убираем лишние HTML/markdown артефакты и заголовочные #."""
+    out = text or ""
+    if "#" in out:
+        out = _HEADER_RE.sub("", out)
+    if "<" in out:
+        out = _HTML_RE.sub("\n", out)
+    if "\n\n\n" in out:
+        out = _BLANK_LINES_RE.sub("\n\n", out)
+    return out.strip()
+
+
+def clean_program(text: str) -> str:
+    """Программа для Telegram: шум → **…** в *…* → жирные «День N» → sanitize."""
+    return sanitize(bold_day_headers(bold_fix(strip_noise(text))))
+
+
+def clean_answer(text: str) -> str:
+    """Ответ на вопрос: как программа, плюс пустая строка перед каждым «День N» (кроме первого)."""
+    out = bold_day_headers(bold_fix(strip_noise(text)))
+    if "\nДень " in out:
+        out = _DAY_BREAK_RE.sub(r"\n\n\1", out)
+        if "\n\n\n" in out:
+            out = _BLANK_LINES_RE.sub("\n\n", out)
+    return sanitize(out)
+
+
+class StreamSanitizer:
+    """
+    sanitize() для превью стриминга. feed() получает весь накопленный сырой текст; законченные
+    абзацы (до «\\n\\n», на стыке которого ни один шаблон sanitize не может сработать) чистятся
+    один раз и запоминаются, заново обрабатывается только хвост. Результат равен sanitize(raw).
+    Если raw не продолжает уже обработанный текст (повтор запроса, текстовый ответ после
+    отклонённого JSON), накопленное сбрасывается.
+    """
+
+    # символы, рядом с которыми стык абзацев может попасть в шаблон (#-заголовок, теги, пробелы)
+    _UNSAFE_BEFORE = frozenset("#<>/ \t\n")
+    _UNSAFE_AFTER = frozenset("#</> \t\n")
+
+    def __init__(self):
+        self._done = ""   # очищенные законченные абзацы
+        self._head = ""   # их сырой текст: raw[:_pos]
+        self._pos = 0     # начало необработанного хвоста в сыром тексте
+
+    def _boundary(self, raw: str) -> int:
+        """Последний безопасный стык «\\n\\n» после _pos (индекс первого \\n) или -1."""
+        end = len(raw)
+        while True:
+            i = raw.rfind("\n\n", self._pos + 1, end)
+            if i < 0:
+                return -1
+            if (
+                i + 2 < len(raw)
+                and raw[i - 1] not in self._UNSAFE_BEFORE
+                and raw[i + 2] not in self._UNSAFE_AFTER
+            ):
+                return i
+            end = i + 1
+
+    def feed(self, raw: str) -> str:
+        if not raw.startswith(self._head):
+            # текст начался заново — сбрасываем накопленное; проверяется на каждом feed(),
+            # поэтому пропущенные (троттлинг) куски нового текста сброс не отменяют
+            self._done, self._head, self._pos = "", "", 0
+        cut = self._boundary(raw)
+        if cut > 0:
+            part = sanitize(raw[self._pos:cut])
+            self._done = f"{self._done}\n\n{part}" if self._done and part else (self._done or part)
+            self._pos = cut + 2
+            self._head = raw[:self._pos]
+        tail = sanitize(raw[self._pos:])
+        if not self._done:
+            return tail
+        return f"{self._done}\n\n{tail}" if tail else self._done
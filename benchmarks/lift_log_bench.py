@@ -0,0 +1,115 @@
+"""
+Дневник подходов: app.lift_log (дописывание в файл + агрегаты в памяти) против прежнего
+save_lift_history из app.storage (50 последних подходов в документе, запись документа;
+из app.storage убран, его копия — _legacy_save).
+
+1. Запись одного подхода: µs и байт на запись — прежний путь (_legacy_save +
+   diff_user_data + сериализация ops / всего документа, как их пишет сессия) против
+   LiftLogs.log_sets (один write() в конец файла).
+2. Сводка для модели (последний вес, расчётный 1ПМ, тоннаж за неделю): проход по истории
+   в документе против готовых агрегатов, µs на упражнение.
+3. Холодная загрузка журнала (первое обращение после рестарта) на --sets подходов.
+
+    python -m benchmarks.lift_log_bench --sets 5000 --lifts 8
+"""
+import argparse
+import copy
+import json
+import random
+import tempfile
+import time
+
+from benchmarks.storage_partial import _heavy_user
+
+LIFTS = ["Жим лёжа", "Присед", "Становая тяга", "Жим стоя", "Тяга в наклоне", "Подтягивания", "Выпады", "Румынская тяга"]
+
+
+def _legacy_save(d: dict, lift_key: str, last_weight: float, reps: int, rir=None) -> None:
+    """Прежний app.storage.save_lift_history над документом в памяти."""
+    entry = {"ts": int(time.time()), "last_weight": float(last_weight), "reps": int(reps), "rir": rir}
+    rec = d.setdefault("lifts", {}).get(lift_key) or {}
+    rec.update(last_weight=entry["last_weight"], reps=entry["reps"], rir=entry["rir"])
+    rec["history"] = (rec.get("history") or [])[-49:] + [entry]
+    d["lifts"][lift_key] = rec
+
+
+def _legacy_summary(rec: dict, now: float) -> tuple:
+    from app.lift_log import estimate_1rm, week_of
+
+    hist = rec.get("history") or []
+    week = week_of(now)
+    best = max((estimate_1rm(e["last_weight"], e["reps"], e.get("rir")) for e in hist), default=0.0)
+    volume = sum(e["last_weight"] * e["reps"] for e in hist if week_of(e["ts"]) == week)
+    return rec.get("last_weight"), best, volume
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=5000, help="подходов в журнале пользователя")
+    parser.add_argument("--lifts", type=int, default=8, help="разных упражнений")
+    parser.add_argument("--history", type=int, default=100, help="длина истории разговоров в документе")
+    args = parser.parse_args()
+
+    from app import storage
+    from app.lift_log import LiftLogs, LoggedSet, lift_key, week_of
+
+    rnd = random.Random(25)
+    names = LIFTS[:args.lifts]
+    sets = [LoggedSet(rnd.choice(names), rnd.choice((40, 50, 60, 62.5, 80, 100)), rnd.randint(3, 12)) for _ in range(args.sets)]
+    now = int(time.time())
+    stamps = [now - (args.sets - i) * 3600 for i in range(args.sets)]
+
+    # 1. запись подхода
+    doc = storage._ensure_structure(_heavy_user(args.history))
+    t_legacy = 0.0
+    ops_bytes = full_bytes = 0
+    for s in sets:
+        before = copy.deepcopy(doc)
+        t = time.perf_counter()
+        _legacy_save(doc, s.name, s.weight, s.reps)
+        ops = storage.diff_user_data(before, doc)
+        ops_raw = json.dumps([list(op) for op in ops], ensure_ascii=False).encode()
+        t_legacy += time.perf_counter() - t
+        ops_bytes += len(ops_raw)
+        full_bytes += len(json.dumps(doc, ensure_ascii=False).encode())
+
+    with tempfile.TemporaryDirectory() as root:
+        logs = LiftLogs(root)
+        t = time.perf_counter()
+        for s, ts in zip(sets, stamps):
+            logs.log_sets("u", [s], ts=ts)
+        t_new = time.perf_counter() - t
+        file_bytes = logs.path("u").stat().st_size
+        n = len(sets)
+        print(f"запись подхода: было {t_legacy / n * 1e6:7.1f} µs, ops {ops_bytes / n:7.0f} Б "
+              f"(документ целиком {full_bytes / n:,.0f} Б)   стало {t_new / n * 1e6:7.1f} µs, {file_bytes / n:.1f} Б в файл")
+
+        # 2. сводка
+        recs = [doc["lifts"][name] for name in names]
+        log = logs.get("u")
+        series = [log.lifts[lift_key(name)] for name in names]
+        repeat = 2000
+        t = time.perf_counter()
+        for _ in range(repeat):
+            for rec in recs:
+                _legacy_summary(rec, now)
+        legacy_us = (time.perf_counter() - t) / repeat / len(recs) * 1e6
+        t = time.perf_counter()
+        for _ in range(repeat):
+            for s in series:
+                s.last_weight, s.best_e1rm, s.volume(week_of(now))
+        new_us = (time.perf_counter() - t) / repeat / len(series) * 1e6
+        kept = sum(len(rec["history"]) for rec in recs)
+        print(f"сводка по упражнению: было {legacy_us:6.2f} µs (по {kept} подходам из {n} — старые потеряны)   "
+              f"стало {new_us:6.2f} µs (по всем)")
+
+        # 3. холодная загрузка
+        t = time.perf_counter()
+        cold = LiftLogs(root).get("u")
+        load_ms = (time.perf_counter() - t) * 1000
+        assert sum(len(s) for s in cold.by_id) == n
+        print(f"холодная загрузка: {n} подходов, {file_bytes / 1024:.0f} КБ файла — {load_ms:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
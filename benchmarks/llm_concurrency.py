@@ -0,0 +1,98 @@
+"""
+200 одновременных QA-запросов к локальной заглушке OpenAI API: потоки против нативного asyncio.
+
+threads — как было: sync OpenAI на каждый запрос внутри asyncio.to_thread (пул потоков
+по умолчанию — min(32, CPU+4) воркеров, новое соединение на запрос);
+native  — FitnessAgent.get_answer на общем AsyncOpenAI из app.llm (keep-alive, LLM_MAX_CONNECTIONS).
+
+    python -m benchmarks.llm_concurrency --requests 200 --ttft 1.0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks.mock_openai import MockOpenAIServer
+
+USER_DATA = {
+    "physical_data": {"name": "Тест", "gender": "мужской", "age": "35", "height": "180", "weight": "82", "target": "похудение"},
+    "physical_data_completed": True,
+    "history": [],
+}
+QUESTION = "Сколько белка в день мне нужно?"
+
+
+def _report(label: str, latencies: list, elapsed: float, server: MockOpenAIServer) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<8} {elapsed:6.2f}s всего   {len(latencies) / elapsed:7.1f} req/s   "
+        f"p50 {statistics.median(latencies):5.2f}s   p95 {p95:5.2f}s   max {latencies[-1]:5.2f}s   "
+        f"одновременно на сервере {server.peak_active:>3}   TCP-соединений {server.connections}"
+    )
+
+
+async def _timed(coro_factory) -> float:
+    t0 = time.perf_counter()
+    await coro_factory()
+    return time.perf_counter() - t0
+
+
+async def bench_threads(n: int, base_url: str) -> list:
+    from openai import OpenAI
+
+    from app.agent import DEEPSEEK_MAX_TOKENS, DEEPSEEK_MODEL
+
+    def _chat_sync() -> str:
+        client = OpenAI(api_key="x", base_url=base_url, timeout=90)
+        resp = client.chat.completions.create(
+            model=DEEPSEEK_MODEL,
+            messages=[{"role": "user", "content": QUESTION}],
+            temperature=0.5,
+            max_tokens=DEEPSEEK_MAX_TOKENS,
+            stream=False,
+        )
+        return resp.choices[0].message.content or ""
+
+    return await asyncio.gather(*(_timed(lambda: asyncio.to_thread(_chat_sync)) for _ in range(n)))
+
+
+async def bench_native(n: int) -> list:
+    from app.agent import FitnessAgent
+    from app.llm import close_llm_client
+
+    def one():
+        agent = FitnessAgent(token="x", user_id="bench", user_data={**USER_DATA, "history": []})
+        return agent.get_answer(QUESTION)
+
+    try:
+        return await asyncio.gather(*(_timed(one) for _ in range(n)))
+    finally:
+        await close_llm_client()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--ttft", type=float, default=1.0, help="«время генерации» ответа заглушкой, сек")
+    parser.add_argument("--tokens", type=int, default=60)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(ttft=args.ttft, tps=1000, tokens=args.tokens).start()
+    # app.llm читает адрес и ключ при импорте
+    os.environ["DEEPSEEK_BASE_URL"] = server.base_url
+    os.environ["DEEPSEEK_API_KEY"] = "x"
+    print(f"{args.requests} одновременных запросов, ответ заглушки ~{args.ttft + args.tokens / 1000:.2f}s")
+    try:
+        for label, run in (("threads", lambda: bench_threads(args.requests, server.base_url)), ("native", lambda: bench_native(args.requests))):
+            server.reset_stats()
+            t0 = time.perf_counter()
+            latencies = asyncio.run(run())
+            _report(label, latencies, time.perf_counter() - t0, server)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Повторы, дедлайн и circuit breaker вызовов LLM против заглушки со сбоями (benchmarks.mock_openai).
+
+Сценарии (FitnessAgent.get_answer, общий клиент app.llm, слой app.resilience):
+  flaky    — 15% 500 и 5% 429: все запросы должны пройти за счёт повторов;
+  slow     — upstream «висит»: запрос обрывается по дедлайну LLM_DEADLINE, а не через RETRIES × TIMEOUT;
+  outage   — всегда 503: breaker открывается после LLM_BREAKER_THRESHOLD сбоев,
+             повторы и новые запросы сразу получают UpstreamUnavailable, к upstream не доходят;
+  recovery — upstream поднялся: после LLM_BREAKER_RESET пробный запрос закрывает breaker.
+
+    python -m benchmarks.llm_faults --requests 100
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.mock_openai import MockOpenAIServer
+
+USER_DATA = {"physical_data": {"name": "Тест", "age": "30"}, "physical_data_completed": True, "history": []}
+
+
+async def _ask_all(n: int) -> tuple:
+    """n одновременных вопросов → (ok, {тип ошибки: число}, время самого долгого, сек)."""
+    from app.agent import FitnessAgent
+
+    async def one():
+        agent = FitnessAgent(token="x", user_id="bench", user_data={**USER_DATA, "history": []})
+        t0 = time.perf_counter()
+        try:
+            await agent.get_answer("Как восстановиться после тренировки?")
+            return None, time.perf_counter() - t0
+        except Exception as e:
+            return type(e).__name__, time.perf_counter() - t0
+
+    results = await asyncio.gather(*(one() for _ in range(n)))
+    errors: dict = {}
+    for err, _ in results:
+        if err:
+            errors[err] = errors.get(err, 0) + 1
+    return n - sum(errors.values()), errors, max(t for _, t in results)
+
+
+async def _run(args, server: MockOpenAIServer) -> None:
+    from app.llm import close_llm_client
+    from app.metrics import METRICS
+    from app.resilience import DEEPSEEK_BREAKER, LLM_BREAKER_RESET, LLM_DEADLINE
+
+    failed = []
+
+    def check(name: str, cond: bool) -> None:
+        print(f"  {'OK  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failed.append(name)
+
+    def scenario(name: str, ok: int, errors: dict, slowest: float) -> None:
+        print(
+            f"{name:<9} ok {ok:>4}  ошибки {errors or '-'}  самый долгий {slowest:5.2f}s  "
+            f"запросов к upstream {server.requests:>4}  сбоев {server.faults:>4}  "
+            f"повторов {METRICS.get('llm.retries'):.0f}  breaker {DEEPSEEK_BREAKER.state}"
+        )
+
+    try:
+        server.reset_stats()
+        server.fail_rate, server.ratelimit_rate = 0.15, 0.05
+        ok, errors, slowest = await _ask_all(args.requests)
+        scenario("flaky", ok, errors, slowest)
+        check("временные ошибки скрыты повторами (>= 95% успешных)", ok >= args.requests * 0.95)
+        server.fail_rate = server.ratelimit_rate = 0.0
+        DEEPSEEK_BREAKER.reset()
+
+        server.reset_stats()
+        server.hang_rate = 1.0
+        ok, errors, slowest = await _ask_all(5)
+        scenario("slow", ok, errors, slowest)
+        check(f"запрос укладывается в дедлайн {LLM_DEADLINE:.0f}s", slowest <= LLM_DEADLINE + 1)
+        server.hang_rate = 0.0
+        DEEPSEEK_BREAKER.reset()
+
+        server.reset_stats()
+        server.down = True
+        ok, errors, slowest = await _ask_all(args.requests)
+        scenario("outage", ok, errors, slowest)
+        check("breaker открыт", DEEPSEEK_BREAKER.state == "open")
+        check("большинство запросов отклонено без обращения к upstream", errors.get("UpstreamUnavailable", 0) >= args.requests // 2)
+        t0 = time.perf_counter()
+        ok, errors, _ = await _ask_all(args.requests)
+        fail_fast = time.perf_counter() - t0
+        print(f"  при открытом breaker: {errors}, {fail_fast * 1000:.1f} ms на {args.requests} запросов")
+        check("при открытом breaker ответ мгновенный", fail_fast < 0.5 and errors.get("UpstreamUnavailable") == args.requests)
+
+        server.down = False
+        await asyncio.sleep(LLM_BREAKER_RESET + 0.1)
+        server.reset_stats()
+        ok, errors, slowest = await _ask_all(args.requests)
+        scenario("recovery", ok, errors, slowest)
+        check("после восстановления breaker закрыт", DEEPSEEK_BREAKER.state == "closed")
+    finally:
+        await close_llm_client()
+    if failed:
+        raise SystemExit(f"FAIL: {', '.join(failed)}")
+    print("OK")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(ttft=0.05, tps=10000, tokens=40).start()
+    server.hang = 60
+    # параметры app.llm / app.resilience читаются при импорте: короткие таймауты для теста
+    os.environ.update({
+        "DEEPSEEK_BASE_URL": server.base_url,
+        "DEEPSEEK_API_KEY": "x",
+        "DEEPSEEK_TIMEOUT": os.getenv("DEEPSEEK_TIMEOUT", "2"),
+        "DEEPSEEK_RETRIES": os.getenv("DEEPSEEK_RETRIES", "4"),
+        "LLM_BACKOFF_BASE": os.getenv("LLM_BACKOFF_BASE", "0.2"),
+        "LLM_BACKOFF_MAX": os.getenv("LLM_BACKOFF_MAX", "1"),
+        "LLM_DEADLINE": os.getenv("LLM_DEADLINE", "5"),
+        "LLM_BREAKER_THRESHOLD": os.getenv("LLM_BREAKER_THRESHOLD", "5"),
+        "LLM_BREAKER_RESET": os.getenv("LLM_BREAKER_RESET", "2"),
+    })
+    try:
+        asyncio.run(_run(args, server))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
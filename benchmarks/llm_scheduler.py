@@ -0,0 +1,86 @@
+"""
+Всплеск трафика через app.scheduler: предел одновременных генераций, приоритет QA,
+честность между пользователями и сброс нагрузки. LLM имитируется asyncio.sleep.
+
+Сценарий: --users пользователей одновременно шлют вопросы и запросы программ,
+плюс один «шумный» пользователь ставит --heavy программ подряд. Печатает ожидание
+в очереди по видам (p50/p95), сколько запросов сброшено и сколько ждал обычный
+пользователь по сравнению с шумным.
+
+    python -m benchmarks.llm_scheduler --users 80 --in-flight 8 --max-queue 50
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from app.scheduler import KIND_PROGRAM, KIND_QA, LLMScheduler, Overloaded
+
+
+def _pct(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float("nan")
+
+
+async def _run(args) -> None:
+    sched = LLMScheduler(max_in_flight=args.in_flight, max_queue=args.max_queue, queue_timeout=args.queue_timeout)
+    waits = {KIND_QA: [], KIND_PROGRAM: []}
+    heavy_waits: list = []
+    shed = {KIND_QA: 0, KIND_PROGRAM: 0}
+    peak = 0
+    position_updates = 0
+
+    async def request(user_id: str, kind: str, duration: float) -> None:
+        nonlocal peak, position_updates
+
+        async def on_position(pos: int) -> None:
+            nonlocal position_updates
+            position_updates += 1
+
+        t0 = time.perf_counter()
+        try:
+            async with sched.slot(user_id, kind, on_position=on_position):
+                waited = time.perf_counter() - t0
+                (heavy_waits if user_id == "heavy" else waits[kind]).append(waited)
+                peak = max(peak, sched.in_flight)
+                await asyncio.sleep(duration)
+        except Overloaded:
+            shed[kind] += 1
+
+    rnd = random.Random(1)
+    jobs = [request("heavy", KIND_PROGRAM, args.program_time) for _ in range(args.heavy)]
+    for u in range(args.users):
+        kind = KIND_QA if rnd.random() < args.qa_share else KIND_PROGRAM
+        jobs.append(request(f"user{u}", kind, args.qa_time if kind == KIND_QA else args.program_time))
+    rnd.shuffle(jobs)
+    t0 = time.perf_counter()
+    await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{len(jobs)} запросов за {elapsed:.2f}s; одновременно максимум {peak} (предел {args.in_flight}); "
+          f"сообщений о позиции в очереди {position_updates}")
+    for kind in (KIND_QA, KIND_PROGRAM):
+        w = waits[kind]
+        print(f"{kind:<8} принято {len(w):>3}  сброшено {shed[kind]:>3}  ожидание p50 {statistics.median(w) if w else float('nan'):6.2f}s  p95 {_pct(w, 0.95):6.2f}s")
+    print(f"шумный пользователь: {len(heavy_waits)} из {args.heavy} приняты, ожидание p50 "
+          f"{statistics.median(heavy_waits) if heavy_waits else float('nan'):.2f}s — остальные не стоят за его очередью")
+    if peak > args.in_flight:
+        raise SystemExit("FAIL: превышен предел одновременных запросов")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=80)
+    parser.add_argument("--heavy", type=int, default=10, help="программ подряд от одного пользователя")
+    parser.add_argument("--qa-share", type=float, default=0.6)
+    parser.add_argument("--in-flight", type=int, default=8)
+    parser.add_argument("--max-queue", type=int, default=50)
+    parser.add_argument("--queue-timeout", type=float, default=30)
+    parser.add_argument("--qa-time", type=float, default=0.2, help="«генерация» ответа, сек")
+    parser.add_argument("--program-time", type=float, default=1.0, help="«генерация» программы, сек")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
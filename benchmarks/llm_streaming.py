@@ -0,0 +1,115 @@
+"""
+Стриминг ответа модели: время до первого контента в Telegram — обычный запрос против stream=True.
+
+Поднимает benchmarks.mock_openai, генерирует программу через FitnessAgent.get_program
+и показывает её через bot.telegram_bot._StreamingReply на фейковом чате (правки с задержкой
+как у Bot API). Проверяет, что правки одного сообщения не чаще STREAM_EDIT_INTERVAL и что
+итоговый текст совпадает с ответом без стриминга.
+
+    python -m benchmarks.llm_streaming --ttft 0.8 --tps 60 --tokens 1500
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.mock_openai import MockOpenAIServer
+
+USER_DATA = {
+    "physical_data": {
+        "name": "Тест", "gender": "женский", "age": "30", "height": "168", "weight": "62", "target": "набор массы",
+        "goal": "65", "schedule": "3", "level": "Начинающий", "preferred_muscle_group": "ягодицы",
+    },
+    "physical_data_completed": True,
+    "history": [],
+}
+
+
+class _FakeMessage:
+    def __init__(self, log: list, latency: float, text: str = ""):
+        self.text = text
+        self.log = log
+        self.latency = latency
+        self.edit_times: list = []
+
+    async def edit_text(self, text, parse_mode=None, disable_web_page_preview=None):
+        await asyncio.sleep(self.latency)
+        self.text = text
+        self.edit_times.append(time.monotonic())
+        self.log.append(("edit", id(self)))
+
+    async def delete(self):
+        await asyncio.sleep(self.latency)
+        self.log.append(("delete", id(self)))
+
+
+class _FakeChat:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.log: list = []
+        self.sent: list = []
+
+    async def send_message(self, text, parse_mode=None, disable_web_page_preview=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        msg = _FakeMessage(self.log, self.latency, text)
+        self.sent.append(msg)
+        self.log.append(("send", id(msg)))
+        return msg
+
+
+async def _run(args) -> None:
+    from app.agent import FitnessAgent
+    from bot.telegram_bot import STREAM_EDIT_INTERVAL, _StreamingReply, _split_for_telegram
+
+    # без стриминга: пользователь видит только «⏳ Генерирую…», пока не придёт весь ответ
+    agent = FitnessAgent(token="x", user_id="bench", user_data={**USER_DATA, "history": []})
+    t0 = time.monotonic()
+    plain = await agent.get_program("")
+    plain_elapsed = time.monotonic() - t0
+
+    chat = _FakeChat(args.latency)
+    progress = _FakeMessage(chat.log, args.latency, "⏳ Генерирую программу...")
+    reply = _StreamingReply(chat, progress)
+    agent = FitnessAgent(token="x", user_id="bench", user_data={**USER_DATA, "history": []})
+    t0 = time.monotonic()
+    streamed = await agent.get_program("", on_text=reply.update)
+    await reply.finish(streamed)
+    stream_elapsed = time.monotonic() - t0
+
+    messages = [progress] + [m for m in chat.sent if m in reply.messages]
+    gaps = [b - a for m in messages for a, b in zip(m.edit_times, m.edit_times[1:])]
+    parts = _split_for_telegram(streamed)
+    final_ok = [m.text for m in reply.messages] == parts and streamed == plain
+
+    print(f"ответ: {len(plain)} символов, {len(parts)} сообщ.; правок {reply.edits}, интервал {STREAM_EDIT_INTERVAL}s")
+    print(f"без стриминга: первый контент через {plain_elapsed:6.2f}s (он же весь ответ)")
+    print(f"стриминг:      первый контент через {reply.time_to_first_content:6.2f}s, весь ответ {stream_elapsed:6.2f}s")
+    print(f"мин. интервал между правками одного сообщения: {min(gaps) if gaps else float('nan'):.2f}s")
+    if not final_ok:
+        raise SystemExit("FAIL: итоговые сообщения не совпадают с ответом без стриминга")
+    # последняя правка ждёт окончания интервала, промежуточные — пропускаются; небольшой допуск на задержки
+    if gaps and min(gaps) < STREAM_EDIT_INTERVAL - 0.05:
+        raise SystemExit("FAIL: правки чаще STREAM_EDIT_INTERVAL")
+    print("OK")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ttft", type=float, default=0.8)
+    parser.add_argument("--tps", type=float, default=60)
+    parser.add_argument("--tokens", type=int, default=1500)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка Bot API на правку/отправку, сек")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(ttft=args.ttft, tps=args.tps, tokens=args.tokens).start()
+    # агент читает адрес API при импорте
+    os.environ["DEEPSEEK_BASE_URL"] = server.base_url
+    os.environ.setdefault("DEEPSEEK_STREAM", "1")
+    try:
+        asyncio.run(_run(args))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
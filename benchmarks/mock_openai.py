@@ -0,0 +1,244 @@
+"""
+Локальная заглушка OpenAI-совместимого API (POST .../chat/completions) — только stdlib.
+
+Отвечает «программой тренировок» из --tokens токенов: первый токен через --ttft секунд,
+дальше --tps токенов в секунду. Поддерживает stream=true (SSE, как DeepSeek/OpenAI)
+и обычный ответ (весь текст после полной «генерации»).
+
+Инъекция сбоев (доли запросов): --fail-rate → 500, --ratelimit-rate → 429 с Retry-After,
+--hang-rate → ответ через --hang секунд (таймаут клиента), --down → всегда 503.
+
+--replay file.jsonl — вместо fake_program отдавать записанные ответы ({"format": "json"|"text",
+"content": "…"} на строку) по кругу: "json" — на запросы с response_format, "text" — на остальные.
+
+    python -m benchmarks.mock_openai --port 8765 --ttft 0.8 --tps 60
+    python -m benchmarks.mock_openai --fail-rate 0.3 --ratelimit-rate 0.1
+    python -m benchmarks.mock_openai --replay recorded.jsonl
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8765 DEEPSEEK_API_KEY=x python main.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+_TOKEN_RE = re.compile(r"\s*\S{1,6}|\s+")
+
+
+def fake_program(tokens: int) -> List[str]:
+    """Текст, похожий на ответ модели (дни, упражнения, **жирный**), порезанный на токены."""
+    out: List[str] = []
+    day = 0
+    while len(out) < tokens:
+        day += 1
+        out += [f"\n\n**День {day} — Ноги и ягодицы**\n"]
+        for n in range(1, 7):
+            out += ["- ", "Приседания ", "со ", "штангой", f": 4x{8 + n}", " (RPE 8)", ",", " отдых ", "90 ", "сек\n"]
+    return out[:tokens]
+
+
+def split_tokens(text: str) -> List[str]:
+    """Записанный ответ → куски по ~токену (для SSE); "".join(...) == text."""
+    return _TOKEN_RE.findall(text)
+
+
+def load_replay(path: str) -> Dict[str, List[str]]:
+    out: Dict[str, List[str]] = {"json": [], "text": []}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                out["json" if rec.get("format") == "json" else "text"].append(rec["content"])
+    return out
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockOpenAIServer"
+
+    def log_message(self, fmt, *args) -> None:  # тише в консоли бенчмарка
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            self.send_error(404)
+            return
+        self.server.track(+1)
+        try:
+            fault = self.server.pick_fault()
+            if fault == "down":
+                self._error(503, "upstream is down")
+            elif fault == "error":
+                self._error(500, "injected failure")
+            elif fault == "ratelimit":
+                self._error(429, "rate limited", {"Retry-After": "1"})
+            else:
+                if fault == "hang":
+                    time.sleep(self.server.hang)
+                self._reply(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # клиент ушёл по таймауту
+        finally:
+            self.server.track(-1)
+
+    def _reply(self, body: dict) -> None:
+        tokens = self.server.next_replay("json" if body.get("response_format") else "text") or fake_program(self.server.tokens)
+        if body.get("stream"):
+            self._stream(body.get("model", "mock"), tokens)
+        else:
+            time.sleep(self.server.ttft + len(tokens) / self.server.tps)
+            self._json({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(tokens)}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": len(tokens), "total_tokens": len(tokens) + 1},
+            })
+
+    def _error(self, status: int, message: str, headers: Optional[dict] = None) -> None:
+        self._json({"error": {"message": message, "type": "mock_error", "code": status}}, status, headers)
+
+    def _json(self, payload: dict, status: int = 200, headers: Optional[dict] = None) -> None:
+        raw = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _stream(self, model: str, tokens: List[str]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload) -> None:
+            data = ("data: " + (payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)) + "\n\n").encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta: dict, finish=None) -> dict:
+            return {
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            }
+
+        time.sleep(self.server.ttft)
+        event(chunk({"role": "assistant", "content": ""}))
+        for tok in tokens:
+            event(chunk({"content": tok}))
+            time.sleep(1 / self.server.tps)
+        event(chunk({}, "stop"))
+        event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # сотни одновременных connect от бенчмарка
+
+    def __init__(self, addr: Tuple[str, int] = ("127.0.0.1", 0), ttft: float = 0.8, tps: float = 60, tokens: int = 600):
+        super().__init__(addr, _Handler)
+        self.ttft = ttft
+        self.tps = tps
+        self.tokens = tokens
+        # инъекция сбоев: доли запросов; можно менять на лету из бенчмарка
+        self.fail_rate = 0.0
+        self.ratelimit_rate = 0.0
+        self.hang_rate = 0.0
+        self.hang = 30.0
+        self.down = False
+        # записанные ответы по формату ("json" / "text"); пусто — fake_program
+        self.replay: Dict[str, List[str]] = {"json": [], "text": []}
+        self.replayed: Dict[str, int] = {"json": 0, "text": 0}
+        self.faults = 0
+        self.requests = 0
+        self.connections = 0   # принятых TCP-соединений (keep-alive клиента → меньше, чем запросов)
+        self.active = 0
+        self.peak_active = 0
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address) -> None:
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def track(self, delta: int) -> None:
+        with self._lock:
+            if delta > 0:
+                self.requests += 1
+            self.active += delta
+            self.peak_active = max(self.peak_active, self.active)
+
+    def pick_fault(self) -> Optional[str]:
+        if self.down:
+            fault = "down"
+        else:
+            r = random.random()
+            fault = None
+            for name, rate in (("error", self.fail_rate), ("ratelimit", self.ratelimit_rate), ("hang", self.hang_rate)):
+                if r < rate:
+                    fault = name
+                    break
+                r -= rate
+        if fault:
+            with self._lock:
+                self.faults += 1
+        return fault
+
+    def next_replay(self, fmt: str) -> Optional[List[str]]:
+        recorded = self.replay.get(fmt)
+        if not recorded:
+            return None
+        with self._lock:
+            n = self.replayed[fmt]
+            self.replayed[fmt] = n + 1
+        return split_tokens(recorded[n % len(recorded)])
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests = self.connections = self.peak_active = self.faults = 0
+            self.replayed = {"json": 0, "text": 0}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockOpenAIServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.8, help="секунд до первого токена")
+    parser.add_argument("--tps", type=float, default=60, help="токенов в секунду")
+    parser.add_argument("--tokens", type=int, default=600)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--ratelimit-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=30.0)
+    parser.add_argument("--down", action="store_true")
+    parser.add_argument("--replay", help="JSONL с записанными ответами")
+    args = parser.parse_args()
+    server = MockOpenAIServer(("127.0.0.1", args.port), args.ttft, args.tps, args.tokens)
+    server.fail_rate, server.ratelimit_rate, server.hang_rate = args.fail_rate, args.ratelimit_rate, args.hang_rate
+    server.hang, server.down = args.hang, args.down
+    if args.replay:
+        server.replay = load_replay(args.replay)
+    print(f"mock OpenAI API on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+PDF-экспорт программ (app.pdf_export): PDF/с и p50/p95 рендера на типовых программах 4–6 дней.
+
+1. Один процесс, подряд (render_pdf) — цена одного рендера; первый вызов отдельно
+   (регистрация шрифтов и стилей, дальше они переиспользуются).
+2. PdfExporter с --workers процессами: --total разных программ по --concurrency одновременно —
+   PDF/с и p50/p95 времени ответа, как видит обработчик бота; заодно проверяется, что цикл
+   событий не блокируется (максимальная задержка тика таймера 10 мс).
+3. Повторный экспорт тех же программ — из кэша по хэшу текста.
+
+    python -m benchmarks.pdf_export_bench --total 200 --workers 2 --concurrency 8
+"""
+import argparse
+import asyncio
+import random
+import time
+
+GROUPS = ["Ноги и ягодицы", "Верх тела", "Спина и бицепс", "Грудь и трицепс", "Плечи и кор", "Всё тело"]
+EXERCISES = [
+    "Приседания со штангой", "Румынская тяга", "Жим лёжа", "Тяга верхнего блока", "Выпады с гантелями",
+    "Жим гантелей сидя", "Тяга гантели в наклоне", "Ягодичный мост", "Подъёмы на носки", "Планка",
+    "Разведения гантелей", "Сгибания на бицепс", "Французский жим", "Гиперэкстензия",
+]
+
+
+def program(rnd: random.Random, n: int) -> str:
+    days = rnd.randint(4, 6)
+    lines = [f"Анна, вот твоя программа на {days} дней (вариант {n}) 💪", ""]
+    for d in range(1, days + 1):
+        lines.append(f"*День {d} — {rnd.choice(GROUPS)}*")
+        for _ in range(rnd.randint(5, 7)):
+            lines.append(f"- {rnd.choice(EXERCISES)} {rnd.randint(3, 5)}×{rnd.randint(6, 15)}, отдых {rnd.choice((60, 90, 120))} сек")
+        lines.append("")
+    lines += ["*Питание*", "КБЖУ: 1900/140/60/200", "- Белок в каждый приём пищи", "", "Совет: *держи технику* и добавляй вес постепенно."]
+    return "\n".join(lines)
+
+
+def _pct(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def _exporter_run(exporter, texts, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    lag = 0.0
+    stop = False
+
+    async def ticker():
+        nonlocal lag
+        while not stop:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.perf_counter() - t - 0.01)
+
+    async def one(text):
+        async with sem:
+            t = time.perf_counter()
+            await exporter.render(text)
+            latencies.append(time.perf_counter() - t)
+
+    tick = asyncio.create_task(ticker())
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(t) for t in texts))
+    elapsed = time.perf_counter() - t0
+    stop = True
+    await tick
+    return elapsed, latencies, lag
+
+
+async def main_async(args) -> None:
+    from app.pdf_export import PdfExporter, render_pdf
+
+    rnd = random.Random(11)
+    texts = [program(rnd, i) for i in range(args.total)]
+    avg_kb = sum(len(t.encode("utf-8")) for t in texts) / len(texts) / 1024
+
+    t = time.perf_counter()
+    first = render_pdf(texts[0])
+    print(f"первый рендер (шрифты, стили): {(time.perf_counter() - t) * 1000:.0f} мс, PDF {len(first) / 1024:.0f} КБ, текст {avg_kb:.1f} КБ")
+    serial = []
+    for text in texts[:args.serial]:
+        t = time.perf_counter()
+        render_pdf(text)
+        serial.append(time.perf_counter() - t)
+    print(f"один процесс:  {len(serial) / sum(serial):6.1f} PDF/с   p50 {_pct(serial, .5) * 1000:5.0f} мс   p95 {_pct(serial, .95) * 1000:5.0f} мс")
+
+    exporter = PdfExporter(workers=args.workers)
+    try:
+        await exporter.render(texts[0])  # поднять воркеры до замера
+        elapsed, lat, lag = await _exporter_run(exporter, texts[1:], args.concurrency)
+        print(f"пул {args.workers} проц.: {len(lat) / elapsed:6.1f} PDF/с   p50 {_pct(lat, .5) * 1000:5.0f} мс   "
+              f"p95 {_pct(lat, .95) * 1000:5.0f} мс   (по {args.concurrency} одновременно; макс. задержка цикла {lag * 1000:.0f} мс)")
+        elapsed, lat, _ = await _exporter_run(exporter, texts[1:], args.concurrency)
+        print(f"повтор (кэш):  {len(lat) / elapsed:6.0f} PDF/с   p95 {_pct(lat, .95) * 1e6:5.0f} µs")
+    finally:
+        await exporter.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--total", type=int, default=200, help="разных программ")
+    parser.add_argument("--serial", type=int, default=50, help="из них рендерить подряд в одном процессе")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Кэш программ (app.response_cache) на типичной нагрузке: много пользователей с одинаковыми
+анкетами нажимают кнопки вариаций. LLM — локальная заглушка (benchmarks.mock_openai).
+
+--users пользователей, анкеты выбираются из --profiles типовых (новичок 3×/неделю на
+похудение и т.п.) с разбросом возраста/роста/веса; каждый нажимает --presses кнопок
+вариаций, доля --random из них — «Случайная вариация» (мимо кэша). У доли --with-summary
+пользователей уже есть карточка клиента (app.coach_summary: личные предпочтения, у части —
+типовая травма) и записи в дневнике подходов (app.lift_log). Печатает долю
+попаданий, сколько запросов дошло до LLM, сэкономленные токены и среднюю задержку
+с попаданием и без — для точного ключа и для PROGRAM_CACHE_BUCKETED.
+
+    python -m benchmarks.program_cache --users 300 --profiles 12
+"""
+import argparse
+import asyncio
+import os
+import random
+
+from benchmarks.mock_openai import MockOpenAIServer
+
+VARIATIONS = [
+    "Сделай акцент на базовые многосуставные упражнения.",
+    "Добавь больше изолирующих упражнений для проработки отдельных мышечных групп.",
+    "Программа с акцентом на развитие силы: меньше повторений (4-6), больше отдыха, тяжелые веса.",
+    "Программа с акцентом на выносливость: больше повторений (15-20), меньше отдыха, умеренные веса.",
+]
+TARGETS = ["похудение", "набор массы", "поддержание формы"]
+LEVELS = ["новичок", "средний", "продвинутый"]
+GROUPS = ["ноги", "ягодицы", "спина", "сбалансированно"]
+INJURIES = ["болит колено, без прыжков", "грыжа поясницы, без осевой нагрузки", "плечо после травмы"]
+
+
+def _profiles(n: int, rnd: random.Random) -> list:
+    return [
+        {
+            "gender": rnd.choice(["мужской", "женский"]),
+            "target": rnd.choice(TARGETS),
+            "level": rnd.choice(LEVELS),
+            "schedule": rnd.choice(["2", "3", "4"]),
+            "preferred_muscle_group": rnd.choice(GROUPS),
+            "age": 20 + rnd.randrange(0, 30, 5),
+            "height": 160 + rnd.randrange(0, 30, 5),
+            "weight": 60 + rnd.randrange(0, 40, 5),
+        }
+        for _ in range(n)
+    ]
+
+
+async def _scenario(label: str, args, server: MockOpenAIServer, bucketed: bool) -> None:
+    import app.agent as agent_mod
+    from app.agent import FitnessAgent
+    from app.coach_summary import SUMMARY_FORMAT
+    from app.response_cache import ResponseCache
+
+    # свой кэш и свои счётчики на каждый сценарий
+    cache = agent_mod.PROGRAM_CACHE = ResponseCache(prefix=f"bench_cache_{label}")
+    agent_mod.PROGRAM_CACHE_BUCKETED = bucketed
+    server.reset_stats()
+
+    rnd = random.Random(7)
+    profiles = _profiles(args.profiles, rnd)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def user(i: int) -> None:
+        phys = dict(rnd.choice(profiles), name=f"user{i}")
+        # точные числа у всех чуть разные: «те же» 30 лет и 80 кг — это 31 год и 78 кг
+        phys["age"] = str(phys["age"] + rnd.randrange(args.jitter + 1))
+        phys["weight"] = str(phys["weight"] + rnd.randrange(args.jitter + 1))
+        phys["height"] = str(phys["height"] + rnd.randrange(args.jitter + 1))
+        doc = {"physical_data": phys, "history": []}
+        lifts = ""
+        if rnd.random() < args.with_summary:
+            card = [f"Предпочтения: любит {rnd.choice(GROUPS)}, тренируется {rnd.choice(['утром', 'вечером'])} ({i})"]
+            if rnd.random() < args.injured:
+                card.append(f"Травмы и ограничения: {rnd.choice(INJURIES)}")
+            doc["coach_summary"] = {"format": SUMMARY_FORMAT, "version": 1, "seq": 2, "text": "\n".join(card)}
+            lifts = f"🏋️ Рабочие веса (дневник подходов):\n- Присед: {40 + i % 60} кг × 8"
+        for _ in range(args.presses):
+            agent = FitnessAgent(token="x", user_id=f"user{i}", user_data=doc, lifts=lifts)
+            random_variation = rnd.random() < args.random
+            async with sem:
+                await agent.get_program(
+                    "Сделай максимально разнообразную программу." if random_variation else rnd.choice(VARIATIONS),
+                    use_cache=not random_variation,
+                )
+
+    await asyncio.gather(*(user(i) for i in range(args.users)))
+    st = cache.stats()
+    print(
+        f"{label:<9} попаданий {st['hit_ratio']:6.1%}  запросов к LLM {server.requests:>5} из {args.users * args.presses}  "
+        f"мимо кэша {st.get('bypass', 0):>4.0f}  сэкономлено токенов {st.get('saved_tokens', 0):>9,.0f}  "
+        f"задержка: попадание {st.get('hit_avg_seconds', 0) * 1000:6.2f} ms, промах {st.get('miss_avg_seconds', 0):5.2f} s"
+    )
+
+
+async def _run(args, server: MockOpenAIServer) -> None:
+    from app.llm import close_llm_client
+
+    try:
+        await _scenario("exact", args, server, bucketed=False)
+        await _scenario("bucketed", args, server, bucketed=True)
+    finally:
+        await close_llm_client()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--profiles", type=int, default=12, help="типовых анкет")
+    parser.add_argument("--presses", type=int, default=3, help="нажатий кнопок вариаций на пользователя")
+    parser.add_argument("--random", type=float, default=0.1, help="доля «Случайной вариации»")
+    parser.add_argument("--jitter", type=int, default=3, help="разброс возраста/роста/веса внутри типовой анкеты")
+    parser.add_argument("--with-summary", type=float, default=0.5,
+                        help="доля пользователей с карточкой клиента и дневником подходов")
+    parser.add_argument("--injured", type=float, default=0.3, help="доля карточек с травмой")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(ttft=args.ttft, tps=5000, tokens=600).start()
+    os.environ.update({"DEEPSEEK_BASE_URL": server.base_url, "DEEPSEEK_API_KEY": "x"})
+    try:
+        asyncio.run(_run(args, server))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
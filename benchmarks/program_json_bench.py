@@ -0,0 +1,203 @@
+"""
+JSON-режим генерации (app.program_json) против текстового пути с чисткой app.textproc.
+
+Записанные ответы — синтетические, в духе реальных: текст с **заголовками**, «4x10 (RPE 8)»,
+LaTeX и #; JSON по схеме JSON_FORMAT_PROMPT, доля --bad-rate испорчена так, как ломаются
+модели (обрыв по max_tokens, «до отказа» в reps, ```json-обёртка, лишний день).
+
+1. Постобработка, µs на программу: clean_program + разбор program_model против
+   parse_program_json + render + разбор; отдельно — проверка дней при стриминге
+   (JsonProgramStream.feed на каждом куске, как on_text).
+2. Отбраковка: доля JSON-ответов, ушедших в текстовый путь, и на какой доле потока
+   неверный день обрывает стрим (раньше — меньше потраченных токенов).
+3. Агент: FitnessAgent.get_program через benchmarks.mock_openai с --replay этих записей —
+   запросов к API на программу (повторы из-за отбраковки) и время ответа, json_mode выкл/вкл.
+
+    python -m benchmarks.program_json_bench --programs 200 --bad-rate 0.1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.mock_openai import MockOpenAIServer, load_replay, split_tokens
+from benchmarks.pdf_export_bench import EXERCISES, GROUPS
+
+USER_DATA = {
+    "physical_data": {
+        "name": "Тест", "gender": "женский", "age": "30", "height": "168", "weight": "62", "target": "набор массы",
+        "goal": "65", "schedule": "4", "level": "Начинающий", "preferred_muscle_group": "ягодицы",
+    },
+    "physical_data_completed": True,
+    "history": [],
+}
+
+
+def recorded_text(rnd: random.Random) -> str:
+    lines = ["Вот твоя программа на неделю 💪", ""]
+    for d in range(1, rnd.randint(4, 6) + 1):
+        lines.append(rnd.choice(["**День {d} — {g}**", "### День {d} — {g}", "День {d} — {g}"]).format(d=d, g=rnd.choice(GROUPS)))
+        for _ in range(rnd.randint(5, 7)):
+            sets, reps = rnd.randint(3, 5), rnd.randint(6, 15)
+            volume = rnd.choice([f"{sets}x{reps}", f"${sets} \\times {reps}$", f"{sets} x {reps}-{reps + 2}"])
+            lines.append(f"{rnd.choice(['-', '•', '*'])} {rnd.choice(EXERCISES)}: {volume} (RPE {rnd.randint(6, 9)}), отдых {rnd.choice((60, 90, 120))} сек")
+        lines.append("")
+    lines += ["**Питание**", "КБЖУ: 1900/140/60/200<br>", "- Белок в каждый приём пищи"]
+    return "\n".join(lines)
+
+
+def recorded_json(rnd: random.Random, bad: bool) -> str:
+    days = [
+        {
+            "title": f"День {d}",
+            "focus": rnd.choice(GROUPS),
+            "exercises": [
+                {"name": rnd.choice(EXERCISES), "sets": rnd.randint(3, 5), "reps": f"{rnd.randint(6, 12)}–{rnd.randint(13, 15)}",
+                 "rest": f"{rnd.choice((60, 90, 120))} сек", "notes": ""}
+                for _ in range(rnd.randint(5, 7))
+            ],
+            "notes": "",
+        }
+        for d in range(1, rnd.randint(4, 6) + 1)
+    ]
+    obj = {"intro": "Вот твоя программа на неделю 💪", "days": days, "nutrition": "КБЖУ: 1900/140/60/200",
+           "notes": ["Белок в каждый приём пищи"]}
+    if not bad:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    kind = rnd.choice(("truncated", "failure", "fenced", "days"))
+    if kind == "failure":
+        days[rnd.randrange(len(days))]["exercises"][0]["reps"] = "до отказа"
+    elif kind == "days":
+        days += [dict(days[0]) for _ in range(8 - len(days))]
+    raw = json.dumps(obj, ensure_ascii=False, indent=2)
+    if kind == "truncated":
+        return raw[:int(len(raw) * rnd.uniform(0.5, 0.95))]
+    if kind == "fenced":
+        return f"```json\n{raw}\n```"
+    return raw
+
+
+def _us(fn, items: list, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for x in items:
+            fn(x)
+    return (time.perf_counter() - t0) / repeat / len(items) * 1e6
+
+
+def _accumulate(raw: str) -> None:
+    """Накопление текста по кускам без проверки — его вычитаем из замера _stream_check."""
+    acc = ""
+    for tok in split_tokens(raw):
+        acc += tok
+
+
+def _stream_check(raw: str) -> float:
+    """Проверка при стриминге; доля потока, на которой ответ отбракован (1.0 — дошёл до конца)."""
+    from app.program_json import JsonProgramStream, ProgramJsonError
+
+    stream = JsonProgramStream()
+    acc = ""
+    for tok in split_tokens(raw):
+        acc += tok
+        try:
+            stream.feed(acc)
+        except ProgramJsonError:
+            return len(acc) / len(raw)
+    return 1.0
+
+
+def offline(texts: list, jsons: list, repeat: int) -> None:
+    from app.program_json import ProgramJsonError, parse_program_json, render
+    from app.program_model import _parse
+    from app.textproc import clean_program
+
+    def json_path(raw):
+        try:
+            _parse(render(parse_program_json(raw)))
+        except ProgramJsonError:
+            pass
+
+    text_us = _us(lambda raw: _parse(clean_program(raw)), texts, repeat)
+    json_us = _us(json_path, jsons, repeat)
+    stream_us = _us(_stream_check, jsons, max(1, repeat // 5)) - _us(_accumulate, jsons, max(1, repeat // 5))
+    print(f"постобработка: текст {text_us:7.1f} µs   JSON {json_us:7.1f} µs на программу ({text_us / json_us:.1f}×)")
+    print(f"проверка дней при стриминге (на каждом куске): {stream_us:7.1f} µs на программу")
+
+    rejected = []
+    for raw in jsons:
+        try:
+            parse_program_json(raw)
+        except ProgramJsonError:
+            rejected.append(_stream_check(raw))
+    early = [r for r in rejected if r < 1.0]
+    share = sum(early) / len(early) if early else float("nan")
+    print(f"отбраковано JSON: {len(rejected)}/{len(jsons)} ({len(rejected) / len(jsons):.1%}); "
+          f"оборвано при стриминге {len(early)}, в среднем на {share:.0%} потока")
+
+
+async def _agent_run(programs: int, json_mode: bool, server: MockOpenAIServer) -> None:
+    from app.agent import FitnessAgent
+    from app.metrics import METRICS
+
+    server.reset_stats()
+    fallback0 = METRICS.get("program_json.fallback")
+    latencies = []
+    for _ in range(programs):
+        agent = FitnessAgent(token="x", user_id="bench", user_data={**USER_DATA, "history": []})
+        shown = []
+
+        async def on_text(text):
+            shown.append(text)
+
+        t = time.perf_counter()
+        final = await agent.get_program("", on_text=on_text, use_cache=False, json_mode=json_mode)
+        latencies.append(time.perf_counter() - t)
+        if not final.strip():
+            raise SystemExit("FAIL: пустая программа")
+    fallbacks = METRICS.get("program_json.fallback") - fallback0
+    latencies.sort()
+    print(f"агент, json_mode={'вкл' if json_mode else 'выкл'}: запросов к API {server.requests / programs:.3f} на программу, "
+          f"в текст {int(fallbacks)}, p50 {latencies[len(latencies) // 2] * 1000:.0f} мс, "
+          f"p95 {latencies[int(len(latencies) * .95)] * 1000:.0f} мс")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--programs", type=int, default=200, help="записанных ответов каждого формата")
+    parser.add_argument("--bad-rate", type=float, default=0.1, help="доля испорченных JSON-ответов")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--agent", type=int, default=50, help="программ через агента и мок API (0 — пропустить)")
+    parser.add_argument("--tps", type=float, default=5000, help="токенов в секунду у мока")
+    args = parser.parse_args()
+
+    rnd = random.Random(24)
+    texts = [recorded_text(rnd) for _ in range(args.programs)]
+    jsons = [recorded_json(rnd, rnd.random() < args.bad_rate) for _ in range(args.programs)]
+    offline(texts, jsons, args.repeat)
+    if not args.agent:
+        return
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        for fmt, items in (("text", texts), ("json", jsons)):
+            for content in items:
+                f.write(json.dumps({"format": fmt, "content": content}, ensure_ascii=False) + "\n")
+    server = MockOpenAIServer(ttft=0.05, tps=args.tps).start()
+    server.replay = load_replay(f.name)
+    os.unlink(f.name)
+    # агент читает адрес API при импорте
+    os.environ["DEEPSEEK_BASE_URL"] = server.base_url
+    os.environ.setdefault("DEEPSEEK_API_KEY", "x")
+    os.environ.setdefault("DEEPSEEK_STREAM", "1")
+    try:
+        asyncio.run(_agent_run(args.agent, False, server))
+        asyncio.run(_agent_run(args.agent, True, server))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
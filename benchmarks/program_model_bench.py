@@ -0,0 +1,136 @@
+"""
+Модель программы (app.program_model): сверка туда-обратно и цена разбора.
+
+1. Сверка (golden): для образцов (benchmarks.textproc_bench.SAMPLES, программы 4–6 дней из
+   benchmarks.pdf_export_bench) и --fuzz случайных текстов после clean_program/clean_answer
+   str(parse(text)) == text; chunks() — части не длиннее предела, без потери текста;
+   для «сырых» текстов chunks() совпадает с прежним _split_for_telegram. Расхождение — FAIL.
+2. Скорость: разбор один раз против повторного сканирования на каждого потребителя
+   (разбивка для Telegram + поиск «День N» в PDF), µs на программу.
+3. Размер: текст против компактной JSON-записи модели (кортежи) — почему хранилище держит текст.
+
+    python -m benchmarks.program_model_bench --fuzz 3000
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+
+def _legacy_split(text: str, max_len: int = 3500) -> list:
+    if len(text) <= max_len:
+        return [text]
+    parts = []
+    remaining = text
+    while len(remaining) > max_len:
+        cut = remaining.rfind("\n\nДень ", 0, max_len)
+        if cut < 0:
+            cut = remaining.rfind("\n\n**День", 0, max_len)
+        if cut < 0:
+            cut = remaining.rfind("\n\n", 0, max_len)
+        if cut < 0:
+            cut = max_len
+        parts.append(remaining[:cut].strip())
+        remaining = remaining[cut:].strip()
+    if remaining:
+        parts.append(remaining)
+    return parts
+
+
+_LEGACY_PDF_DAY_RE = re.compile(r"^\**\s*(День\s+\d+(?:\s*—\s*.+?)?)\s*\**$")
+
+
+def _legacy_consumers(text: str) -> None:
+    """Как было: каждый потребитель заново режет и сканирует текст."""
+    _legacy_split(text, 500)
+    for line in text.split("\n"):
+        _LEGACY_PDF_DAY_RE.match(line.strip())
+
+
+def _compact(program) -> list:
+    from app.program_model import Exercise
+
+    def line(x):
+        return [x.lead, x.name, x.sets, x.reps, x.tail] if isinstance(x, Exercise) else x
+
+    return [[line(x) for x in program.intro], [[d.title, [line(x) for x in d.lines]] for d in program.days]]
+
+
+def _texts(rnd: random.Random, fuzz: int) -> list:
+    from app.textproc import clean_answer, clean_program
+    from benchmarks.pdf_export_bench import program
+    from benchmarks.textproc_bench import SAMPLES, _fuzz_text
+
+    out = []
+    for raw in SAMPLES + [_fuzz_text(rnd) for _ in range(fuzz)]:
+        out += [clean_program(raw), clean_answer(raw)]
+    return out + [program(rnd, i) for i in range(200)]
+
+
+def _check(texts: list) -> int:
+    from app.program_model import _parse
+
+    structured = 0
+    for text in texts:
+        program = _parse(text)
+        if str(program) != text:
+            raise SystemExit(f"FAIL round-trip: {text!r}\n  стало: {str(program)!r}")
+        structured += program.structured
+        for max_len in (120, 500, 3500):
+            parts = program.chunks(max_len)
+            if any(len(p) > max_len for p in parts):
+                raise SystemExit(f"FAIL chunks > {max_len}: {text!r}")
+            if "".join("".join(parts).split()) != "".join(text.split()):
+                raise SystemExit(f"FAIL chunks lost text ({max_len}): {text!r}\n  части: {parts!r}")
+            if not program.structured and parts != _legacy_split(text, max_len):
+                raise SystemExit(f"FAIL raw chunks differ ({max_len}): {text!r}")
+    return structured
+
+
+def _us(fn, items: list, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for x in items:
+            fn(x)
+    return (time.perf_counter() - t0) / repeat / len(items) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fuzz", type=int, default=3000, help="случайных текстов для сверки")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    from app.program_model import _parse, iter_lines, parse
+
+    rnd = random.Random(3)
+    texts = _texts(rnd, args.fuzz)
+    structured = _check(texts)
+    print(f"сверка: {len(texts)} текстов, туда-обратно без потерь; разобрано в модель {structured}, остальные — как текст")
+
+    from benchmarks.pdf_export_bench import program
+
+    programs = [program(rnd, i) for i in range(200)]
+    parse.cache_clear()
+    before = _us(_legacy_consumers, programs, args.repeat)
+    first = _us(_parse, programs, args.repeat)
+
+    def consumers(text):
+        p = parse(text)
+        p.chunks(500)
+        for _ in iter_lines(p):
+            pass
+
+    consumers_us = _us(consumers, programs, args.repeat)
+    print(f"разбор модели (один раз на текст): {first:7.1f} µs на программу")
+    print(f"потребители: было {before:7.1f} µs   стало {consumers_us:7.1f} µs (модель из кэша parse)")
+
+    text_bytes = sum(len(json.dumps(t, ensure_ascii=False).encode("utf-8")) for t in programs)
+    model_bytes = sum(len(json.dumps(_compact(_parse(t)), ensure_ascii=False).encode("utf-8")) for t in programs)
+    print(f"размер в JSON: текст {text_bytes / len(programs):.0f} Б, модель {model_bytes / len(programs):.0f} Б "
+          f"({model_bytes / text_bytes:.0%} от текста)")
+
+
+if __name__ == "__main__":
+    main()
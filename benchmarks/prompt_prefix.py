@@ -0,0 +1,122 @@
+"""
+Сборка промпта программы и контекстный кэш DeepSeek: раньше и сейчас.
+
+before — как было: блок «ГЛАВНЫЙ ПРИОРИТЕТ» собирается на каждый запрос и стоит в конце
+         сообщения пользователя, после анкеты;
+after  — блок берётся из FOCUS_BLOCKS (собран при импорте) и идёт отдельным system-сообщением
+         сразу после SYSTEM_PROMPT, анкета — последней.
+
+Печатает время сборки сообщений и оплачиваемые входные токены на потоке запросов
+--users пользователей. Кэш DeepSeek имитируется: совпавший с одним из прошлых запросов
+префикс (единицами по 64 токена) оплачивается по цене попадания (--hit-price от обычной).
+Токены оцениваются как символы / 3. Реальные числа — метрики llm.prompt_cache_hit_tokens /
+llm.prompt_cache_miss_tokens (app.llm.record_usage).
+
+    python -m benchmarks.prompt_prefix --users 500
+"""
+import argparse
+import hashlib
+import random
+import time
+
+CHARS_PER_TOKEN = 3
+UNIT = 64 * CHARS_PER_TOKEN
+
+GROUPS = ["ноги", "ягодицы", "спина", "грудь", "сбалансированно"]
+VARIATIONS = ["", "Больше базовых.", "Больше изоляции.", "Акцент на силу."]
+
+
+def _serialize(messages: list) -> str:
+    return "".join(f"<{m['role']}>{m['content']}" for m in messages)
+
+
+class _PrefixCache:
+    """Имитация контекстного кэша: хэши всех префиксов длиной k × UNIT уже виденных запросов."""
+
+    def __init__(self):
+        self._seen = set()
+
+    def bill(self, text: str) -> tuple:
+        hit_units = 0
+        units = len(text) // UNIT
+        for k in range(1, units + 1):
+            h = hashlib.blake2b(text[: k * UNIT].encode("utf-8"), digest_size=16).digest()
+            if h in self._seen:
+                hit_units = k
+            else:
+                self._seen.add(h)
+        total = len(text) // CHARS_PER_TOKEN
+        hit = hit_units * 64
+        return hit, total - hit
+
+
+def _before(agent, phys: dict, instruction: str) -> list:
+    from app.agent import SYSTEM_PROMPT, _build_focus_block
+
+    group = phys.get("preferred_muscle_group")
+    prompt = agent._format_profile(phys)
+    if group and group != "сбалансированно":
+        prompt += "\n\n" + _build_focus_block(group)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt + (f"\n\nПожелания: {instruction}" if instruction else "")},
+    ]
+
+
+def _after(agent, phys: dict, instruction: str) -> list:
+    from app.agent import SYSTEM_PROMPT
+
+    profile = agent._format_profile(phys)
+    block = agent._focus_for(phys, None)
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if block:
+        messages.append({"role": "system", "content": block})
+    messages.append({"role": "user", "content": profile + (f"\n\nПожелания: {instruction}" if instruction else "")})
+    return messages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--builds", type=int, default=20000, help="сборок для замера времени")
+    parser.add_argument("--hit-price", type=float, default=0.1, help="цена токена из кэша относительно обычного")
+    args = parser.parse_args()
+
+    from app.agent import FitnessAgent
+
+    agent = FitnessAgent.__new__(FitnessAgent)
+    rnd = random.Random(3)
+    requests = []
+    for _ in range(args.users):
+        phys = {
+            "gender": rnd.choice(["мужской", "женский"]),
+            "target": rnd.choice(["похудение", "набор массы"]),
+            "age": str(rnd.randint(18, 55)),
+            "height": str(rnd.randint(155, 195)),
+            "weight": str(rnd.randint(50, 110)),
+            "schedule": rnd.choice(["2", "3", "4"]),
+            "level": rnd.choice(["новичок", "средний"]),
+            "preferred_muscle_group": rnd.choice(GROUPS),
+        }
+        requests.append((phys, rnd.choice(VARIATIONS)))
+
+    for label, build in (("before", _before), ("after", _after)):
+        t0 = time.perf_counter()
+        for i in range(args.builds):
+            build(agent, *requests[i % len(requests)])
+        per_build = (time.perf_counter() - t0) / args.builds
+
+        cache = _PrefixCache()
+        hit = miss = 0
+        for phys, instruction in requests:
+            h, m = cache.bill(_serialize(build(agent, phys, instruction)))
+            hit, miss = hit + h, miss + m
+        billed = miss + hit * args.hit_price
+        print(
+            f"{label:<7} сборка {per_build * 1e6:6.1f} µs   входных токенов {hit + miss:>9,}   "
+            f"из кэша {hit / (hit + miss):6.1%}   к оплате (в обычных токенах) {billed:>11,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
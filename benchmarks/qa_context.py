@@ -0,0 +1,107 @@
+"""
+Входные токены и задержка QA-запроса на синтетических диалогах растущей длины:
+как было (последние 10 реплик целиком) и с упаковкой app.context_packer.
+
+Для каждой длины диалога печатает оценку входных токенов (estimate_tokens) — ещё и со
+сводкой app.coach_summary, которая учла все реплики, кроме последней, — время сборки
+контекста (первая сборка оценивает токены реплик, повторная берёт оценки из кэша) и оценку
+времени до первого токена: --ttft + входные токены / --prefill-tps (скорость чтения
+промпта моделью; реальную задержку показывает benchmarks.llm_streaming на живом API).
+
+    python -m benchmarks.qa_context --turns 1 2 5 10 20 40
+"""
+import argparse
+import random
+import time
+
+ANSWER_LINES = [
+    "*День {d}* — {g}",
+    "• Жим штанги лёжа 4×8–10, отдых 2 мин",
+    "• Тяга верхнего блока к груди 3×10–12",
+    "• Румынская тяга с гантелями 3×10",
+    "• Завтрак: овсянка 60 г (в сухом виде), 2 яйца, банан",
+    "• Обед: куриная грудка 150 г, гречка 70 г (в сухом виде), салат",
+    "КБЖУ: 1900/140/60/200",
+    "Совет: держи технику и добавляй вес, когда выполняешь верхнюю границу повторений.",
+]
+COACH_SUMMARY_TEXT = (
+    "Предпочтения: тренируется дома и в зале, любит короткие тренировки\n"
+    "Травмы и ограничения: побаливает левое плечо после жима\n"
+    "Программы: сплит верх/низ, 3 дня, акцент на ноги\n"
+    "Питание: ~1900 ккал, не ест рыбу"
+)
+QUESTIONS = [
+    "Составь меню на неделю под мой КБЖУ",
+    "Чем заменить жим лёжа, если болит плечо?",
+    "Сколько отдыхать между подходами на массу?",
+    "Можно ли тренироваться каждый день?",
+]
+
+
+def _dialogue(turns: int, rnd: random.Random) -> list:
+    hist = []
+    for _ in range(turns):
+        lines = [rnd.choice(ANSWER_LINES).format(d=d + 1, g="ноги") for d in range(rnd.randint(15, 60))]
+        hist.append(("🧍 " + rnd.choice(QUESTIONS), "🤖 " + "\n".join(lines)))
+    return hist
+
+
+def _legacy_messages(agent, question: str, max_turns: int = 10) -> list:
+    from app.agent import QA_SYSTEM_PROMPT
+
+    turns = [(u[2:], b[2:]) for u, b in agent.user_data["history"]][-max_turns:]
+    messages = [
+        {"role": "system", "content": QA_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Анкета:\n{agent._phys_prompt}"},
+    ]
+    for u, b in turns:
+        messages += [{"role": "user", "content": u}, {"role": "assistant", "content": b}]
+    messages.append({"role": "user", "content": f"Вопрос (текущий):\n{question}"})
+    return messages
+
+
+def _ms(fn, repeat: int = 20) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 2, 5, 10, 20, 40])
+    parser.add_argument("--ttft", type=float, default=0.5, help="задержка до первого токена без учёта промпта, сек")
+    parser.add_argument("--prefill-tps", type=float, default=4000, help="токенов промпта в секунду")
+    args = parser.parse_args()
+
+    from app.agent import FitnessAgent
+    from app.coach_summary import SUMMARY_FORMAT
+    from app.context_packer import QA_INPUT_BUDGET, messages_tokens
+
+    rnd = random.Random(5)
+    question = "А что есть после вечерней тренировки?"
+    print(f"бюджет входа QA_INPUT_BUDGET={QA_INPUT_BUDGET}")
+    print(f"{'реплик':>6}  {'было, ток.':>10}  {'стало, ток.':>11}  {'со сводкой':>10}  {'TTFT было':>9}  {'стало':>6}  "
+          f"{'со сводкой':>10}  {'сборка: первая':>14}  {'повторная':>9}")
+    for n in args.turns:
+        agent = FitnessAgent.__new__(FitnessAgent)
+        agent._phys_prompt = "Цель: похудение\nПол: женский\nВозраст: 29 лет\nРост: 168 см\nТекущий вес: 70 кг"
+        agent.user_data = {"history": _dialogue(n, rnd)}
+
+        before = messages_tokens(_legacy_messages(agent, question))
+        t0 = time.perf_counter()
+        packed = agent._qa_history_messages(question)
+        first = (time.perf_counter() - t0) * 1000
+        again = _ms(lambda: agent._qa_history_messages(question))
+        after = messages_tokens(packed)
+        agent.user_data["coach_summary"] = {"format": SUMMARY_FORMAT, "version": 1, "seq": n - 1, "text": COACH_SUMMARY_TEXT}
+        summarized = messages_tokens(agent._qa_history_messages(question))
+        print(
+            f"{n:>6}  {before:>10,}  {after:>11,}  {summarized:>10,}  {args.ttft + before / args.prefill_tps:>8.2f}s  "
+            f"{args.ttft + after / args.prefill_tps:>5.2f}s  {args.ttft + summarized / args.prefill_tps:>9.2f}s  "
+            f"{first:>12.2f}ms  {again:>7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
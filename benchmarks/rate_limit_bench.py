@@ -0,0 +1,92 @@
+"""
+Скорость проверок app.rate_limit: горячие корзины, много пользователей с вытеснением,
+запись в хранилище и восстановление после рестарта.
+
+Сценарии (хранилище — MemoryStateStore, чтобы мерить сам лимитер):
+  hot     — --hot пользователей многократно, все корзины в памяти: проверок/сек;
+  churn   — --users разных пользователей по одному разу (холодное чтение из хранилища
+            на каждого), затем время идёт и полностью пополненные корзины вытесняются;
+  flush   — запись изменённых корзин в хранилище;
+  restart — новый лимитер на том же хранилище видит списанное до «рестарта».
+
+    python -m benchmarks.rate_limit_bench --checks 200000 --users 50000
+"""
+import argparse
+import asyncio
+import time
+from unittest import mock
+
+from app.rate_limit import ACTION_PROGRAM, ACTION_QA, Limit, RateLimiter
+from app.state_store import MemoryStateStore
+
+
+def _limiter(store: MemoryStateStore) -> RateLimiter:
+    return RateLimiter(
+        store=store,
+        user_limit=Limit(20, 60),
+        action_limits={ACTION_PROGRAM: Limit(1, 30), ACTION_QA: Limit(10, 60)},
+        global_limits={ACTION_PROGRAM: Limit(1e9, 60), ACTION_QA: Limit(1e9, 60)},
+    )
+
+
+async def _run(args) -> None:
+    failed = []
+
+    def check(name: str, cond: bool) -> None:
+        print(f"  {'OK  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failed.append(name)
+
+    store = MemoryStateStore()
+    limiter = _limiter(store)
+
+    t0 = time.perf_counter()
+    allowed = 0
+    for i in range(args.checks):
+        allowed += (await limiter.acquire(f"hot{i % args.hot}", ACTION_QA)).allowed
+    elapsed = time.perf_counter() - t0
+    print(f"hot      {args.checks} проверок за {elapsed:.2f}s — {args.checks / elapsed:,.0f}/s, "
+          f"{elapsed / args.checks * 1e6:.1f} µs на проверку; разрешено {allowed}")
+    check("каждый горячий пользователь получил не больше 10 вопросов", allowed <= args.hot * 10)
+
+    t0 = time.perf_counter()
+    for i in range(args.users):
+        await limiter.acquire(f"u{i}", ACTION_PROGRAM)
+    elapsed = time.perf_counter() - t0
+    in_memory = len(limiter._buckets)
+    print(f"churn    {args.users} новых пользователей за {elapsed:.2f}s — {args.users / elapsed:,.0f}/s; "
+          f"корзин в памяти {in_memory}")
+
+    t0 = time.perf_counter()
+    written = await limiter.flush()
+    print(f"flush    {written} корзин за {time.perf_counter() - t0:.2f}s")
+    check("записаны все изменённые корзины", written == in_memory)
+
+    restarted = _limiter(store)
+    denied = await restarted.acquire("u0", ACTION_PROGRAM)
+    print(f"restart  u0 после рестарта: allowed={denied.allowed}, повтор через {denied.retry_after:.0f}s")
+    check("списанное переживает рестарт", not denied.allowed)
+
+    # через минуту все корзины пополнены: каждое обращение вытесняет несколько старых
+    later = time.time() + 61
+    with mock.patch("app.rate_limit.time.time", return_value=later):
+        for i in range(args.hot):
+            await limiter.acquire(f"late{i}", ACTION_QA)
+    print(f"evict    после {args.hot} обращений через минуту корзин в памяти {len(limiter._buckets)} (было {in_memory})")
+    check("пополненные корзины вытесняются", len(limiter._buckets) < in_memory)
+
+    if failed:
+        raise SystemExit(f"FAIL: {', '.join(failed)}")
+    print("OK")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checks", type=int, default=200000)
+    parser.add_argument("--hot", type=int, default=1000, help="горячих пользователей")
+    parser.add_argument("--users", type=int, default=50000, help="разовых пользователей")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+«📑 История ответов» на папке с --files сохранёнными программами: как было (glob по общей
+data/users + stat() каждого совпадения + сортировка) и по индексу app.saved_programs
+(срез data["programs"] + открытие k файлов из папки пользователя).
+
+Во временной папке создаются --users JSON-документов и --files файлов program_{user_id}_{ts}.txt
+(поровну между пользователями), затем замеряются:
+1. листинг одного пользователя по-старому — мс на нажатие (от числа файлов во всей папке);
+2. перенос app.saved_programs.migrate (файловый бэкенд, без DATABASE_URL);
+3. листинг по индексу — первая страница и последняя (от числа файлов не зависит).
+
+    python -m benchmarks.saved_programs_bench --files 100000 --users 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+
+def _legacy_list(folder: Path, user_id: str, limit: int = 10) -> list:
+    files = list(folder.glob(f"program_{user_id}_*.txt"))
+    files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
+    return [f.read_bytes() for f in files[:limit]]
+
+
+def _index_list(data: dict, user_id: str, root: str, number: int) -> list:
+    from app.saved_programs import entry_path, page
+
+    return [entry_path(user_id, e, root).read_bytes() for e in page(data, number)]
+
+
+def _ms(fn, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.pop("NF_GYM_DB_POSTGRES_URI", None)
+    from app.saved_programs import SAVED_PAGE_SIZE, migrate
+    from app.storage import DEFAULT_USER_DATA, load_user_data
+
+    tmp = Path(tempfile.mkdtemp(prefix="saved_programs_bench_"))
+    try:
+        folder, root = tmp / "users", tmp / "users" / "programs"
+        folder.mkdir()
+        t0 = time.perf_counter()
+        users = [str(100000 + u) for u in range(args.users)]
+        for user_id in users:
+            (folder / f"{user_id}.json").write_text(json.dumps(DEFAULT_USER_DATA, ensure_ascii=False), encoding="utf-8")
+        base_ts = 1_700_000_000
+        for i in range(args.files):
+            user_id = users[i % len(users)]
+            body = f"*День 1 — Ноги*\nПрисед 4×8\n(программа №{i})\n"
+            (folder / f"program_{user_id}_{base_ts + i}.txt").write_text(body, encoding="utf-8")
+        print(f"папка: {args.files:,} программ + {args.users:,} JSON ({time.perf_counter() - t0:.1f} с на создание)")
+
+        user_id = users[len(users) // 2]
+        legacy = _ms(lambda: _legacy_list(folder, user_id), args.repeat)
+        print(f"было:   glob + stat + сортировка       {legacy:8.2f} мс на нажатие")
+
+        t0 = time.perf_counter()
+        n_users, n_files = migrate(str(folder), str(root))
+        print(f"перенос: {n_files:,} файлов {n_users:,} пользователей за {time.perf_counter() - t0:.1f} с")
+
+        data = load_user_data(user_id, str(folder))
+        pages = (len(data["programs"]) + SAVED_PAGE_SIZE - 1) // SAVED_PAGE_SIZE
+        first = _ms(lambda: _index_list(data, user_id, str(root), 0), args.repeat)
+        last = _ms(lambda: _index_list(data, user_id, str(root), pages - 1), args.repeat)
+        print(f"стало:  индекс, первая страница ({SAVED_PAGE_SIZE})   {first:8.2f} мс   ×{legacy / first:.0f}")
+        print(f"        индекс, последняя ({pages}-я)     {last:8.2f} мс")
+        print(f"        загрузка документа с индексом   {_ms(lambda: load_user_data(user_id, str(folder)), args.repeat):8.2f} мс")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Несколько процессов-воркеров на одном хранилище состояния: проверка CAS и аренды пользователя.
+
+Каждый воркер много раз «обрабатывает апдейт» случайного пользователя: берёт аренду,
+читает счётчик, пишет +1 через compare_and_set. В конце сумма счётчиков должна совпасть
+с числом апдейтов (ни одной потерянной записи), а конфликтов под арендой быть не должно.
+Отдельно — счётчик без аренды на чистом CAS с повторами и порядок: --ordered сообщений одного
+пользователя приходят вперемешку, пока аренду держит предыдущее, и должны обработаться по update_id.
+
+    python -m benchmarks.state_store_workers --store sqlite --workers 4 --updates 200
+    DATABASE_URL=... python -m benchmarks.state_store_workers --store postgres
+"""
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import random
+import tempfile
+import time
+
+from app import state_store
+from app.metrics import METRICS
+
+
+def _make_store(kind: str, sqlite_path: str) -> state_store.StateStore:
+    if kind == "sqlite":
+        return state_store.SQLiteStateStore(sqlite_path)
+    return state_store.create_state_store(kind)
+
+
+async def _worker(kind: str, sqlite_path: str, prefix: str, users: int, updates: int, seed: int) -> tuple:
+    store = _make_store(kind, sqlite_path)
+    if isinstance(store, state_store.PostgresStateStore):
+        await store.open()
+    rnd = random.Random(seed)
+    conflicts_under_lock = 0
+    started = time.perf_counter()
+    for _ in range(updates):
+        key = f"{prefix}:user:{rnd.randrange(users)}"
+        async with store.lock(f"lock:{key}", ttl=30, timeout=30):
+            rec = await store.get(key)
+            value = (rec.value if rec else 0) + 1
+            if await store.compare_and_set(key, value, rec.version if rec else None, ttl=3600) is None:
+                conflicts_under_lock += 1
+        # без аренды: оптимистичный цикл read → CAS → повтор
+        while True:
+            rec = await store.get(f"{prefix}:total")
+            value = (rec.value if rec else 0) + 1
+            if await store.compare_and_set(f"{prefix}:total", value, rec.version if rec else None, ttl=3600):
+                break
+    elapsed = time.perf_counter() - started
+    await store.close()
+    return conflicts_under_lock, METRICS.get("state_store.cas_conflicts"), METRICS.get("state_store.lock_waits"), elapsed
+
+
+def _run(args: tuple) -> tuple:
+    return asyncio.run(_worker(*args))
+
+
+async def _totals(kind: str, sqlite_path: str, prefix: str, users: int) -> tuple:
+    store = _make_store(kind, sqlite_path)
+    if isinstance(store, state_store.PostgresStateStore):
+        await store.open()
+    per_user = 0
+    for u in range(users):
+        rec = await store.get(f"{prefix}:user:{u}")
+        per_user += rec.value if rec else 0
+    rec = await store.get(f"{prefix}:total")
+    await store.close()
+    return per_user, rec.value if rec else 0
+
+
+async def _ordering(kind: str, sqlite_path: str, prefix: str, messages: int) -> list:
+    store = _make_store(kind, sqlite_path)
+    if isinstance(store, state_store.PostgresStateStore):
+        await store.open()
+    key = f"lock:{prefix}:user:ordered"
+    update_ids = list(range(1, messages + 1))
+    random.Random(8).shuffle(update_ids)
+    handled = []
+
+    async def message(update_id: int, arrival: float) -> None:
+        await asyncio.sleep(arrival)
+        async with store.lock(key, ttl=30, timeout=30, order=update_id):
+            handled.append(update_id)
+            await asyncio.sleep(0.01)
+
+    async with store.lock(key, ttl=30, timeout=30):
+        tasks = [asyncio.create_task(message(u, i * 0.005)) for i, u in enumerate(update_ids)]
+        await asyncio.sleep(messages * 0.005 + 0.3)
+    await asyncio.gather(*tasks)
+    await store.close()
+    return handled
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--updates", type=int, default=200, help="апдейтов на воркер")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--ordered", type=int, default=20, help="сообщений одного пользователя для проверки порядка")
+    args = parser.parse_args()
+
+    sqlite_path = os.path.join(tempfile.mkdtemp(), "state.sqlite3")
+    prefix = f"bench{int(time.time())}"
+    jobs = [(args.store, sqlite_path, prefix, args.users, args.updates, i) for i in range(args.workers)]
+    with mp.get_context("spawn").Pool(args.workers) as pool:
+        results = pool.map(_run, jobs)
+
+    per_user, total = asyncio.run(_totals(args.store, sqlite_path, prefix, args.users))
+    handled = asyncio.run(_ordering(args.store, sqlite_path, prefix, args.ordered))
+    in_order = handled == sorted(handled)
+    expected = args.workers * args.updates
+    under_lock = sum(r[0] for r in results)
+    cas_retries = sum(r[1] for r in results) - under_lock
+    lock_waits = sum(r[2] for r in results)
+    elapsed = max(r[3] for r in results)
+    print(f"store={args.store} workers={args.workers} updates={expected} users={args.users}")
+    print(f"под арендой: сумма счётчиков {per_user}/{expected}, CAS-конфликтов {under_lock}, ожиданий аренды {lock_waits:.0f}")
+    print(f"без аренды:  счётчик {total}/{expected}, повторов CAS {cas_retries:.0f}")
+    print(f"время {elapsed:.2f}s, {2 * expected / elapsed:.0f} апдейтов/с (оба счётчика)")
+    print(f"порядок: {len(handled)} сообщений пришли вперемешку, обработаны {'по update_id' if in_order else handled}")
+    if per_user != expected or total != expected or under_lock:
+        raise SystemExit("FAIL: потерянные обновления")
+    if not in_order:
+        raise SystemExit("FAIL: сообщения обработаны не по порядку")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
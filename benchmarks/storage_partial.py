@@ -0,0 +1,66 @@
+"""
+Сколько байт пишется на одну операцию: полный документ против частичных ops.
+
+Считает полезную нагрузку записи для «тяжёлого» пользователя с длинной историей:
+для Postgres — размер JSON в UPSERT против параметров jsonb_set-UPDATE,
+для файлов — размер JSON-документа против строки в журнале {user_id}.json.log.
+
+    python -m benchmarks.storage_partial --history 200
+"""
+import argparse
+import copy
+import json
+
+from app import storage
+
+PROGRAM = ("*День {n} — Грудь и трицепс*\n"
+           "- Жим гантелей лёжа — 3×10, отдых 90 сек., усилие: умеренно, рекомендуемый вес: ~18 кг на руку\n") * 25
+
+
+def _heavy_user(history_len: int) -> dict:
+    d = copy.deepcopy(storage.DEFAULT_USER_DATA)
+    d["physical_data"].update({"name": "Марина", "age": 30, "weight": 70, "height": 170, "target": "похудение"})
+    d["physical_data_completed"] = True
+    d["history"] = [("🧍 Запрос программы", "🤖 " + PROGRAM.format(n=i)) for i in range(history_len)]
+    d["last_program"] = d["last_reply"] = PROGRAM.format(n=1)
+    return d
+
+
+def _scenarios(base: dict):
+    def weight(d):
+        storage.update_user_param("u", "weight", 71.5, data=d)
+
+    def qa_turn(d):
+        d["history"].append(("🧍 Сколько белка в день?", "🤖 " + "Около 1.6–2 г на кг веса. " * 40))
+        d["last_reply"] = d["history"][-1][1]
+
+    def goal(d):
+        storage.set_user_goal("u", "набор массы", data=d)
+
+    return [("update_user_param(weight)", weight), ("QA-ответ в историю", qa_turn), ("set_user_goal", goal)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", type=int, default=200, help="длина истории пользователя")
+    args = parser.parse_args()
+
+    base = storage._ensure_structure(_heavy_user(args.history))
+    print(f"history={args.history}, документ {len(json.dumps(base, ensure_ascii=False).encode()):,} байт\n")
+    print(f"{'операция':<28}{'PG full':>12}{'PG ops':>10}{'file full':>12}{'file log':>10}")
+    for label, mutate in _scenarios(base):
+        new = copy.deepcopy(base)
+        mutate(new)
+        new = storage._ensure_structure(new)
+        ops = storage.diff_user_data(base, new)
+
+        pg_full = len(json.dumps(new, ensure_ascii=False).encode())
+        _, params = storage._pg_ops_sql(ops)
+        pg_ops = sum(len(p.encode()) if isinstance(p, str) else len(json.dumps(p).encode()) for p in params)
+        file_full = len(json.dumps(new, ensure_ascii=False, indent=4).encode())
+        file_log = len((json.dumps([list(op) for op in ops], ensure_ascii=False) + "\n").encode())
+        print(f"{label:<28}{pg_full:>12,}{pg_ops:>10,}{file_full:>12,}{file_log:>10,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Постобработка ответов модели: прежняя цепочка re.sub (копия ниже, _legacy_*) против app.textproc.
+
+1. Сверка (golden): на образцах ответов и --fuzz случайных текстах из «шумных» кусков (LaTeX,
+   RPE/RIR, **жирный**, #-заголовки, <br>/<p>, •, пробелы) результат clean_program/clean_answer
+   совпадает с прежним (агент + _sanitize_for_tg бота), а StreamSanitizer на каждом префиксе
+   потока — с sanitize() всего префикса. Любое расхождение — FAIL с примером.
+2. Скорость: µs на КБ текста для программы, ответа и превью стриминга (весь ответ кусками
+   по --chunk символов, как on_text: каждый раз весь накопленный текст).
+
+    python -m benchmarks.textproc_bench --fuzz 5000 --kb 8
+"""
+import argparse
+import random
+import re
+import time
+
+# --- прежняя реализация (app.agent до app.textproc и _sanitize_for_tg из бота) ---
+
+_LEGACY_RPE_PATTERNS = [
+    r"\(?\s*RPE\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
+    r"\(?\s*RIR\s*=?\s*\d+(?:\s*-\s*\d+)?\s*\)?",
+    r"\bдо\s+отказа\b",
+    r"\bпочти\s+до\s+отказа\b",
+]
+
+
+def _legacy_strip_noise(text: str) -> str:
+    out = text or ""
+    out = re.sub(r"\$([^$]*)\$", r"\1", out)
+    out = re.sub(r"\\times", "×", out)
+    out = re.sub(r"\\text\{\s*([^}]*)\s*\}", r"\1", out)
+    out = re.sub(r"\\%", "%", out)
+    for p in _LEGACY_RPE_PATTERNS:
+        out = re.sub(p, "", out, flags=re.IGNORECASE)
+    out = re.sub(r"^\s*•\s+", "- ", out, flags=re.MULTILINE)
+    out = re.sub(r"(\d)\s*[xX\*]\s*(\d)", r"\1×\2", out)
+    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
+    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
+    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
+    out = re.sub(r"\(\s*\)", "", out)
+    out = re.sub(r",\s*,", ", ", out)
+    out = re.sub(r"[ \t]{2,}", " ", out)
+    out = re.sub(r"[ \t]+\n", "\n", out)
+    out = re.sub(r"\n[ \t]+", "\n", out)
+    out = re.sub(r"\n{3,}", "\n\n", out)
+    return out.strip()
+
+
+def _legacy_bold_day_headers(text: str) -> str:
+    out = []
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not re.match(r"День\s+\d+(\s*—\s*.+)?$", stripped):
+            out.append(line)
+            continue
+        if stripped.startswith("**") and stripped.endswith("**"):
+            stripped = stripped[2:-2]
+        elif stripped.startswith("*") and stripped.endswith("*"):
+            out.append(line)
+            continue
+        prefix = line[: len(line) - len(line.lstrip())]
+        out.append(prefix + "*" + stripped + "*")
+    return "\n".join(out)
+
+
+def _legacy_bold_fix(text: str) -> str:
+    return re.sub(r"\*\*(.+?)\*\*", r"*\1*", text, flags=re.DOTALL)
+
+
+def _legacy_format_qa_answer(text: str) -> str:
+    out = _legacy_bold_fix(text)
+    out = _legacy_bold_day_headers(out)
+    out = re.sub(r"\n(День \d+)", r"\n\n\1", out)
+    out = re.sub(r"\n{3,}", "\n\n", out)
+    return out.strip()
+
+
+def _legacy_sanitize(text: str) -> str:
+    out = text or ""
+    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
+    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
+    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
+    out = re.sub(r"\n{3,}", "\n\n", out)
+    return out.strip()
+
+
+def legacy_program(text: str) -> str:
+    return _legacy_sanitize(_legacy_bold_day_headers(_legacy_bold_fix(_legacy_strip_noise(text))))
+
+
+def legacy_answer(text: str) -> str:
+    return _legacy_sanitize(_legacy_format_qa_answer(_legacy_strip_noise(text).strip()))
+
+
+# --- образцы ---
+
+SAMPLES = [
+    """### Программа на 3 дня
+
+**День 1 — Ноги и ягодицы**
+• Приседания со штангой 4x8 (RPE 8)
+• Румынская тяга 3 x 10, отдых 90 сек
+• Ягодичный мост $4 \\times 12$ до отказа
+<br>
+**День 2 — Верх тела**
+- Жим лёжа 4*8 (RIR 2)
+- Тяга верхнего блока 3x12 ( ) ,  , почти до отказа
+
+День 3 — Ноги
+
+- Выпады 3×10 на каждую ногу
+- Подъёмы на носки 4x15<p>
+
+КБЖУ: 1900/140/60/200""",
+    """## Меню на день
+
+Завтрак: овсянка 60 г \\text{ (в сухом виде) }, 2 яйца
+Обед: гречка 70 г, курица 150 г — белок 35\\%
+
+
+
+Ужин: творог 5% 200 г<br/>Перекус: яблоко""",
+    """Отдыхай 2–3 минуты между подходами на массу.
+День 1
+Жим 5x5
+День 2
+Тяга 5 x 5 (RPE=7-8)
+# Совет
+Добавляй вес, когда **все подходы** выполнены.""",
+]
+
+_FRAGMENTS = [
+    "День {n}", "**День {n} — Ноги**", "*День {n}*", "  День {n} — Спина  ", "### ", "# ", "##",
+    "Присед 4x8", "жим 3 X 10", "тяга 5*5", "(RPE 8)", "RIR 2", " rpe=7-8 ", "до отказа", "почти до  отказа",
+    "$3 \\times 12$", "\\text{ кг }", "20\\%", "$x$", "<br>", "<BR/>", " <br /> ", "<p>", "</p>", "• ", "  •  пункт",
+    "( )", "()", ", ,", "**жирный**", "**", "*", "  ", "\t", "\n", "\n", "\n\n", "\n\n\n", " \n ", "слово", "отдых 90 сек",
+    "КБЖУ: 1400/100/60/110", "😊", "- ", "—",
+]
+
+
+def _fuzz_text(rnd: random.Random) -> str:
+    return "".join(rnd.choice(_FRAGMENTS).replace("{n}", str(rnd.randint(1, 7))) for _ in range(rnd.randint(1, 60)))
+
+
+def _long_text(kb: int) -> str:
+    out = []
+    while sum(len(p) for p in out) < kb * 1024:
+        out.extend(SAMPLES)
+    return "\n\n".join(out)
+
+
+def _check(rnd: random.Random, fuzz: int, chunk: int) -> int:
+    from app.textproc import StreamSanitizer, clean_answer, clean_program, sanitize
+
+    texts = SAMPLES + [_fuzz_text(rnd) for _ in range(fuzz)]
+    for text in texts:
+        for label, new, old in (("program", clean_program, legacy_program), ("answer", clean_answer, legacy_answer),
+                                ("sanitize", sanitize, _legacy_sanitize)):
+            if new(text) != old(text):
+                raise SystemExit(f"FAIL {label}: {text!r}\n  было:  {old(text)!r}\n  стало: {new(text)!r}")
+        stream = StreamSanitizer()
+        for end in list(range(1, len(text), rnd.randint(1, chunk))) + [len(text)]:
+            prefix = text[:end]
+            if stream.feed(prefix) != _legacy_sanitize(prefix):
+                raise SystemExit(f"FAIL stream: {prefix!r}\n  было:  {_legacy_sanitize(prefix)!r}\n  стало: {stream.feed(prefix)!r}")
+    return len(texts)
+
+
+def _us_per_kb(fn, text: str, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - t0) / repeat * 1e6 / (len(text.encode("utf-8")) / 1024)
+
+
+def _stream_old(text: str, chunk: int) -> None:
+    for end in range(chunk, len(text) + chunk, chunk):
+        _legacy_sanitize(text[:end])
+
+
+def _stream_new(text: str, chunk: int) -> None:
+    from app.textproc import StreamSanitizer
+
+    stream = StreamSanitizer()
+    for end in range(chunk, len(text) + chunk, chunk):
+        stream.feed(text[:end])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fuzz", type=int, default=5000, help="случайных текстов для сверки")
+    parser.add_argument("--kb", type=int, default=8, help="размер текста для замера скорости")
+    parser.add_argument("--chunk", type=int, default=40, help="символов на кусок потока")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    from app.textproc import clean_answer, clean_program
+
+    n = _check(random.Random(7), args.fuzz, args.chunk)
+    print(f"сверка: {n} текстов — программа, ответ, sanitize и поток совпадают с прежней реализацией")
+
+    text = _long_text(args.kb)
+    print(f"текст {len(text.encode('utf-8')) / 1024:.1f} КБ, {args.repeat} повторов")
+    for label, old, new in (("программа", legacy_program, clean_program), ("ответ", legacy_answer, clean_answer)):
+        before, after = _us_per_kb(old, text, args.repeat), _us_per_kb(new, text, args.repeat)
+        print(f"{label:<10} было {before:7.1f} µs/КБ   стало {after:7.1f} µs/КБ   ×{before / after:.1f}")
+    repeat = max(1, args.repeat // 20)
+    before = _us_per_kb(lambda t: _stream_old(t, args.chunk), text, repeat)
+    after = _us_per_kb(lambda t: _stream_new(t, args.chunk), text, repeat)
+    print(f"{'поток':<10} было {before:7.1f} µs/КБ   стало {after:7.1f} µs/КБ   ×{before / after:.1f}  (весь поток кусками по {args.chunk})")
+
+
+if __name__ == "__main__":
+    main()
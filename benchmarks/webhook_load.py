@@ -0,0 +1,233 @@
+"""
+Нагрузочный тест webhook-режима: синтетические Update JSON → бот → заглушка Bot API.
+
+Скрипт поднимает заглушку Telegram Bot API (getMe/setWebhook/sendMessage отвечают ok),
+запускает `main.py` в режиме webhook с TELEGRAM_API_BASE_URL на заглушку и шлёт апдейты
+«📋 Моя анкета» от разных пользователей (ответ бота — одно сообщение, без LLM).
+Меряет:
+  - ack: время ответа webhook (апдейт принят в очередь);
+  - e2e: от POST апдейта до sendMessage бота в заглушку;
+  - drain: в конце шлёт пачку апдейтов и сразу SIGTERM — все принятые должны получить ответ.
+
+    python -m benchmarks.webhook_load --updates 2000 --concurrency 50 --workers 2
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+ROOT = Path(__file__).resolve().parents[1]
+TOKEN = "123456:LOADTEST"
+SECRET = "loadtest-secret"
+TEXT = "📋 Моя анкета"
+
+
+class _Replies:
+    def __init__(self):
+        self.pending = collections.defaultdict(collections.deque)  # chat_id -> время POST апдейтов
+        self.e2e: list = []
+        self.count = 0
+        self.changed = asyncio.Event()
+
+
+class _BotApiStub(tornado.web.RequestHandler):
+    def initialize(self, replies: _Replies) -> None:
+        self.replies = replies
+
+    def _param(self, name: str):
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return (json.loads(self.request.body or b"{}")).get(name)
+        return self.get_body_argument(name, None)
+
+    async def post(self, token: str, method: str) -> None:
+        now = int(time.time())
+        chat_id = self._param("chat_id")
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {"message_id": 1, "date": now, "chat": {"id": int(chat_id or 0), "type": "private"}, "text": "ok"}
+            if method == "sendMessage" and chat_id is not None:
+                queue = self.replies.pending.get(int(chat_id))
+                if queue:
+                    self.replies.e2e.append(time.perf_counter() - queue.popleft())
+                self.replies.count += 1
+                self.replies.changed.set()
+        else:
+            result = True
+        self.finish({"ok": True, "result": result})
+
+    get = post
+
+
+def _update(update_id: int, chat_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": TEXT,
+        },
+    }
+
+
+def _pct(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else float("nan")
+
+
+def _report(label: str, latencies: list, elapsed: float) -> None:
+    p50 = statistics.median(latencies) * 1000 if latencies else float("nan")
+    print(
+        f"{label:<6} {len(latencies) / elapsed:>9.1f} upd/s   p50 {p50:7.2f} ms   "
+        f"p95 {_pct(latencies, 0.95):7.2f} ms   p99 {_pct(latencies, 0.99):7.2f} ms"
+    )
+
+
+async def _wait_healthy(client: httpx.AsyncClient, url: str, proc: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"бот завершился с кодом {proc.returncode}, см. лог")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("бот не поднялся за отведённое время")
+
+
+async def _post_all(client, url, replies, first_id, count, users, concurrency, acks) -> int:
+    sem = asyncio.Semaphore(concurrency)
+    accepted = 0
+
+    async def one(i: int) -> None:
+        nonlocal accepted
+        chat_id = 100000 + (i % users)
+        async with sem:
+            t0 = time.perf_counter()
+            replies.pending[chat_id].append(t0)
+            try:
+                resp = await client.post(url, json=_update(first_id + i, chat_id), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                ok = resp.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                acks.append(time.perf_counter() - t0)
+                accepted += 1
+            else:
+                replies.pending[chat_id].remove(t0)
+
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return accepted
+
+
+async def _wait_replies(replies: _Replies, target: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while replies.count < target and time.monotonic() < deadline:
+        replies.changed.clear()
+        try:
+            await asyncio.wait_for(replies.changed.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args) -> None:
+    replies = _Replies()
+    stub_sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    stub_port = stub_sockets[0].getsockname()[1]
+    stub = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/bot([^/]+)/(\w+)", _BotApiStub, {"replies": replies})]))
+    stub.add_sockets(stub_sockets)
+
+    workdir = tempfile.mkdtemp(prefix="webhook_load_")
+    env = dict(
+        os.environ,
+        PYTHONPATH=str(ROOT),
+        TELEGRAM_TOKEN=TOKEN,
+        BOT_MODE="webhook",
+        WEBHOOK_URL=f"http://127.0.0.1:{args.port}",
+        WEBHOOK_SECRET=SECRET,
+        WEBHOOK_PORT=str(args.port),
+        WEBHOOK_LISTEN="127.0.0.1",
+        WEBHOOK_WORKERS=str(args.workers),
+        WEBHOOK_CONCURRENCY=str(args.worker_concurrency),
+        TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{stub_port}/bot",
+    )
+    if args.workers > 1:
+        env.setdefault("STATE_STORE", "sqlite")
+        env.setdefault("STATE_STORE_SQLITE_PATH", os.path.join(workdir, "state.sqlite3"))
+        env["USER_CACHE_MODE"] = "off"
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen([sys.executable, str(ROOT / "main.py")], cwd=workdir, env=env, stdout=log, stderr=log)
+    print(f"бот: pid {proc.pid}, workers={args.workers}, лог {log_path}")
+
+    base = f"http://127.0.0.1:{args.port}"
+    before = drained_accepted = 0
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+        try:
+            await _wait_healthy(client, base + "/healthz", proc)
+
+            acks: list = []
+            t0 = time.perf_counter()
+            accepted = await _post_all(client, base + "/telegram", replies, 1, args.updates, args.users, args.concurrency, acks)
+            ack_elapsed = time.perf_counter() - t0
+            await _wait_replies(replies, accepted, timeout=120)
+            e2e_elapsed = time.perf_counter() - t0
+
+            print(f"принято {accepted}/{args.updates}, ответов {replies.count}")
+            _report("ack", acks, ack_elapsed)
+            _report("e2e", replies.e2e, e2e_elapsed)
+
+            # drain: пачка апдейтов и сразу SIGTERM — принятые должны быть обработаны до выхода
+            before = replies.count
+            burst = asyncio.create_task(
+                _post_all(client, base + "/telegram", replies, args.updates + 1, args.drain_burst, args.users, args.concurrency, [])
+            )
+            await asyncio.sleep(0.05)
+            proc.send_signal(signal.SIGTERM)
+            drained_accepted = await burst
+        finally:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+            while proc.poll() is None:
+                await asyncio.sleep(0.1)
+
+    answered = replies.count - before
+    print(f"drain: принято {drained_accepted} апдейтов после/во время SIGTERM, обработано {answered}, код выхода {proc.returncode}")
+    stub.stop()
+    if answered < drained_accepted:
+        raise SystemExit("FAIL: часть принятых апдейтов потеряна при остановке")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST от нагрузчика")
+    parser.add_argument("--users", type=int, default=200, help="разных chat_id")
+    parser.add_argument("--workers", type=int, default=1, help="WEBHOOK_WORKERS бота")
+    parser.add_argument("--worker-concurrency", type=int, default=32, help="WEBHOOK_CONCURRENCY бота")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--drain-burst", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,53 @@
 from __future__ import annotations
 
+import asyncio
+import math
 import os
-import re
 import time
 import logging
-from pathlib import Path
-from typing import Optional, Dict, List
+from typing import Optional, List
 
-from telegram import Update, ReplyKeyboardMarkup, Chat
+from telegram import Update, ReplyKeyboardMarkup, Chat, InputMediaDocument
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
 from app.agent import FitnessAgent
+from app.coach_summary import COACH_SUMMARY, history_seq
+from app.lift_log import LIFT_LOGS, parse_sets
+from app.metrics import METRICS
+from app.pdf_export import PDF_AVAILABLE, PDF_EXPORTER
+from app.program_model import parse as parse_program, split_text
+from app.rate_limit import ACTION_EXPORT, ACTION_PROGRAM, ACTION_QA, RATE_LIMITER
+from app.resilience import UpstreamUnavailable
+from app.saved_programs import (
+    SAVED_PAGE_SIZE, SAVED_ZIP_MAX_FILES, build_zip as build_saved_zip, count as saved_count, download_name,
+    file_id as get_file_id, forget_file_ids, latest as saved_latest, page as saved_page,
+    read_entries as read_saved, remember_file_id, save_program,
+)
+from app.scheduler import KIND_PROGRAM, KIND_QA, LLM_SCHEDULER, Overloaded
+from app.session import UserSession
+from app.state_store import LockTimeout
 from app.storage import (
-    load_user_data, save_user_data, set_last_reply, get_last_reply, 
-    set_user_goal, update_user_param, get_user_profile_text,
+    set_last_reply, get_last_reply, 
+    set_user_goal, update_user_param, get_user_profile_text, compact_history,
     validate_age, validate_height, validate_weight, validate_schedule
 )
+from app.textproc import StreamSanitizer
 
 logger = logging.getLogger("bot.telegram_bot")
 
-LAST_REPLIES: dict[str, str] = {}
-
-user_states: Dict[str, dict] = {}
-
-# Rate limiting: user_id -> последнее время генерации
-last_generation_time: Dict[str, float] = {}
-GENERATION_COOLDOWN = 30  # секунд между генерациями
+# Runtime-состояние (шаг анкеты) живёт в session.runtime (app.state_store), а не в словарях
+# модуля: переживает рестарт и общее для воркеров. Частоту генераций ограничивает app.rate_limit.
+# стриминг ответа: правка сообщения не чаще раза в N секунд (Telegram режет частые editMessageText)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_CURSOR = " ▌"
+# DeepSeek лежит (открыт circuit breaker) — отвечаем сразу, без ожидания таймаутов
+UPSTREAM_DOWN_MSG = "🛠 Сервис генерации сейчас недоступен. Попробуй через пару минут."
+# очередь генераций переполнена (app.scheduler) — сбрасываем нагрузку
+OVERLOADED_MSG = "🚦 Сейчас очень много запросов. Попробуй ещё раз через минуту."
+# предыдущее сообщение пользователя ещё обрабатывается дольше STATE_LOCK_WAIT (аренда app.state_store)
+BUSY_MSG = "⏳ Я ещё отвечаю на твоё предыдущее сообщение. Дождись ответа и повтори."
 
 GOAL_MAPPING = {
     "🏃‍♂️ Похудеть": "похудение",
@@ -61,18 +82,39 @@ MAIN_KEYBOARD = ReplyKeyboardMarkup(
         ["❓ Задать вопрос AI-тренеру"],
         ["🆕 Другая программа", "🎯 Изменить цель"],
         ["📋 Моя анкета", "⚙️ Изменить параметры"],
-        ["💾 Сохранить в файл", "📑 История ответов"],
+        ["💾 Сохранить в файл", "📄 PDF"],
+        ["📑 История ответов", "🏋️ Дневник подходов"],
         ["🔁 Начать заново"],
     ],
     resize_keyboard=True,
     is_persistent=True,
 )
 
+LIFT_LOG_KEYBOARD = ReplyKeyboardMarkup(
+    [["◀️ Назад в меню"]],
+    resize_keyboard=True,
+)
+LIFT_LOG_HINT = (
+    "Пиши подходы по одному упражнению на строку: «Жим лёжа 60x8», «Присед 100x5x5» "
+    "(вес × подходы × повторения), «Подтягивания 0x10», можно с запасом: «… rir 2»."
+)
+
+SAVED_MORE_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        ["📑 Ещё ответы", "📦 Все архивом"],
+        ["◀️ Назад в меню"],
+    ],
+    resize_keyboard=True,
+)
+
+# всегда новая генерация, мимо кэша программ (app.response_cache)
+RANDOM_VARIATION = "🎲 Случайная вариация"
+
 VARIATIONS_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["💪 Больше базовых", "🎯 Больше изоляции"],
         ["🏋️ Акцент на силу", "⚡ Акцент на выносливость"],
-        ["🎲 Случайная вариация"],
+        [RANDOM_VARIATION],
         ["◀️ Назад в меню"],
     ],
     resize_keyboard=True,
@@ -106,39 +148,11 @@ EDIT_PARAMS_KEYBOARD = ReplyKeyboardMarkup(
 )
 
 
-def _sanitize_for_tg(text: str) -> str:
-    """Убираем лишние HTML/markdown артефакты и заголовочные #."""
-    out = text or ""
-    # убрать #/## из начала строк
-    out = re.sub(r"^\s*#{1,6}\s*", "", out, flags=re.MULTILINE)
-    # <br>, <p>
-    out = re.sub(r"\s*<br\s*/?>\s*", "\n", out, flags=re.IGNORECASE)
-    out = re.sub(r"</?p\s*/?>", "\n", out, flags=re.IGNORECASE)
-    # убрать лишние пустые строки (>2 подряд -> 2)
-    out = re.sub(r"\n{3,}", "\n\n", out)
-    return out.strip()
-
 def _split_for_telegram(text: str, max_len: int = 3500) -> List[str]:
-    """Делим длинный текст на части, стараясь резать по границам дней/абзацев."""
+    """Делим длинный текст на части: программу/ответ с днями — целыми днями (app.program_model), прочее — по абзацам."""
     if len(text) <= max_len:
         return [text]
-
-    parts: List[str] = []
-    remaining = text
-    while len(remaining) > max_len:
-        # пробуем найти границу дня
-        cut = remaining.rfind("\n\nДень ", 0, max_len)
-        if cut < 0:
-            cut = remaining.rfind("\n\n**День", 0, max_len)
-        if cut < 0:
-            cut = remaining.rfind("\n\n", 0, max_len)
-        if cut < 0:
-            cut = max_len
-        parts.append(remaining[:cut].strip())
-        remaining = remaining[cut:].strip()
-    if remaining:
-        parts.append(remaining)
-    return parts
+    return parse_program(text).chunks(max_len)
 
 async def _safe_send(chat: Chat, text: str, use_markdown: bool = True):
     """Безопасная отправка: разбивка на куски + fallback без Markdown при ошибке."""
@@ -157,63 +171,323 @@ async def _safe_send(chat: Chat, text: str, use_markdown: bool = True):
             logger.error("Markdown failed, fallback to plain. Err: %s", e)
             await chat.send_message(chunk, disable_web_page_preview=True)
 
+_RATE_LIMIT_WHAT = {
+    ACTION_PROGRAM: "следующей генерацией",
+    ACTION_QA: "следующим вопросом",
+    ACTION_EXPORT: "следующим сохранением",
+}
+
+
+async def _rate_limited(update: Update, user_id: str, action: str) -> bool:
+    """Списывает действие из лимитов app.rate_limit; True — лимит исчерпан (пользователю уже ответили)."""
+    decision = await RATE_LIMITER.acquire(user_id, action)
+    if decision.allowed:
+        return False
+    if decision.scope == "global":
+        await update.message.reply_text(OVERLOADED_MSG)
+    else:
+        await update.message.reply_text(
+            f"⏳ Подожди ещё {math.ceil(decision.retry_after)} секунд перед {_RATE_LIMIT_WHAT[action]}.\n\n"
+            "Это защита от перегрузки 😊"
+        )
+    return True
+
+
+class _StreamingReply:
+    """
+    Показывает ответ модели по мере генерации: правит progress_msg, а когда текст перерастает
+    одно сообщение — досылает следующие по границам _split_for_telegram (уже отправленные части
+    дальше не меняются). Правки не чаще STREAM_EDIT_INTERVAL, на RetryAfter — пауза.
+    Промежуточный текст идёт без Markdown (незакрытые * ломают разметку), финальный — как _safe_send.
+
+        reply = _StreamingReply(update.effective_chat, progress_msg)
+        plan = await agent.get_program(..., on_text=reply.update)
+        await reply.finish(plan)
+    """
+
+    def __init__(self, chat: Chat, progress_msg, interval: float = STREAM_EDIT_INTERVAL):
+        self.chat = chat
+        self.messages = [progress_msg]
+        self.shown: List[str] = [progress_msg.text or ""]
+        self.initial = self.shown[0]
+        self.interval = interval
+        self.edits = 0
+        self.started = time.monotonic()
+        self.first_content_at: Optional[float] = None
+        self._next_at = 0.0
+        self._sanitizer = StreamSanitizer()
+
+    @property
+    def time_to_first_content(self) -> Optional[float]:
+        return None if self.first_content_at is None else self.first_content_at - self.started
+
+    async def queued(self, position: int) -> None:
+        """Колбэк LLM_SCHEDULER: номер в очереди; 0 — запрос пошёл, возвращаем исходный текст."""
+        if self.first_content_at is not None or (position and time.monotonic() < self._next_at):
+            return
+        await self._call(0, f"⏳ Ты в очереди: {position}" if position else self.initial, markdown=False, final=False)
+
+    async def update(self, raw: str) -> None:
+        if time.monotonic() < self._next_at:
+            return
+        text = self._sanitizer.feed(raw)
+        if text:
+            # промежуточный текст меняется на каждом куске — без разбора и кэша моделей
+            await self._render(split_text(text), cursor=True)
+            if self.first_content_at is None:
+                self.first_content_at = time.monotonic()
+
+    async def finish(self, text: str) -> None:
+        """Финальный текст (после чистки и форматирования): Markdown, лишние сообщения удаляются."""
+        await asyncio.sleep(max(0.0, self._next_at - time.monotonic()))
+        parts = _split_for_telegram(text.strip())
+        await self._render(parts, cursor=False, markdown=True)
+        if self.first_content_at is None:
+            self.first_content_at = time.monotonic()
+        await self._drop_extra(len(parts))
+        if self.time_to_first_content is not None:
+            logger.info(
+                "Streamed reply: first content after %.2fs, %d edits, %d messages",
+                self.time_to_first_content, self.edits, len(self.messages),
+            )
+
+    async def fail(self, error_msg: str) -> None:
+        await self._drop_extra(1)
+        await self._call(0, error_msg, markdown=False, final=True)
+
+    async def _render(self, parts: List[str], cursor: bool, markdown: bool = False) -> None:
+        for i, part in enumerate(parts):
+            if cursor and i == len(parts) - 1:
+                part += STREAM_CURSOR
+            if i < len(self.shown) and self.shown[i] == part:
+                continue
+            if not await self._call(i, part, markdown, final=not cursor):
+                return
+
+    async def _call(self, i: int, text: str, markdown: bool, final: bool) -> bool:
+        """Правит i-е сообщение (или досылает новое). False — если промежуточную правку пришлось пропустить."""
+        while True:
+            try:
+                try:
+                    await self._send_or_edit(i, text, ParseMode.MARKDOWN if markdown else None)
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        pass
+                    elif markdown:
+                        logger.error("Markdown failed, fallback to plain. Err: %s", e)
+                        await self._send_or_edit(i, text, None)
+                    else:
+                        raise
+            except RetryAfter as e:
+                delay = float(e.retry_after)
+                self._next_at = time.monotonic() + delay
+                if not final:
+                    return False
+                await asyncio.sleep(delay)
+                continue
+            if i < len(self.shown):
+                self.shown[i] = text
+            self._next_at = time.monotonic() + self.interval
+            return True
+
+    async def _send_or_edit(self, i: int, text: str, parse_mode) -> None:
+        if i < len(self.messages):
+            await self.messages[i].edit_text(text, parse_mode=parse_mode, disable_web_page_preview=True)
+            self.edits += 1
+        else:
+            msg = await self.chat.send_message(text, parse_mode=parse_mode, disable_web_page_preview=True)
+            self.messages.append(msg)
+            self.shown.append(text)
+
+    async def _drop_extra(self, keep: int) -> None:
+        for msg in self.messages[keep:]:
+            try:
+                await msg.delete()
+            except Exception as e:
+                logger.warning("Failed to delete stale streamed message: %s", e)
+        del self.messages[keep:]
+        del self.shown[keep:]
+
+
 async def _send_main_menu(update: Update):
     await update.effective_chat.send_message(
         "Что дальше? Выбери действие в меню ⬇️",
         reply_markup=MAIN_KEYBOARD,
     )
 
-async def _save_last_to_file(update: Update, user_id: str):
-    """Сохранение последней программы/ответа в файл .txt и отправка документом."""
-    text = LAST_REPLIES.get(user_id) or get_last_reply(user_id) or ""
+async def send_onboarding_welcome(update: Update, data: dict):
+    """Первый /start участника из пакетного импорта (app.onboarding): анкета уже есть, программа обычно готова."""
+    program = data.get("last_program")
+    await update.message.reply_text(
+        "Привет! Я твой персональный фитнес-тренер GymAiMentor 💪🏼\n"
+        + ("Твой зал уже передал мне анкету, программа готова ⬇️" if program else
+           "Твой зал уже передал мне анкету. Программу получишь кнопкой «🆕 Другая программа» ⬇️")
+    )
+    if program:
+        await _safe_send(update.effective_chat, program, use_markdown=True)
+    await _send_main_menu(update)
+
+async def _save_last_to_file(update: Update, user_id: str, data: dict):
+    """Сохранение последней программы/ответа в файл .txt (с записью в индекс data["programs"]) и отправка документом."""
+    text = get_last_reply(user_id, data=data) or ""
     if not text.strip():
         await update.effective_chat.send_message(
             "Сначала сгенерируй программу (кнопкой «📄 Другая программа»)."
         )
         return
-    ts = int(time.time())
-    fname = f"program_{user_id}_{ts}.txt"
-    out_path = Path("data/users") / fname
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    out_path.write_text(text, encoding="utf-8")
-    with open(out_path, "rb") as fh:
-        await update.effective_chat.send_document(
-            fh, filename=fname, caption="Вот файл с твоим последним запросом 👌🏼"
+    _, entry = await asyncio.to_thread(save_program, user_id, text, data)
+    msg = await update.effective_chat.send_document(
+        text.encode("utf-8"), filename=download_name(user_id, entry), caption="Вот файл с твоим последним запросом 👌🏼"
+    )
+    # история ответов потом пошлёт этот файл по file_id, без повторной загрузки
+    remember_file_id(data, entry, msg.document.file_id if msg and msg.document else None)
+
+async def _send_last_as_pdf(update: Update, user_id: str, data: dict):
+    """Последняя программа/ответ в PDF: рендер в пуле процессов app.pdf_export, повтор того же текста — из кэша."""
+    text = get_last_reply(user_id, data=data) or ""
+    if not text.strip():
+        await update.effective_chat.send_message(
+            "Сначала сгенерируй программу (кнопкой «📄 Другая программа»)."
         )
+        return
+    if not PDF_AVAILABLE:
+        await update.effective_chat.send_message("PDF-экспорт сейчас недоступен. Сохрани ответ кнопкой «💾 Сохранить в файл».")
+        return
+    name = ((data.get("physical_data") or {}).get("name") or "").strip()
+    title = f"Программа тренировок — {name}" if name else "Программа тренировок"
+    try:
+        pdf = await PDF_EXPORTER.render(text, title)
+    except Exception:
+        logger.exception(f"PDF render failed for user {user_id}")
+        await update.effective_chat.send_message("Не получилось собрать PDF 😔 Попробуй «💾 Сохранить в файл».")
+        return
+    await update.effective_chat.send_document(
+        pdf, filename=f"program_{user_id}.pdf", caption="Вот твоя программа в PDF 📄"
+    )
 
-async def _show_saved_programs(update: Update, user_id: str):
-    """Показывает список последних сохраненных программ пользователя."""
-    user_dir = Path("data/users")
-    pattern = f"program_{user_id}_*.txt"
-    
-    files = list(user_dir.glob(pattern))
-    
-    if not files:
+async def _send_saved(update: Update, user_id: str, data: dict, entries: List[dict], head: str = ""):
+    """
+    Файлы программ одним send_media_group (один файл — send_document). Уже отправленные идут
+    по file_id, остальные читаются параллельно в потоках; новые file_id запоминаются в data.
+    """
+    cached = [get_file_id(data, e) for e in entries]
+    contents = iter(await read_saved(user_id, [e for e, fid in zip(entries, cached) if not fid]))
+    media = []
+    for entry, fid in zip(entries, cached):
+        source = fid or next(contents)
+        if source is None:
+            continue
+        date_str = time.strftime("%d.%m.%Y %H:%M", time.localtime(entry["ts"]))
+        caption = f"📎 {entry.get('title') or 'Запрос'}\n{date_str}"
+        if head and not media:
+            caption = f"{head}\n\n{caption}"
+        media.append((entry, source, caption))
+    if not media:
+        await update.effective_chat.send_message("Файлы сохранённых ответов не найдены 🤷")
+        return
+    try:
+        if len(media) == 1:
+            entry, source, caption = media[0]
+            messages = [await update.effective_chat.send_document(
+                source, filename=download_name(user_id, entry), caption=caption
+            )]
+        else:
+            messages = await update.effective_chat.send_media_group([
+                InputMediaDocument(source, caption=caption, filename=download_name(user_id, entry))
+                for entry, source, caption in media
+            ])
+    except BadRequest:
+        if not any(cached):
+            raise
+        # file_id больше не принимается — загружаем файлы заново
+        logger.warning(f"Cached file_id rejected for user {user_id}, re-uploading saved programs")
+        forget_file_ids(data, entries)
+        await _send_saved(update, user_id, data, entries, head)
+        return
+    for (entry, _, _), msg in zip(media, messages):
+        remember_file_id(data, entry, msg.document.file_id if msg and msg.document else None)
+    METRICS.inc("saved_programs.sent", len(media))
+    METRICS.inc("saved_programs.uploaded", sum(1 for _, source, _ in media if isinstance(source, bytes)))
+
+async def _show_saved_programs(update: Update, session: UserSession, more: bool = False):
+    """
+    Показывает страницу сохранённых программ (SAVED_PAGE_SIZE штук, от новых к старым) по индексу
+    из документа; номер следующей страницы — в session.runtime, кнопка «📑 Ещё ответы».
+    Запросов к Telegram — один-два: файлы страницы и, если нужно сменить клавиатуру, сообщение с ней.
+    """
+    user_id, data = session.user_id, session.data
+    total = saved_count(data)
+    if not total:
         await update.effective_chat.send_message(
             "У тебя пока нет сохранённых запросов.\n\nИспользуй кнопку «💾 Сохранить ответ» после генерации ответа."
         )
         return
-    
-    files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-    
-    recent_files = files[:10]
-    
-    await update.effective_chat.send_message(
-        f"📑 Найдено сохранённых ответов: {len(files)}\n\nОтправляю последние {len(recent_files)}..."
+
+    number = session.runtime.get("saved_page", 0) if more else 0
+    entries = saved_page(data, number)
+    if not entries:
+        session.runtime.pop("saved_page", None)
+        await update.effective_chat.send_message("Это были все сохранённые ответы.", reply_markup=MAIN_KEYBOARD)
+        return
+    shown = number * SAVED_PAGE_SIZE + len(entries)
+    has_more = shown < total
+    if has_more:
+        session.runtime["saved_page"] = number + 1
+    else:
+        session.runtime.pop("saved_page", None)
+
+    if number == 0:
+        head = f"📑 Сохранённых ответов: {total}" + (f", последние {len(entries)}" if has_more else "")
+    else:
+        head = f"📑 Ответы {number * SAVED_PAGE_SIZE + 1}–{shown} из {total}"
+    await _send_saved(update, user_id, data, entries, head)
+
+    if has_more:
+        await update.effective_chat.send_message(
+            "Показать более ранние или все одним архивом?", reply_markup=SAVED_MORE_KEYBOARD
+        )
+    elif more:
+        await update.effective_chat.send_message("Это все сохранённые ответы.", reply_markup=MAIN_KEYBOARD)
+
+async def _send_saved_zip(update: Update, user_id: str, data: dict):
+    """Все сохранённые программы (до SAVED_ZIP_MAX_FILES последних) одним ZIP-файлом, собранным в памяти."""
+    entries = saved_latest(data, SAVED_ZIP_MAX_FILES)
+    if not entries:
+        await update.effective_chat.send_message("У тебя пока нет сохранённых запросов.", reply_markup=MAIN_KEYBOARD)
+        return
+    raw, added = await asyncio.to_thread(build_saved_zip, user_id, entries)
+    if not added:
+        await update.effective_chat.send_message("Файлы сохранённых ответов не найдены 🤷", reply_markup=MAIN_KEYBOARD)
+        return
+    await update.effective_chat.send_document(
+        raw, filename=f"programs_{user_id}.zip", caption=f"📦 Сохранённые ответы: {added}", reply_markup=MAIN_KEYBOARD
     )
-    
-    for file_path in recent_files:
-        try:
-            timestamp = int(file_path.stem.split('_')[-1])
-            date_str = time.strftime("%d.%m.%Y %H:%M", time.localtime(timestamp))
-            caption = f"📎 Запрос от {date_str}"
-        except (ValueError, IndexError):
-            caption = f"📎 {file_path.name}"
-        
-        with open(file_path, "rb") as fh:
-            await update.effective_chat.send_document(
-                fh, filename=file_path.name, caption=caption
-            )
+    METRICS.inc("saved_programs.zip_files", added)
+
+async def _show_lift_log(update: Update, user_id: str):
+    """Вход в дневник подходов: текущие рабочие веса и подсказка по формату."""
+    log = await LIFT_LOGS.get_async(user_id)
+    recent = log.recent()
+    head = "🏋️ Дневник подходов пока пуст."
+    if recent:
+        head = "\n".join(["🏋️ Твои рабочие веса:"] + [f"- {s.describe()}" for s in recent])
+    await update.message.reply_text(f"{head}\n\n{LIFT_LOG_HINT}", reply_markup=LIFT_LOG_KEYBOARD)
+
+
+async def _log_lift_sets(update: Update, user_id: str, text: str):
+    """Запись подходов из сообщения: дописывание в журнал (app.lift_log), ответ — обновлённые агрегаты."""
+    try:
+        sets = parse_sets(text)
+    except ValueError as e:
+        await update.message.reply_text(f"Не понял строку «{e}».\n{LIFT_LOG_HINT}", reply_markup=LIFT_LOG_KEYBOARD)
+        return
+    if not sets:
+        await update.message.reply_text(LIFT_LOG_HINT, reply_markup=LIFT_LOG_KEYBOARD)
+        return
+    touched = await LIFT_LOGS.log_sets_async(user_id, sets)
+    lines = [f"✅ Записал подходов: {len(sets)}"] + [f"- {s.describe()}" for s in touched]
+    await update.message.reply_text("\n".join(lines), reply_markup=LIFT_LOG_KEYBOARD)
+
 
 def _normalize_name(raw: str) -> str:
     name = (raw or "").strip()
@@ -243,27 +517,69 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
 
-    user_id = str(update.effective_user.id)
+    # один документ на апдейт: читаем один раз, пишем не больше одного раза в конце
+    try:
+        async with UserSession(str(update.effective_user.id), order=update.update_id) as session:
+            seq = history_seq(session.data)
+            await _handle_message(update, context, session)
+    except LockTimeout:
+        # без аренды не обрабатываем: две сессии одного пользователя затёрли бы друг друга
+        await update.message.reply_text(BUSY_MSG)
+        return
+    # новые реплики уже записаны (сессия закрыта) — сводку обновит фоновая задача
+    if history_seq(session.data) != seq:
+        COACH_SUMMARY.schedule(session.user_id)
+
+
+async def _handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, session: UserSession):
+    user_id = session.user_id
     text = (update.message.text or "").strip()
 
     # текущие данные пользователя
-    data = load_user_data(user_id)
+    data = session.data
     phys = data.get("physical_data") or {}
     name = phys.get("name")
     completed = bool(data.get("physical_data_completed"))
-    state = user_states.get(user_id) or {"mode": None, "step": 0, "data": {}}
+    state = session.state or {"mode": None, "step": 0, "data": {}}
     
     logger.debug(f"handle_message - user_id: {user_id}, text: {text[:50]}, state.mode: {state.get('mode')}, completed: {completed}")
 
 
     if text == "💾 Сохранить в файл":
         logger.info(f"User {user_id} ({name}) saving last reply to file")
-        await _save_last_to_file(update, user_id)
+        if await _rate_limited(update, user_id, ACTION_EXPORT):
+            return
+        await _save_last_to_file(update, user_id, data)
+        return
+
+    if text == "📄 PDF":
+        logger.info(f"User {user_id} ({name}) exporting last reply to PDF")
+        if await _rate_limited(update, user_id, ACTION_EXPORT):
+            return
+        await _send_last_as_pdf(update, user_id, data)
         return
 
     if text == "📑 История ответов":
         logger.info(f"User {user_id} ({name}) viewing saved programs history")
-        await _show_saved_programs(update, user_id)
+        await _show_saved_programs(update, session)
+        return
+
+    if text == "📑 Ещё ответы":
+        await _show_saved_programs(update, session, more=True)
+        return
+
+    if text == "📦 Все архивом":
+        logger.info(f"User {user_id} ({name}) exporting saved programs as zip")
+        if await _rate_limited(update, user_id, ACTION_EXPORT):
+            return
+        session.runtime.pop("saved_page", None)
+        await _send_saved_zip(update, user_id, data)
+        return
+
+    if text == "🏋️ Дневник подходов":
+        logger.info(f"User {user_id} ({name}) opening lift log")
+        session.state = {"mode": "lift_log", "step": 0, "data": {}}
+        await _show_lift_log(update, user_id)
         return
 
     if text == "📋 Моя анкета":
@@ -274,7 +590,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         logger.info(f"User {user_id} ({name}) viewing profile")
-        profile_text = get_user_profile_text(user_id)
+        profile_text = get_user_profile_text(user_id, data=data)
         await update.message.reply_text(profile_text, parse_mode=ParseMode.MARKDOWN)
         return
 
@@ -293,7 +609,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "◀️ Назад в меню":
-        user_states.pop(user_id, None)
+        session.state = None
         await update.message.reply_text("Главное меню ⬇️", reply_markup=MAIN_KEYBOARD)
         return
 
@@ -309,7 +625,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"User {user_id} ({name}) changing goal from {phys.get('target')}")
         
         # переход в режим выбора новой цели
-        user_states[user_id] = {"mode": "changing_goal", "step": 0, "data": {}}
+        session.state = {"mode": "changing_goal", "step": 0, "data": {}}
         
         # показываем текущую цель
         current_goal = phys.get("target", "не указана")
@@ -328,7 +644,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         # сразу меню стиля тренировок; группа мышц — из профиля
         muscle_from_profile = phys.get("preferred_muscle_group") or "сбалансированно"
-        user_states[user_id] = {
+        session.state = {
             "mode": "choosing_variation",
             "step": 0,
             "data": {"muscle_group": muscle_from_profile},
@@ -344,21 +660,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🎯 Больше изоляции": "Добавь больше изолирующих упражнений для проработки отдельных мышечных групп.",
         "🏋️ Акцент на силу": "Программа с акцентом на развитие силы: меньше повторений (4-6), больше отдыха, тяжелые веса.",
         "⚡ Акцент на выносливость": "Программа с акцентом на выносливость: больше повторений (15-20), меньше отдыха, умеренные веса.",
-        "🎲 Случайная вариация": "Сделай максимально разнообразную и нестандартную программу, используй креативные упражнения.",
+        RANDOM_VARIATION: "Сделай максимально разнообразную и нестандартную программу, используй креативные упражнения.",
     }
     
     if text in variation_map:
-        # Rate limiting check
-        current_time = time.time()
-        last_time = last_generation_time.get(user_id, 0)
-        time_since_last = current_time - last_time
-        
-        if time_since_last < GENERATION_COOLDOWN:
-            wait_time = int(GENERATION_COOLDOWN - time_since_last)
-            await update.message.reply_text(
-                f"⏳ Подожди ещё {wait_time} секунд перед следующей генерацией.\n\n"
-                "Это защита от перегрузки 😊"
-            )
+        if await _rate_limited(update, user_id, ACTION_PROGRAM):
             return
         
         muscle_group = state.get("data", {}).get("muscle_group", "")
@@ -366,31 +672,37 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"User {user_id} ({name}) requested program variation: {text}, muscle_group: {muscle_group}")
         
         progress_msg = await update.message.reply_text("⏳ Генерирую программу...")
+        reply = _StreamingReply(update.effective_chat, progress_msg)
         start_time = time.time()
         
         try:
-            agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id)
+            agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id, user_data=data)
             variation = variation_map[text]
+            # слот планировщика — только если программы нет в кэше; случайная вариация всегда генерируется заново
             plan = await agent.get_program(
                 variation,
                 focus_group_override=muscle_group if (muscle_group and muscle_group != "сбалансированно") else None,
+                on_text=reply.update,
+                use_cache=text != RANDOM_VARIATION,
+                admit=lambda: LLM_SCHEDULER.slot(user_id, KIND_PROGRAM, on_position=reply.queued),
             )
             
             generation_time = time.time() - start_time
             logger.info(f"Program generated for user {user_id} in {generation_time:.2f}s")
             
-            await progress_msg.edit_text("✨ Программа готова!")
-            
-            # обновляем время последней генерации
-            last_generation_time[user_id] = current_time
-            
         except Exception as e:
             logger.exception(f"Error generating program for user {user_id}")
+            # генерация не состоялась — не засчитываем её в лимит
+            RATE_LIMITER.refund(user_id, ACTION_PROGRAM)
             
             # различные типы ошибок
             error_msg = "❌ Не получилось сгенерировать программу.\n\n"
             
-            if "timeout" in str(e).lower():
+            if isinstance(e, Overloaded):
+                error_msg += OVERLOADED_MSG
+            elif isinstance(e, UpstreamUnavailable):
+                error_msg += UPSTREAM_DOWN_MSG
+            elif "timeout" in str(e).lower():
                 error_msg += "⏱️ Сервер не ответил вовремя. Попробуй ещё раз через минуту."
             elif "connection" in str(e).lower():
                 error_msg += "🌐 Проблемы с подключением к серверу. Попробуй позже."
@@ -399,20 +711,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 error_msg += f"Попробуй ещё раз позже.\n\nТехническая информация: {str(e)[:100]}"
             
-            await progress_msg.edit_text(error_msg)
+            await reply.fail(error_msg)
             return
         
-        plan = _sanitize_for_tg(plan)
-        LAST_REPLIES[user_id] = plan
-        set_last_reply(user_id, plan)
+        set_last_reply(user_id, plan, data=data)
         
         # очищаем состояние после генерации
-        user_states.pop(user_id, None)
+        session.state = None
         
         # логируем успешную отправку
         logger.info(f"Program sent to user {user_id}, length: {len(plan)} chars")
         
-        await _safe_send(update.effective_chat, plan, use_markdown=True)
+        await reply.finish(plan)
         await _send_main_menu(update)
         return
 
@@ -422,23 +732,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # полный сброс: имя, анкета, история, последняя программа/ответ
         data["physical_data"] = {}                 # <- имя тоже очищаем
         data["physical_data_completed"] = False
-        data["history"] = []
+        compact_history(data, keep=0)              # история уходит в архив
         data["last_program"] = None
         data["last_reply"] = None
-        save_user_data(user_id, data)
+        data["coach_summary"] = None               # сводка прошлых разговоров — тоже заново
 
         # сбрасываем runtime-состояние и начинаем заново с вопроса про имя
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
+        session.state = {"mode": "awaiting_name", "step": 0, "data": {}}
         await update.message.reply_text("Заполним анкету заново 📝 Как тебя зовут?")
         return
 
     if not completed and state.get("mode") is None:
         if not name:
-            user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
+            session.state = {"mode": "awaiting_name", "step": 0, "data": {}}
             await update.message.reply_text("Как тебя зовут?")
             return
         # если имя уже есть, добавляем его в state["data"]
-        user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
+        session.state = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
         await update.message.reply_text(
             f"{name}, выбери свою цель тренировок ⬇️",
             reply_markup=GOAL_KEYBOARD,
@@ -446,11 +756,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "❓ Задать вопрос AI-тренеру":
-        user_states[user_id] = {"mode": "qa", "step": 0, "data": {}}
-        # Сброс истории диалога: для ответа учитываются только анкета (профиль, цели, уровень) и новый вопрос
-        data = load_user_data(user_id)
-        data["history"] = []
-        save_user_data(user_id, data)
+        session.state = {"mode": "qa", "step": 0, "data": {}}
+        # Сброс истории диалога: для ответа учитываются только анкета (профиль, цели, уровень) и новый вопрос.
+        # Старые реплики не теряются — уходят в архив истории.
+        compact_history(data, keep=0)
         await update.message.reply_text("Задай вопрос по тренировкам/питанию ✍🏼")
         logger.info(f"User {user_id} ({name}) entered Q&A mode")
         return
@@ -458,43 +767,53 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state.get("mode") == "qa":
         logger.info(f"User {user_id} ({name}) asked: {text[:100]}")
         
+        if await _rate_limited(update, user_id, ACTION_QA):
+            return
+        
         progress_msg = await update.message.reply_text("⏳ Думаю над ответом...")
+        reply = _StreamingReply(update.effective_chat, progress_msg)
         start_time = time.time()
         
         try:
-            agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id)
-            answer = await agent.get_answer(text)
+            agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id, user_data=data)
+            async with LLM_SCHEDULER.slot(user_id, KIND_QA, on_position=reply.queued):
+                answer = await agent.get_answer(text, on_text=reply.update)
             
             answer_time = time.time() - start_time
             logger.info(f"Answer generated for user {user_id} in {answer_time:.2f}s")
-            
-            await progress_msg.delete()
         except Exception as e:
             logger.exception(f"Error generating answer for user {user_id}")
+            RATE_LIMITER.refund(user_id, ACTION_QA)
             
             error_msg = "❌ Не удалось получить ответ.\n\n"
             
-            if "timeout" in str(e).lower():
+            if isinstance(e, Overloaded):
+                error_msg += OVERLOADED_MSG
+            elif isinstance(e, UpstreamUnavailable):
+                error_msg += UPSTREAM_DOWN_MSG
+            elif "timeout" in str(e).lower():
                 error_msg += "⏱️ Сервер не ответил вовремя. Попробуй переформулировать вопрос."
             elif "connection" in str(e).lower():
                 error_msg += "🌐 Проблемы с подключением. Попробуй позже."
             else:
                 error_msg += "Попробуй задать вопрос ещё раз."
             
-            await progress_msg.edit_text(error_msg)
+            await reply.fail(error_msg)
             return
         
-        answer = _sanitize_for_tg(answer)
-        LAST_REPLIES[user_id] = answer
-        set_last_reply(user_id, answer)
+        set_last_reply(user_id, answer, data=data)
         
         logger.info(f"Answer sent to user {user_id}, length: {len(answer)} chars")
         
-        await _safe_send(update.effective_chat, answer, use_markdown=True)
+        await reply.finish(answer)
         footer = f"{name}, выбери дальнейшее действие или продолжи диалог с AI-тренером ⬇️" if name else "Выбери дальнейшее действие или продолжи диалог с AI-тренером ⬇️"
         await update.effective_chat.send_message(footer, reply_markup=MAIN_KEYBOARD)
         return
 
+    if state.get("mode") == "lift_log":
+        await _log_lift_sets(update, user_id, text)
+        return
+
     # имя
     if state.get("mode") == "awaiting_name":
         if not text:
@@ -503,9 +822,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         normalized_name = _normalize_name(text)
         phys["name"] = normalized_name
         data["physical_data"] = phys
-        save_user_data(user_id, data)
         # добавляем имя в state["data"], чтобы оно попало в финальное сохранение
-        user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": normalized_name}}
+        session.state = {"mode": "awaiting_goal", "step": 0, "data": {"name": normalized_name}}
         await update.message.reply_text(
             f"{normalized_name}, выбери свою цель тренировок ⬇️",
             reply_markup=GOAL_KEYBOARD,
@@ -516,7 +834,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state.get("mode") == "awaiting_goal":
         if text in GOAL_MAPPING:
             # цель выбрана — идём дальше к полу, сохраняем имя из предыдущего шага
-            user_states[user_id] = {
+            session.state = {
                 "mode": "awaiting_gender", 
                 "step": 0, 
                 "data": {**state["data"], "target": GOAL_MAPPING[text]}
@@ -530,7 +848,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # обработчики редактирования параметров
     if text == "👤 Имя":
-        user_states[user_id] = {"mode": "editing_name", "step": 0, "data": {}}
+        session.state = {"mode": "editing_name", "step": 0, "data": {}}
         current_name = phys.get("name", "не указано")
         await update.message.reply_text(
             f"Текущее имя: {current_name}\n\nВведи новое имя:"
@@ -538,7 +856,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "🔢 Возраст":
-        user_states[user_id] = {"mode": "editing_age", "step": 0, "data": {}}
+        session.state = {"mode": "editing_age", "step": 0, "data": {}}
         current_age = phys.get("age", "не указан")
         await update.message.reply_text(
             f"Текущий возраст: {current_age} лет\n\nВведи новый возраст (10-100 лет):"
@@ -546,7 +864,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "⚖️ Текущий вес":
-        user_states[user_id] = {"mode": "editing_weight", "step": 0, "data": {}}
+        session.state = {"mode": "editing_weight", "step": 0, "data": {}}
         current_weight = phys.get("weight", "не указан")
         await update.message.reply_text(
             f"Текущий вес: {current_weight} кг\n\nВведи новый текущий вес в килограммах (например: 75 или 75.5):"
@@ -554,7 +872,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "🎯 Желаемый вес":
-        user_states[user_id] = {"mode": "editing_goal_weight", "step": 0, "data": {}}
+        session.state = {"mode": "editing_goal_weight", "step": 0, "data": {}}
         current_goal = phys.get("goal", "не указан")
         await update.message.reply_text(
             f"Желаемый вес: {current_goal} кг\n\nВведи новый желаемый вес в килограммах (например: 70 или 70.5):"
@@ -562,7 +880,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "📈 Частота тренировок":
-        user_states[user_id] = {"mode": "editing_schedule", "step": 0, "data": {}}
+        session.state = {"mode": "editing_schedule", "step": 0, "data": {}}
         current_schedule = phys.get("schedule", "не указана")
         await update.message.reply_text(
             f"Текущая частота: {current_schedule} раз/неделю\n\nСколько раз в неделю сможешь посещать зал (1-7)?"
@@ -570,7 +888,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "⚠️ Ограничения / предпочтения":
-        user_states[user_id] = {"mode": "editing_restrictions", "step": 0, "data": {}}
+        session.state = {"mode": "editing_restrictions", "step": 0, "data": {}}
         current_restrictions = phys.get("restrictions", "нет")
         await update.message.reply_text(
             f"Текущие ограничения: {current_restrictions}\n\nОпиши новые ограничения по здоровью или предпочтения в тренировках (или напиши 'нет'):"
@@ -578,7 +896,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "🏋️ Уровень подготовки":
-        user_states[user_id] = {"mode": "editing_level", "step": 0, "data": {}}
+        session.state = {"mode": "editing_level", "step": 0, "data": {}}
         current_level = phys.get("level", "не указан")
         await update.message.reply_text(
             f"Текущий уровень: {current_level}\n\nВыбери новый уровень подготовки:",
@@ -587,7 +905,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "💪 Акцент на мышцы":
-        user_states[user_id] = {"mode": "editing_muscle_group", "step": 0, "data": {}}
+        session.state = {"mode": "editing_muscle_group", "step": 0, "data": {}}
         muscle_group_display = {
             "ноги": "🦵 Ноги",
             "ягодицы": "🍑 Ягодицы",
@@ -612,10 +930,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state.get("mode") == "changing_goal":
         if text in GOAL_MAPPING:
             # сохраняем новую цель через специальную функцию
-            set_user_goal(user_id, GOAL_MAPPING[text])
+            set_user_goal(user_id, GOAL_MAPPING[text], data=data)
             
             # очищаем состояние
-            user_states.pop(user_id, None)
+            session.state = None
             
             # подтверждение
             await update.message.reply_text(
@@ -634,8 +952,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not new_name:
             await update.message.reply_text("❌ Имя не может быть пустым.\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "name", new_name)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "name", new_name, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Имя успешно обновлено: {new_name}",
             reply_markup=MAIN_KEYBOARD,
@@ -648,8 +966,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not valid:
             await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "age", value)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "age", value, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Возраст успешно обновлён: {value} лет",
             reply_markup=MAIN_KEYBOARD,
@@ -662,8 +980,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not valid:
             await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "weight", value)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "weight", value, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Текущий вес успешно обновлён: {value} кг",
             reply_markup=MAIN_KEYBOARD,
@@ -676,8 +994,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not valid:
             await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "goal", value)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "goal", value, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Желаемый вес успешно обновлён: {value} кг",
             reply_markup=MAIN_KEYBOARD,
@@ -690,8 +1008,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not valid:
             await update.message.reply_text(f"❌ {error}\n\nПопробуй ещё раз:")
             return
-        update_user_param(user_id, "schedule", value)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "schedule", value, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Частота тренировок успешно обновлена: {value} раз/неделю",
             reply_markup=MAIN_KEYBOARD,
@@ -701,8 +1019,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # обработка ввода новых ограничений
     if state.get("mode") == "editing_restrictions":
         restrictions = text if text.lower() not in ["нет", "no", "-"] else None
-        update_user_param(user_id, "restrictions", restrictions)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "restrictions", restrictions, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Ограничения / предпочтения успешно обновлены: {restrictions or 'нет'}",
             reply_markup=MAIN_KEYBOARD,
@@ -718,8 +1036,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         level = "опытный" if ("Опыт" in text or "🔥" in text) else "начинающий"
-        update_user_param(user_id, "level", level)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "level", level, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Уровень подготовки успешно обновлён: {level}",
             reply_markup=MAIN_KEYBOARD,
@@ -749,8 +1067,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         muscle_group = muscle_groups_map[text]
-        update_user_param(user_id, "preferred_muscle_group", muscle_group)
-        user_states.pop(user_id, None)
+        update_user_param(user_id, "preferred_muscle_group", muscle_group, data=data)
+        session.state = None
         await update.message.reply_text(
             f"✅ Акцент на мышцы успешно обновлён: {text}",
             reply_markup=MAIN_KEYBOARD,
@@ -767,7 +1085,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         st = {"mode": "survey", "step": 2, "data": {**state["data"], "gender": g}}
-        user_states[user_id] = st
+        session.state = st
         await update.message.reply_text("Сколько тебе лет?")
         return
 
@@ -834,15 +1152,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if state["step"] <= len(questions):
             idx = state["step"] - 1
             _, qtext = questions[idx]
-            # ВАЖНО: сохраняем обновленный state обратно в user_states
-            user_states[user_id] = {"mode": "survey", "step": state["step"] + 1, "data": state["data"]}
-            logger.debug(f"Moving to next question, saved state: {user_states[user_id]}")
+            # ВАЖНО: сохраняем обновленный state обратно в сессию
+            session.state = {"mode": "survey", "step": state["step"] + 1, "data": state["data"]}
+            logger.debug(f"Moving to next question, saved state: {session.state}")
             await update.message.reply_text(qtext)
             return
         
         # все вопросы пройдены → переход к выбору уровня подготовки
         logger.debug(f"Survey completed - state[data]: {state['data']}")
-        user_states[user_id] = {"mode": "awaiting_level", "step": 0, "data": state["data"]}
+        session.state = {"mode": "awaiting_level", "step": 0, "data": state["data"]}
         await update.message.reply_text("Выбери свой уровень подготовки:", reply_markup=LEVEL_KEYBOARD)
         return
 
@@ -859,7 +1177,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.debug(f"Level selected: {level}")
         
         # сохраняем уровень и переходим к выбору мышечной группы
-        user_states[user_id] = {
+        session.state = {
             "mode": "awaiting_muscle_group", 
             "step": 0, 
             "data": {**state["data"], "level": level}
@@ -896,7 +1214,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # сохраняем выбранную группу мышц
         muscle_group = muscle_groups_map[text]
         finished = {**state["data"], "preferred_muscle_group": muscle_group}
-        user_states.pop(user_id, None)
+        session.state = None
 
         logger.debug(f"Before save - state[data]: {state['data']}")
         logger.debug(f"Before save - finished: {finished}")
@@ -905,63 +1223,92 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         base.update(finished)
         data["physical_data"] = base
         data["physical_data_completed"] = True
-        save_user_data(user_id, data)
+        # анкету фиксируем до долгой генерации, чтобы не потерять её при сбое
+        await session.flush()
 
         logger.info(f"User {user_id} ({base.get('name')}) completed registration with muscle group: {muscle_group}")
         logger.debug(f"Saved physical_data: {base}")
 
+        if await _rate_limited(update, user_id, ACTION_PROGRAM):
+            await _send_main_menu(update)
+            return
+
         progress_msg = await update.message.reply_text("⏳ Спасибо! Формирую твою персональную программу…")
+        reply = _StreamingReply(update.effective_chat, progress_msg)
         start_time = time.time()
 
-        agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id)
+        agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id, user_data=data)
         try:
-            plan = await agent.get_program("")
+            plan = await agent.get_program(
+                "",
+                on_text=reply.update,
+                admit=lambda: LLM_SCHEDULER.slot(user_id, KIND_PROGRAM, on_position=reply.queued),
+            )
             
             generation_time = time.time() - start_time
             logger.info(f"First program generated for user {user_id} in {generation_time:.2f}s")
-            
-            await progress_msg.edit_text("✨ Программа готова!")
         except Exception as e:
             logger.exception(f"Error generating first program for user {user_id}")
+            RATE_LIMITER.refund(user_id, ACTION_PROGRAM)
             
             error_msg = "❌ Не удалось сгенерировать программу.\n\n"
             
-            if "timeout" in str(e).lower():
+            if isinstance(e, Overloaded):
+                error_msg += OVERLOADED_MSG
+            elif isinstance(e, UpstreamUnavailable):
+                error_msg += UPSTREAM_DOWN_MSG
+            elif "timeout" in str(e).lower():
                 error_msg += "⏱️ Сервер не ответил вовремя. Используй кнопку «🆕 Другая программа» чтобы попробовать снова."
             elif "connection" in str(e).lower():
                 error_msg += "🌐 Проблемы с подключением. Попробуй через минуту кнопкой «🆕 Другая программа»."
             else:
                 error_msg += "Попробуй через кнопку «🆕 Другая программа» в главном меню."
             
-            await progress_msg.edit_text(error_msg)
+            await reply.fail(error_msg)
             await _send_main_menu(update)
             return
 
-        plan = _sanitize_for_tg(plan)
-        LAST_REPLIES[user_id] = plan
-        set_last_reply(user_id, plan)
+        set_last_reply(user_id, plan, data=data)
         
         logger.info(f"First program sent to user {user_id}, length: {len(plan)} chars")
         
-        await _safe_send(update.effective_chat, plan, use_markdown=True)
+        await reply.finish(plan)
         await _send_main_menu(update)
         return
 
     if not completed:
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
+        session.state = {"mode": "awaiting_name", "step": 0, "data": {}}
         await update.message.reply_text("Как тебя зовут?")
         return
 
-    agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id)
+    if await _rate_limited(update, user_id, ACTION_PROGRAM):
+        return
+
+    progress_msg = await update.message.reply_text("⏳ Формирую программу с учётом твоих пожеланий…")
+    reply = _StreamingReply(update.effective_chat, progress_msg)
+    agent = FitnessAgent(token=os.getenv("DEEPSEEK_API_KEY"), user_id=user_id, user_data=data)
     try:
-        plan = await agent.get_program(text)
+        # свободные пожелания почти не повторяются — мимо общего кэша, с полной карточкой и весами
+        plan = await agent.get_program(
+            text,
+            on_text=reply.update,
+            use_cache=False,
+            admit=lambda: LLM_SCHEDULER.slot(user_id, KIND_PROGRAM, on_position=reply.queued),
+        )
+    except Overloaded:
+        RATE_LIMITER.refund(user_id, ACTION_PROGRAM)
+        await reply.fail(OVERLOADED_MSG)
+        return
+    except UpstreamUnavailable:
+        RATE_LIMITER.refund(user_id, ACTION_PROGRAM)
+        await reply.fail(UPSTREAM_DOWN_MSG)
+        return
     except Exception:
+        RATE_LIMITER.refund(user_id, ACTION_PROGRAM)
         logger.exception("Ошибка генерации программы (с пожеланиями)")
-        await update.message.reply_text("Не получилось сгенерировать программу. Попробуй ещё раз.")
+        await reply.fail("Не получилось сгенерировать программу. Попробуй ещё раз.")
         return
 
-    plan = _sanitize_for_tg(plan)
-    LAST_REPLIES[user_id] = plan
-    set_last_reply(user_id, plan)
-    await _safe_send(update.effective_chat, plan, use_markdown=True)
+    set_last_reply(user_id, plan, data=data)
+    await reply.finish(plan)
     await _send_main_menu(update)
@@ -0,0 +1,189 @@
+"""
+Webhook-режим бота: HTTP-сервер на tornado (идёт с python-telegram-bot[webhooks]) вместо polling.
+
+- проверка заголовка X-Telegram-Bot-Api-Secret-Token (WEBHOOK_SECRET);
+- WEBHOOK_WORKERS процессов слушают один порт (сокет открывается до fork), в каждом
+  до WEBHOOK_CONCURRENCY апдейтов обрабатываются параллельно; сообщения одного пользователя
+  обрабатываются по одному, ожидающие аренду из app.state_store получают её по update_id;
+- по SIGTERM/SIGINT сервер перестаёт принимать апдейты (503 — Telegram повторит их позже,
+  в том числе на другую реплику) и ждёт до WEBHOOK_DRAIN_TIMEOUT секунд, пока доработают
+  уже принятые апдейты и идущие генерации LLM;
+- очередь апдейтов при деплое не сбрасывается (drop_pending_updates=False);
+- GET /metrics — счётчики app.metrics этого воркера в формате Prometheus (воркеры делят порт,
+  так что каждый запрос попадает в один из них; значения помечены pid).
+"""
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Callable, List
+
+from telegram import Update
+from telegram.ext import Application
+
+try:
+    import tornado.httpserver
+    import tornado.netutil
+    import tornado.web
+except ImportError:
+    tornado = None  # type: ignore
+
+from app import state_store, storage
+from app.metrics import render_prometheus
+
+logger = logging.getLogger("bot.webhook")
+
+WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "").rstrip("/")        # публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN: str = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH: str = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS: int = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_CONCURRENCY: int = int(os.getenv("WEBHOOK_CONCURRENCY", "32"))
+WEBHOOK_DRAIN_TIMEOUT: float = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "120"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class _ServerState:
+    def __init__(self):
+        self.draining = False
+
+
+class _UpdateHandler(tornado.web.RequestHandler if tornado else object):
+    def initialize(self, app: Application, state: _ServerState) -> None:
+        self.app = app
+        self.state = state
+
+    async def post(self) -> None:
+        if self.state.draining:
+            self.set_status(503)
+            return
+        token = self.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning("Webhook request with wrong secret token from %s", self.request.remote_ip)
+            self.set_status(403)
+            return
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except (ValueError, TypeError, KeyError):
+            self.set_status(400)
+            return
+        # ответ Telegram — сразу после постановки в очередь, обработка идёт в Application
+        await self.app.update_queue.put(update)
+        self.set_status(200)
+
+
+class _HealthHandler(tornado.web.RequestHandler if tornado else object):
+    def initialize(self, state: _ServerState) -> None:
+        self.state = state
+
+    def get(self) -> None:
+        self.set_status(503 if self.state.draining else 200)
+        self.finish("draining" if self.state.draining else "ok")
+
+
+class _MetricsHandler(tornado.web.RequestHandler if tornado else object):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(render_prometheus())
+
+
+def check_webhook_config() -> None:
+    if tornado is None:
+        raise RuntimeError("Для webhook-режима нужен python-telegram-bot[webhooks] (tornado)")
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Для webhook-режима задай WEBHOOK_URL и WEBHOOK_SECRET")
+    if WEBHOOK_WORKERS > 1:
+        # у каждого процесса своя память: и состояние диалога, и кэш документов должны быть общими
+        if state_store.resolve_state_store_kind() == "memory":
+            raise RuntimeError("WEBHOOK_WORKERS > 1 требует общего STATE_STORE (postgres или sqlite)")
+        if storage.USER_CACHE_MODE != storage.MODE_OFF:
+            raise RuntimeError("WEBHOOK_WORKERS > 1 требует USER_CACHE_MODE=off")
+
+
+async def _register_webhook(app: Application) -> None:
+    await app.bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=False,
+        max_connections=min(100, max(1, WEBHOOK_WORKERS * WEBHOOK_CONCURRENCY)),
+    )
+    logger.info("Webhook set to %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+
+async def _serve(build_app: Callable[[], Application], sockets: List, register: bool) -> None:
+    app = build_app()
+    state = _ServerState()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:  # initialize()/shutdown()
+        if app.post_init:
+            await app.post_init(app)
+        if register:
+            await _register_webhook(app)
+        await app.start()
+        server = tornado.httpserver.HTTPServer(tornado.web.Application([
+            (WEBHOOK_PATH, _UpdateHandler, {"app": app, "state": state}),
+            (r"/healthz", _HealthHandler, {"state": state}),
+            (r"/metrics", _MetricsHandler),
+        ]))
+        server.add_sockets(sockets)
+        logger.info("Webhook worker %s listening on %s:%s%s", os.getpid(), WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+
+        await stop.wait()
+        logger.info("Worker %s draining (up to %.0fs)", os.getpid(), WEBHOOK_DRAIN_TIMEOUT)
+        state.draining = True
+        server.stop()
+        try:
+            # Application.stop() дообрабатывает очередь и ждёт запущенные хендлеры
+            await asyncio.wait_for(app.stop(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Drain timeout: some updates were not finished")
+        await server.close_all_connections()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    logger.info("Worker %s stopped", os.getpid())
+
+
+def _worker_main(build_app: Callable[[], Application], sockets: List, register: bool) -> None:
+    asyncio.run(_serve(build_app, sockets, register))
+
+
+def run_webhook(build_app: Callable[[], Application]) -> None:
+    """
+    Запускает webhook-сервер. build_app — фабрика Application (хендлеры, post_init/post_shutdown):
+    вызывается в каждом воркере, т.к. Application и пулы соединений нельзя делить между процессами.
+    """
+    check_webhook_config()
+    sockets = tornado.netutil.bind_sockets(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    if WEBHOOK_WORKERS <= 1:
+        _worker_main(build_app, sockets, True)
+        return
+
+    ctx = multiprocessing.get_context("fork")
+    procs = [
+        ctx.Process(target=_worker_main, args=(build_app, sockets, i == 0), name=f"webhook-worker-{i}")
+        for i in range(WEBHOOK_WORKERS)
+    ]
+    for p in procs:
+        p.start()
+
+    def _forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signum)
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for p in procs:
+        p.join()
+        if p.exitcode:
+            logger.error("%s exited with code %s", p.name, p.exitcode)
@@ -3,6 +3,7 @@ import logging
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -10,8 +11,16 @@ from telegram.ext import (
     filters,
 )
 
-from app.storage import load_user_data, save_user_data
-from bot.telegram_bot import user_states, GOAL_KEYBOARD, handle_message
+from app.coach_summary import close_coach_summary
+from app.llm import close_llm_client
+from app.metrics import close_metrics_log, init_metrics_log
+from app.pdf_export import close_pdf_exporter
+from app.onboarding import mark_welcomed, pending_welcome
+from app.rate_limit import init_rate_limiter, close_rate_limiter
+from app.session import UserSession
+from app.state_store import LockTimeout, init_state_store, close_state_store
+from app.storage import init_storage, close_storage, compact_history
+from bot.telegram_bot import BUSY_MSG, GOAL_KEYBOARD, handle_message, send_onboarding_welcome
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -22,32 +31,53 @@ logger = logging.getLogger("main")
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
+def _reset_profile(session: UserSession, name) -> None:
+    """Мягкий сброс состояния пользователя: анкета заново, имя сохраняем."""
+    d = session.data
+    d["physical_data"] = {"name": name}
+    d["physical_data_completed"] = False
+    compact_history(d, keep=0)
+    d["last_program"] = None
+    d["last_reply"] = None
+
+    # runtime-состояние: сразу следующий шаг (имя или цель)
+    if not name:
+        session.state = {"mode": "awaiting_name", "step": 0, "data": {}}
+    else:
+        session.state = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Сбрасываем анкету (кроме имени, если было) и сразу даём выбрать цель.
-    Если имени нет — спрашиваем имя.
+    Если имени нет — спрашиваем имя. Участнику из пакетного импорта (app.onboarding)
+    при первом /start показываем готовую программу.
     """
     if not update.message:
         return
 
     user_id = str(update.effective_user.id)
-    d = load_user_data(user_id)
-    name = (d.get("physical_data") or {}).get("name")
-
-    # мягкий сброс состояния пользователя
-    d["physical_data"] = {"name": name}
-    d["physical_data_completed"] = False
-    d["history"] = []
-    d["last_program"] = None
-    d["last_reply"] = None
-    save_user_data(user_id, d)
+    try:
+        async with UserSession(user_id, order=update.update_id) as session:
+            d = session.data
+            name = (d.get("physical_data") or {}).get("name")
+            imported = pending_welcome(d)
+            if imported:
+                # анкету (и обычно программу) заранее загрузил зал — app.onboarding; без сброса
+                mark_welcomed(d)
+                session.state = None
+                welcome_data = dict(d)
+            else:
+                _reset_profile(session, name)
+    except LockTimeout:
+        await update.message.reply_text(BUSY_MSG)
+        return
 
-    # чистим runtime-состояние
-    user_states.pop(user_id, None)
+    if imported:
+        await send_onboarding_welcome(update, welcome_data)
+        return
 
     if not name:
         # начинаем с имени
-        user_states[user_id] = {"mode": "awaiting_name", "step": 0, "data": {}}
         await update.message.reply_text(
             "Привет! Я твой персональный фитнес-тренер GymAiMentor 💪🏼\n"
             "Помогу составить для тебя программу тренировок и отвечу на любые вопросы.\n"
@@ -56,7 +86,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # имя уже есть — сразу просим цель (ВАЖНО: без лишнего отступа)
-    user_states[user_id] = {"mode": "awaiting_goal", "step": 0, "data": {"name": name}}
     await update.message.reply_text(
         f"{name}, выбери свою цель тренировок ⬇️",
         reply_markup=GOAL_KEYBOARD,
@@ -66,19 +95,62 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # прокидываем в общий handler — он покажет актуальные кнопки/состояния
     await handle_message(update, context)
 
+async def on_startup(app: Application):
+    # пул соединений и схема БД — один раз на процесс
+    await init_storage()
+    await init_state_store()
+    await init_rate_limiter()
+    await init_metrics_log()
+
+async def on_shutdown(app: Application):
+    await close_metrics_log()
+    await close_coach_summary()
+    await close_llm_client()
+    await close_pdf_exporter()
+    await close_rate_limiter()
+    await close_state_store()
+    await close_storage()
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.exception("Unhandled error", exc_info=context.error)
 
-def run_main():
-    if not TELEGRAM_TOKEN:
-        raise RuntimeError("Переменная окружения TELEGRAM_TOKEN не задана")
+# polling — локально (один процесс, очередь апдейтов сбрасывается при старте);
+# webhook — для продакшена, настройки в bot/webhook.py
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# другой адрес Bot API (локальный telegram-bot-api или заглушка из benchmarks/webhook_load.py)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+def build_app(concurrent_updates: int = 1) -> Application:
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    if concurrent_updates > 1:
+        # сообщения одного пользователя всё равно идут по очереди — см. аренду в UserSession
+        builder = builder.concurrent_updates(concurrent_updates)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("menu", menu))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_error_handler(on_error)
+    return app
+
+def run_main():
+    if not TELEGRAM_TOKEN:
+        raise RuntimeError("Переменная окружения TELEGRAM_TOKEN не задана")
+
+    if BOT_MODE == "webhook":
+        from bot.webhook import WEBHOOK_CONCURRENCY, run_webhook
+
+        print("Бот запущен (webhook).")
+        run_webhook(lambda: build_app(WEBHOOK_CONCURRENCY))
+        return
 
+    app = build_app()
     print("Бот запущен (polling).")
     app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
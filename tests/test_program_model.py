@@ -0,0 +1,74 @@
+"""app.program_model: текст → модель → текст без потерь, «сырой» текст ведёт себя как раньше."""
+import random
+
+import pytest
+
+from app.program_model import Exercise, _parse, iter_lines, parse, split_text
+from app.textproc import clean_answer, clean_program
+from benchmarks.program_model_bench import _legacy_split
+from benchmarks.textproc_bench import SAMPLES, _fuzz_text
+
+PROGRAM = """Вот твоя программа 💪
+
+*День 1 — Ноги*
+- Приседания со штангой 4×8–10, отдых 2 мин
+- Румынская тяга 3×12
+Растяжка в конце
+
+*День 2*
+1) Жим лёжа 5×5 (тяжело)
+- Подтягивания до отказа"""
+
+
+def _texts():
+    rnd = random.Random(23)
+    out = [PROGRAM]
+    for raw in SAMPLES + [_fuzz_text(rnd) for _ in range(300)]:
+        out += [clean_program(raw), clean_answer(raw)]
+    return out
+
+
+def test_structured_round_trip():
+    program = _parse(PROGRAM)
+    assert program.structured
+    assert str(program) == PROGRAM
+    assert [day.title for day in program.days] == ["День 1 — Ноги", "День 2"]
+    assert program.days[0].exercises[0] == Exercise("- ", "Приседания со штангой", 4, "8–10", ", отдых 2 мин")
+    assert program.days[1].exercises == [Exercise("1) ", "Жим лёжа", 5, "5", " (тяжело)")]
+    # строки, которые не упражнение, остаются текстом
+    assert "Растяжка в конце" in program.days[0].lines
+    assert "- Подтягивания до отказа" in program.days[1].lines
+    assert [kind for kind, _ in iter_lines(program)].count("day") == 2
+
+
+@pytest.mark.parametrize("text", [
+    "Просто ответ на вопрос без дней.",
+    "День 1 — Ноги\n- Присед 4x8",  # заголовок не отформатирован clean_program
+    "",
+])
+def test_raw_fallback(text):
+    program = _parse(text)
+    assert not program.structured
+    assert str(program) == text
+    assert program.chunks(10) == split_text(text, 10)
+    assert list(iter_lines(program)) == [("line", line) for line in text.split("\n")]
+
+
+def test_round_trip_on_formatted_texts():
+    for text in _texts():
+        assert str(_parse(text)) == text
+
+
+@pytest.mark.parametrize("max_len", [120, 500, 3500])
+def test_chunks_keep_text(max_len):
+    for text in _texts():
+        program = _parse(text)
+        parts = program.chunks(max_len)
+        assert all(len(part) <= max_len for part in parts)
+        assert "".join("".join(parts).split()) == "".join(text.split())
+        if not program.structured:
+            assert parts == _legacy_split(text, max_len)
+
+
+def test_parse_is_cached():
+    assert parse(PROGRAM) is parse(PROGRAM)
@@ -0,0 +1,41 @@
+"""app.textproc даёт тот же результат, что прежняя реализация (копия — в benchmarks.textproc_bench)."""
+import random
+
+import pytest
+
+from app.textproc import StreamSanitizer, clean_answer, clean_program, sanitize
+from benchmarks.textproc_bench import SAMPLES, _fuzz_text, _legacy_sanitize, legacy_answer, legacy_program
+
+
+def _texts():
+    rnd = random.Random(18)
+    return SAMPLES + [_fuzz_text(rnd) for _ in range(500)]
+
+
+@pytest.mark.parametrize("new, old", [
+    (clean_program, legacy_program),
+    (clean_answer, legacy_answer),
+    (sanitize, _legacy_sanitize),
+], ids=["program", "answer", "sanitize"])
+def test_matches_legacy(new, old):
+    for text in _texts():
+        assert new(text) == old(text), text
+
+
+def test_stream_matches_legacy():
+    rnd = random.Random(9)
+    for text in _texts()[:100]:
+        stream = StreamSanitizer()
+        for end in list(range(1, len(text), rnd.randint(1, 40))) + [len(text)]:
+            prefix = text[:end]
+            assert stream.feed(prefix) == _legacy_sanitize(prefix), prefix
+
+
+def test_stream_restarts_on_new_text():
+    # превью JSON-дней, затем текстовый ответ после отклонённого JSON: первые куски
+    # нового текста пропущены троттлингом, но он длиннее уже обработанного
+    first = SAMPLES[0] + "\n\nДень 1\n\nПрисед 3x8\n\n"
+    second = "Программа\n\n" + "Жим лёжа 4x6 и тяга в наклоне 4x8. " * 20
+    stream = StreamSanitizer()
+    stream.feed(first)
+    assert stream.feed(second) == _legacy_sanitize(second)